@@ -1,10 +1,11 @@
 import os
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from typing import List
 from fastapi import APIRouter, HTTPException
 from tortoise.exceptions import DoesNotExist
 from celery.result import AsyncResult
 from app.core.encryption import decrypt_data
+from app.core.locks import project_locks, QUEUE
 from app.schemas.connection import (
     CheckProjectNameRequest, CheckProjectNameResponse, TableColumnsResponse,
     DeleteAwsProjectConfirmation, DeleteAwsS3Bucket, DeleteAwsExport
@@ -19,6 +20,8 @@ from app.models.alert import Alert, Alert_Pydantic
 from app.models.database import Database_Pydantic, Database, DataResponse
 from app.models.alert_integration import Integration, Integration_Pydantic, IntegrationIn_Pydantic
 from app.models.dashboard_request import DashboardRequest, DashboardRequest_Pydantic, DashboardRequestIn_Pydantic
+from app.models.ingestion_run import IngestionRun
+from app.ingestion.run_ledger import STAGES
 from app.worker.celery_worker import (task_sample, task_delete_aws_project, task_delete_aws_s3_bucket,
                                       task_delete_aws_export, task_drop_schema, task_delete_gcp_project,
                                       task_delete_azure_project, task_run_daily_ingestion,
@@ -436,9 +439,106 @@ async def rerun_ingestion(project_id: int):
             if obj.export is False and obj.status is False:
                 return {"status": True, "message": "Export is not enabled"}
 
-        task = task_run_daily_ingestion.delay({"project_id": project_obj.id})
+        # A rerun waits for an ingestion already in progress instead of being dropped
+        task = task_run_daily_ingestion.delay({"project_id": project_obj.id, "lock_policy": QUEUE})
         print({"task_id": task.id})
         return {"status": True, "message": "Data Ingestion successfully scheduled"}
     except Exception as e:
         print(f"Error: {e}")
         raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get('/{project_id}/locks', tags=["project"])
+async def get_project_locks(project_id: int):
+    """Ingestion and other stage locks currently held for the project."""
+    try:
+        project_obj = await Project.get(id=project_id)
+        locks = project_locks(project_obj.name)
+        return {"project_id": project_id, "running": bool(locks), "locks": locks}
+    except DoesNotExist:
+        raise HTTPException(status_code=404, detail="Project not found")
+    except Exception as e:
+        print(f"Error: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize_ingestion_runs(runs):
+    """Counts, duration percentiles, mean stage durations and volumes of a list of runs."""
+    finished = [run for run in runs if run.status != "running"]
+    succeeded = [run for run in finished if run.status == "succeeded"]
+    durations = [run.duration_s for run in succeeded if run.duration_s is not None]
+    stage_means = {}
+    for stage in STAGES:
+        values = [run.stage_durations.get(stage) for run in succeeded if run.stage_durations.get(stage) is not None]
+        if values:
+            stage_means[stage] = round(sum(values) / len(values), 3)
+    peaks = [run.peak_memory_bytes for run in runs if run.peak_memory_bytes]
+    return {
+        "runs": len(runs),
+        "succeeded": len(succeeded),
+        "failed": sum(1 for run in finished if run.status == "failed"),
+        "skipped": sum(1 for run in finished if run.status == "skipped"),
+        "running": len(runs) - len(finished),
+        "success_rate": round(len(succeeded) / len(finished), 3) if finished else None,
+        "duration_s": {
+            "mean": round(sum(durations) / len(durations), 3) if durations else None,
+            "p50": _percentile(durations, 0.5),
+            "p95": _percentile(durations, 0.95),
+            "max": max(durations) if durations else None,
+        },
+        "mean_stage_durations_s": stage_means,
+        "rows_loaded": sum(run.rows_loaded or 0 for run in succeeded),
+        "bytes_read": sum(run.bytes_read or 0 for run in runs),
+        "max_peak_memory_bytes": max(peaks) if peaks else None,
+        "last_success_at": max((run.finished_at for run in succeeded if run.finished_at), default=None),
+    }
+
+
+@router.get('/{project_id}/ingestion-runs', tags=["project"])
+async def get_project_ingestion_runs(project_id: int, days: int = 30, limit: int = 100, status: str = None):
+    """
+    Ingestion runs of the project started in the last `days` days, newest first, with
+    summary metrics over all of them. `limit` caps the runs listed, not the summary.
+    """
+    try:
+        await Project.get(id=project_id)
+        query = IngestionRun.filter(project_id=project_id,
+                                    started_at__gte=datetime.now(timezone.utc) - timedelta(days=days))
+        if status:
+            query = query.filter(status=status)
+        runs = await query.order_by('-started_at').all()
+        return {
+            "project_id": project_id,
+            "days": days,
+            "summary": summarize_ingestion_runs(runs),
+            "runs": [
+                {
+                    "run_id": run.run_id,
+                    "provider": run.provider,
+                    "trigger": run.trigger,
+                    "status": run.status,
+                    "started_at": run.started_at,
+                    "finished_at": run.finished_at,
+                    "duration_s": run.duration_s,
+                    "stage_durations": run.stage_durations,
+                    "rows_read": run.rows_read,
+                    "rows_loaded": run.rows_loaded,
+                    "bytes_read": run.bytes_read,
+                    "peak_memory_bytes": run.peak_memory_bytes,
+                    "error": run.error,
+                }
+                for run in runs[:limit]
+            ],
+        }
+    except DoesNotExist:
+        raise HTTPException(status_code=404, detail="Project not found")
+    except Exception as e:
+        print(f"Error: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
@@ -1,6 +1,5 @@
-from azure.identity import ClientSecretCredential
-from azure.mgmt.resource import SubscriptionClient
-from azure.core.exceptions import HttpResponseError, ClientAuthenticationError
+import requests
+from app.ingestion.azure.arm_client import ArmClient, get_token
 
 
 def azure_validate_creds(azure_client_id: str, azure_client_secret: str, azure_tenant_id: str) -> bool:
@@ -8,19 +7,12 @@ def azure_validate_creds(azure_client_id: str, azure_client_secret: str, azure_t
     Function to test Azure connection.
     """
     try:
-        # Create a credential object using the provided client ID, client secret, and tenant ID
-        credential = ClientSecretCredential(
-            client_id=azure_client_id,
-            client_secret=azure_client_secret,
-            tenant_id=azure_tenant_id
-        )
-
-        # Attempt to get a token to verify credentials
-        token = credential.get_token("https://management.azure.com/.default")
+        # Attempt to get a token to verify credentials; it is cached for the ARM calls that follow
+        get_token(azure_tenant_id, azure_client_id, azure_client_secret)
 
         return True
 
-    except ClientAuthenticationError as e:
+    except requests.HTTPError as e:
         print(f"Azure authentication error: {e}")
         return False
     except Exception as e:
@@ -31,26 +23,19 @@ def azure_validate_creds(azure_client_id: str, azure_client_secret: str, azure_t
 def get_azure_subscriptions(client_id: str, client_secret: str,tenant_id: str):
     try:
         # Authenticate using service principal
-        credentials = ClientSecretCredential(
-            client_id=client_id,
-            client_secret=client_secret,
-            tenant_id=tenant_id
-        )
-        # Initialize the SubscriptionClient
-        subscription_client = SubscriptionClient(credentials)
-        # Fetch the list of subscriptions
-        subscriptions = subscription_client.subscriptions.list()
-        subscriptions_list = list(subscriptions)
+        client = ArmClient(tenant_id, client_id, client_secret)
+        # Fetch the list of subscriptions, following nextLink
+        subscriptions_list = client.list_all("/subscriptions", params={"api-version": "2022-12-01"})
         if not subscriptions_list:
             return []
         else:
             # Prepare the list of subscriptions
             subscriptions_info = [
-                {"subscription_id": sub.subscription_id, "display_name": sub.display_name}
+                {"subscription_id": sub["subscriptionId"], "display_name": sub.get("displayName")}
                 for sub in subscriptions_list
             ]
             return subscriptions_info
-    except HttpResponseError as e:
+    except requests.HTTPError as e:
         raise Exception(f"HTTP response error: {e}")
     except Exception as e:
         raise Exception(f"An error occurred: {e}")
@@ -0,0 +1,236 @@
+# app/core/locks.py
+
+import functools
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+import redis
+from celery import current_task
+
+# Redis holding the locks; the Celery broker unless set
+LOCK_REDIS_URL = os.getenv("LOCK_REDIS_URL", os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0"))
+# Seconds a lease lasts without renewal; it is renewed every third of it while the run is alive
+LOCK_TTL = int(os.getenv("LOCK_TTL", "900"))
+# Seconds a queued run keeps being re-enqueued for the lock before giving up
+LOCK_QUEUE_TIMEOUT = int(os.getenv("LOCK_QUEUE_TIMEOUT", "7200"))
+# Seconds before a queued run is tried again; it does not hold a worker while it waits
+LOCK_REQUEUE_DELAY = int(os.getenv("LOCK_REQUEUE_DELAY", "60"))
+
+LOCK_PREFIX = "cloudmeter:lock"
+# What a run does when its lock is held: SKIP returns at once, QUEUE is enqueued again later
+SKIP = "skip"
+QUEUE = "queue"
+
+# Extend or delete a lease only while it still holds our token
+_RENEW = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('set', KEYS[2], ARGV[3], 'px', ARGV[2])
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1], KEYS[2])
+end
+return 0
+"""
+
+_client = None
+# Leases held by this process, checked by `check_held`
+_held = set()
+
+
+def get_redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(LOCK_REDIS_URL, decode_responses=True)
+    return _client
+
+
+def lock_key(project, stage):
+    return f"{LOCK_PREFIX}:{project}:{stage}"
+
+
+class LockBusy(Exception):
+    """Raised when a lock is held by another run and the policy does not wait for it."""
+
+    def __init__(self, project, stage, holder):
+        self.project = project
+        self.stage = stage
+        self.holder = holder
+        super().__init__(f"{stage} of {project} is already running ({(holder or {}).get('owner')})")
+
+
+class LeaseLost(Exception):
+    """Raised when a run finds that a lease it holds expired or was taken over."""
+
+    def __init__(self, project, stage):
+        self.project = project
+        self.stage = stage
+        super().__init__(f"{stage} lock of {project} was lost; another run may hold it")
+
+
+class LeaseLock:
+    """
+    Redis lease lock of one project and stage, e.g. ('acme', 'ingestion').
+
+    The lease expires LOCK_TTL seconds after it was last renewed, so a worker that dies
+    frees its project without manual cleanup. While held, a daemon thread renews it every
+    third of the TTL. Only the holder's token can renew or release it. Alongside the lease
+    an info key records who holds it and since when, for `lock_status`. A lease that
+    could not be renewed is marked lost, and `check_held` aborts the run holding it.
+
+    Usage:
+        with LeaseLock(project_name, "ingestion"):
+            run_ingestion()
+    """
+
+    def __init__(self, project, stage, ttl=LOCK_TTL, owner=None):
+        self.project = project
+        self.stage = stage
+        self.key = lock_key(project, stage)
+        self.info_key = f"{self.key}:info"
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.info = None
+        self.lost = False
+        self._stop = threading.Event()
+        self._renewer = None
+
+    def _info(self):
+        return json.dumps({"owner": self.owner, "acquired_at": time.time()})
+
+    def try_acquire(self):
+        client = get_redis()
+        if not client.set(self.key, self.token, nx=True, px=self.ttl * 1000):
+            return False
+        self.info = self._info()
+        client.set(self.info_key, self.info, px=self.ttl * 1000)
+        return True
+
+    def acquire(self):
+        """Take the lease. Raises LockBusy when another run holds it."""
+        if not self.try_acquire():
+            raise LockBusy(self.project, self.stage, lock_status(self.project, self.stage))
+        self.lost = False
+        _held.add(self)
+        self._stop.clear()
+        self._renewer = threading.Thread(target=self._renew_loop, daemon=True)
+        self._renewer.start()
+        print(f"🔒 Acquired {self.stage} lock of {self.project}")
+        return self
+
+    def _renew_loop(self):
+        renew = get_redis().register_script(_RENEW)
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                if not renew(keys=[self.key, self.info_key], args=[self.token, self.ttl * 1000, self.info]):
+                    self.lost = True
+                    print(f"⚠️ {self.stage} lock of {self.project} was lost before the run finished")
+                    return
+            except redis.RedisError as ex:
+                # The lease survives a blip shorter than its remaining TTL
+                print(f"⚠️ Could not renew {self.stage} lock of {self.project}: {ex}")
+
+    def check(self):
+        """Raise LeaseLost if the lease could not be kept while the run held it."""
+        if self.lost:
+            raise LeaseLost(self.project, self.stage)
+
+    def release(self):
+        """Give the lease up. A Redis error is logged; the lease then expires on its own."""
+        self._stop.set()
+        if self._renewer:
+            self._renewer.join()
+        _held.discard(self)
+        try:
+            get_redis().register_script(_RELEASE)(keys=[self.key, self.info_key], args=[self.token])
+        except redis.RedisError as ex:
+            print(f"⚠️ Could not release {self.stage} lock of {self.project}, it expires in {self.ttl}s: {ex}")
+            return
+        print(f"🔓 Released {self.stage} lock of {self.project}")
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+def check_held():
+    """Raise LeaseLost if any lease held by this process was lost; called between stages."""
+    for lock in list(_held):
+        lock.check()
+
+
+def queue_deadline_passed(queued_since):
+    """True once a run first queued at `queued_since` (epoch seconds) has waited too long."""
+    return queued_since is not None and time.time() - queued_since >= LOCK_QUEUE_TIMEOUT
+
+
+def lock_status(project, stage):
+    """Return {'locked', 'owner', 'acquired_at', 'expires_in'} of one lock."""
+    client = get_redis()
+    key = lock_key(project, stage)
+    expires_in = client.pttl(key)
+    if expires_in < 0:
+        return {"project": project, "stage": stage, "locked": False}
+    info = json.loads(client.get(f"{key}:info") or "{}")
+    return {
+        "project": project,
+        "stage": stage,
+        "locked": True,
+        "owner": info.get("owner"),
+        "acquired_at": info.get("acquired_at"),
+        "expires_in": expires_in / 1000,
+    }
+
+
+def project_locks(project):
+    """Status of every lock currently held for `project`."""
+    prefix = f"{LOCK_PREFIX}:{project}:"
+    stages = [key[len(prefix):] for key in get_redis().scan_iter(match=f"{prefix}*")
+              if not key.endswith(":info")]
+    return [lock_status(project, stage) for stage in sorted(stages)]
+
+
+def exclusive(stage, project_of=lambda payload: payload["project_name"], default_policy=QUEUE, on_busy=None):
+    """
+    Run a task taking a payload dict under the lock of its project and `stage`.
+
+    The payload's `lock_policy` (SKIP or QUEUE) overrides `default_policy`. A run that
+    does not get the lock returns False after calling `on_busy` with the LockBusy error.
+    With QUEUE the task is first enqueued again with the same payload,
+    LOCK_REQUEUE_DELAY seconds later, until LOCK_QUEUE_TIMEOUT has passed.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(payload, *args, **kwargs):
+            policy = payload.get("lock_policy", default_policy)
+            try:
+                lock = LeaseLock(project_of(payload), stage).acquire()
+            except LockBusy as ex:
+                queued_at = payload.get("lock_queued_at")
+                if policy == QUEUE and current_task and not queue_deadline_passed(queued_at):
+                    payload = dict(payload, lock_queued_at=queued_at or time.time())
+                    current_task.apply_async(args=(payload,) + args, kwargs=kwargs, countdown=LOCK_REQUEUE_DELAY)
+                    print(f"⏳ Queued {func.__name__} again in {LOCK_REQUEUE_DELAY}s: {ex}")
+                else:
+                    print(f"⏭️ Skipping {func.__name__}: {ex}")
+                if on_busy is not None:
+                    on_busy(ex)
+                return False
+            try:
+                result = func(payload, *args, **kwargs)
+                lock.check()
+                return result
+            finally:
+                lock.release()
+        return wrapper
+    return decorator
@@ -41,6 +41,7 @@ async def init_tortoise_connection():
             "app.models.tags",
             "app.models.resources",
             "app.models.resources_tags",
+            "app.models.ingestion_run",
 ]},)
 
 
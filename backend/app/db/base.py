@@ -23,6 +23,7 @@ TORTOISE_ORM = {
                 "app.models.tags",
                 "app.models.resources",
                 "app.models.resources_tags",
+                "app.models.ingestion_run",
                 "aerich.models"
             ],
             "default_connection": "default",
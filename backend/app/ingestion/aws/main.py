@@ -1,16 +1,29 @@
 
 import hashlib
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 from .export_ops import create_export, update_export, create_boto3_client
 from .s3 import *
-from .postgres_operations import execute_sql_files, dump_to_postgresql, fetch_existing_hash_keys,connection
+from .postgres_operations import execute_sql_files, dump_to_postgresql, connection
+from .postgres_operations import replace_billing_period, ingestion_slot, create_partitioned_bronze_table
+from .postgres_operations import fetch_loaded_periods
+from app.ingestion.focus_schema import coerce_dataframe
+from app.ingestion.partitions import split_by_period, period_fingerprint
+from app.ingestion.sql_runner import SqlPipeline
+from app.ingestion import run_ledger
 import pandas as pd
 from app.ingestion.aws.export_ops import create_export, update_export, create_boto3_client
 from app.ingestion.aws.s3 import *
 from app.ingestion.aws.postgres_operations import execute_sql_files, dump_to_postgresql
 from .resource_metrics import fetch_and_store_cloudwatch_metrics
-from app.ingestion.aws.metrics_s3 import metrics_dump
+from app.ingestion.aws.metrics_s3 import metrics_dump, compact_s3_metrics
 
+# Billing periods processed in parallel within one ingestion run
+AWS_PERIOD_WORKERS = int(os.getenv("AWS_PERIOD_WORKERS", "4"))
+# Billing periods processed at once across all tenants and worker processes
+AWS_MAX_CONCURRENT_PERIODS = int(os.getenv("AWS_MAX_CONCURRENT_PERIODS", "8"))
 
 
 def generate_hash_key(df):
@@ -36,42 +49,85 @@ def generate_hash_key(df):
     return df
 
 
-def filter_new_data(df, schema_name, table_name):
+def remove_duplicates(df):
     """
-    Filter out rows that already exist in the database based on the hash_key.
+    Remove duplicate rows from the DataFrame based on all column values.
 
     Args:
-        df (pd.DataFrame): The DataFrame containing the new data.
-        schema_name (str): The schema name in the PostgreSQL database.
-        table_name (str): The table name in the PostgreSQL database.
+        df (pd.DataFrame): The input DataFrame.
 
     Returns:
-        pd.DataFrame: A DataFrame containing only the new rows.
+        pd.DataFrame: A DataFrame with duplicate rows removed.
     """
-    # Fetch existing hash keys from the database
-    existing_hash_keys = fetch_existing_hash_keys(schema_name, table_name)
-
-    new_data = df[~df['hash_key'].isin(existing_hash_keys)]
-    existing_hash_keys.update(new_data['hash_key'])  # update cache to avoid duplicates
-
-    # # Filter the DataFrame to exclude rows with existing hash keys
-    # new_data = df[~df['hash_key'].isin(existing_hash_keys)]
-    print(f"New data rows: {len(new_data)}")
-    return new_data
+    # Remove duplicate rows based on all column values
+    return df.drop_duplicates()
 
 
-def remove_duplicates(df):
+def process_billing_period(s3_client, s3_bucket, period_folder, schema_name, table_name, loaded_periods,
+                           load_batch_id):
     """
-    Remove duplicate rows from the DataFrame based on all column values.
+    Download, parse, hash and load the latest export file of one billing period.
 
-    Args:
-        df (pd.DataFrame): The input DataFrame.
+    Runs inside a worker thread while holding one of the cluster-wide ingestion
+    slots. Each billing month in the file replaces its bronze partition as a whole,
+    tagged with the run's load_batch_id so the silver refresh can pick up just these
+    rows. Months whose fingerprint matches the loaded partition are skipped.
 
     Returns:
-        pd.DataFrame: A DataFrame with duplicate rows removed.
+        tuple: (file_type, rows_loaded). file_type is None when nothing was processed.
     """
-    # Remove duplicate rows based on all column values
-    return df.drop_duplicates()
+    with ingestion_slot(AWS_MAX_CONCURRENT_PERIODS):
+        latest_file = get_latest_file(s3_client, s3_bucket, period_folder)
+        if not latest_file:
+            return None, 0
+
+        print(f"Downloading and processing file: {latest_file}")
+        with run_ledger.stage("download"):
+            if latest_file.endswith('.csv.gz'):
+                df = download_and_extract_csv(s3_client, s3_bucket, latest_file)
+                file_type = 'csv'
+            elif latest_file.endswith('.parquet'):
+                df = download_and_read_parquet(s3_client, s3_bucket, latest_file)
+                file_type = 'parquet'
+            else:
+                print(f"Unsupported file format: {latest_file}")
+                return None, 0
+        run_ledger.add("rows_read", len(df))
+
+        with run_ledger.stage("parse"):
+            # Convert unhashable columns (like lists) to strings
+            df = df.applymap(lambda x: str(x) if isinstance(x, list) else x)
+
+            # Remove duplicates within the file
+            df = df.drop_duplicates(subset=df.columns.difference(['hash_key']))
+
+        # Generate hash key
+        with run_ledger.stage("hash"):
+            df = generate_hash_key(df)
+            df = df.drop_duplicates(subset=['hash_key'])
+
+        rows_loaded = 0
+        for period_start, period_data in split_by_period(df, 'BillingPeriodStart').items():
+            fingerprint = period_fingerprint(period_data['hash_key'])
+            if loaded_periods.get(period_start) == fingerprint:
+                print(f"Billing period {period_start:%Y-%m} is unchanged in '{latest_file}', skipping.")
+                continue
+
+            # Cast to the registered bronze types only after hashing, so keys of
+            # rows loaded by earlier runs stay the same
+            with run_ledger.stage("parse"):
+                period_data = coerce_dataframe(period_data, 'aws_focus')
+                period_data['load_batch_id'] = load_batch_id
+
+            with run_ledger.stage("load"):
+                replace_billing_period(period_data, schema_name, table_name, 'BillingPeriodStart', period_start,
+                                       fingerprint, load_batch_id)
+            rows_loaded += len(period_data)
+            run_ledger.add("rows_loaded", len(period_data))
+
+        if not rows_loaded:
+            print(f"No new data to append for file: {latest_file}")
+        return file_type, rows_loaded
 
 
 def aws_create_focus_export(
@@ -126,105 +182,27 @@ def aws_run_ingestion(project_name,
             parent_folder = f'{s3_prefix}/{export_name}/data/'
 
             sql_file_paths = {
-                'create_table': f'{base_path}/sql/create_table.sql',
                 'new_schema': f'{base_path}/sql/new_schema.sql',
                 'gz_gold_views': f'{base_path}/sql/gz_gold_views.sql',
                 'parquet_silver': f'{base_path}/sql/parquet_silver.sql',
-                'parquet_gold_views': f'{base_path}/sql/parquet_gold_views.sql'
+                'silver_tags': f'{base_path}/sql/silver_tags.sql',
+                'parquet_gold_views': f'{base_path}/sql/parquet_gold_views.sql',
+                'parquet_gold_projections': f'{base_path}/sql/parquet_gold_projections.sql'
             }
 
             # Execute SQL file to create a new schema
             execute_sql_files(sql_file_paths['new_schema'], schema_name, monthly_budget)
             print(f'Schema {schema_name} created....')
-            execute_sql_files(sql_file_paths['create_table'], schema_name, monthly_budget)
-            print(f'Table {table_name} created....')
+            create_partitioned_bronze_table('aws_focus', schema_name, table_name, 'BillingPeriodStart')
+            # Identifies the bronze rows loaded by this run
+            load_batch_id = uuid.uuid4().hex
             # Create S3 client
             s3_client = get_s3_client(aws_access_key, aws_secret_key, aws_region)
 
             # List period folders in the S3 bucket
             period_folders = list_period_folders(s3_client, s3_bucket, parent_folder)
-            all_dfs = []
-            file_type = None  # Track the type of file being processed
-        
-            # # Process each period folder
-            # for period_folder in period_folders.keys():
-            #     latest_file = get_latest_file(s3_client, s3_bucket, period_folder)
-            #     if latest_file:
-            #         print(f"Downloading and processing file: {latest_file}")
-            #         if latest_file.endswith('.csv.gz'):
-            #             df = download_and_extract_csv(s3_client, s3_bucket, latest_file)
-            #             file_type = 'csv'
-            #         elif latest_file.endswith('.parquet'):
-            #             df = download_and_read_parquet(s3_client, s3_bucket, latest_file)
-            #             file_type = 'parquet'
-            #         else:
-            #             print(f"Unsupported file format: {latest_file}")
-            #             continue
-            #         all_dfs.append(df)
-
-    #         if all_dfs:
-
-    #             # Combine all DataFrames into a single DataFrame
-    #             combined_df = pd.concat(all_dfs, ignore_index=True)
-
-    #             print("Inspecting DataFrame before removing duplicates...")
-    #             print(combined_df.dtypes)
-    #             print(combined_df.head())
-
-    #             # Convert unhashable columns to hashable types
-    #             for col in combined_df.columns:
-    #                 if combined_df[col].apply(lambda x: isinstance(x, list)).any():
-    #                     print(f"Column '{col}' contains lists. Converting to strings.")
-    #                     combined_df[col] = combined_df[col].apply(lambda x: str(x) if isinstance(x, list) else x)
-
-    #             # Remove duplicates
-    #             combined_df = combined_df.drop_duplicates()
-    #             print("Duplicates removed successfully.")
-    #             # Generate hash key for the combined DataFrame
-    #             combined_df = generate_hash_key(combined_df)
-
-    #             # Fetch existing hash keys
-    #             existing_hash_keys = fetch_existing_hash_keys(schema_name, table_name)
-
-    #             # Filter out rows that already exist in the database
-    #             new_data = combined_df[~combined_df['hash_key'].isin(existing_hash_keys)]
-
-    #             if not new_data.empty:
-    #                 # Append only new data to PostgreSQL
-    #                 dump_to_postgresql( new_data, schema_name, table_name)
-    #                 print(f"Appended {len(new_data)} new rows to the table '{table_name}'.")
-
-    #                 # Run the appropriate SQL scripts based on file type
-    #                 if file_type == 'csv':
-    #                     execute_sql_files(sql_file_paths['gz_gold_views'], schema_name, monthly_budget)
-    #                 elif file_type == 'parquet':
-    #                     execute_sql_files( sql_file_paths['parquet_silver'], schema_name, monthly_budget)
-    #                     print(f"Parquet silver file executed....")
-    #                     execute_sql_files( sql_file_paths['parquet_gold_views'], schema_name, monthly_budget)
-    #                     print(f"Parquet gold viws created....")
-    #             else:
-    #                 print("No new data to append.")
-    #         else:
-    #             print("No CSV or Parquet files found to process.")
-    #         # Call CloudWatch ingestion after S3 + PostgreSQL logic
-    #     fetch_and_store_cloudwatch_metrics(
-    #         aws_access_key=aws_access_key,
-    #         aws_secret_key=aws_secret_key,
-    #         region=aws_region,
-    #         db_host=DB_HOST_NAME,
-    #         db_port=DB_PORT,
-    #         db_user=DB_USER_NAME,
-    #         db_password=DB_PASSWORD,
-    #         db_name=DB_NAME,
-    #         db_schema=schema_name,  # or any schema you want to use
-    #         db_table='metrics_details'
-    #     )
-
-    # except Exception as ex:
-    #     print(f"An error occurred: {ex}")
-
-
-                    # Call CloudWatch ingestion after processing all files
+
+        # Call CloudWatch ingestion after processing all files
         fetch_and_store_cloudwatch_metrics(
                 aws_access_key=aws_access_key,
                 aws_secret_key=aws_secret_key,
@@ -237,65 +215,59 @@ def aws_run_ingestion(project_name,
                 db_schema=schema_name,
                 db_table='metrics_details'
             )
-        for period_folder in period_folders.keys():
-            latest_file = get_latest_file(s3_client, s3_bucket, period_folder)
-            if latest_file:
-                print(f"Downloading and processing file: {latest_file}")
-                if latest_file.endswith('.csv.gz'):
-                    df = download_and_extract_csv(s3_client, s3_bucket, latest_file)
-                    file_type = 'csv'
-                elif latest_file.endswith('.parquet'):
-                    df = download_and_read_parquet(s3_client, s3_bucket, latest_file)
-                    file_type = 'parquet'
-                else:
-                    print(f"Unsupported file format: {latest_file}")
+        # Billing periods are independent, so they are downloaded, hashed and
+        # loaded concurrently. Loaded month fingerprints are fetched once and shared.
+        loaded_periods = fetch_loaded_periods(schema_name, table_name)
+        loaded_file_types = set()
+        failed_periods = []
+        with ThreadPoolExecutor(max_workers=AWS_PERIOD_WORKERS) as executor:
+            futures = {
+                executor.submit(process_billing_period, s3_client, s3_bucket, period_folder,
+                                schema_name, table_name, loaded_periods, load_batch_id): period_folder
+                for period_folder in period_folders.keys()
+            }
+            for future in as_completed(futures):
+                period_folder = futures[future]
+                try:
+                    file_type, rows_loaded = future.result()
+                except Exception as ex:
+                    print(f"Billing period {period_folder} failed and was rolled back: {ex}")
+                    failed_periods.append(period_folder)
                     continue
-
-                # Convert unhashable columns (like lists) to strings
-                # for col in df.columns:
-                #     if df[col].apply(lambda x: isinstance(x, list)).any():
-                #         print(f"Column '{col}' contains lists. Converting to strings.")
-                #         df[col] = df[col].apply(lambda x: str(x) if isinstance(x, list) else x)
-                df = df.applymap(lambda x: str(x) if isinstance(x, list) else x)
-
-
-                # Remove duplicates within the file
-                # df = df.drop_duplicates()
-                df = df.drop_duplicates(subset=df.columns.difference(['hash_key']))
-
-
-                # Generate hash key
-                df = generate_hash_key(df)
-
-                # Filter new data only
-                new_data = filter_new_data(df, schema_name, table_name)
-
-                if not new_data.empty:
-                    # Dump to PostgreSQL
-                    # dump_to_postgresql(new_data, schema_name, table_name)
-                    chunk_size = 100000
-                    for start in range(0, len(new_data), chunk_size):
-                        chunk = new_data.iloc[start:start + chunk_size]
-                        dump_to_postgresql(chunk, schema_name, table_name)
-
-
-                    print(f"Appended {len(new_data)} new rows from file '{latest_file}' to the table '{table_name}'.")
-
-                    # Execute relevant SQLs based on file type
-                    if file_type == 'csv':
-                        execute_sql_files(sql_file_paths['gz_gold_views'], schema_name, monthly_budget)
-                    elif file_type == 'parquet':
-                        execute_sql_files(sql_file_paths['parquet_silver'], schema_name, monthly_budget)
-                        print(f"Parquet silver file executed....")
-                        execute_sql_files(sql_file_paths['parquet_gold_views'], schema_name, monthly_budget)
-                        print(f"Parquet gold views created....")
-                else:
-                    print(f"No new data to append for file: {latest_file}")
-        execute_sql_files(f'{base_path}/sql/bronze_s3_metrics.sql', schema_name, monthly_budget)
+                if rows_loaded:
+                    loaded_file_types.add(file_type)
+
+        # Silver is refreshed from this run's batch and gold rebuilt once after
+        # every period has landed, instead of once per file.
+        if 'csv' in loaded_file_types:
+            execute_sql_files(sql_file_paths['gz_gold_views'], schema_name, monthly_budget)
+        # Silver, tags and gold run as stages of one pipeline. A run that failed part
+        # way is finished first, even when this run loaded nothing new.
+        focus_pipeline = SqlPipeline('aws_focus_parquet', schema_name,
+                                     {'budget': monthly_budget, 'batch_id': load_batch_id})
+        focus_pipeline.add_stage('silver', sql_file_paths['parquet_silver'])
+        focus_pipeline.add_stage('silver_tags', sql_file_paths['silver_tags'], depends_on=['silver'])
+        focus_pipeline.add_stage('gold', sql_file_paths['parquet_gold_views'], depends_on=['silver_tags'])
+        focus_pipeline.add_migration('gold_views', sql_file_paths['parquet_gold_projections'], depends_on=['gold'])
+        focus_pipeline.run_or_raise(resume=True, new_run='parquet' in loaded_file_types)
+
+        SqlPipeline('aws_bronze', schema_name).add_migration(
+            'bronze_s3_metrics', f'{base_path}/sql/bronze_s3_metrics.sql').run_or_raise()
+        # Rows still stored under the value-based keys are compacted before new rows land
+        compact_s3_metrics(schema_name)
         metrics_dump(aws_access_key, aws_secret_key,aws_region,schema_name )
-        execute_sql_files(f'{base_path}/sql/silver_s3_metrics.sql', schema_name, monthly_budget)
-        execute_sql_files(f'{base_path}/sql/gold_s3_metrics.sql', schema_name, monthly_budget)
+        metrics_pipeline = SqlPipeline('aws_s3_metrics', schema_name, {'budget': monthly_budget})
+        metrics_pipeline.add_stage('silver', f'{base_path}/sql/silver_s3_metrics.sql')
+        metrics_pipeline.add_stage('gold', f'{base_path}/sql/gold_s3_metrics.sql', depends_on=['silver'])
+        metrics_pipeline.run_or_raise(resume=True)
+
+        # The periods that loaded are committed and built above; the failed ones are
+        # retried with the project.
+        if failed_periods:
+            raise RuntimeError(f"Billing periods {', '.join(sorted(failed_periods))} of {schema_name} failed to load")
 
     except Exception as ex:
+        # Raised on, so the task retries the project and the ledger records the failure
         print(f"An error occurred: {ex}")
+        raise
 
@@ -8,13 +8,15 @@ import boto3
 from botocore.exceptions import ClientError, NoCredentialsError
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
-import hashlib
 
 # Configuration for the target table
 S3_BRONZE_TABLE_NAME = "bronze_s3_bucket_metrics" # Consistent name
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../../')))
-from app.ingestion.aws.postgres_operations import dump_to_postgresql, fetch_existing_hash_keys
+from app.ingestion.aws.postgres_operations import upsert_metrics, compact_metrics
+from app.ingestion.aws.postgres_operations import fetch_metric_watermarks, advance_metric_watermarks
+from app.ingestion.watermarks import CollectionWindow, utc_now
+from app.ingestion.metric_keys import add_metric_keys
 
 # Logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
@@ -23,6 +25,12 @@ LOG = logging.getLogger("s3_metrics_scraper")
 # Config
 MAX_OBJECT_SAMPLE = 100
 THREADS = 10
+LOOKBACK = timedelta(days=3)
+# Watermarks of this collector, and the bronze columns identifying a series
+S3_COLLECTOR = "aws_s3"
+SERIES_COLUMNS = ("bucket_name", "metric_name", "timestamp")
+# Storage metrics S3 publishes once a day; a series stored within the last day is skipped
+DAILY_METRICS = {"BucketSizeBytes", "NumberOfObjects"}
 
 def session_for_region(access_key, secret_key, region_name=None):
     return boto3.Session(
@@ -116,12 +124,19 @@ def list_bucket_metrics_for_bucket(aws_access_key, aws_secret_key, bucket_name,
         LOG.warning("Failed to list metrics for bucket %s in %s: %s", bucket_name, region, e)
         return []
 
-def fetch_latest_datapoint(aws_access_key, aws_secret_key, bucket_name, region, metric):
+def fetch_latest_datapoint(aws_access_key, aws_secret_key, bucket_name, region, metric, window=None):
+    if window is None:
+        window = CollectionWindow(utc_now(), LOOKBACK)
+    metric_name = metric.get("MetricName")
+    if metric_name in DAILY_METRICS and not window.backfill:
+        last = window.watermarks.get((bucket_name.lower(), metric_name))
+        if last is not None and last > window.now - timedelta(days=1):
+            return None
     try:
         sess = session_for_region(aws_access_key, aws_secret_key, region)
         cw = sess.client("cloudwatch", region_name=region)
-        now = datetime.now(timezone.utc)
-        start = now - timedelta(days=3)
+        now = window.now.replace(tzinfo=timezone.utc)
+        start = window.start(bucket_name, metric_name).replace(tzinfo=timezone.utc)
         period = 3600
 
         dimensions = metric.get("Dimensions", [])
@@ -146,9 +161,10 @@ def fetch_latest_datapoint(aws_access_key, aws_secret_key, bucket_name, region,
         return None
 
     latest = max(datapoints, key=lambda d: d["Timestamp"])
-    value = latest.get("Average")
-    if value is None:
-        value = latest.get("Sum") or latest.get("Maximum") or latest.get("Minimum")
+    # The statistic the value was read from is part of the row's key
+    aggregation = next(
+        (stat for stat in ("Average", "Sum", "Maximum", "Minimum") if latest.get(stat) is not None), "Average")
+    value = latest.get(aggregation)
 
     # Determine StorageType. Default to None/empty string if not a dimension.
     storage_type = None
@@ -165,12 +181,13 @@ def fetch_latest_datapoint(aws_access_key, aws_secret_key, bucket_name, region,
         "dimensions_json": json.dumps(dimensions),
         "timestamp": latest["Timestamp"].astimezone(timezone.utc).replace(tzinfo=None),  # naive UTC
         "value": value,
+        "aggregation": aggregation,
         "unit": latest.get("Unit"),
         # account_id and storage_class will be added in scrape_bucket_metrics/metrics_dump
     }
     return record
 
-def scrape_bucket_metrics(aws_access_key, aws_secret_key, bucket):
+def scrape_bucket_metrics(aws_access_key, aws_secret_key, bucket, window=None):
     name = bucket["Name"]
     region = bucket["Region"]
     account_id = bucket["AccountId"] # Retrieve account ID
@@ -180,7 +197,8 @@ def scrape_bucket_metrics(aws_access_key, aws_secret_key, bucket):
         return []
     records = []
     with ThreadPoolExecutor(max_workers=6) as ex:
-        futures = {ex.submit(fetch_latest_datapoint, aws_access_key, aws_secret_key, name, region, m): m for m in metrics}
+        futures = {ex.submit(fetch_latest_datapoint, aws_access_key, aws_secret_key, name, region, m, window): m
+                   for m in metrics}
         for fut in as_completed(futures):
             res = fut.result()
             if res:
@@ -193,7 +211,7 @@ def scrape_bucket_metrics(aws_access_key, aws_secret_key, bucket):
                 records.append(res)
     return records
 
-def collect_all_s3_metrics(aws_access_key, aws_secret_key, default_region="us-east-1"):
+def collect_all_s3_metrics(aws_access_key, aws_secret_key, default_region="us-east-1", window=None):
     LOG.info("=" * 60)
     LOG.info("🚀 Starting S3 metrics collection...")
     LOG.info("=" * 60)
@@ -205,7 +223,7 @@ def collect_all_s3_metrics(aws_access_key, aws_secret_key, default_region="us-ea
 
     all_records = []
     with ThreadPoolExecutor(max_workers=THREADS) as pool:
-        futures = {pool.submit(scrape_bucket_metrics, aws_access_key, aws_secret_key, b): b for b in buckets}
+        futures = {pool.submit(scrape_bucket_metrics, aws_access_key, aws_secret_key, b, window): b for b in buckets}
         for fut in as_completed(futures):
             b = futures[fut]
             try:
@@ -230,17 +248,10 @@ def _compute_s3_hash_key_for_df(df: pd.DataFrame) -> pd.DataFrame:
     if 'bucket_name' not in df.columns:
         df['bucket_name'] = ''
     df['bucket_name'] = df['bucket_name'].astype(str).fillna('').str.lower()
-    # normalize timestamp to 'YYYY-MM-DD HH:MM:SS' (second precision)
     df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True).dt.tz_convert(None)
-    df['timestamp_str'] = df['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
-    # value normalization
-    df['value_norm'] = df['value'].astype(float).round(6).astype(str)
-    def row_hash(r):
-        s = f"{r['bucket_name']}|{r['timestamp_str']}|{r.get('metric_name','') or ''}|{r.get('value_norm','')}"
-        return hashlib.md5(s.encode('utf-8')).hexdigest()
-    df['hash_key'] = df.apply(row_hash, axis=1)
-    df = df.drop(columns=['timestamp_str','value_norm'], errors='ignore')
-    return df
+    # One row per bucket, metric, timestamp, statistic and storage type; the value is not
+    # part of the key, so a revised datapoint replaces the stored one
+    return add_metric_keys(df, *SERIES_COLUMNS, "aggregation", dimension_column="storage_type")
 
 def metrics_dump(aws_access_key, aws_secret_key, region, schema_name):
     # Use the consistent table name
@@ -248,7 +259,18 @@ def metrics_dump(aws_access_key, aws_secret_key, region, schema_name):
     LOG.info("🔄 Starting S3 metrics dump...")
     LOG.info("Schema: %s, Table: %s", schema_name, table_name)
 
-    all_metrics_df = collect_all_s3_metrics(aws_access_key, aws_secret_key, region)
+    # Each series is requested from its watermark. Only the latest datapoint is kept, so
+    # there are no gaps to detect.
+    run_started = utc_now()
+    try:
+        watermarks = fetch_metric_watermarks(schema_name, S3_COLLECTOR, table_name, SERIES_COLUMNS)
+    except Exception as e:
+        LOG.warning("Could not read S3 metric watermarks, backfilling: %s", e)
+        watermarks = {}
+    window = CollectionWindow(run_started, LOOKBACK, watermarks)
+    window.summary("S3 metrics")
+
+    all_metrics_df = collect_all_s3_metrics(aws_access_key, aws_secret_key, region, window)
 
     LOG.info("=" * 60)
     if all_metrics_df is None or all_metrics_df.empty:
@@ -261,7 +283,7 @@ def metrics_dump(aws_access_key, aws_secret_key, region, schema_name):
     REQUIRED_COLUMNS = [
         "bucket_name", "region", "account_id", "timestamp", "metric_name", 
         "value", "unit", "storage_class", "storage_type", "dimensions_json", 
-        "arn", "storage_classes_sample_json"
+        "arn", "storage_classes_sample_json", "aggregation"
     ]
     
     for col in REQUIRED_COLUMNS:
@@ -276,33 +298,22 @@ def metrics_dump(aws_access_key, aws_secret_key, region, schema_name):
     # compute hash keys
     all_metrics_df = _compute_s3_hash_key_for_df(all_metrics_df)
 
-    # fetch existing hash keys from bronze to avoid duplicate insert
-    try:
-        # Pass the corrected table name
-        existing = fetch_existing_hash_keys(schema_name, table_name)
-    except Exception as e:
-        # The original code logged a warning; we'll keep that but log the specific error
-        LOG.warning("Could not fetch existing hash keys: %s", e)
-        existing = set()
-
-    # filter only new unique rows
-    new_df = all_metrics_df[~all_metrics_df['hash_key'].isin(existing)].copy()
-    LOG.info("Total collected: %d  New unique: %d", len(all_metrics_df), len(new_df))
-
-    if new_df.empty:
-        LOG.info("No new unique S3 metric rows to insert. Skipping DB dump.")
-        LOG.info("=" * 60)
-        return
-
-    # dump in chunks
+    # Rows are upserted on their stable key, so datapoints collected again update their rows
     try:
         chunk_size = 100000
-        num_chunks = (len(new_df) + chunk_size - 1) // chunk_size
-        LOG.info("Inserting %d rows in %d chunk(s)...", len(new_df), num_chunks)
-        for start in range(0, len(new_df), chunk_size):
-            chunk = new_df.iloc[start:start + chunk_size]
-            # Pass the corrected table name
-            dump_to_postgresql(chunk, schema_name, table_name)
+        num_chunks = (len(all_metrics_df) + chunk_size - 1) // chunk_size
+        LOG.info("Upserting %d rows in %d chunk(s)...", len(all_metrics_df), num_chunks)
+        for start in range(0, len(all_metrics_df), chunk_size):
+            chunk = all_metrics_df.iloc[start:start + chunk_size]
+            upsert_metrics(chunk, schema_name, table_name)
+        advance_metric_watermarks(schema_name, S3_COLLECTOR, all_metrics_df, SERIES_COLUMNS, run_started)
         LOG.info("✅ S3 metrics dumped successfully to %s.%s!", schema_name, table_name)
     except Exception as e:
-        LOG.error("Failed to dump S3 metrics: %s", e)
\ No newline at end of file
+        LOG.error("Failed to dump S3 metrics: %s", e)
+
+
+def compact_s3_metrics(schema_name):
+    """Collapse S3 datapoints still stored under the value-based keys."""
+    return compact_metrics(schema_name, S3_BRONZE_TABLE_NAME, SERIES_COLUMNS, {}, "Average",
+                           dimension_column="storage_type", order_column="ingested_at",
+                           dependent_tables=[("silver_s3_metrics", "hash_key")])
@@ -1,9 +1,15 @@
 import psycopg2
 from psycopg2 import sql
 import os
+import time
+from contextlib import contextmanager
 import pandas as pd
 from sqlalchemy import create_engine
 from dotenv import load_dotenv
+from app.ingestion.partitions import ensure_partitioned_table, fetch_period_fingerprints
+from app.ingestion.partitions import build_staging_partition, swap_in_partition
+from app.ingestion.watermarks import seed_watermarks, fetch_watermarks, detect_gaps, advance_watermarks
+from app.ingestion.metric_keys import upsert_metric_rows, compact_metrics_table
 
 # Load environment variables from .env file
 load_dotenv()
@@ -193,12 +199,14 @@ def drop_schema(connection, schema_name):
 
 
 @connection
-def execute_sql_files(connection, sql_file_path, schema_name, budget):
+def execute_sql_files(connection, sql_file_path, schema_name, budget, batch_id=None):
     try:
         # Read the SQL file
         with open(sql_file_path, 'r') as file:
             sql_script = file.read()
         sql_script = sql_script.replace('__schema__', schema_name).replace('__budget__', str(budget)).replace('__databasename__', DB_NAME).replace('__password__', DB_PASSWORD)
+        if batch_id is not None:
+            sql_script = sql_script.replace('__batch_id__', batch_id)
 
         # Create a cursor object
         cursor = connection.cursor()
@@ -206,6 +214,8 @@ def execute_sql_files(connection, sql_file_path, schema_name, budget):
         # Execute the SQL script
         cursor.execute(sql_script)
         print(cursor.statusmessage)
+        for notice in connection.notices:
+            print(notice.strip())
 
         # Commit the transaction
         connection.commit()
@@ -218,6 +228,24 @@ def execute_sql_files(connection, sql_file_path, schema_name, budget):
     except Exception as error:
         print(f"Error executing {sql_file_path}: {error}")
 
+@connection
+def create_partitioned_bronze_table(connection, provider, schema_name, table_name, partition_column):
+    """Create the bronze table, range-partitioned by billing month, if it does not exist."""
+    cursor = connection.cursor()
+    ensure_partitioned_table(cursor, provider, schema_name, table_name, partition_column)
+    cursor.close()
+    print(f"Partitioned table {schema_name}.{table_name} is ready.")
+
+
+@connection
+def fetch_loaded_periods(connection, schema_name, table_name):
+    """Return {month start: fingerprint} for the billing months loaded in a bronze table."""
+    cursor = connection.cursor()
+    fingerprints = fetch_period_fingerprints(cursor, schema_name, table_name)
+    cursor.close()
+    print(f"Fetched fingerprints of {len(fingerprints)} loaded billing periods.")
+    return fingerprints
+
 @connection
 def fetch_existing_hash_keys(connection, schema_name, table_name):
     try:
@@ -232,3 +260,128 @@ def fetch_existing_hash_keys(connection, schema_name, table_name):
     except Exception as ex:
         print(f"Error fetching hash keys: {ex}")
         return set()
+
+
+@connection
+def upsert_metrics(connection, frame, schema_name, table_name, collector=None, series_columns=None):
+    """
+    Write metrics rows keyed by `add_metric_keys`, updating datapoints already stored.
+
+    With a `collector`, its watermarks are advanced past the rows in the same transaction.
+    """
+    cursor = connection.cursor()
+    written = upsert_metric_rows(cursor, frame, schema_name, table_name)
+    if collector:
+        advance_watermarks(cursor, schema_name, collector, frame, *series_columns)
+    cursor.close()
+    print(f"Upserted {written} rows into {schema_name}.{table_name}.")
+
+
+@connection
+def compact_metrics(connection, schema_name, table_name, series_columns, aggregations, default_aggregation,
+                    dimension_column=None, order_column=None, dependent_tables=()):
+    """Drop duplicate datapoints of a metrics table still holding un-keyed rows and move it to stable keys."""
+    cursor = connection.cursor()
+    deleted, rekeyed = compact_metrics_table(
+        cursor, schema_name, table_name, series_columns, 'aggregation', aggregations, default_aggregation,
+        dimension_column=dimension_column, order_column=order_column, dependent_tables=dependent_tables)
+    cursor.close()
+    if deleted or rekeyed:
+        print(f"Compacted {schema_name}.{table_name}: {deleted} duplicate rows deleted, {rekeyed} rows rekeyed.")
+    return deleted, rekeyed
+
+
+@connection
+def fetch_metric_watermarks(connection, schema_name, collector, table_name, series_columns):
+    """
+    Return {(resource_id, metric_name): last stored timestamp} of a metrics collector,
+    seeding the watermarks from its bronze table on the first incremental run.
+
+    Args:
+        series_columns (tuple): Resource, metric and timestamp columns of `table_name`.
+    """
+    cursor = connection.cursor()
+    seed_watermarks(cursor, schema_name, collector, table_name, *series_columns)
+    connection.commit()
+    watermarks = fetch_watermarks(cursor, schema_name, collector)
+    cursor.close()
+    print(f"Fetched {len(watermarks)} {collector} watermarks.")
+    return watermarks
+
+
+@connection
+def detect_metric_gaps(connection, schema_name, collector, table_name, series_columns, max_step, since):
+    """Return {(resource_id, metric_name): gap start} of the unchecked holes in a metrics table."""
+    cursor = connection.cursor()
+    gaps = detect_gaps(cursor, schema_name, collector, table_name, *series_columns, max_step, since)
+    cursor.close()
+    if gaps:
+        print(f"Found gaps in {len(gaps)} {collector} series, requesting them again.")
+    return gaps
+
+
+@connection
+def advance_metric_watermarks(connection, schema_name, collector, frame, series_columns, checked_at):
+    """Advance a collector's watermarks past the rows of a frame that was stored in bronze."""
+    cursor = connection.cursor()
+    advance_watermarks(cursor, schema_name, collector, frame, *series_columns, checked_at)
+    cursor.close()
+    print(f"Advanced {collector} watermarks.")
+
+
+@connection
+def replace_billing_period(connection, period_data, schema_name, table_name, partition_column, period_start,
+                           fingerprint, load_batch_id):
+    """
+    Replace one billing month of a partitioned bronze table with `period_data`.
+
+    The month is first loaded into a staging table and committed, then swapped in for
+    the current partition in a second, short transaction. Readers see the old month
+    until that commit and other months are never touched.
+    """
+    cursor = connection.cursor()
+    stage = build_staging_partition(cursor, period_data, schema_name, table_name, partition_column, period_start)
+    connection.commit()
+    swap_in_partition(cursor, schema_name, table_name, stage, period_start, fingerprint, load_batch_id)
+    cursor.close()
+    print(f"Replaced billing period {period_start:%Y-%m} of {schema_name}.{table_name} with {len(period_data)} rows.")
+
+
+# Advisory lock class used for the cluster-wide billing period slots
+INGESTION_SLOT_LOCK_CLASS = 26026
+
+
+@contextmanager
+def ingestion_slot(max_slots, poll_seconds=5):
+    """
+    Hold one of `max_slots` cluster-wide ingestion slots for the life of the block.
+
+    Slots are Postgres session advisory locks, so the limit is shared by every
+    tenant and every worker process talking to the same database.
+    """
+    slot_connection = psycopg2.connect(
+        host=DB_HOST_NAME,
+        database=DB_NAME,
+        user=DB_USER_NAME,
+        password=DB_PASSWORD,
+        port=DB_PORT,
+        sslmode='require'
+    )
+    slot_connection.autocommit = True
+    cursor = slot_connection.cursor()
+    slot = None
+    try:
+        while slot is None:
+            for candidate in range(max_slots):
+                cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", (INGESTION_SLOT_LOCK_CLASS, candidate))
+                if cursor.fetchone()[0]:
+                    slot = candidate
+                    break
+            if slot is None:
+                time.sleep(poll_seconds)
+        yield slot
+    finally:
+        if slot is not None:
+            cursor.execute("SELECT pg_advisory_unlock(%s, %s)", (INGESTION_SLOT_LOCK_CLASS, slot))
+        cursor.close()
+        slot_connection.close()
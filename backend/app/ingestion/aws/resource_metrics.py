@@ -3,6 +3,14 @@ import boto3
 import datetime
 import pandas as pd
 from sqlalchemy import create_engine, text
+from app.ingestion.aws.postgres_operations import fetch_metric_watermarks, detect_metric_gaps, advance_metric_watermarks
+from app.ingestion.watermarks import CollectionWindow, utc_now
+
+# Watermarks of this collector, and the metrics_details columns identifying a series
+CLOUDWATCH_COLLECTOR = "aws_cloudwatch"
+SERIES_COLUMNS = ("namespace", "metric_name", "timestamp")
+LOOKBACK = datetime.timedelta(days=14)
+PERIOD_SECONDS = 3600  # 1 hour
 
 def fetch_and_store_cloudwatch_metrics(aws_access_key, aws_secret_key, region,
                                        db_host, db_port, db_user, db_password,
@@ -27,16 +35,27 @@ def fetch_and_store_cloudwatch_metrics(aws_access_key, aws_secret_key, region,
         'AWS/ApiGateway': ['Count', '4xxError', '5xxError', 'Latency']
     }
 
-    end_time = datetime.datetime.utcnow()
-    start_time = end_time - datetime.timedelta(days=14)
-    period = 3600  # 1 hour
+    # Each series is requested from its watermark; new ones are backfilled over LOOKBACK
+    end_time = utc_now()
+    try:
+        watermarks = fetch_metric_watermarks(db_schema, CLOUDWATCH_COLLECTOR, db_table, SERIES_COLUMNS)
+        gaps = detect_metric_gaps(db_schema, CLOUDWATCH_COLLECTOR, db_table, SERIES_COLUMNS,
+                                  datetime.timedelta(seconds=PERIOD_SECONDS), end_time - LOOKBACK)
+    except Exception as e:
+        print(f"Could not read CloudWatch watermarks, backfilling: {e}")
+        watermarks, gaps = {}, {}
+    window = CollectionWindow(end_time, LOOKBACK, watermarks, gaps)
+    window.summary("CloudWatch metrics")
+    period = PERIOD_SECONDS
     metrics_data = []
+    windows = {}
 
     for namespace, metrics in services_metrics.items():
         for metric_name in metrics:
             metric_id = metric_name.lower()
             if metric_id[0].isdigit():
                 metric_id = "metric_" + metric_id
+            start_time = window.start(namespace, metric_name)
             try:
                 response = cloudwatch.get_metric_data(
                     MetricDataQueries=[
@@ -56,6 +75,7 @@ def fetch_and_store_cloudwatch_metrics(aws_access_key, aws_secret_key, region,
                     StartTime=start_time,
                     EndTime=end_time
                 )
+                windows[(namespace, metric_name)] = start_time
                 for result in response['MetricDataResults']:
                     timestamps = result['Timestamps']
                     values = result['Values']
@@ -88,8 +108,17 @@ def fetch_and_store_cloudwatch_metrics(aws_access_key, aws_secret_key, region,
                 );
             """))
 
-        df.to_sql(db_table, engine, schema=db_schema, if_exists='append', index=False)
+        # The requested windows overlap stored datapoints, so they replace what is stored for them
+        with engine.begin() as conn:
+            for (namespace, metric_name), start_time in windows.items():
+                conn.execute(text(
+                    f"DELETE FROM {db_schema}.{db_table} "
+                    f"WHERE namespace = :namespace AND metric_name = :metric_name AND timestamp >= :start_time"
+                ), {"namespace": namespace, "metric_name": metric_name,
+                      "start_time": start_time.replace(tzinfo=datetime.timezone.utc)})
+            df.to_sql(db_table, conn, schema=db_schema, if_exists='append', index=False)
 
+        advance_metric_watermarks(db_schema, CLOUDWATCH_COLLECTOR, df, SERIES_COLUMNS, end_time)
         print("CloudWatch metrics ingestion complete.")
     else:
         print("No metrics data to save.")
@@ -6,6 +6,7 @@ import io
 import gzip
 from datetime import datetime
 from app.ingestion.aws.postgres_operations import *
+from app.ingestion import run_ledger
 
 
 def bucket(region, aws_access_key, aws_secret_key):
@@ -182,6 +183,7 @@ import pandas as pd
 
 def download_and_extract_csv(s3_client, bucket_name, key, chunksize=None):
     response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    run_ledger.add("bytes_read", response.get('ContentLength', 0))
     
     # Use streaming directly from the response body
     with gzip.GzipFile(fileobj=response['Body'], mode='rb') as gz:
@@ -192,4 +194,5 @@ def download_and_extract_csv(s3_client, bucket_name, key, chunksize=None):
 
 def download_and_read_parquet(s3_client, bucket_name, key):
     response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    run_ledger.add("bytes_read", response.get('ContentLength', 0))
     return pd.read_parquet(io.BytesIO(response['Body'].read()), engine='pyarrow')
@@ -23,6 +23,11 @@ CREATE TABLE IF NOT EXISTS __schema__.bronze_s3_bucket_metrics (
 -- Prevent duplicate raw rows by hash_key
 CREATE UNIQUE INDEX IF NOT EXISTS ux_bronze_s3_hash ON __schema__.bronze_s3_bucket_metrics (hash_key);
 
+-- Statistic the value was read with; part of hash_key
+ALTER TABLE __schema__.bronze_s3_bucket_metrics ADD COLUMN IF NOT EXISTS aggregation TEXT;
+-- Rows written before it was keyed; empty once the table is compacted
+CREATE INDEX IF NOT EXISTS ix_bronze_s3_unkeyed ON __schema__.bronze_s3_bucket_metrics (hash_key) WHERE aggregation IS NULL;
+
 -- convenience view for quick inspection
 CREATE OR REPLACE VIEW __schema__.v_bronze_s3_recent AS
 SELECT * FROM __schema__.bronze_s3_bucket_metrics ORDER BY ingested_at DESC LIMIT 1000;
\ No newline at end of file
@@ -43,14 +43,14 @@ SELECT
     __budget__::integer AS monthly_budget,
 	"x_ServiceCode" AS x_service_code,
     substr(cast(digest("Tags"::text, 'sha256') as text), 3, 64) as tags_key,
-    "hash_key" as hash_key,
+    encode("hash_key", 'hex') as hash_key,  -- bronze keys are binary digests
     "ResourceName" as resource_name
 FROM __schema__.silver_focus_aws;
 
 -- drop view __schema__.gold_aws_fact_focus;
 
 
-CREATE OR REPLACE FUNCTION aws_tags_view_generation()
+CREATE OR REPLACE FUNCTION __schema__.aws_tags_view_generation()
 RETURNS text AS $$
 DECLARE
     record_tagkey record;
@@ -84,7 +84,7 @@ DECLARE
     q_statement text;
 BEGIN
     -- Generate the view creation query
-    q_statement := aws_tags_view_generation();
+    q_statement := __schema__.aws_tags_view_generation();
 
     -- Drop the existing view if it exists
     EXECUTE del_statement;
@@ -0,0 +1,47 @@
+-- Gold views. This file runs as a schema migration:
+-- it is applied only when its content (including the embedded budget) changes, so
+-- daily loads no longer take view locks that queue behind dashboard queries.
+
+CREATE OR REPLACE VIEW __schema__.gold_aws_billing_dim AS
+SELECT billing_account_id, billing_account_name, sub_account_id, sub_account_name
+FROM __schema__.gold_aws_billing_dim_mat;
+
+CREATE OR REPLACE VIEW __schema__.gold_aws_fact_focus AS
+SELECT
+    billed_cost,
+    consumed_unit,
+    consumed_quantity,
+    charge_period_start,
+    charge_period_end,
+    contracted_cost,
+    effective_cost,
+    list_cost,
+    list_unit_price,
+    region_id,
+    region_name,
+    pricing_category,
+    pricing_quantity,
+    pricing_unit,
+    contracted_unit_price,
+    provider_name,
+    resource_id,
+    billing_period_start,
+    billing_period_end,
+    billing_account_name,
+    charge_category,
+    charge_class,
+    charge_description,
+    charge_frequency,
+    service_name,
+    service_category,
+    x_operation,
+    x_usage_type,
+    sku_price_id,
+    sku_id,
+    billing_account_id,
+    __budget__::integer AS monthly_budget,
+    x_service_code,
+    tags_key,
+    hash_key,
+    resource_name
+FROM __schema__.gold_aws_fact_focus_mat;
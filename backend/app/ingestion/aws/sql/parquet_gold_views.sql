@@ -85,94 +85,182 @@
 -- $$ LANGUAGE plpgsql;
 
 
+-- Gold is materialized: gold_aws_fact_focus_mat is maintained incrementally from the
+-- current silver batch and gold_aws_billing_dim_mat is refreshed concurrently, so
+-- dashboards read indexed tables while ingestion writes without blocking them.
+-- The public gold_* views keep their names and columns and only project these.
+DO $$
+DECLARE
+    v_full_backfill boolean;
+    v_inserted bigint := 0;
+    v_deleted bigint := 0;
+BEGIN
+    v_full_backfill := NOT EXISTS (
+            SELECT 1 FROM information_schema.tables
+            WHERE table_schema = '__schema__' AND table_name = 'gold_aws_fact_focus_mat')
+        OR EXISTS (
+            SELECT 1 FROM __schema__.silver_refresh_log
+            WHERE table_name = 'silver_focus_aws_2' AND load_batch_id = '__batch_id__' AND full_backfill);
+
+    CREATE TABLE IF NOT EXISTS __schema__.gold_aws_fact_focus_mat (
+        billed_cost double precision,
+        consumed_unit text,
+        consumed_quantity double precision,
+        charge_period_start timestamp,
+        charge_period_end timestamp,
+        contracted_cost double precision,
+        effective_cost double precision,
+        list_cost double precision,
+        list_unit_price double precision,
+        region_id text,
+        region_name text,
+        pricing_category text,
+        pricing_quantity double precision,
+        pricing_unit text,
+        contracted_unit_price double precision,
+        provider_name text,
+        resource_id text,
+        billing_period_start timestamp,
+        billing_period_end timestamp,
+        billing_account_name text,
+        charge_category text,
+        charge_class double precision,
+        charge_description text,
+        charge_frequency text,
+        service_name text,
+        service_category text,
+        x_operation text,
+        x_usage_type text,
+        sku_price_id text,
+        sku_id text,
+        billing_account_id bigint,
+        x_service_code text,
+        tags_key text,
+        hash_key text PRIMARY KEY,
+        resource_name text
+    );
+    CREATE INDEX IF NOT EXISTS gold_aws_fact_focus_mat_charge_period_idx ON __schema__.gold_aws_fact_focus_mat (charge_period_start);
+    CREATE INDEX IF NOT EXISTS gold_aws_fact_focus_mat_resource_idx ON __schema__.gold_aws_fact_focus_mat (resource_id, charge_period_start);
+    CREATE INDEX IF NOT EXISTS gold_aws_fact_focus_mat_service_idx ON __schema__.gold_aws_fact_focus_mat (service_name, charge_period_start);
+    CREATE INDEX IF NOT EXISTS gold_aws_fact_focus_mat_tags_idx ON __schema__.gold_aws_fact_focus_mat (tags_key);
+    CREATE INDEX IF NOT EXISTS gold_aws_fact_focus_mat_billing_period_idx ON __schema__.gold_aws_fact_focus_mat (billing_period_start);
+
+    IF v_full_backfill THEN
+        TRUNCATE __schema__.gold_aws_fact_focus_mat;
+    END IF;
+
+    -- Silver rows are keyed on a content hash and never change, so new keys are all we need
+    INSERT INTO __schema__.gold_aws_fact_focus_mat
+    SELECT
+        "BilledCost",
+        "ConsumedUnit",
+        "ConsumedQuantity",
+        "ChargePeriodStart"::timestamp,
+        "ChargePeriodEnd"::timestamp,
+        "ContractedCost",
+        "EffectiveCost",
+        "ListCost",
+        "ListUnitPrice",
+        "RegionId",
+        "RegionName",
+        "PricingCategory",
+        "PricingQuantity",
+        "PricingUnit",
+        "ContractedUnitPrice",
+        "ProviderName",
+        "ResourceId",
+        "BillingPeriodStart"::timestamp,
+        "BillingPeriodEnd"::timestamp,
+        "BillingAccountName",
+        "ChargeCategory",
+        -- FOCUS ChargeClass is text ('Correction'); only numeric values survive the cast
+        CASE WHEN "ChargeClass"::text ~ '^-?[0-9]+(\.[0-9]+)?$' THEN "ChargeClass"::double precision END,
+        "ChargeDescription",
+        "ChargeFrequency",
+        "ServiceName",
+        "ServiceCategory",
+        "x_Operation",
+        "x_UsageType",
+        "SkuPriceId",
+        "SkuId",
+        "BillingAccountId"::bigint,
+        "x_ServiceCode",
+        tags_key,
+        "hash_key",
+        "ResourceName"
+    FROM __schema__.silver_focus_aws_2
+    WHERE load_batch_id = '__batch_id__' OR v_full_backfill
+    ON CONFLICT (hash_key) DO NOTHING;
+    GET DIAGNOSTICS v_inserted = ROW_COUNT;
 
+    -- Follow silver when a restated billing month lost rows
+    DELETE FROM __schema__.gold_aws_fact_focus_mat g
+    USING (
+        SELECT DISTINCT date_trunc('month', "BillingPeriodStart") AS month_start
+        FROM __schema__.silver_focus_aws_2
+        WHERE load_batch_id = '__batch_id__'
+    ) restated
+    WHERE g.billing_period_start >= restated.month_start
+      AND g.billing_period_start < restated.month_start + interval '1 month'
+      AND NOT EXISTS (SELECT 1 FROM __schema__.silver_focus_aws_2 s WHERE s.hash_key = g.hash_key);
+    GET DIAGNOSTICS v_deleted = ROW_COUNT;
 
+    RAISE NOTICE 'gold_aws_fact_focus_mat batch %: % rows added, % removed (full backfill: %)',
+        '__batch_id__', v_inserted, v_deleted, v_full_backfill;
 
---sloved datatype errro --
--- Create or replace view for gold_aws_billing_dim
-CREATE OR REPLACE VIEW __schema__.gold_aws_billing_dim AS
-SELECT DISTINCT
-    "BillingAccountId" ::bigint AS billing_account_id,
-    "BillingAccountName" AS billing_account_name,
-    "SubAccountId" ::bigint AS sub_account_id,
-    "SubAccountName" AS sub_account_name
-FROM __schema__.silver_focus_aws_2;
-
-CREATE OR REPLACE VIEW __schema__.gold_aws_fact_focus AS
-SELECT
-    "BilledCost" AS billed_cost,
-    "ConsumedUnit" AS consumed_unit,
-    "ConsumedQuantity" AS consumed_quantity,
-    "ChargePeriodStart"::timestamp AS charge_period_start,  -- Convert to timestamp
-    "ChargePeriodEnd"::timestamp AS charge_period_end,      -- Convert to timestamp
-    "ContractedCost" AS contracted_cost,
-    "EffectiveCost" AS effective_cost,
-    "ListCost" AS list_cost,
-    "ListUnitPrice" AS list_unit_price,
-    "RegionId" AS region_id,
-    "RegionName" AS region_name,
-    "PricingCategory" AS pricing_category,
-    "PricingQuantity" AS pricing_quantity,
-    "PricingUnit"  AS pricing_unit,
-    "ContractedUnitPrice" AS contracted_unit_price,
-    "ProviderName" AS provider_name,
-    "ResourceId" AS resource_id,
-    "BillingPeriodStart"::timestamp AS billing_period_start,  -- Convert to timestamp
-    "BillingPeriodEnd"::timestamp AS billing_period_end,      -- Convert to timestamp
-    "BillingAccountName" AS billing_account_name,
-    "ChargeCategory" AS charge_category,
-    "ChargeClass" ::double precision AS charge_class,
-    "ChargeDescription" AS charge_description,
-    "ChargeFrequency" AS charge_frequency,
-    "ServiceName" AS service_name,
-    "ServiceCategory" AS service_category,
-    "x_Operation" AS x_operation,
-    "x_UsageType" AS x_usage_type,
-    "SkuPriceId" AS sku_price_id,
-    "SkuId" AS sku_id,
-    "BillingAccountId" ::bigint AS billing_account_id,
-    __budget__::integer AS monthly_budget,
-	"x_ServiceCode" AS x_service_code,
-    substr(cast(digest("Tags"::text, 'sha256') as text), 3, 64) as tags_key,
-    "hash_key" as hash_key,
-    "ResourceName" as resource_name
-FROM __schema__.silver_focus_aws_2;
-
-
-CREATE OR REPLACE FUNCTION aws_tags_view_generation()
+    IF NOT EXISTS (SELECT 1 FROM pg_matviews WHERE schemaname = '__schema__' AND matviewname = 'gold_aws_billing_dim_mat') THEN
+        CREATE MATERIALIZED VIEW __schema__.gold_aws_billing_dim_mat AS
+        SELECT DISTINCT
+            "BillingAccountId"::bigint AS billing_account_id,
+            "BillingAccountName" AS billing_account_name,
+            "SubAccountId"::bigint AS sub_account_id,
+            "SubAccountName" AS sub_account_name
+        FROM __schema__.silver_focus_aws_2;
+        CREATE UNIQUE INDEX gold_aws_billing_dim_mat_uidx
+            ON __schema__.gold_aws_billing_dim_mat (billing_account_id, billing_account_name, sub_account_id, sub_account_name);
+    ELSE
+        REFRESH MATERIALIZED VIEW CONCURRENTLY __schema__.gold_aws_billing_dim_mat;
+    END IF;
+END $$;
+
+
+-- The tags view pivots the normalized aws_resource_tags table (see silver_tags.sql),
+-- with one column per key in aws_tag_key_catalog.
+-- Created in the tenant schema, so tenants ingested at the same time do not replace
+-- one shared function.
+CREATE OR REPLACE FUNCTION __schema__.aws_tags_view_generation()
 RETURNS text AS $$
 DECLARE
     record_tagkey record;
-    q_statement text = format(E'CREATE OR REPLACE VIEW __schema__.gold_aws_tags AS\nSELECT DISTINCT\n    substr(cast(digest(cast("Tags" AS text), \'sha256\') AS text), 3, 64) AS tags_key,');
+    q_statement text = E'CREATE OR REPLACE VIEW __schema__.gold_aws_tags AS\nSELECT\n    tags_key,';
 BEGIN
-    -- Loop through each distinct tag key from Tags, cast to jsonb
     FOR record_tagkey IN
-        SELECT DISTINCT jsonb_object_keys("Tags"::jsonb) AS tagkey FROM __schema__.silver_focus_aws_2
+        SELECT tag_key AS tagkey FROM __schema__.aws_tag_key_catalog ORDER BY tag_key
     LOOP
-        q_statement := q_statement || format(E'\n    "Tags"->>%L AS %I,', record_tagkey.tagkey, record_tagkey.tagkey);
+        q_statement := q_statement || format(E'\n    max(tag_value) FILTER (WHERE tag_key = %L) AS %I,', record_tagkey.tagkey, record_tagkey.tagkey);
     END LOOP;
 
     -- Remove the trailing comma and complete the query
     q_statement := rtrim(q_statement, ',');
-    q_statement := q_statement || E'\nFROM __schema__.silver_focus_aws_2\nWHERE\n    "Tags" IS NOT NULL';
+    q_statement := q_statement || E'\nFROM __schema__.aws_resource_tags\nGROUP BY tags_key';
     RAISE NOTICE E'\n%', q_statement;
     RETURN q_statement;
 END;
 $$ LANGUAGE plpgsql;
 
--- Execute the function to generate and create the aws_tags view
+-- Recreate the tags view only when its generated definition changed (a new tag key).
+-- The definition's md5 is kept as the view comment, so unchanged runs take no view lock.
 DO $$
 DECLARE
-    del_statement text := 'DROP VIEW IF EXISTS __schema__.gold_aws_tags';
     q_statement text;
 BEGIN
     -- Generate the view creation query
-    q_statement := aws_tags_view_generation();
-    
-    -- Drop the existing view if it exists
-    EXECUTE del_statement;
-    
-    -- Execute the dynamically generated query
-    EXECUTE q_statement;
+    q_statement := __schema__.aws_tags_view_generation();
+
+    IF obj_description(to_regclass('__schema__.gold_aws_tags'), 'pg_class') IS DISTINCT FROM md5(q_statement) THEN
+        EXECUTE 'DROP VIEW IF EXISTS __schema__.gold_aws_tags';
+        EXECUTE q_statement;
+        EXECUTE format('COMMENT ON VIEW __schema__.gold_aws_tags IS %L', md5(q_statement));
+    END IF;
 END;
 $$ LANGUAGE plpgsql;
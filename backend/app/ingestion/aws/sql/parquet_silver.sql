@@ -1,131 +1,140 @@
--- -- select "Tags" from __schema__.silver_focus_aws limit 100;
+-- Incremental bronze -> silver refresh.
+-- Only bronze rows from the current load batch (__batch_id__) are upserted on hash_key,
+-- so the cost of a run follows the size of the new data rather than all history.
+-- Bronze replaces a restated billing month as a whole partition, so silver rows of those
+-- months that are no longer in bronze are removed as well.
 DO $$
+DECLARE
+    v_full_backfill boolean := false;
+    v_inserted bigint := 0;
+    v_updated bigint := 0;
+    v_deleted bigint := 0;
+    v_started_at timestamp := clock_timestamp();
 BEGIN
+    CREATE TABLE IF NOT EXISTS __schema__.silver_refresh_log (
+        id bigserial PRIMARY KEY,
+        table_name text NOT NULL,
+        load_batch_id text,
+        full_backfill boolean NOT NULL DEFAULT false,
+        rows_inserted bigint NOT NULL DEFAULT 0,
+        rows_updated bigint NOT NULL DEFAULT 0,
+        started_at timestamp NOT NULL,
+        finished_at timestamp NOT NULL DEFAULT clock_timestamp()
+    );
+    ALTER TABLE __schema__.silver_refresh_log ADD COLUMN IF NOT EXISTS rows_deleted bigint NOT NULL DEFAULT 0;
+
     IF NOT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_schema = '__schema__' AND table_name = 'silver_focus_aws_2') THEN
-        -- Create the table if it does not exist
-        CREATE TABLE __schema__.silver_focus_aws_2 AS
+        CREATE TABLE __schema__.silver_focus_aws_2 (
+            "AvailabilityZone" text,
+            "BilledCost" double precision,
+            "BillingAccountId" text,
+            "BillingAccountName" text,
+            "BillingCurrency" text,
+            "BillingPeriodEnd" timestamp without time zone,
+            "BillingPeriodStart" timestamp without time zone,
+            "ChargeCategory" text,
+            "ChargeClass" text,
+            "ChargeDescription" text,
+            "ChargeFrequency" text,
+            "ChargePeriodEnd" timestamp without time zone,
+            "ChargePeriodStart" timestamp without time zone,
+            "CommitmentDiscountCategory" text,
+            "CommitmentDiscountId" text,
+            "CommitmentDiscountName" text,
+            "CommitmentDiscountStatus" text,
+            "CommitmentDiscountType" text,
+            "ConsumedQuantity" double precision,
+            "ConsumedUnit" text,
+            "ContractedCost" double precision,
+            "ContractedUnitPrice" double precision,
+            "EffectiveCost" double precision,
+            "InvoiceIssuerName" text,
+            "ListCost" double precision,
+            "ListUnitPrice" double precision,
+            "PricingCategory" text,
+            "PricingQuantity" double precision,
+            "PricingUnit" text,
+            "ProviderName" text,
+            "PublisherName" text,
+            "RegionId" text,
+            "RegionName" text,
+            "ResourceId" text,
+            "ResourceName" text,
+            "ResourceType" text,
+            "ServiceCategory" text,
+            "ServiceName" text,
+            "SkuId" text,
+            "SkuPriceId" text,
+            "SubAccountId" text,
+            "SubAccountName" text,
+            "Tags" json,
+            "x_CostCategories" text,
+            "x_Discounts" text,
+            "x_Operation" text,
+            "x_ServiceCode" text,
+            "x_UsageType" text,
+            "hash_key" text,
+            tags_key text,
+            load_batch_id text
+        );
+        CREATE UNIQUE INDEX silver_focus_aws_2_hash_key_uidx ON __schema__.silver_focus_aws_2 (hash_key);
+        v_full_backfill := true;
+    ELSIF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE schemaname = '__schema__' AND indexname = 'silver_focus_aws_2_hash_key_uidx') THEN
+        -- Earlier versions re-inserted all of bronze on every run. Collapse those
+        -- duplicates once, key the table on hash_key and backfill anything missing.
+        ALTER TABLE __schema__.silver_focus_aws_2 ADD COLUMN IF NOT EXISTS load_batch_id text;
+        DELETE FROM __schema__.silver_focus_aws_2 a
+        USING __schema__.silver_focus_aws_2 b
+        WHERE a.hash_key = b.hash_key
+          AND a.ctid > b.ctid;
+        CREATE UNIQUE INDEX silver_focus_aws_2_hash_key_uidx ON __schema__.silver_focus_aws_2 (hash_key);
+        v_full_backfill := true;
+    END IF;
+
+    -- tags_key identifies the tag set of a row. It is computed once here instead of
+    -- hashing the Tags JSON inside the gold views on every query.
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = '__schema__' AND table_name = 'silver_focus_aws_2' AND column_name = 'tags_key') THEN
+        ALTER TABLE __schema__.silver_focus_aws_2 ADD COLUMN tags_key text;
+        UPDATE __schema__.silver_focus_aws_2
+        SET tags_key = substr(cast(digest("Tags"::text, 'sha256') as text), 3, 64)
+        WHERE "Tags" IS NOT NULL;
+    END IF;
+    CREATE INDEX IF NOT EXISTS silver_focus_aws_2_billing_period_idx ON __schema__.silver_focus_aws_2 ("BillingPeriodStart");
+    CREATE INDEX IF NOT EXISTS silver_focus_aws_2_load_batch_idx ON __schema__.silver_focus_aws_2 (load_batch_id);
+
+    WITH upserted AS (
+        INSERT INTO __schema__.silver_focus_aws_2 (
+            "AvailabilityZone", "BilledCost", "BillingAccountId", "BillingAccountName", "BillingCurrency",
+            "BillingPeriodEnd", "BillingPeriodStart", "ChargeCategory", "ChargeClass", "ChargeDescription",
+            "ChargeFrequency", "ChargePeriodEnd", "ChargePeriodStart", "CommitmentDiscountCategory",
+            "CommitmentDiscountId", "CommitmentDiscountName", "CommitmentDiscountStatus", "CommitmentDiscountType",
+            "ConsumedQuantity", "ConsumedUnit", "ContractedCost", "ContractedUnitPrice", "EffectiveCost",
+            "InvoiceIssuerName", "ListCost", "ListUnitPrice", "PricingCategory", "PricingQuantity", "PricingUnit",
+            "ProviderName", "PublisherName", "RegionId", "RegionName", "ResourceId", "ResourceName", "ResourceType",
+            "ServiceCategory", "ServiceName", "SkuId", "SkuPriceId", "SubAccountId", "SubAccountName", "Tags",
+            "x_CostCategories", "x_Discounts", "x_Operation", "x_ServiceCode", "x_UsageType", "hash_key",
+            tags_key, load_batch_id
+        )
         SELECT
-            "AvailabilityZone",
-            "BilledCost",
-            "BillingAccountId",
-            "BillingAccountName",
-            "BillingCurrency",
-            "BillingPeriodEnd",
-            "BillingPeriodStart",
-            "ChargeCategory",
-            "ChargeClass",
-            "ChargeDescription",
-            "ChargeFrequency",
-            "ChargePeriodEnd",
-            "ChargePeriodStart",
-            "CommitmentDiscountCategory",
-            "CommitmentDiscountId",
-            "CommitmentDiscountName",
-            "CommitmentDiscountStatus",
-            "CommitmentDiscountType",
-            "ConsumedQuantity",
-            "ConsumedUnit",
-            "ContractedCost",
-            "ContractedUnitPrice",
-            "EffectiveCost",
-            "InvoiceIssuerName",
-            "ListCost",
-            "ListUnitPrice",
-            "PricingCategory",
-            "PricingQuantity",
-            "PricingUnit",
-            "ProviderName",
-            "PublisherName",
-            "RegionId",
-            "RegionName",
-            "ResourceId",
-            "ResourceName",
-            "ResourceType",
-            "ServiceCategory",
-            "ServiceName",
-            "SkuId",
-            "SkuPriceId",
-            "SubAccountId",
-            "SubAccountName",
-            -- Transform Tags column into JSON and store it in the new table
-            (
-                SELECT
-                    json_object_agg(
-                        -- Extract key and remove unwanted characters
-                        TRIM(BOTH '()' FROM REGEXP_REPLACE(split_part(tag, ',', 1), '^"|"$', '')),
-                        -- Extract value and remove unwanted characters
-                        TRIM(BOTH '()' FROM REGEXP_REPLACE(split_part(tag, ',', 2), '^"|"$', ''))
-                    )
-                FROM
-                    unnest(
-                        string_to_array(
-                            TRIM(BOTH '{}' FROM "Tags"),
-                            '","'
-                        )
-                    ) AS tag
-            ) AS "Tags",
-            "x_CostCategories",
-            "x_Discounts",
-            "x_Operation",
-            "x_ServiceCode",
-            "x_UsageType",
-            "hash_key"
+            "AvailabilityZone", "BilledCost", "BillingAccountId", "BillingAccountName", "BillingCurrency",
+            "BillingPeriodEnd", "BillingPeriodStart", "ChargeCategory", "ChargeClass", "ChargeDescription",
+            "ChargeFrequency", "ChargePeriodEnd", "ChargePeriodStart", "CommitmentDiscountCategory",
+            "CommitmentDiscountId", "CommitmentDiscountName", "CommitmentDiscountStatus", "CommitmentDiscountType",
+            "ConsumedQuantity", "ConsumedUnit", "ContractedCost", "ContractedUnitPrice", "EffectiveCost",
+            "InvoiceIssuerName", "ListCost", "ListUnitPrice", "PricingCategory", "PricingQuantity", "PricingUnit",
+            "ProviderName", "PublisherName", "RegionId", "RegionName", "ResourceId", "ResourceName", "ResourceType",
+            "ServiceCategory", "ServiceName", "SkuId", "SkuPriceId", "SubAccountId", "SubAccountName",
+            parsed.tags,
+            "x_CostCategories", "x_Discounts", "x_Operation", "x_ServiceCode", "x_UsageType",
+            -- Bronze keys are binary digests; silver and gold keep the hex form
+            encode("hash_key", 'hex'),
+            substr(cast(digest(parsed.tags::text, 'sha256') as text), 3, 64),
+            load_batch_id
         FROM
-            __schema__.silver_focus_aws;
-    ELSE
-        -- If the table exists, you can truncate or perform other operations as needed
-        -- TRUNCATE TABLE __schema__.silver_focus_aws_2;
-        -- Optionally, you could re-insert data from the original table
-        INSERT INTO __schema__.silver_focus_aws_2
-        SELECT
-            "AvailabilityZone",
-            "BilledCost",
-            "BillingAccountId"::bigint AS "BillingAccountId",
-            "BillingAccountName",
-            "BillingCurrency",
-            "BillingPeriodEnd",
-            "BillingPeriodStart",
-            "ChargeCategory",
-            "ChargeClass"::double precision AS "ChargeClass",
-            "ChargeDescription",
-            "ChargeFrequency",
-            "ChargePeriodEnd",
-            "ChargePeriodStart",
-            -- "CommitmentDiscountCategory"::double precision AS "CommitmentDiscountCategory",
-            -- "CommitmentDiscountId"::double precision AS "CommitmentDiscountId",
-            -- "CommitmentDiscountName"::double precision AS "CommitmentDiscountName",
-            -- "CommitmentDiscountStatus"::double precision AS "CommitmentDiscountStatus",
-            -- "CommitmentDiscountType"::double precision AS "CommitmentDiscountType",
-            "CommitmentDiscountCategory" AS "CommitmentDiscountCategory",
-            "CommitmentDiscountId" AS "CommitmentDiscountId",
-            "CommitmentDiscountName" AS "CommitmentDiscountName",
-            "CommitmentDiscountStatus" AS "CommitmentDiscountStatus",
-            "CommitmentDiscountType" AS "CommitmentDiscountType",
-            "ConsumedQuantity",
-            "ConsumedUnit",
-            "ContractedCost",
-            "ContractedUnitPrice",
-            "EffectiveCost",
-            "InvoiceIssuerName",
-            "ListCost",
-            "ListUnitPrice",
-            "PricingCategory",
-            "PricingQuantity",
-            "PricingUnit",
-            "ProviderName",
-            "PublisherName",
-            "RegionId",
-            "RegionName",
-            "ResourceId",
-            "ResourceName"::double precision AS "ResourceName",
-            "ResourceType",
-            "ServiceCategory",
-            "ServiceName",
-            "SkuId",
-            "SkuPriceId",
-            "SubAccountId"::bigint AS "SubAccountId",
-            "SubAccountName",
-            (
+            __schema__.silver_focus_aws
+        CROSS JOIN LATERAL (
+            -- Typed loads already store a JSON object; older rows hold the text form.
+            SELECT CASE WHEN "Tags"::text ~ '^\{"[^"]*":' THEN "Tags"::text::json ELSE (
                 SELECT
                     json_object_agg(
                         TRIM(BOTH '()' FROM REGEXP_REPLACE(split_part(tag, ',', 1), '^"|"$', '')),
@@ -134,18 +143,41 @@ BEGIN
                 FROM
                     unnest(
                         string_to_array(
-                            TRIM(BOTH '{}' FROM "Tags"),
+                            TRIM(BOTH '{}' FROM "Tags"::text),
                             '","'
                         )
                     ) AS tag
-            ) AS "Tags",
-            "x_CostCategories",
-            "x_Discounts",
-            "x_Operation",
-            "x_ServiceCode",
-            "x_UsageType",
-            "hash_key"
-        FROM
-            __schema__.silver_focus_aws;
-    END IF;
+            ) END AS tags
+        ) AS parsed
+        WHERE
+            load_batch_id = '__batch_id__' OR v_full_backfill
+        ON CONFLICT (hash_key) DO UPDATE
+            SET load_batch_id = EXCLUDED.load_batch_id
+        RETURNING (xmax = 0) AS inserted
+    )
+    SELECT
+        count(*) FILTER (WHERE inserted),
+        count(*) FILTER (WHERE NOT inserted)
+    INTO v_inserted, v_updated
+    FROM upserted;
+
+    -- Rows dropped from a restated month; bronze lookups hit one partition each
+    DELETE FROM __schema__.silver_focus_aws_2 s
+    USING (
+        SELECT DISTINCT date_trunc('month', "BillingPeriodStart") AS month_start
+        FROM __schema__.silver_focus_aws
+        WHERE load_batch_id = '__batch_id__'
+    ) restated
+    WHERE s."BillingPeriodStart" >= restated.month_start
+      AND s."BillingPeriodStart" < restated.month_start + interval '1 month'
+      AND NOT EXISTS (
+          SELECT 1 FROM __schema__.silver_focus_aws b
+          WHERE b.hash_key = decode(s.hash_key, 'hex') AND b."BillingPeriodStart" = s."BillingPeriodStart");
+    GET DIAGNOSTICS v_deleted = ROW_COUNT;
+
+    INSERT INTO __schema__.silver_refresh_log (table_name, load_batch_id, full_backfill, rows_inserted, rows_updated, rows_deleted, started_at)
+    VALUES ('silver_focus_aws_2', '__batch_id__', v_full_backfill, v_inserted, v_updated, v_deleted, v_started_at);
+
+    RAISE NOTICE 'silver_focus_aws_2 batch %: % inserted, % updated, % deleted (full backfill: %)',
+        '__batch_id__', v_inserted, v_updated, v_deleted, v_full_backfill;
 END $$;
@@ -1,5 +1,5 @@
 -- silver_s3_metrics.sql
--- Normalized silver table for S3 metrics (recomputes canonical hash_key and avoids duplicates)
+-- Normalized silver table for S3 metrics, one row per bronze datapoint (keyed by the bronze hash_key)
 
 CREATE TABLE IF NOT EXISTS __schema__.silver_s3_metrics (
     bucket_name TEXT,
@@ -22,7 +22,15 @@ CREATE TABLE IF NOT EXISTS __schema__.silver_s3_metrics (
 
 CREATE INDEX IF NOT EXISTS ix_silver_s3_bucket_time ON __schema__.silver_s3_metrics (LOWER(bucket_name), timestamp);
 
--- Insert unique rows from bronze into silver
+-- Silver rows share the stable bronze key, so a datapoint collected again updates its row.
+-- Rows left from the value-based keys are collapsed before the key is made unique.
+DELETE FROM __schema__.silver_s3_metrics a
+USING __schema__.silver_s3_metrics b
+WHERE a.hash_key = b.hash_key AND a.ctid < b.ctid;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_silver_s3_hash ON __schema__.silver_s3_metrics (hash_key);
+
+-- Upsert bronze rows into silver
 INSERT INTO __schema__.silver_s3_metrics (
     bucket_name, region, account_id, timestamp, event_date, event_hour,
     metric_name, value, unit, storage_class, storage_type, dimensions_json, arn, storage_classes_sample_json, hash_key
@@ -42,20 +50,11 @@ SELECT
     b.dimensions_json,
     b.arn,
     b.storage_classes_sample_json,
-    -- canonical hash - second precision, lower(bucket_name)
-    md5(
-        LOWER(COALESCE(b.bucket_name,'')) || '|' ||
-        COALESCE(to_char(date_trunc('second', COALESCE(b.timestamp, now())::timestamp),'YYYY-MM-DD HH24:MI:SS'),'') || '|' ||
-        COALESCE(b.metric_name,'') || '|' ||
-        COALESCE(round(COALESCE(b.value,0.0)::numeric,6)::text,'')
-    ) AS hash_key
+    b.hash_key
 FROM __schema__.bronze_s3_bucket_metrics b
-WHERE NOT EXISTS (
-    SELECT 1 FROM __schema__.bronze_s3_bucket_metrics s
-    WHERE s.hash_key = md5(
-        LOWER(COALESCE(b.bucket_name,'')) || '|' ||
-        COALESCE(to_char(date_trunc('second', COALESCE(b.timestamp, now())::timestamp),'YYYY-MM-DD HH24:MI:SS'),'') || '|' ||
-        COALESCE(b.metric_name,'') || '|' ||
-        COALESCE(round(COALESCE(b.value,0.0)::numeric,6)::text,'')
-    )
-);
+ON CONFLICT (hash_key) DO UPDATE
+SET value = EXCLUDED.value,
+    unit = EXCLUDED.unit,
+    dimensions_json = EXCLUDED.dimensions_json,
+    storage_classes_sample_json = EXCLUDED.storage_classes_sample_json
+WHERE __schema__.silver_s3_metrics.value IS DISTINCT FROM EXCLUDED.value;
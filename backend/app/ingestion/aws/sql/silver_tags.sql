@@ -0,0 +1,53 @@
+-- Normalized resource tags, maintained incrementally from the current silver batch.
+-- aws_resource_tags holds one row per (tag set, tag key) and aws_tag_key_catalog the
+-- distinct tag keys, so dashboards filter on indexed columns instead of re-parsing JSON.
+DO $$
+DECLARE
+    v_full_backfill boolean;
+    v_tag_rows bigint := 0;
+BEGIN
+    -- Rebuild from all of silver the first time, or when silver itself was backfilled
+    v_full_backfill := NOT EXISTS (
+            SELECT 1 FROM information_schema.tables
+            WHERE table_schema = '__schema__' AND table_name = 'aws_resource_tags')
+        OR EXISTS (
+            SELECT 1 FROM __schema__.silver_refresh_log
+            WHERE table_name = 'silver_focus_aws_2' AND load_batch_id = '__batch_id__' AND full_backfill);
+
+    CREATE TABLE IF NOT EXISTS __schema__.aws_resource_tags (
+        tags_key text NOT NULL,
+        tag_key text NOT NULL,
+        tag_value text,
+        PRIMARY KEY (tags_key, tag_key)
+    );
+    CREATE INDEX IF NOT EXISTS aws_resource_tags_key_value_idx ON __schema__.aws_resource_tags (tag_key, tag_value);
+
+    CREATE TABLE IF NOT EXISTS __schema__.aws_tag_key_catalog (
+        tag_key text PRIMARY KEY,
+        first_seen_at timestamp NOT NULL DEFAULT now(),
+        last_seen_at timestamp NOT NULL DEFAULT now()
+    );
+
+    -- A tags_key is a hash of the whole tag set, so existing pairs never change
+    WITH new_tags AS (
+        INSERT INTO __schema__.aws_resource_tags (tags_key, tag_key, tag_value)
+        SELECT DISTINCT s.tags_key, t.key, t.value
+        FROM __schema__.silver_focus_aws_2 s
+        CROSS JOIN LATERAL json_each_text(s."Tags") AS t
+        WHERE s.tags_key IS NOT NULL
+          AND json_typeof(s."Tags") = 'object'
+          AND (s.load_batch_id = '__batch_id__' OR v_full_backfill)
+        ON CONFLICT (tags_key, tag_key) DO NOTHING
+        RETURNING tag_key
+    ),
+    catalog AS (
+        INSERT INTO __schema__.aws_tag_key_catalog (tag_key)
+        SELECT DISTINCT tag_key FROM new_tags
+        ON CONFLICT (tag_key) DO UPDATE
+            SET last_seen_at = now()
+    )
+    SELECT count(*) INTO v_tag_rows FROM new_tags;
+
+    RAISE NOTICE 'aws_resource_tags batch %: % new tag rows (full backfill: %)',
+        '__batch_id__', v_tag_rows, v_full_backfill;
+END $$;
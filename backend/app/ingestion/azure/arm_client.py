@@ -0,0 +1,187 @@
+"""
+Shared client for Azure Resource Manager, used by the Azure collectors and API endpoints.
+
+Tokens are cached per service principal and scope for the whole process and refreshed
+AZURE_TOKEN_REFRESH_MARGIN seconds before they expire, so a run asks Azure AD for one
+token per scope instead of one per module. Requests go through one pooled
+`requests.Session`, reusing TLS connections to management.azure.com across calls and
+modules. Throttled (429) requests are retried after their Retry-After and transient
+failures (5xx, connection errors) of idempotent methods with jittered backoff, as the
+async collectors in async_arm.py do. List operations are paged through `nextLink`.
+Every request is timed into ENDPOINT_LATENCY.
+
+Usage:
+    client = ArmClient(tenant_id, client_id, client_secret)
+    vms = client.list_all(f"/subscriptions/{subscription_id}/providers/Microsoft.Compute/virtualMachines",
+                          params={"api-version": "2023-07-01"})
+    response = client.put(url, json=definition)
+"""
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+from app.ingestion.azure.async_arm import AZURE_METRICS_MAX_ATTEMPTS, AZURE_RATELIMIT_LOW_WATERMARK
+from app.ingestion.azure.async_arm import RATELIMIT_HEADER_PREFIX, RETRY_STATUSES, ENDPOINT_LATENCY
+from app.ingestion.azure.async_arm import _retry_after, _backoff
+
+load_dotenv()
+
+# Seconds before expiry at which a cached token is replaced
+AZURE_TOKEN_REFRESH_MARGIN = int(os.getenv("AZURE_TOKEN_REFRESH_MARGIN", "300"))
+# Connections kept open per host by the shared session
+AZURE_ARM_POOL_SIZE = int(os.getenv("AZURE_ARM_POOL_SIZE", "16"))
+
+ARM_URL = "https://management.azure.com"
+ARM_SCOPE = "https://management.azure.com/.default"
+ARM_TIMEOUT = 60
+# Methods whose transient failures are retried; a POST is only retried after a 429
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE"}
+
+_session = None
+_session_lock = threading.Lock()
+_tokens = {}
+_token_lock = threading.Lock()
+
+
+def shared_session():
+    """The process' pooled session, created on first use (after a worker forks)."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=AZURE_ARM_POOL_SIZE))
+            _session = session
+    return _session
+
+
+def timed_request(method, url, **kwargs):
+    """Send a request over the shared session, recording its latency."""
+    started, status = time.monotonic(), 0
+    try:
+        response = shared_session().request(method, url, **kwargs)
+        status = response.status_code
+        return response
+    finally:
+        ENDPOINT_LATENCY.record(method, url, time.monotonic() - started, status)
+
+
+def get_token(tenant_id, client_id, client_secret, scope=ARM_SCOPE):
+    """
+    Return a client-credentials token for `scope`, from the process cache while it is valid
+    for more than AZURE_TOKEN_REFRESH_MARGIN seconds. Raises when Azure AD refuses it.
+    """
+    key = (tenant_id, client_id, client_secret, scope)
+    with _token_lock:
+        cached = _tokens.get(key)
+        if cached and cached[1] - AZURE_TOKEN_REFRESH_MARGIN > time.time():
+            return cached[0]
+
+        response = timed_request(
+            "POST", f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token",
+            data={
+                "client_id": client_id,
+                "client_secret": client_secret,
+                "scope": scope,
+                "grant_type": "client_credentials",
+            },
+            timeout=30,
+        )
+        response.raise_for_status()
+        body = response.json()
+        token = body.get("access_token")
+        if not token:
+            raise RuntimeError("No access token received from Azure")
+        _tokens[key] = (token, time.time() + int(body.get("expires_in", 3599)))
+        return token
+
+
+class ArmClient:
+    """Authenticated requests of one service principal over the shared session."""
+
+    def __init__(self, tenant_id, client_id, client_secret, scope=ARM_SCOPE):
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.scope = scope
+        self.paused_until = 0.0
+
+    def headers(self):
+        """Authorization headers with a valid token, e.g. for an aiohttp session."""
+        return {
+            "Authorization": f"Bearer {get_token(self.tenant_id, self.client_id, self.client_secret, self.scope)}",
+            "Content-Type": "application/json",
+        }
+
+    def _observe(self, response):
+        """Pause before the next request while the remaining ARM quota is low."""
+        remaining = [
+            int(value) for name, value in response.headers.items()
+            if name.lower().startswith(RATELIMIT_HEADER_PREFIX) and value.isdigit()
+        ]
+        if remaining and min(remaining) < AZURE_RATELIMIT_LOW_WATERMARK:
+            pause = (AZURE_RATELIMIT_LOW_WATERMARK - min(remaining)) / AZURE_RATELIMIT_LOW_WATERMARK
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+
+    def request(self, method, url, params=None, json=None, timeout=ARM_TIMEOUT):
+        """
+        Send a request and return its response.
+
+        `url` may be a path below management.azure.com. Throttled and transient failures are
+        retried up to AZURE_METRICS_MAX_ATTEMPTS times; the last response is returned as is,
+        so callers check the status (e.g. with `raise_for_status`).
+        """
+        if url.startswith("/"):
+            url = ARM_URL + url
+        for attempt in range(AZURE_METRICS_MAX_ATTEMPTS):
+            last_attempt = attempt == AZURE_METRICS_MAX_ATTEMPTS - 1
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                response = timed_request(method, url, params=params, json=json, headers=self.headers(),
+                                         timeout=timeout)
+            except requests.RequestException as ex:
+                if method not in IDEMPOTENT_METHODS or last_attempt:
+                    raise
+                print(f"⚠️ {method} {url.split('?')[0]} attempt {attempt + 1} failed: {ex}")
+                time.sleep(_backoff(attempt))
+                continue
+
+            self._observe(response)
+            throttled = response.status_code == 429
+            transient = response.status_code in RETRY_STATUSES and method in IDEMPOTENT_METHODS
+            if not (throttled or transient) or last_attempt:
+                return response
+            delay = _retry_after(response.headers) if throttled else _backoff(attempt)
+            print(f"⚠️ {method} {url.split('?')[0]} returned {response.status_code}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+    def get(self, url, params=None, **kwargs):
+        return self.request("GET", url, params=params, **kwargs)
+
+    def post(self, url, json=None, **kwargs):
+        return self.request("POST", url, json=json, **kwargs)
+
+    def put(self, url, json=None, **kwargs):
+        return self.request("PUT", url, json=json, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def get_json(self, url, params=None):
+        response = self.get(url, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    def paged(self, url, params=None):
+        """Yield the items of a list operation, following `nextLink` across pages."""
+        while url:
+            body = self.get_json(url, params=params)
+            yield from body.get("value", [])
+            # nextLink already carries the query, including the api-version
+            url, params = body.get("nextLink"), None
+
+    def list_all(self, url, params=None):
+        return list(self.paged(url, params=params))
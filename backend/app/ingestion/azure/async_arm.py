@@ -0,0 +1,225 @@
+"""
+Async requests against Azure Resource Manager and Azure Monitor with adaptive throttling.
+
+Collectors share one aiohttp session and one `AdaptiveThrottle` per subscription. The
+throttle bounds the requests in flight and adjusts that bound from the
+`x-ms-ratelimit-remaining-*` headers of every response: it backs off as the remaining
+quota runs low and grows again while there is headroom. A 429 halves the bound and
+pauses every request of the subscription for the `Retry-After` the service asked for.
+Only reads are sent, so throttled, failed and timed-out requests are retried.
+
+Usage:
+    throttle = AdaptiveThrottle()
+    stats = RequestStats()
+    async with aiohttp.ClientSession(headers=headers, timeout=ARM_REQUEST_TIMEOUT) as session:
+        data = await get_json(session, url, throttle, stats)
+    stats.report('VM metrics')
+
+Every request is also timed into ENDPOINT_LATENCY, shared with the synchronous client in
+arm_client.py, so a run can report its latency per endpoint.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+import aiohttp
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Upper bound on requests in flight per subscription
+AZURE_METRICS_CONCURRENCY = int(os.getenv("AZURE_METRICS_CONCURRENCY", "8"))
+# Attempts per request before it is reported as failed
+AZURE_METRICS_MAX_ATTEMPTS = int(os.getenv("AZURE_METRICS_MAX_ATTEMPTS", "5"))
+# Remaining quota below which the throttle starts backing off
+AZURE_RATELIMIT_LOW_WATERMARK = int(os.getenv("AZURE_RATELIMIT_LOW_WATERMARK", "100"))
+
+ARM_REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=60)
+RATELIMIT_HEADER_PREFIX = "x-ms-ratelimit-remaining-"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+DEFAULT_RETRY_AFTER = 10
+
+
+class AdaptiveThrottle:
+    """Concurrency bound for one subscription, adjusted from the service's rate-limit headers."""
+
+    def __init__(self, max_concurrency=AZURE_METRICS_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def observe(self, status, headers):
+        """Adjust the bound after a response."""
+        if status == 429:
+            self.limit = max(1, self.limit // 2)
+            self.pause(_retry_after(headers))
+            return
+
+        remaining = [
+            int(value) for name, value in headers.items()
+            if name.lower().startswith(RATELIMIT_HEADER_PREFIX) and value.isdigit()
+        ]
+        if not remaining:
+            return
+        lowest = min(remaining)
+        if lowest < AZURE_RATELIMIT_LOW_WATERMARK:
+            # Spread what is left of the quota instead of spending it in one burst
+            self.limit = max(1, self.limit // 2)
+            self.pause((AZURE_RATELIMIT_LOW_WATERMARK - lowest) / AZURE_RATELIMIT_LOW_WATERMARK)
+        elif self.limit < self.max_concurrency:
+            self.limit += 1
+
+
+class RequestStats:
+    """Throughput counters for one collection run."""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failed = 0
+        self.datapoints = 0
+
+    def report(self, label):
+        elapsed = max(time.monotonic() - self.started_at, 1e-6)
+        print(f"📈 {label}: {self.requests} requests ({self.requests / elapsed:.1f}/s), "
+              f"{self.retries} retries, {self.throttled} throttled, {self.failed} failed, "
+              f"{self.datapoints} datapoints ({self.datapoints / elapsed:.0f}/s) in {elapsed:.1f}s")
+
+
+def endpoint_label(method, url):
+    """
+    Name requests to one endpoint alike, e.g. 'GET management.azure.com microsoft.insights/metrics'
+    for the metrics of any resource.
+    """
+    parts = urlsplit(url)
+    segments = [segment for segment in parts.path.split("/") if segment]
+    lowered = [segment.lower() for segment in segments]
+    if "providers" in lowered:
+        # Provider namespace followed by alternating type / name segments; names are dropped
+        provider = len(lowered) - 1 - lowered[::-1].index("providers")
+        segments = segments[provider + 1:]
+        path = "/".join(segments[:1] + segments[1::2])
+    else:
+        path = segments[-1] if segments else ""
+    return f"{method} {parts.netloc} {path}"
+
+
+class EndpointLatency:
+    """Request latency per endpoint, for every client of the process."""
+
+    def __init__(self, samples=1000):
+        self.samples = samples
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, method, url, seconds, status):
+        label = endpoint_label(method, url)
+        with self._lock:
+            entry = self.endpoints.setdefault(label, {"count": 0, "errors": 0, "total": 0.0,
+                                                      "recent": deque(maxlen=self.samples)})
+            entry["count"] += 1
+            entry["total"] += seconds
+            entry["recent"].append(seconds)
+            if status >= 400 or status == 0:
+                entry["errors"] += 1
+
+    def report(self, label):
+        with self._lock:
+            endpoints = sorted(self.endpoints.items(), key=lambda item: item[1]["total"], reverse=True)
+            lines = []
+            for endpoint, entry in endpoints:
+                recent = sorted(entry["recent"])
+                p50 = recent[len(recent) // 2]
+                p95 = recent[min(len(recent) - 1, int(len(recent) * 0.95))]
+                lines.append(f"   {endpoint}: {entry['count']} requests, {entry['errors']} errors, "
+                             f"mean {entry['total'] / entry['count'] * 1000:.0f}ms, "
+                             f"p50 {p50 * 1000:.0f}ms, p95 {p95 * 1000:.0f}ms")
+        print(f"⏱️ {label}: latency per endpoint")
+        for line in lines:
+            print(line)
+
+
+# Latency of every Azure request sent by this process
+ENDPOINT_LATENCY = EndpointLatency()
+
+
+def _retry_after(headers):
+    try:
+        return float(headers.get("Retry-After", DEFAULT_RETRY_AFTER))
+    except ValueError:
+        return DEFAULT_RETRY_AFTER
+
+
+def _backoff(attempt):
+    return min(60, 2 ** attempt) * (0.5 + random.random() / 2)
+
+
+async def request_json(session, method, url, throttle, stats, params=None, json=None, headers=None):
+    """
+    Send a read request and return its JSON body, or None once every attempt failed.
+
+    Only use this for idempotent requests: GETs and query POSTs such as metrics:getBatch.
+    Throttled (429) and transient (5xx, connection, timeout) failures are retried up to
+    AZURE_METRICS_MAX_ATTEMPTS times: after a 429 for its Retry-After, otherwise with
+    jittered exponential backoff. Other statuses are not retried.
+    """
+    for attempt in range(AZURE_METRICS_MAX_ATTEMPTS):
+        if attempt:
+            stats.retries += 1
+        await throttle.acquire()
+        started, status = time.monotonic(), 0
+        try:
+            stats.requests += 1
+            async with session.request(method, url, params=params, json=json, headers=headers) as response:
+                status = response.status
+                throttle.observe(response.status, response.headers)
+                if response.status == 200:
+                    return await response.json()
+                if response.status not in RETRY_STATUSES:
+                    print(f"❌ {method} {url.split('?')[0]} failed: {response.status}")
+                    stats.failed += 1
+                    return None
+                if response.status == 429:
+                    stats.throttled += 1
+                    delay = _retry_after(response.headers)
+                else:
+                    delay = _backoff(attempt)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            print(f"⚠️ {method} {url.split('?')[0]} attempt {attempt + 1} failed: {ex}")
+            delay = _backoff(attempt)
+        finally:
+            ENDPOINT_LATENCY.record(method, url, time.monotonic() - started, status)
+            await throttle.release()
+        await asyncio.sleep(delay)
+
+    print(f"❌ {method} {url.split('?')[0]} gave up after {AZURE_METRICS_MAX_ATTEMPTS} attempts")
+    stats.failed += 1
+    return None
+
+
+async def get_json(session, url, throttle, stats, params=None, headers=None):
+    """GET `url` with retries; see `request_json`."""
+    return await request_json(session, "GET", url, throttle, stats, params=params, headers=headers)
@@ -1,89 +1,26 @@
 import time
 
-import requests, datetime, json, os
+import datetime, json, os
 from dotenv import load_dotenv
 from azure.identity import ClientSecretCredential
 from azure.storage.blob import BlobServiceClient
 from azure.mgmt.resource import ResourceManagementClient
+from app.ingestion.azure.arm_client import ArmClient
 
 
 def print_object(obj):
     print(json.dumps(obj, indent=4))
 
 
-class AutoAuthRequests():
-    def __init__(self, azure_tenant_id, azure_client_id, azure_client_secret):
-        self.azure_tenant_id = azure_tenant_id
-        self.azure_client_id = azure_client_id
-        self.azure_client_secret = azure_client_secret
-        self.expires_in = datetime.datetime.now().timestamp() * 1000 - 1
-        self.access_token, self.expires_in = self.get_access_token()
-
-    def get_access_token(self):
-        url = f'https://login.microsoftonline.com/{self.azure_tenant_id}/oauth2/v2.0/token'
-        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-        data = {
-            'client_id': self.azure_client_id,
-            'scope': 'https://management.azure.com/.default',
-            'client_secret': self.azure_client_secret,
-            'grant_type': 'client_credentials'
-        }
-        response = requests.post(url, headers=headers, data=data)
-        access_token = response.json()['access_token']
-        expires_in = response.json()['expires_in']
-        return access_token, expires_in
-
-    def get(self, *args, **kwargs):
-        if self.expires_in < datetime.datetime.now().timestamp() * 1000:
-            self.access_token, self.expires_in = self.get_access_token()
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.access_token}'
-        }
-        kwargs['headers'] = headers
-        return requests.get(*args, **kwargs)
-
-    def post(self, *args, **kwargs):
-        if self.expires_in < datetime.datetime.now().timestamp() * 1000:
-            self.access_token, self.expires_in = self.get_access_token()
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.access_token}'
-        }
-        kwargs['headers'] = headers
-        return requests.post(*args, **kwargs)
-
-    def put(self, *args, **kwargs):
-        if self.expires_in < datetime.datetime.now().timestamp() * 1000:
-            self.access_token, self.expires_in = self.get_access_token()
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.access_token}'
-        }
-        kwargs['headers'] = headers
-        return requests.put(*args, **kwargs)
-
-    def delete(self, *args, **kwargs):
-        if self.expires_in < datetime.datetime.now().timestamp() * 1000:
-            self.access_token, self.expires_in = self.get_access_token()
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.access_token}'
-        }
-        kwargs['headers'] = headers
-        return requests.delete(*args, **kwargs)
-
-
 class AzFunctions():
     def __init__(self, azure_tenant_id, azure_client_id, azure_client_secret):
-        self.requests = AutoAuthRequests(azure_tenant_id, azure_client_id, azure_client_secret)
+        # Shared ARM client: cached token, pooled connections and retries on throttling
+        self.requests = ArmClient(azure_tenant_id, azure_client_id, azure_client_secret)
         self.credential = ClientSecretCredential(azure_tenant_id, azure_client_id, azure_client_secret)
 
     def list_exports(self, subscription_id):
         url = f'https://management.azure.com/subscriptions/{subscription_id}/providers/Microsoft.CostManagement/exports?api-version=2023-11-01'
-        response = self.requests.get(url)
-        response.raise_for_status()
-        return response.json()['value']
+        return self.requests.list_all(url)
 
     def register_cost_management_export(self, provider_namespace, subscription_id):
         resource_client = ResourceManagementClient(self.credential, subscription_id)
@@ -1,15 +1,345 @@
 from azure.identity import ClientSecretCredential
+from azure.identity.aio import ClientSecretCredential as AsyncClientSecretCredential
 from azure.storage.blob import BlobServiceClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import asyncio
+import io
+import json
+import os
+import posixpath
+import queue
+import re
+import threading
 import pandas as pd
-from io import StringIO
+from app.ingestion.focus_schema import csv_dtypes
+from app.ingestion.partitions import month_start
+from app.ingestion import run_ledger
 
 load_dotenv()
 
+# Export blobs downloaded at the same time
+AZURE_BLOB_DOWNLOAD_CONCURRENCY = int(os.getenv("AZURE_BLOB_DOWNLOAD_CONCURRENCY", "4"))
+# Bytes of downloaded chunks and parsed batches held in memory at once
+AZURE_BLOB_MEMORY_BUDGET_MB = int(os.getenv("AZURE_BLOB_MEMORY_BUDGET_MB", "512"))
+# Rows per parsed batch handed to the loader
+AZURE_BLOB_BATCH_ROWS = int(os.getenv("AZURE_BLOB_BATCH_ROWS", "50000"))
 
-def get_df_from_blob(tenant_id, client_id, client_secret, storage_account_name, container_name):
+MANIFEST_NAME = "manifest.json"
+# Cost Management writes each export into a folder named after its date range, e.g. 20240901-20240930
+DATE_RANGE_PATTERN = re.compile(r"(?:^|/)(\d{8})-(\d{8})(?=/|$)")
+
+
+class ExportRun:
+    """
+    One delivery of a cost export: the CSV blobs written together for a date range.
+
+    `period_key` names what the run covers (export folder and date range). The newest run
+    of a period supersedes every earlier one, which only held a partial or outdated copy
+    of the same rows.
+    """
+
+    def __init__(self, period_key, run_id, submitted_at, blobs, months=None):
+        self.period_key = period_key
+        self.run_id = run_id
+        self.submitted_at = submitted_at
+        self.blobs = blobs
+        # Billing months covered by the run, or None when the layout does not say
+        self.months = months
+        self.rows_loaded = {}
+
+    def etags(self):
+        return {blob.name: blob.etag for blob in self.blobs}
+
+
+def _is_data_blob(name):
+    return name.endswith('.csv') or name.endswith('.csv.gz')
+
+
+def _months_between(start, end):
+    """Return the month starts from `start` to `end` inclusive."""
+    months, current, last = set(), month_start(start), month_start(end)
+    while current <= last:
+        months.add(current)
+        current = month_start(current.replace(day=28) + pd.Timedelta(days=4))
+    return months
+
+
+def _date_range_folder(name):
+    """Return (folder path, months) for the date range folder in a blob path, or (None, None)."""
+    match = None
+    for match in DATE_RANGE_PATTERN.finditer(name):
+        pass
+    if match is None:
+        return None, None
+    try:
+        months = _months_between(pd.Timestamp(match.group(1)), pd.Timestamp(match.group(2)))
+    except ValueError:
+        return None, None
+    return name[:match.end()], months
+
+
+def _manifest_run(container_client, manifest, blobs_by_name):
+    """Build the run described by an export manifest, or None if it lists no CSV blobs."""
+    content = json.loads(container_client.get_blob_client(manifest.name).download_blob().readall())
+    run_info = content.get('runInfo', {})
+    names = []
+    for entry in content.get('blobs', []):
+        name = entry.get('blobName', '')
+        # Manifests may carry the container name as the first path segment
+        if name not in blobs_by_name and '/' in name:
+            name = name.split('/', 1)[1]
+        if name in blobs_by_name and _is_data_blob(name):
+            names.append(name)
+    if not names:
+        return None
+
+    folder, months = _date_range_folder(manifest.name)
+    if run_info.get('startDate') and run_info.get('endDate'):
+        months = _months_between(pd.Timestamp(run_info['startDate']), pd.Timestamp(run_info['endDate']))
+    # Without a date range folder the runId folder is the innermost directory
+    period_key = folder or posixpath.dirname(posixpath.dirname(manifest.name))
+    submitted_at = pd.Timestamp(run_info.get('submittedTime') or manifest.last_modified)
+    if submitted_at.tzinfo is None:
+        submitted_at = submitted_at.tz_localize('UTC')
+    return ExportRun(period_key, run_info.get('runId'), submitted_at,
+                     [blobs_by_name[name] for name in names], months)
+
+
+def list_export_runs(container_client):
+    """
+    Group the CSV blobs of an export container into runs and keep the newest run per period.
+
+    Blobs listed in a `manifest.json` belong to that manifest's run. Other blobs inside a
+    date range folder are single-file runs of that folder. Blobs outside any date range
+    folder are each their own period, so containers filled by hand load as before.
+
+    Returns:
+        list[ExportRun]: The current run of every period.
+    """
+    blobs_by_name = {blob.name: blob for blob in container_client.list_blobs()}
+
+    runs, claimed = [], set()
+    for blob in blobs_by_name.values():
+        if posixpath.basename(blob.name) != MANIFEST_NAME:
+            continue
+        try:
+            run = _manifest_run(container_client, blob, blobs_by_name)
+        except ValueError as ex:
+            print(f"Skipping unreadable manifest {blob.name}: {ex}")
+            continue
+        if run is not None:
+            runs.append(run)
+            claimed.update(run.etags())
+
+    for blob in blobs_by_name.values():
+        if blob.name in claimed or not _is_data_blob(blob.name):
+            continue
+        folder, months = _date_range_folder(blob.name)
+        submitted_at = pd.Timestamp(blob.last_modified)
+        runs.append(ExportRun(folder or blob.name, None, submitted_at, [blob], months))
+
+    latest = {}
+    for run in runs:
+        current = latest.get(run.period_key)
+        if current is None or run.submitted_at > current.submitted_at:
+            latest[run.period_key] = run
+    superseded = len(runs) - len(latest)
+    if superseded:
+        print(f"Ignoring {superseded} export runs superseded by a newer run of the same period.")
+    return list(latest.values())
+
+
+def select_runs_to_load(runs, ledger):
+    """
+    Pick the runs whose rows have to be downloaded.
+
+    A run is changed when the ledger holds a different set of blobs or ETags for its
+    period. Bronze replaces whole billing months, so every other run covering a month of
+    a changed run is loaded with it. If a changed run's months are unknown, everything
+    is loaded.
+
+    Args:
+        runs (list[ExportRun]): Current run of every period.
+        ledger (dict | None): {period_key: {blob_name: etag}} of the loaded blobs.
+            None loads every run.
+
+    Returns:
+        list[ExportRun]
+    """
+    if ledger is None:
+        return runs
+    changed = [run for run in runs if ledger.get(run.period_key) != run.etags()]
+    if not changed:
+        return []
+    if any(run.months is None for run in changed):
+        return runs
+
+    months = set().union(*(run.months for run in changed))
+    return [run for run in runs
+            if run in changed or run.months is None or run.months & months]
+
+
+class BlobDownloadAborted(Exception):
+    """Raised in download and parser threads once the load has been abandoned."""
+
+
+class MemoryBudget:
     """
-    Combines all CSV files in the specified Azure Blob Storage container into a single DataFrame.
+    Byte budget shared by every download of a load.
+
+    Downloads wait for room before fetching their next chunk. Parsed batches are
+    reserved without waiting, since they already exist, and so hold the downloads back
+    until the loader has consumed them.
+    """
+
+    def __init__(self, limit_bytes):
+        self.limit = limit_bytes
+        self.used = 0
+        self.aborted = False
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        # A chunk larger than the whole budget waits until nothing else is held
+        size = min(size, self.limit)
+        with self._condition:
+            self._condition.wait_for(lambda: self.aborted or self.used + size <= self.limit)
+            if self.aborted:
+                raise BlobDownloadAborted()
+            self.used += size
+        return size
+
+    def reserve(self, size):
+        with self._condition:
+            self.used += size
+
+    def release(self, size):
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+    def abort(self):
+        with self._condition:
+            self.aborted = True
+            self._condition.notify_all()
+
+
+class _BlobPipe(io.RawIOBase):
+    """Readable stream over the chunks of one download; budget is released as they are read."""
+
+    def __init__(self, budget):
+        super().__init__()
+        self._budget = budget
+        self._chunks = queue.Queue()
+        self._buffer = b""
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def feed(self, chunk, reserved):
+        self._chunks.put((chunk, reserved))
+
+    def finish(self, error=None):
+        self._chunks.put((None, error))
+
+    def readinto(self, buffer):
+        while not self._buffer:
+            if self._eof:
+                return 0
+            chunk, extra = self._chunks.get()
+            if chunk is None:
+                self._eof = True
+                if extra is not None:
+                    raise extra
+                return 0
+            self._budget.release(extra)
+            self._buffer = chunk
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def _normalize_tags(df):
+    # If the 'Tags' column is empty, its data type changes to double precision,
+    # so we need to convert it to string to ensure consistent processing.
+    if 'Tags' in df.columns:
+        if df['Tags'].dtype != 'object':  # Not text
+            df['Tags'] = df['Tags'].astype(str)  # Convert to string
+
+        # Replace NaN with empty JSON object and ensure proper formatting
+        df['Tags'] = df['Tags'].fillna('{}').astype(str)
+        df['Tags'] = df['Tags'].replace('nan', '{}')
+
+        # Validate and correct improper JSON formats (e.g., replacing single quotes with double quotes)
+        df['Tags'] = df['Tags'].apply(lambda x: x if x == '{}' else x.replace("'", '"'))
+    return df
+
+
+def _parse_blob(pipe, run, blob, emit):
+    """Parse a blob's CSV from its pipe in batches, handing each batch to `emit`."""
+    compression = 'gzip' if blob.name.endswith('.gz') else None
+    # Numeric columns are parsed by the reader; the rest stay text for coerce_dataframe
+    with pd.read_csv(io.BufferedReader(pipe), dtype=csv_dtypes('azure_focus'),
+                     chunksize=AZURE_BLOB_BATCH_ROWS, compression=compression) as reader:
+        for batch in reader:
+            run.rows_loaded[blob.name] = run.rows_loaded.get(blob.name, 0) + len(batch)
+            emit(_normalize_tags(batch))
+
+
+async def _download_blob(container_client, blob, pipe, budget):
+    error = None
+    try:
+        downloader = await container_client.download_blob(blob.name)
+        async for chunk in downloader.chunks():
+            # The chunk is already here; the budget decides whether the next one is fetched
+            reserved = await asyncio.to_thread(budget.acquire, len(chunk))
+            run_ledger.add("bytes_read", len(chunk))
+            pipe.feed(chunk, reserved)
+    except BaseException as ex:
+        error = ex if isinstance(ex, Exception) else BlobDownloadAborted()
+        raise
+    finally:
+        pipe.finish(error)
+
+
+async def _load_blob(container_client, run, blob, budget, semaphore, emit):
+    async with semaphore:
+        pipe = _BlobPipe(budget)
+        download = asyncio.ensure_future(_download_blob(container_client, blob, pipe, budget))
+        parse = asyncio.ensure_future(asyncio.to_thread(_parse_blob, pipe, run, blob, emit))
+        try:
+            await asyncio.gather(download, parse)
+        except BaseException:
+            # One failed blob fails the load: months must not be replaced from partial data
+            budget.abort()
+            await asyncio.gather(download, parse, return_exceptions=True)
+            raise
+        print(f"Loaded {run.rows_loaded.get(blob.name, 0)} rows from {blob.name}.")
+
+
+async def _download_runs(tenant_id, client_id, client_secret, storage_account_name, container_name,
+                         runs, budget, emit):
+    # Every active blob holds a parser thread and may wait on the budget in another
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=2 * AZURE_BLOB_DOWNLOAD_CONCURRENCY + 1))
+    semaphore = asyncio.Semaphore(AZURE_BLOB_DOWNLOAD_CONCURRENCY)
+    credential = AsyncClientSecretCredential(tenant_id, client_id, client_secret)
+    async with credential, AsyncBlobServiceClient(
+            account_url=f"https://{storage_account_name}.blob.core.windows.net",
+            credential=credential) as blob_service_client:
+        container_client = blob_service_client.get_container_client(container_name)
+        await asyncio.gather(*(
+            _load_blob(container_client, run, blob, budget, semaphore, emit)
+            for run in runs for blob in run.blobs
+        ))
+
+
+def get_export_runs_to_load(tenant_id, client_id, client_secret, storage_account_name, container_name, ledger=None):
+    """
+    List the export runs in the specified Azure Blob Storage container whose rows have to be loaded.
 
     Args:
         tenant_id (str): The Azure Active Directory tenant ID.
@@ -17,9 +347,11 @@ def get_df_from_blob(tenant_id, client_id, client_secret, storage_account_name,
         client_secret (str): The Azure Active Directory client secret.
         storage_account_name (str): The name of the Azure Storage account.
         container_name (str): The name of the container within the storage account.
+        ledger (dict, optional): {period_key: {blob_name: etag}} of the blobs already in
+            bronze. When omitted every current export run is loaded.
 
     Returns:
-        pd.DataFrame: A DataFrame containing the combined data from all CSV files in the container.
+        list[ExportRun]
     """
     # Authenticate using the ClientSecretCredential
     credential = ClientSecretCredential(tenant_id, client_id, client_secret)
@@ -29,38 +361,76 @@ def get_df_from_blob(tenant_id, client_id, client_secret, storage_account_name,
                                             credential=credential)
     blob_container_client = blob_service_client.get_container_client(container_name)
 
-    # List all blobs in the container
-    blob_list = blob_container_client.list_blobs()
+    runs = list_export_runs(blob_container_client)
+    runs_to_load = select_runs_to_load(runs, ledger)
+    print(f"{len(runs_to_load)} of {len(runs)} export periods are new or changed.")
+    return runs_to_load
 
-    # Filter out only CSV files
-    csv_blobs = [blob for blob in blob_list if blob.name.endswith('.csv')]
 
-    # Initialize an empty list to hold the DataFrames
-    dataframes = []
+def iter_blob_batches(tenant_id, client_id, client_secret, storage_account_name, container_name, runs):
+    """
+    Download and parse the CSV blobs of `runs`, yielding DataFrame batches as they are parsed.
 
-    # Download each CSV file and read it into a DataFrame
-    for blob in csv_blobs:
-        blob_client = blob_container_client.get_blob_client(blob)
-        csv_content = blob_client.download_blob().readall().decode('utf-8')
-        df = pd.read_csv(StringIO(csv_content))
-        dataframes.append(df)
+    Blobs are downloaded concurrently on a background event loop and streamed into one
+    chunked parser each, so network and parsing overlap. Downloaded chunks and batches
+    not yet consumed count against AZURE_BLOB_MEMORY_BUDGET_MB; downloads pause while
+    it is used up, which keeps memory flat however large the export set is. Each run's
+    `rows_loaded` is filled in as its blobs are parsed.
 
-    # Combine all DataFrames into a single DataFrame
-    combined_dataframe = pd.concat(dataframes, ignore_index=True)
-    # If the 'Tags' column is empty, its data type changes to double precision,
-    # so we need to convert it to string to ensure consistent processing.
-    if 'Tags' in combined_dataframe.columns:
-        if combined_dataframe['Tags'].dtype != 'object':  # Not text
-            combined_dataframe['Tags'] = combined_dataframe['Tags'].astype(str)  # Convert to string
+    A failed download or parse raises here, and stopping early cancels the downloads.
 
-        # Replace NaN with empty JSON object and ensure proper formatting
-        combined_dataframe['Tags'] = combined_dataframe['Tags'].fillna('{}').astype(str)
-        combined_dataframe['Tags'] = combined_dataframe['Tags'].replace('nan', '{}')
+    Yields:
+        pd.DataFrame: Up to AZURE_BLOB_BATCH_ROWS rows of one blob, numeric columns as float64
+            and the rest as text.
+    """
+    budget = MemoryBudget(AZURE_BLOB_MEMORY_BUDGET_MB * 1024 * 1024)
+    batches = queue.Queue(maxsize=AZURE_BLOB_DOWNLOAD_CONCURRENCY)
+    finished = object()
 
-        # Validate and correct improper JSON formats (e.g., replacing single quotes with double quotes)
-        combined_dataframe['Tags'] = combined_dataframe['Tags'].apply(lambda x: x if x == '{}' else x.replace("'", '"'))
-    
-    print("Data type of 'Tags' column:", combined_dataframe['Tags'].dtypes)
+    def put(item):
+        while not budget.aborted:
+            try:
+                batches.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+        raise BlobDownloadAborted()
+
+    def emit(batch):
+        size = int(batch.memory_usage(deep=True).sum())
+        budget.reserve(size)
+        try:
+            put((batch, size))
+        except BlobDownloadAborted:
+            budget.release(size)
+            raise
 
+    def download():
+        error = None
+        try:
+            asyncio.run(_download_runs(tenant_id, client_id, client_secret, storage_account_name,
+                                       container_name, runs, budget, emit))
+        except BaseException as ex:
+            error = ex
+        try:
+            put((finished, error))
+        except BlobDownloadAborted:
+            pass
 
-    return combined_dataframe
+    thread = threading.Thread(target=download, name="azure-blob-download", daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch, size = batches.get()
+            if batch is finished:
+                if size is not None:
+                    raise size
+                return
+            try:
+                yield batch
+            finally:
+                budget.release(size)
+    finally:
+        # Unblocks the download thread when the caller stopped early
+        budget.abort()
+        thread.join()
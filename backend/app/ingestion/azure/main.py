@@ -1,13 +1,32 @@
 import hashlib
+import uuid
 import pandas as pd
-from .postgres_operation import dump_to_postgresql, run_sql_file,fetch_existing_hash_keys,create_hash_key
-from .blob import get_df_from_blob
+from .postgres_operation import run_sql_file, create_hash_key
+from .postgres_operation import create_partitioned_bronze_table, fetch_loaded_periods, replace_billing_periods
+from .postgres_operation import fetch_blob_ledger, record_loaded_blobs
+from app.ingestion.focus_schema import coerce_dataframe
+from app.ingestion.sql_runner import SqlPipeline
+from app.ingestion import run_ledger
+from .blob import get_export_runs_to_load, iter_blob_batches
 import psycopg2
-from .metrics_vm import metrics_dump
-from .metrics_storage_account import metrics_dump as storage_metrics_dump
+from .metrics_vm import metrics_dump, compact_vm_metrics
+from .metrics_storage_account import metrics_dump as storage_metrics_dump, compact_storage_metrics
 import json
 
 
+def prepare_batches(batches, load_batch_id):
+    """Cast each downloaded batch to the registered bronze types, then hash its rows."""
+    for batch in run_ledger.timed_iter(batches, "download"):
+        run_ledger.add("rows_read", len(batch))
+        # Keys are built from the typed values, so they do not depend on how a blob was split
+        with run_ledger.stage("parse"):
+            batch = coerce_dataframe(batch, 'azure_focus')
+        with run_ledger.stage("hash"):
+            batch = create_hash_key(batch)
+        batch['load_batch_id'] = load_batch_id
+        yield batch
+
+
 def azure_main(project_name,
                budget,
                tenant_id,
@@ -20,54 +39,66 @@ def azure_main(project_name,
     table_name = "bronze_azure_focus"
     schema_name = project_name.lower()
     print(f'Azure subscription id: {subscription_id}')
-    # Get the dataframe from the blob storage
-    df = get_df_from_blob(tenant_id, client_id, client_secret, storage_account_name, container_name)
-    print(f'df created')
-
-    # Create a hash key using all columns in the dataset
-    df = create_hash_key(df)
-    print(f'hash_key column added to dataframe')
-
     run_sql_file(f'{base_path}/sql/new_schema.sql', schema_name, budget)
     print(f'schema {schema_name} created')
-    run_sql_file(f'{base_path}/sql/create_table.sql', schema_name, budget)
-    print(f'Table {table_name} created')
-    run_sql_file(f'{base_path}/sql/bronze_metrics.sql', schema_name, budget)
+    create_partitioned_bronze_table('azure_focus', schema_name, table_name, 'BillingPeriodStart')
+    # Bronze DDL is versioned per schema and only applied when it changes
+    bronze_pipeline = SqlPipeline('azure_bronze', schema_name)
+    bronze_pipeline.add_migration('bronze_metrics', f'{base_path}/sql/bronze_metrics.sql')
+    bronze_pipeline.add_migration('bronze_storage_metrics', f'{base_path}/sql/bronze_storage_metrics.sql')
+    bronze_pipeline.add_migration('blob_ledger', f'{base_path}/sql/blob_ledger.sql')
+    bronze_pipeline.run_or_raise()
+    # Metrics tables still holding rows under the old keys are compacted before new rows land
+    compact_vm_metrics(schema_name, "bronze_azure_vm_metrics")
+    compact_storage_metrics(schema_name, "bronze_azure_storage_account_metrics")
     run_sql_file(f'{base_path}/sql/genai_response.sql', schema_name, budget)
 
+    # Only export runs that are new or changed since the last load are downloaded
+    ledger = fetch_blob_ledger(schema_name, container_name) or {}
+    runs_to_load = get_export_runs_to_load(tenant_id, client_id, client_secret, storage_account_name,
+                                           container_name, ledger=ledger)
+
+    # Exports restate the open month, so every month present in the blobs replaces its
+    # bronze partition unless its fingerprint shows it is unchanged
+    load_batch_id = uuid.uuid4().hex
+    replaced = True
+    if runs_to_load:
+        loaded_periods = fetch_loaded_periods(schema_name, table_name) or {}
+        batches = iter_blob_batches(tenant_id, client_id, client_secret, storage_account_name, container_name,
+                                    runs_to_load)
+        # Download, hash and parse time of the batches pulled by the load is booked separately
+        with run_ledger.stage("load"):
+            replaced = replace_billing_periods(prepare_batches(batches, load_batch_id), schema_name, table_name,
+                                               'BillingPeriodStart', loaded_periods, load_batch_id)
+        # A month that failed keeps its blobs out of the ledger, so the next run retries them
+        if replaced:
+            record_loaded_blobs(schema_name, container_name, runs_to_load)
 
-    # Check for existing hash keys in the PostgreSQL table
-    existing_hash_keys = fetch_existing_hash_keys(schema_name, table_name)
-    # print(f'Existing hash keys fetched: {len(existing_hash_keys)}')
-
-     # Filter out rows with hash keys that already exist in PostgreSQL
-    new_data = df[~df['hash_key'].isin(existing_hash_keys)]
-    print(f'Number of new records to insert: {len(new_data)}')
-
-    # If there is new data, dump it into PostgreSQL
-    if not new_data.empty:
-        dump_to_postgresql(new_data, schema_name, table_name)
-        print(f'New records appended to PostgreSQL')
-
-    # Run SQL files for silver and gold stages
-    run_sql_file(f'{base_path}/sql/silver.sql', schema_name, budget)
-    
     # Step 6: 🔁 Call dump_metrics() to fetch Azure VM metrics and dump
     metrics_dump(tenant_id, client_id, client_secret,subscription_id, schema_name,"bronze_azure_vm_metrics")
-    
-    run_sql_file(f'{base_path}/sql/silver_metrics.sql', schema_name, budget)
-    run_sql_file(f'{base_path}/sql/gold.sql', schema_name, budget)
+
+    # Silver and gold run as stages of one pipeline; an unfinished earlier run is completed first
+    focus_pipeline = SqlPipeline('azure_focus', schema_name, {'budget': budget, 'batch_id': load_batch_id})
+    focus_pipeline.add_stage('silver', f'{base_path}/sql/silver.sql')
+    focus_pipeline.add_stage('silver_metrics', f'{base_path}/sql/silver_metrics.sql')
+    focus_pipeline.add_stage('gold', f'{base_path}/sql/gold.sql', depends_on=['silver', 'silver_metrics'])
+    focus_pipeline.add_migration('gold_views', f'{base_path}/sql/gold_views.sql', depends_on=['gold'])
+    focus_pipeline.run_or_raise(resume=True)
 
     # run_llm_vm(schema_name)
     print(f"LLM response generated")
 
-    run_sql_file(f'{base_path}/sql/bronze_storage_metrics.sql', schema_name, budget)
     storage_metrics_dump(tenant_id, client_id, client_secret, subscription_id,
                         schema_name, "bronze_azure_storage_account_metrics")
     
-    run_sql_file(f'{base_path}/sql/silver_storage_metrics.sql', schema_name, budget)
-
-    run_sql_file(f'{base_path}/sql/gold_storage_metrics.sql', schema_name, budget)
+    storage_pipeline = SqlPipeline('azure_storage_metrics', schema_name, {'budget': budget})
+    storage_pipeline.add_stage('silver', f'{base_path}/sql/silver_storage_metrics.sql')
+    storage_pipeline.add_stage('gold', f'{base_path}/sql/gold_storage_metrics.sql', depends_on=['silver'])
+    storage_pipeline.run_or_raise(resume=True)
+
+    # Months that were replaced are refreshed above; the run still fails so it is retried
+    if not replaced:
+        raise RuntimeError(f"Billing months of {schema_name}.{table_name} failed to load")
 
 
 # used to test in local---
@@ -0,0 +1,95 @@
+"""
+Persistent cache of Azure Monitor metric definitions.
+
+Resources of one type in one region expose the same metric definitions, so the collectors
+discover them once per (resource type, region, namespace) instead of per resource. The
+definitions are kept in the project schema's `metric_definitions` table for
+AZURE_METRIC_DEFINITIONS_TTL_HOURS, shared by every worker and run: a run loads the fresh
+entries with one query, calls `metricDefinitions` only for the keys that are missing or
+expired, and stores what it fetched when it ends. Failed discoveries are not stored.
+
+The cursor helpers leave commits to the caller; postgres_operation.py wraps them with its
+`@connection` decorator.
+"""
+import asyncio
+import os
+from datetime import timedelta
+from psycopg2 import sql
+from psycopg2.extras import execute_values, Json
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DEFINITIONS_TABLE = "metric_definitions"
+# Age after which stored definitions are discovered again
+AZURE_METRIC_DEFINITIONS_TTL_HOURS = int(os.getenv("AZURE_METRIC_DEFINITIONS_TTL_HOURS", "168"))
+
+
+def ensure_definitions_table(cursor, schema_name):
+    cursor.execute(sql.SQL(
+        "CREATE TABLE IF NOT EXISTS {}.{} ("
+        "resource_type text NOT NULL, "
+        "region text NOT NULL, "
+        "namespace text NOT NULL, "
+        "definitions jsonb NOT NULL, "
+        "fetched_at timestamp NOT NULL DEFAULT now(), "
+        "PRIMARY KEY (resource_type, region, namespace))"
+    ).format(sql.Identifier(schema_name), sql.Identifier(DEFINITIONS_TABLE)))
+
+
+def fetch_definitions(cursor, schema_name, ttl=timedelta(hours=AZURE_METRIC_DEFINITIONS_TTL_HOURS)):
+    """Return {(resource_type, region, namespace): definitions} of the entries younger than `ttl`."""
+    ensure_definitions_table(cursor, schema_name)
+    cursor.execute(sql.SQL(
+        "SELECT resource_type, region, namespace, definitions FROM {}.{} WHERE fetched_at > now() - %s"
+    ).format(sql.Identifier(schema_name), sql.Identifier(DEFINITIONS_TABLE)), (ttl,))
+    return {(resource_type, region, namespace): definitions
+            for resource_type, region, namespace, definitions in cursor.fetchall()}
+
+
+def store_definitions(cursor, schema_name, definitions):
+    """Insert or refresh entries of {(resource_type, region, namespace): definitions}."""
+    ensure_definitions_table(cursor, schema_name)
+    records = [(resource_type, region, namespace, Json(defs))
+               for (resource_type, region, namespace), defs in definitions.items()]
+    execute_values(cursor, sql.SQL(
+        "INSERT INTO {}.{} (resource_type, region, namespace, definitions) VALUES %s "
+        "ON CONFLICT (resource_type, region, namespace) DO UPDATE "
+        "SET definitions = EXCLUDED.definitions, fetched_at = now()"
+    ).format(sql.Identifier(schema_name), sql.Identifier(DEFINITIONS_TABLE)).as_string(cursor), records)
+
+
+class MetricDefinitionCache:
+    """
+    Metric definitions of one run: the stored entries, plus those discovered during the run.
+
+    Args:
+        definitions (dict): Fresh entries loaded with `fetch_definitions`.
+    """
+
+    def __init__(self, definitions=None):
+        self.definitions = dict(definitions or {})
+        self.discovered = {}
+        self.hits = 0
+        self._pending = {}
+
+    async def get(self, key, discover):
+        """
+        Return the definitions of `key`, awaiting `discover()` (a metricDefinitions call on
+        one resource of the key) only when they are not cached. Concurrent callers of one
+        key share a single discovery.
+        """
+        if key in self.definitions:
+            self.hits += 1
+            return self.definitions[key]
+        if key not in self._pending:
+            self._pending[key] = asyncio.ensure_future(discover())
+        definitions = await self._pending[key]
+        if definitions:
+            self.definitions[key] = definitions
+            self.discovered[key] = definitions
+        return definitions or []
+
+    def summary(self, label):
+        print(f"📚 {label}: {self.hits} metric definition lookup(s) served from cache, "
+              f"{len(self.discovered)} discovered")
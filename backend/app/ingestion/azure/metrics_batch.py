@@ -0,0 +1,125 @@
+"""
+Multi-resource metric queries against the regional Azure Monitor `metrics:getBatch` API.
+
+The ARM metrics endpoint answers one resource per request and every request counts
+against the subscription's ARM read quota. `metrics:getBatch` is served by the regional
+metrics data plane (https://{region}.metrics.monitor.azure.com) and answers up to 50
+resources and 20 metric names of one namespace per request, so collectors group their
+resources by namespace and region and split each response back per resource. The data
+plane needs a token for the metrics.monitor.azure.com audience, not the ARM one.
+
+Resources whose batch request is rejected (region without the data plane, missing
+permission, unknown metric) are left out of the result, and the collector falls back to
+per-resource ARM calls for them.
+"""
+import asyncio
+import os
+from dotenv import load_dotenv
+from app.ingestion.azure.async_arm import request_json
+from app.ingestion.azure.arm_client import get_token
+
+load_dotenv()
+
+# Set to false to collect every metric through the per-resource ARM endpoint
+AZURE_METRICS_BATCH_ENABLED = os.getenv("AZURE_METRICS_BATCH_ENABLED", "true").lower() == "true"
+
+METRICS_BATCH_SCOPE = "https://metrics.monitor.azure.com/.default"
+METRICS_BATCH_API_VERSION = "2024-02-01"
+# Service limits of one getBatch request
+METRICS_BATCH_MAX_RESOURCES = 50
+METRICS_BATCH_MAX_METRICS = 20
+
+
+def get_metrics_batch_token(tenant_id, client_id, client_secret):
+    """Return a metrics data-plane token, or None when batch collection is disabled or unavailable."""
+    if not AZURE_METRICS_BATCH_ENABLED:
+        return None
+    try:
+        return get_token(tenant_id, client_id, client_secret, scope=METRICS_BATCH_SCOPE)
+    except Exception as e:
+        print(f"⚠️ No metrics data-plane token, collecting per resource: {e}")
+        return None
+
+
+def resource_namespace(resource_id):
+    """
+    Return the metric namespace of a resource ID, e.g.
+    '.../providers/Microsoft.Storage/storageAccounts/acc/blobServices/default'
+    -> 'Microsoft.Storage/storageAccounts/blobServices'.
+    """
+    parts = resource_id.strip("/").split("/")
+    lowered = [part.lower() for part in parts]
+    if "providers" not in lowered:
+        return ""
+    provider_parts = parts[lowered.index("providers") + 1:]
+    # Provider name followed by alternating type / name segments
+    return "/".join([provider_parts[0]] + provider_parts[1::2])
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+async def _get_batch(session, url, resource_ids, metric_names, params, headers, throttle, stats):
+    """Query every metric name for one chunk of resources; None if any request failed."""
+    payloads = {}
+    for names in _chunks(metric_names, METRICS_BATCH_MAX_METRICS):
+        data = await request_json(
+            session, "POST", url, throttle, stats,
+            params={**params, "metricnames": ",".join(names)},
+            json={"resourceids": resource_ids},
+            headers=headers,
+        )
+        if data is None:
+            return None
+        for entry in data.get("values", []):
+            resource_id = (entry.get("resourceid") or "").lower()
+            payload = payloads.setdefault(resource_id, {
+                "namespace": entry.get("namespace", ""),
+                "resourceregion": entry.get("resourceregion", ""),
+                "value": [],
+            })
+            payload["value"].extend(entry.get("value", []))
+    return payloads
+
+
+async def get_metrics_batch(session, subscription_id, region, namespace, resource_ids, metric_names, aggregations,
+                            timespan, interval, headers, throttle, stats, metric_filter=None):
+    """
+    Fetch metrics of many resources of one namespace and region.
+
+    Args:
+        resource_ids (list): Resources of `namespace` located in `region`.
+        aggregations (list): Aggregations to return for every metric, e.g. ['Average', 'Total'].
+        timespan (str): 'start/end' in ISO 8601, as used by the ARM endpoint.
+        headers (dict): Authorization header with a metrics data-plane token.
+
+    Returns:
+        dict: {lower-cased resource ID: payload shaped like an ARM metrics response} for
+        every resource that was answered. Resources of failed requests are missing.
+    """
+    start_time, end_time = timespan.split("/")
+    url = f"https://{region}.metrics.monitor.azure.com/subscriptions/{subscription_id}/metrics:getBatch"
+    params = {
+        "api-version": METRICS_BATCH_API_VERSION,
+        "metricnamespace": namespace,
+        "starttime": start_time,
+        "endtime": end_time,
+        "interval": interval,
+        "aggregation": ",".join(aggregations),
+    }
+    if metric_filter:
+        params["filter"] = metric_filter
+
+    results = await asyncio.gather(*(
+        _get_batch(session, url, chunk, metric_names, params, headers, throttle, stats)
+        for chunk in _chunks(resource_ids, METRICS_BATCH_MAX_RESOURCES)
+    ))
+    payloads = {}
+    for chunk, result in zip(_chunks(resource_ids, METRICS_BATCH_MAX_RESOURCES), results):
+        if result is None:
+            print(f"⚠️ metrics:getBatch failed for {len(chunk)} {namespace} resource(s) in {region}, "
+                  f"falling back to per-resource calls")
+            continue
+        payloads.update(result)
+    return payloads
@@ -1,19 +1,29 @@
 import os
 import sys
-import time
 import json
-import requests
+import asyncio
+import aiohttp
 import pandas as pd
 from datetime import datetime, timedelta
 from urllib.parse import quote_plus
 import psycopg2
 from psycopg2.extras import execute_values
-from app.ingestion.azure.postgres_operation import  dump_to_postgresql, fetch_existing_hash_keys
+from app.ingestion.azure.postgres_operation import upsert_metrics, compact_metrics
+from app.ingestion.azure.postgres_operation import fetch_metric_watermarks, detect_metric_gaps, advance_metric_watermarks
+from app.ingestion.azure.postgres_operation import fetch_metric_definitions, store_metric_definitions
+from app.ingestion.azure.metric_definitions import MetricDefinitionCache
+from app.ingestion.watermarks import CollectionWindow, utc_now
+from app.ingestion.metric_keys import add_metric_keys
+from app.ingestion.metrics_sink import MetricsSink
+from app.ingestion.azure.async_arm import AdaptiveThrottle, RequestStats, get_json, ARM_REQUEST_TIMEOUT, ENDPOINT_LATENCY
+from app.ingestion.azure.arm_client import ArmClient
+from app.ingestion.azure.metrics_batch import get_metrics_batch, get_metrics_batch_token, resource_namespace
 
 # ---------------- Config ----------------
 API_VERSION_LIST_STORAGE = "2023-01-01"
 API_VERSION_METRIC_DEFS = "2023-10-01"
 API_VERSION_METRICS = "2023-10-01"
+STORAGE_ACCOUNT_TYPE = "Microsoft.Storage/storageAccounts"
 
 DESIRED_METRICS = [
     "UsedCapacity",
@@ -55,54 +65,26 @@ SERVICE_RESOURCE_SUFFIX = {
 
 INTERVAL = os.getenv("INTERVAL", "PT1H")
 DAYS_BACK = int(os.getenv("DAYS_BACK", "90"))
-SLEEP_BETWEEN_CALLS = float(os.getenv("SLEEP_BETWEEN_CALLS", "0.35"))
+# A longer distance between two stored datapoints of a series is a gap
+INTERVAL_STEP = timedelta(hours=1)
+# Watermarks of this collector, and the bronze columns identifying a series
+STORAGE_COLLECTOR = "azure_storage_account"
+SERIES_COLUMNS = ("resource_id", "metric_name", "timestamp")
 BATCH_INSERT_SIZE = int(os.getenv("BATCH_INSERT_SIZE", "5000"))
 
 # ---------------- Helpers ----------------
-def get_access_token(tenant_id, client_id, client_secret):
-    token_url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
-    data = {
-        "client_id": client_id,
-        "client_secret": client_secret,
-        "scope": "https://management.azure.com/.default",
-        "grant_type": "client_credentials",
-    }
-    r = requests.post(token_url, data=data, timeout=30)
-    r.raise_for_status()
-    token = r.json().get("access_token")
-    if not token:
-        raise RuntimeError("No access token received from Azure")
-    return token
-
-def list_storage_accounts(subscription_id, headers):
-    url = (
-        f"https://management.azure.com/subscriptions/{subscription_id}/providers/Microsoft.Storage/storageAccounts"
-        f"?api-version={API_VERSION_LIST_STORAGE}"
-    )
-    r = requests.get(url, headers=headers, timeout=30)
-    r.raise_for_status()
-    return r.json().get("value", [])
-
-# metric definitions cache
-_METRIC_DEFS_CACHE = {}
-
-def get_metric_definitions(resource_id, headers):
-    if resource_id in _METRIC_DEFS_CACHE:
-        return _METRIC_DEFS_CACHE[resource_id]
-    url = f"https://management.azure.com{resource_id}/providers/microsoft.insights/metricDefinitions?api-version={API_VERSION_METRIC_DEFS}"
-    try:
-        r = requests.get(url, headers=headers, timeout=30)
-        if r.status_code != 200:
-            print(f"⚠️ metricDefinitions failed for {resource_id}: {r.status_code}")
-            _METRIC_DEFS_CACHE[resource_id] = []
-            return []
-        defs = r.json().get("value", [])
-        _METRIC_DEFS_CACHE[resource_id] = defs
-        return defs
-    except Exception as e:
-        print(f"⚠️ metricDefinitions exception for {resource_id}: {e}")
-        _METRIC_DEFS_CACHE[resource_id] = []
-        return []
+def list_storage_accounts(client, subscription_id):
+    return client.list_all(f"/subscriptions/{subscription_id}/providers/Microsoft.Storage/storageAccounts",
+                           params={"api-version": API_VERSION_LIST_STORAGE})
+
+async def get_metric_definitions(session, resource_id, throttle, stats):
+    """Return the metric definitions of a resource, or None when they could not be fetched."""
+    url = f"https://management.azure.com{resource_id}/providers/microsoft.insights/metricDefinitions"
+    data = await get_json(session, url, throttle, stats, params={"api-version": API_VERSION_METRIC_DEFS})
+    if data is None:
+        print(f"⚠️ metricDefinitions failed for {resource_id}")
+        return None
+    return data.get("value", [])
 
 def inspect_metric_definition(defs, metric_name):
     for m in defs:
@@ -133,6 +115,32 @@ def pick_aggregation(preferred, supported):
             return cand
     return supported[0]
 
+def service_filter(allowed_values):
+    chosen_val = None
+    if allowed_values:
+        for candidate in allowed_values:
+            if candidate and candidate.lower().startswith("blob"):
+                chosen_val = candidate
+                break
+        if not chosen_val:
+            chosen_val = allowed_values[0]
+    else:
+        chosen_val = "blobs"
+    return f"Service eq '{chosen_val}'"
+
+def plan_metric_queries(defs, metric_names):
+    """Return {metric name: (aggregation, filter or None)} for the metrics present in `defs`."""
+    queries = {}
+    for metric_name in metric_names:
+        meta = inspect_metric_definition(defs, metric_name)
+        if meta is None:
+            continue
+        preferred_agg = PREFERRED_AGG.get(metric_name, "Average")
+        agg_to_use = pick_aggregation(preferred_agg, meta.get("supported_aggs") or [])
+        metric_filter = service_filter(meta.get("allowed_values", [])) if meta.get("needs_service_filter") else None
+        queries[metric_name] = (agg_to_use, metric_filter)
+    return queries
+
 def service_resource_id_for_metric(storage_account_resource_id, metric_name):
     suffix = SERVICE_RESOURCE_SUFFIX.get(metric_name)
     if not suffix:
@@ -141,205 +149,253 @@ def service_resource_id_for_metric(storage_account_resource_id, metric_name):
         return storage_account_resource_id
     return storage_account_resource_id.rstrip("/") + suffix
 
-def fetch_metric_response(resource_to_query, storage_account_name, headers, timespan, interval, metric_name, agg_to_use, needs_service_filter=False, allowed_values=None):
-    filter_param = ""
-    if needs_service_filter:
-        chosen_val = None
-        if allowed_values:
-            for candidate in allowed_values:
-                if candidate and candidate.lower().startswith("blob"):
-                    chosen_val = candidate
-                    break
-            if not chosen_val:
-                chosen_val = allowed_values[0]
-        else:
-            chosen_val = "blobs"
-        filter_param = f"&$filter=Service eq '{chosen_val}'"
-    metric_q = quote_plus(metric_name)
-    metrics_url = (
-        f"https://management.azure.com{resource_to_query}/providers/microsoft.insights/metrics"
-        f"?api-version={API_VERSION_METRICS}"
-        f"&metricnames={metric_q}"
-        f"&timespan={timespan}"
-        f"&interval={interval}"
-        f"&aggregation={agg_to_use}"
-        f"{filter_param}"
-    )
-    try:
-        r = requests.get(metrics_url, headers=headers, timeout=30)
-    except Exception as e:
-        print(f"❌ REQUEST ERROR for {storage_account_name} metric {metric_name}: {e}")
-        return None
-    if r.status_code == 400:
-        # metric not available for this resource -> skip
-        print(f"⊘ Metric not available for '{storage_account_name}' -> {metric_name} (agg={agg_to_use}). 400")
-        return None
-    if r.status_code != 200:
-        print(f"⚠️ Unexpected status for '{storage_account_name}' -> {metric_name} (agg={agg_to_use}): {r.status_code}")
-        return r
-    return r
+async def fetch_metric_response(session, resource_to_query, storage_account_name, throttle, stats, timespan, interval,
+                                metric_name, agg_to_use, metric_filter=None):
+    params = {
+        "api-version": API_VERSION_METRICS,
+        "metricnames": metric_name,
+        "timespan": timespan,
+        "interval": interval,
+        "aggregation": agg_to_use,
+    }
+    if metric_filter:
+        params["$filter"] = metric_filter
+    url = f"https://management.azure.com{resource_to_query}/providers/microsoft.insights/metrics"
+    data = await get_json(session, url, throttle, stats, params=params)
+    if data is None:
+        # metric not available for this resource, or the request kept failing -> skip
+        print(f"⊘ No data for '{storage_account_name}' -> {metric_name} (agg={agg_to_use})")
+    return data
+
+def get_storage_account_details(storage_account):
+    """Details of a storage account as returned by the storageAccounts list call."""
+    props = storage_account.get("properties", {}) or {}
+    sku = storage_account.get("sku", {}) or {}
+    sku_name = sku.get("name", "")
+    replication_type = sku_name.split("_")[-1] if "_" in sku_name else "unknown"
+    return {
+        "sku": sku_name or "unknown",
+        "access_tier": props.get("accessTier", "unknown"),
+        "replication": replication_type,
+        "location": storage_account.get("location", "unknown"),
+        "kind": storage_account.get("kind", "unknown"),
+        "creation_time": props.get("creationTime", ""),
+        "status": props.get("statusOfPrimary", "unknown"),
+    }
 
-def get_storage_account_details(resource_id, headers):
-    url = f"https://management.azure.com{resource_id}?api-version={API_VERSION_LIST_STORAGE}"
-    try:
-        r = requests.get(url, headers=headers, timeout=30)
-        if r.status_code != 200:
-            return {}
-        data = r.json()
-        props = data.get("properties", {}) or {}
-        sku = data.get("sku", {}) or {}
-        sku_name = sku.get("name", "")
-        replication_type = sku_name.split("_")[-1] if "_" in sku_name else "unknown"
-        return {
-            "sku": sku_name or "unknown",
-            "access_tier": props.get("accessTier", "unknown"),
-            "replication": replication_type,
-            "location": data.get("location", "unknown"),
-            "kind": data.get("kind", "unknown"),
-            "creation_time": props.get("creationTime", ""),
-            "status": props.get("statusOfPrimary", "unknown"),
-        }
-    except Exception as e:
-        print(f"⚠️ get_storage_account_details error for {resource_id}: {e}")
-        return {}
+def point_value(point, aggregation):
+    """Value of a datapoint for `aggregation`, falling back to whichever aggregation is present."""
+    preferred = aggregation.lower()
+    if preferred in point:
+        return point.get(preferred)
+    for k in ["total", "average", "count", "maximum", "minimum", "sum"]:
+        if k in point:
+            return point.get(k)
+    return 0.0
+
+def storage_metric_rows(payload, storage_account, subscription_id, aggregations):
+    """Flatten one metrics response of a storage account into datapoint rows."""
+    name = storage_account.get("name")
+    resource_id = storage_account.get("id")
+    details = get_storage_account_details(storage_account)
+    namespace = payload.get("namespace", "")
+    resourceregion = payload.get("resourceregion", "")
 
-# ---------- Collection ----------
-def collect_all_storage_metrics(storage_accounts, headers, timespan, interval, subscription_id):
     rows = []
-    for storage_account in storage_accounts:
-        name = storage_account.get("name")
-        resource_id = storage_account.get("id")
-        print(f"\n📦 Processing storage account: {name}")
+    for metric in payload.get("value", []):
+        full_id = metric.get("id", "")
+        resource_id_clean = (full_id.split("/providers/Microsoft.Insights/metrics")[0] if "/providers/Microsoft.Insights/metrics" in full_id else full_id)
+        metric_unit = metric.get("unit", "")
+        metric_name_actual = (metric.get("name") or {}).get("value", "")
+        display_desc = metric.get("displayDescription", "")
+        aggregation = aggregations.get(metric_name_actual, PREFERRED_AGG.get(metric_name_actual, "Total"))
+
+        for series in metric.get("timeseries", []):
+            for point in series.get("data", []):
+                row = {
+                    "storage_account_name": name,
+                    "resource_group": resource_id.split("/")[4] if resource_id and "/" in resource_id else "unknown",
+                    "subscription_id": subscription_id,
+                    "timestamp": point.get("timeStamp"),
+                    "value": point_value(point, aggregation),
+                    "metric_name": metric_name_actual,
+                    "unit": metric_unit,
+                    "displaydescription": display_desc,
+                    "namespace": namespace,
+                    "resourceregion": resourceregion,
+                    "resource_id": resource_id_clean,
+                    "sku": details.get("sku", "unknown"),
+                    "access_tier": details.get("access_tier", "unknown"),
+                    "replication": details.get("replication", "unknown"),
+                    "location": details.get("location", "unknown"),
+                    "kind": details.get("kind", "unknown"),
+                    "storage_account_status": details.get("status", "unknown"),
+                    "cost": None,
+                    "aggregation": aggregation,
+                }
+                rows.append(row)
+    return rows
 
-        # For each desired metric, look up metricDefinitions on appropriate resource (service-level when applicable)
-        per_metric_defs = {}
-        available_union = set()
+# ---------- Collection ----------
+def group_storage_targets(storage_accounts):
+    """
+    Group the resources to query by (namespace, region, kind).
+
+    Account-level metrics are read from the account and capacity metrics from its service
+    resources, so one account contributes a target to several groups. Accounts of one kind
+    in one region share metric definitions.
+
+    Returns:
+        dict: {(namespace, region, kind): {"metrics": [...], "targets": [(account, resource id), ...]}}
+    """
+    groups = {}
+    for storage_account in storage_accounts:
+        targets = {}
         for metric in DESIRED_METRICS:
-            resource_to_check = service_resource_id_for_metric(resource_id, metric)
-            defs = get_metric_definitions(resource_to_check, headers)
-            available = set(((m.get("name") or {}).get("value")) for m in defs if (m.get("name") or {}).get("value"))
-            per_metric_defs[metric] = {"resource": resource_to_check, "defs": defs, "available": available}
-            available_union.update(available)
-
-        metrics_to_query = [m for m in DESIRED_METRICS if m in available_union]
-        print(f"   ℹ️ Metrics to query for this account: {metrics_to_query}")
-
-        details = get_storage_account_details(resource_id, headers)
-
-        for metric_name in metrics_to_query:
-            meta_entry = per_metric_defs.get(metric_name)
-            if meta_entry is None:
-                resource_to_query = service_resource_id_for_metric(resource_id, metric_name)
-                defs = get_metric_definitions(resource_to_query, headers)
-                meta = inspect_metric_definition(defs, metric_name)
-            else:
-                resource_to_query = meta_entry["resource"]
-                defs = meta_entry["defs"]
-                meta = inspect_metric_definition(defs, metric_name)
-
-            if meta is None:
-                preferred_agg = PREFERRED_AGG.get(metric_name, "Average")
-                agg_to_use = preferred_agg
-                needs_service_filter = False
-                allowed_values = []
-            else:
-                supported = meta.get("supported_aggs") or []
-                preferred_agg = PREFERRED_AGG.get(metric_name, "Average")
-                agg_to_use = pick_aggregation(preferred_agg, supported)
-                needs_service_filter = meta.get("needs_service_filter", False)
-                allowed_values = meta.get("allowed_values", [])
-
-            resp = fetch_metric_response(resource_to_query, name, headers, timespan, interval, metric_name, agg_to_use, needs_service_filter, allowed_values)
-            time.sleep(SLEEP_BETWEEN_CALLS)
-            if resp is None:
-                continue
-            if resp.status_code != 200:
-                continue
-
-            payload = resp.json()
-            namespace = payload.get("namespace", "")
-            resourceregion = payload.get("resourceregion", "")
-
-            for metric in payload.get("value", []):
-                full_id = metric.get("id", "")
-                resource_id_clean = (full_id.split("/providers/Microsoft.Insights/metrics")[0] if "/providers/Microsoft.Insights/metrics" in full_id else full_id)
-                metric_unit = metric.get("unit", "")
-                metric_name_actual = (metric.get("name") or {}).get("value", metric_name)
-                display_desc = metric.get("displayDescription", "")
-
-                for series in metric.get("timeseries", []):
-                    for point in series.get("data", []):
-                        if "total" in point:
-                            value = point.get("total")
-                        elif "average" in point:
-                            value = point.get("average")
-                        elif "count" in point:
-                            value = point.get("count")
-                        else:
-                            value = None
-                            for k in ["maximum", "minimum", "sum"]:
-                                if k in point:
-                                    value = point.get(k)
-                                    break
-                            if value is None:
-                                value = 0.0
-
-                        row = {
-                            "storage_account_name": name,
-                            "resource_group": resource_id.split("/")[4] if resource_id and "/" in resource_id else "unknown",
-                            "subscription_id": subscription_id,
-                            "timestamp": point.get("timeStamp"),
-                            "value": value,
-                            "metric_name": metric_name_actual,
-                            "unit": metric_unit,
-                            "displaydescription": display_desc,
-                            "namespace": namespace,
-                            "resourceregion": resourceregion,
-                            "resource_id": resource_id_clean,
-                            "sku": details.get("sku", "unknown"),
-                            "access_tier": details.get("access_tier", "unknown"),
-                            "replication": details.get("replication", "unknown"),
-                            "location": details.get("location", "unknown"),
-                            "kind": details.get("kind", "unknown"),
-                            "storage_account_status": details.get("status", "unknown"),
-                            "cost": None,
-                        }
-                        rows.append(row)
-    return pd.DataFrame(rows)
-
-# ---------- Postgres helpers ----------
-
-def fetch_existing_hash_keys(schema_name, table_name):
-    """Return set of existing hash_key values from target table."""
-    try:
-        conn = get_db_conn()
-        cur = conn.cursor()
-        cur.execute(f"SELECT hash_key FROM {schema_name}.{table_name}")
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        return set(r[0] for r in rows if r and r[0] is not None)
-    except Exception as e:
-        print(f"⚠️ fetch_existing_hash_keys failed: {e} -> returning empty set")
-        return set()
-
+            target = service_resource_id_for_metric(storage_account.get("id"), metric)
+            key = (resource_namespace(target), storage_account.get("location", "").lower(), storage_account.get("kind", ""))
+            group = groups.setdefault(key, {"metrics": [], "targets": []})
+            if metric not in group["metrics"]:
+                group["metrics"].append(metric)
+            if key not in targets:
+                targets[key] = target
+                group["targets"].append((storage_account, target))
+    return groups
+
+async def collect_storage_group(session, key, group, throttle, batch_throttle, stats, window, interval,
+                                subscription_id, batch_headers, sink, definitions):
+    """
+    Collect one group's metrics into `sink` with metrics:getBatch, one request per service
+    filter, window start and 50 resources, and the resources the batch API did not answer
+    with per-resource calls. The group's metric definitions come from the `definitions`
+    cache, or are discovered on its first resource.
+    """
+    namespace, region, kind = key
+    defs = await definitions.get(
+        (f"{STORAGE_ACCOUNT_TYPE}:{kind}", region, namespace),
+        lambda: get_metric_definitions(session, group["targets"][0][1], throttle, stats),
+    )
+    queries = plan_metric_queries(defs, group["metrics"])
+    if not queries:
+        return
+    aggregations = {metric: agg for metric, (agg, _) in queries.items()}
+
+    by_filter = {}
+    for metric, (agg, metric_filter) in queries.items():
+        by_filter.setdefault(metric_filter, []).append(metric)
+
+    datapoints, fallback = 0, []
+    for metric_filter, metric_names in by_filter.items():
+        by_start = {}
+        if batch_headers:
+            for storage_account, target in group["targets"]:
+                by_start.setdefault(window.start_for(target, metric_names), []).append((storage_account, target))
+        else:
+            by_start[None] = group["targets"]
+        for start, targets in by_start.items():
+            payloads = {}
+            if start is not None:
+                payloads = await get_metrics_batch(
+                    session, subscription_id, region, namespace, [target for _, target in targets], metric_names,
+                    sorted(set(aggregations[m] for m in metric_names)), window.timespan(start), interval,
+                    batch_headers, batch_throttle, stats, metric_filter=metric_filter,
+                )
+            # Rows go to the sink per response, so only one batch response is held at a time
+            for storage_account, target in targets:
+                payload = payloads.pop(target.lower(), None)
+                if payload is None:
+                    fallback.extend((storage_account, target, metric) for metric in metric_names)
+                    continue
+                rows = storage_metric_rows(payload, storage_account, subscription_id, aggregations)
+                datapoints += len(rows)
+                sink.add(rows)
+
+    async def fetch_fallback(storage_account, target, metric):
+        payload = await fetch_metric_response(session, target, storage_account.get("name"), throttle, stats,
+                                              window.timespan(window.start(target, metric)), interval, metric,
+                                              *queries[metric])
+        if payload is None:
+            return 0
+        rows = storage_metric_rows(payload, storage_account, subscription_id, aggregations)
+        sink.add(rows)
+        return len(rows)
+
+    datapoints += sum(await asyncio.gather(*(fetch_fallback(*item) for item in fallback)))
+
+    stats.datapoints += datapoints
+    print(f"✅ {namespace} in {region} ({kind}): {len(group['targets'])} resource(s), "
+          f"{len(fallback)} per-resource call(s), {datapoints} datapoints")
+
+async def collect_all_storage_metrics(storage_accounts, headers, window, interval, subscription_id, sink, definitions,
+                                      batch_headers=None):
+    """
+    Collect the metrics of every storage account over one shared session into `sink`.
+
+    Targets are grouped by namespace, region and kind and fetched with metrics:getBatch when
+    `batch_headers` holds a metrics data-plane token; the rest go through the per-resource
+    ARM endpoint. Requests are bounded by adaptive throttles instead of fixed sleeps.
+
+    Returns:
+        bool: False when a group failed unexpectedly.
+    """
+    throttle = AdaptiveThrottle()
+    batch_throttle = AdaptiveThrottle()
+    stats = RequestStats()
+    groups = group_storage_targets(storage_accounts)
+
+    async with aiohttp.ClientSession(headers=headers, timeout=ARM_REQUEST_TIMEOUT) as session:
+        results = await asyncio.gather(*(
+            collect_storage_group(session, key, group, throttle, batch_throttle, stats, window, interval,
+                                  subscription_id, batch_headers, sink, definitions)
+            for key, group in groups.items()
+        ), return_exceptions=True)
+    complete = True
+    for key, result in zip(groups, results):
+        if isinstance(result, Exception):
+            print(f"❌ UNEXPECTED ERROR during processing of {key}. Skipping. Error: {result}")
+            complete = False
+    stats.report(f"Storage metrics for subscription {subscription_id}")
+    return complete
 
 # ---------- Main ----------
+COLUMN_ORDER = [
+    "storage_account_name", "resource_group", "subscription_id", "timestamp", "value",
+    "metric_name", "unit", "displaydescription", "namespace", "resourceregion",
+    "resource_id", "sku", "access_tier", "replication", "kind",
+    "storage_account_status", "cost", "aggregation", "hash_key"
+]
+
+def prepare_storage_rows(df):
+    """Key a batch of rows and put it in the bronze column order."""
+    # A datapoint is identified by its series, timestamp and aggregation; the key is
+    # stable across processes, so datapoints collected again update their rows
+    df = add_metric_keys(df, *SERIES_COLUMNS, "aggregation")
+    for c in COLUMN_ORDER:
+        if c not in df.columns:
+            df[c] = None
+    return df[COLUMN_ORDER]
+
 def metrics_dump(tenant_id, client_id, client_secret, subscription_id, schema_name, table_name):
     print("🔄 Starting Storage Account metrics dump...")
+    client = ArmClient(tenant_id, client_id, client_secret)
     try:
-        token = get_access_token(tenant_id, client_id, client_secret)
+        headers = client.headers()
     except Exception as e:
         print(f"❌ Auth failed: {e}")
         return
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    end_time = datetime.utcnow()
-    start_time = end_time - timedelta(days=DAYS_BACK)
-    timespan = f"{start_time.isoformat()}Z/{end_time.isoformat()}Z"
-    print(f"📅 Time range: {start_time.date()} to {end_time.date()} ({DAYS_BACK} days)")
+    batch_token = get_metrics_batch_token(tenant_id, client_id, client_secret)
+    batch_headers = {"Authorization": f"Bearer {batch_token}"} if batch_token else None
+    # Each series is requested from its watermark; new ones are backfilled over DAYS_BACK
+    run_started = utc_now()
+    lookback = timedelta(days=DAYS_BACK)
+    watermarks = fetch_metric_watermarks(schema_name, STORAGE_COLLECTOR, table_name, SERIES_COLUMNS) or {}
+    gaps = detect_metric_gaps(schema_name, STORAGE_COLLECTOR, table_name, SERIES_COLUMNS, INTERVAL_STEP,
+                              run_started - lookback) or {}
+    window = CollectionWindow(run_started, lookback, watermarks, gaps)
+    window.summary(f"Storage metrics for subscription {subscription_id}")
 
     try:
-        storage_accounts = list_storage_accounts(subscription_id, headers)
+        storage_accounts = list_storage_accounts(client, subscription_id)
         print(f"📦 Found {len(storage_accounts)} storage account(s)")
     except Exception as e:
         print(f"❌ Failed to list storage accounts: {e}")
@@ -349,40 +405,32 @@ def metrics_dump(tenant_id, client_id, client_secret, subscription_id, schema_na
         print("No storage accounts found. Exiting.")
         return
 
-    df = collect_all_storage_metrics(storage_accounts, headers, timespan, INTERVAL, subscription_id)
-    if df.empty:
+    # Rows are written in batches as they are collected; each batch advances the
+    # watermarks of its series in the same transaction
+    sink = MetricsSink(
+        f"Storage metrics for subscription {subscription_id}",
+        write=lambda frame: upsert_metrics(frame, schema_name, table_name, STORAGE_COLLECTOR, SERIES_COLUMNS),
+        prepare=prepare_storage_rows,
+    )
+    # Metric definitions are shared per account kind and region through the schema's definitions cache
+    definitions = MetricDefinitionCache(fetch_metric_definitions(schema_name))
+    collected = asyncio.run(collect_all_storage_metrics(storage_accounts, headers, window, INTERVAL, subscription_id,
+                                                        sink, definitions, batch_headers))
+    if definitions.discovered:
+        store_metric_definitions(schema_name, definitions.discovered)
+    definitions.summary(f"Storage metrics for subscription {subscription_id}")
+    if sink.close() and collected:
+        # Gaps are only marked checked once every series was requested and written
+        advance_metric_watermarks(schema_name, STORAGE_COLLECTOR, pd.DataFrame(), SERIES_COLUMNS, run_started)
+    if sink.rows_written:
+        print(f"✅ Storage account metrics dumped successfully to {schema_name}.{table_name}!")
+    else:
         print("No metrics collected. Exiting.")
-        return
-
-    print("============================================================")
-    print(f"📊 Total records collected: {len(df)}")
-
-    # create hash_key
-    df = df.copy()
-    df['hash_key'] = df[['storage_account_name', 'timestamp', 'metric_name', 'resource_id', 'subscription_id']].astype(str).sum(axis=1).apply(lambda x: hash(x) % (10**12))
-
-    existing = fetch_existing_hash_keys(schema_name, table_name)
-    new_df = df[~df['hash_key'].isin(existing)].copy()
-    print(f"🔎 New unique records to insert (after dedupe): {len(new_df)}")
+    ENDPOINT_LATENCY.report(f"Storage metrics for subscription {subscription_id}")
 
-    if new_df.empty:
-        print("No new unique records to insert.")
-        return
-
-    # ensure columns order
-    column_order = [
-        "storage_account_name", "resource_group", "subscription_id", "timestamp", "value",
-        "metric_name", "unit", "displaydescription", "namespace", "resourceregion",
-        "resource_id", "sku", "access_tier", "replication", "kind",
-        "storage_account_status", "cost", "hash_key"
-    ]
-    for c in column_order:
-        if c not in new_df.columns:
-            new_df[c] = None
-    new_df = new_df[column_order]
 
-    try:
-        dump_to_postgresql(new_df, schema_name, table_name)
-        print(f"✅ Storage account metrics dumped successfully to {schema_name}.{table_name}!")
-    except Exception as e:
-        print(f"❌ Failed to dump to PostgreSQL: {e}")
+def compact_storage_metrics(schema_name, table_name):
+    """Drop duplicate storage datapoints still stored under the old per-process keys."""
+    return compact_metrics(schema_name, table_name, SERIES_COLUMNS, PREFERRED_AGG, "Average",
+                           order_column="ingested_at",
+                           dependent_tables=[("silver_azure_storage_metrics_clean", "metric_observation_id")])
@@ -1,12 +1,21 @@
-import requests
 import json
+import asyncio
+import aiohttp
 import pandas as pd
 from datetime import datetime, timedelta
 import os 
-import time
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../../')))
-from app.ingestion.azure.postgres_operation import dump_to_postgresql
+from app.ingestion.azure.postgres_operation import upsert_metrics, compact_metrics
+from app.ingestion.azure.postgres_operation import fetch_metric_watermarks, detect_metric_gaps, advance_metric_watermarks
+from app.ingestion.azure.postgres_operation import fetch_metric_definitions, store_metric_definitions
+from app.ingestion.azure.metric_definitions import MetricDefinitionCache
+from app.ingestion.watermarks import CollectionWindow, utc_now
+from app.ingestion.metric_keys import add_metric_keys
+from app.ingestion.metrics_sink import MetricsSink
+from app.ingestion.azure.async_arm import AdaptiveThrottle, RequestStats, get_json, ARM_REQUEST_TIMEOUT, ENDPOINT_LATENCY
+from app.ingestion.azure.arm_client import ArmClient
+from app.ingestion.azure.metrics_batch import get_metrics_batch, get_metrics_batch_token, METRICS_BATCH_MAX_METRICS
 
 AGGREGATION_METHODS = {
     "Percentage CPU": "Average",
@@ -28,192 +37,290 @@ VCPU_MAP = {
 # ------------------ CONFIG ------------------ #
 interval = "P1D"
 days_back = 90
+VM_NAMESPACE = "Microsoft.Compute/virtualMachines"
+# Watermarks of this collector, and the bronze columns identifying a series
+VM_COLLECTOR = "azure_vm"
+SERIES_COLUMNS = ("resource_id", "metric_name", "timestamp")
+# A longer distance between two stored datapoints of a series is a gap
+interval_step = timedelta(days=1)
 
 
 
 
-def create_hash_key(df, columns):
-    # Placeholder for hash key generation logic
-    df['hash_key'] = df[columns].astype(str).sum(axis=1).apply(lambda x: hash(x) % (10**8))
-    return df
-
-def fetch_existing_hash_keys(schema_name, table_name):
-    # Placeholder for fetching existing keys for deduplication
-    return set() # Return an empty set for this example
-
-def get_available_metrics(vm_id, headers):
+async def get_metric_definitions(session, vm_id, throttle, stats):
+    """Return the metric definitions of a VM, or None when they could not be fetched."""
     url = (
         f"https://management.azure.com{vm_id}/providers/microsoft.insights/metricDefinitions"
         f"?api-version=2023-10-01"
     )
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        print(f"❌ Failed to fetch available metrics for {vm_id}: {response.status_code}")
-        return []
-
-    definitions = response.json().get("value", [])
-    return [metric["name"]["value"] for metric in definitions if "name" in metric]
-
-def get_access_token(tenant_id, client_id, client_secret):
-    token_url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
-    token_data = {
-        "client_id": client_id,
-        "client_secret": client_secret,
-        "scope": "https://management.azure.com/.default",
-        "grant_type": "client_credentials"
-    }
-    response = requests.post(token_url, data=token_data)
-    access_token = response.json().get("access_token")
-    if not access_token:
-        raise Exception("❌ Failed to retrieve access token")
-    return access_token
-
-def list_vms(subscription_id, headers):
-    url = f"https://management.azure.com/subscriptions/{subscription_id}/providers/Microsoft.Compute/virtualMachines?api-version=2023-07-01"
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        raise Exception(f"❌ Failed to list VMs: {response.status_code}")
-    return response.json().get("value", [])
-
-def fetch_vm_metrics(vm, headers, timespan, interval, metric_name, aggregation):
+    data = await get_json(session, url, throttle, stats)
+    if data is None:
+        print(f"❌ Failed to fetch available metrics for {vm_id}")
+        return None
+    return data.get("value", [])
+
+def metric_names(definitions):
+    return [metric["name"]["value"] for metric in definitions or [] if "name" in metric]
+
+async def get_available_metrics(session, vm_id, throttle, stats):
+    return metric_names(await get_metric_definitions(session, vm_id, throttle, stats))
+
+def list_vms(client, subscription_id):
+    return client.list_all(f"/subscriptions/{subscription_id}/providers/Microsoft.Compute/virtualMachines",
+                           params={"api-version": "2023-07-01"})
+
+async def fetch_vm_metrics(session, vm, throttle, stats, timespan, interval, metric_names):
+    """Fetch up to METRICS_BATCH_MAX_METRICS metrics of one VM in a single ARM call."""
     vm_id = vm["id"]
-    metrics_url = (
-        f"https://management.azure.com{vm_id}/providers/microsoft.insights/metrics"
-        f"?api-version=2023-10-01"
-        f"&metricnames={metric_name.replace(' ', '%20')}"
-        f"&timespan={timespan}"
-        f"&interval={interval}"
-        f"&aggregation={aggregation}" # ✅ FIXED: Use the correct aggregation dynamically
-    )
-    return requests.get(metrics_url, headers=headers)
+    metrics_url = f"https://management.azure.com{vm_id}/providers/microsoft.insights/metrics"
+    params = {
+        "api-version": "2023-10-01",
+        "metricnames": ",".join(metric_names),
+        "timespan": timespan,
+        "interval": interval,
+        # Both aggregations are returned; metric_rows keeps the one each metric uses
+        "aggregation": ",".join(sorted(set(AGGREGATION_METHODS.values()) | {"Average"})),
+    }
+    return await get_json(session, metrics_url, throttle, stats, params=params)
+
+def metric_rows(data, vm, aggregation, subscription_id):
+    """
+    Flatten one metrics response of a VM into datapoint rows.
+
+    With `aggregation` None, each metric's value is read from its AGGREGATION_METHODS entry.
+    """
+    vm_name = vm["name"]
+    resource_group = vm["id"].split("/")[4]
+    instance_type = vm.get("properties", {}).get("hardwareProfile", {}).get("vmSize", "unknown")
+    namespace = data.get("namespace", "")
+    resourceregion = data.get("resourceregion", "")
 
-def collect_all_vm_metrics(vms, headers, timespan, interval, metric_names, subscription_id):
     rows = []
-    for vm in vms:
-        vm_name = vm["name"]
-        vm_id = vm["id"]
-        resource_group = vm_id.split("/")[4]
-        instance_type = vm.get("properties", {}).get("hardwareProfile", {}).get("vmSize", "unknown")
-
-        for metric_name in metric_names:
-            aggregation = AGGREGATION_METHODS.get(metric_name, "Average")
-            response = fetch_vm_metrics(vm, headers, timespan, interval, metric_name, aggregation) # Pass aggregation
-            time.sleep(0.5)
-            if response.status_code != 200:
-                print(f"❌ Failed for VM '{vm_name}' on metric '{metric_name}': {response.status_code}")
+    for metric in data.get("value", []):
+        full_id = metric.get("id", "")
+        resource_id = full_id.split("/providers/Microsoft.Insights/metrics")[0] if "/providers/Microsoft.Insights/metrics" in full_id else full_id
+        metric_unit = metric.get("unit", "")
+        metric_name_actual = metric["name"]["value"]
+        display_desc = metric.get("displayDescription", "")
+        metric_aggregation = aggregation or AGGREGATION_METHODS.get(metric_name_actual, "Average")
+
+        for series in metric.get("timeseries", []):
+            for point in series.get("data", []):
+                
+                # ✅ FIXED: Extract value based on the correct aggregation type
+                if metric_aggregation == "Total":
+                    raw_value = point.get("total", 0.0)
+                else:
+                    # Default to Average
+                    raw_value = point.get("average", 0.0)
+                    
+                # Normalize only if the metric is 'Percentage CPU'
+                if metric_name_actual.lower() in ["percentage cpu", "cpu percentage"]:
+                    # Convert to 0-100% scale (same as Azure UI)
+                    value = min(raw_value, 100)  # Cap at 100%
+                else:
+                    value = raw_value
+
+                row = {
+                    "vm_name": vm_name,
+                    "resource_group": resource_group,
+                    "subscription_id": subscription_id,
+                    "timestamp": point.get("timeStamp"),
+                    "value": value,
+                    "metric_name": metric_name_actual,
+                    "unit": metric_unit,
+                    "displaydescription": display_desc,
+                    "namespace": namespace,
+                    "resourceregion": resourceregion,
+                    "resource_id": resource_id,
+                    "instance_type": instance_type,
+                    "cost": "",  # To be filled from separate billing export later
+                    "aggregation": metric_aggregation,
+                }
+                rows.append(row)
+    return rows
+
+async def collect_vm_metrics(session, vm, throttle, stats, window, interval, subscription_id, sink,
+                             available_metrics=None):
+    """
+    Fetch a VM's metrics through the per-resource ARM endpoint, discovering them unless
+    given, from the earliest start `window` needs for any of them, into `sink`.
+    """
+    vm_name = vm["name"]
+    if available_metrics is None:
+        available_metrics = await get_available_metrics(session, vm["id"], throttle, stats)
+    if not available_metrics:
+        print(f"⚠️ No metrics available for VM: {vm_name}")
+        return
+
+    print(f"Processing VM: {vm_name}")
+    timespan = window.timespan(window.start_for(vm["id"], available_metrics))
+    metric_chunks = [
+        available_metrics[i:i + METRICS_BATCH_MAX_METRICS]
+        for i in range(0, len(available_metrics), METRICS_BATCH_MAX_METRICS)
+    ]
+    responses = await asyncio.gather(*(
+        fetch_vm_metrics(session, vm, throttle, stats, timespan, interval, metric_names)
+        for metric_names in metric_chunks
+    ))
+
+    for metric_names, data in zip(metric_chunks, responses):
+        if data is None:
+            print(f"❌ Failed for VM '{vm_name}' on metrics {metric_names}")
+            continue
+        rows = metric_rows(data, vm, None, subscription_id)
+        stats.datapoints += len(rows)
+        sink.add(rows)
+    print(f"✅ Successfully processed metrics for VM: {vm_name}")
+
+async def collect_region_vm_metrics(session, region, vms, throttle, batch_throttle, stats, window, interval,
+                                    subscription_id, batch_headers, sink, definitions):
+    """
+    Collect the metrics of all VMs of one region with metrics:getBatch into `sink`.
+
+    VMs share the metric definitions of their namespace, so they are read from the
+    `definitions` cache, or discovered once per region. VMs whose windows start together
+    share batch requests, so a VM being backfilled does not widen the window of the
+    others. VMs the batch API did not answer are collected per resource.
+    """
+    available_metrics = metric_names(await definitions.get(
+        (VM_NAMESPACE, region, VM_NAMESPACE),
+        lambda: get_metric_definitions(session, vms[0]["id"], throttle, stats),
+    ))
+    if not available_metrics:
+        return await _collect_per_vm(session, vms, throttle, stats, window, interval, subscription_id, sink)
+
+    by_start = {}
+    if batch_headers:
+        for vm in vms:
+            by_start.setdefault(window.start_for(vm["id"], available_metrics), []).append(vm)
+    else:
+        by_start[None] = vms
+    aggregations = sorted(set(AGGREGATION_METHODS.get(name, "Average") for name in available_metrics))
+
+    batched, fallback = 0, []
+    for start, start_vms in by_start.items():
+        payloads = {}
+        if start is not None:
+            payloads = await get_metrics_batch(
+                session, subscription_id, region, VM_NAMESPACE, [vm["id"] for vm in start_vms], available_metrics,
+                aggregations, window.timespan(start), interval, batch_headers, batch_throttle, stats,
+            )
+        # Rows go to the sink per response, so only one batch response is held at a time
+        for vm in start_vms:
+            data = payloads.pop(vm["id"].lower(), None)
+            if data is None:
+                fallback.append(vm)
                 continue
+            rows = metric_rows(data, vm, None, subscription_id)
+            stats.datapoints += len(rows)
+            sink.add(rows)
+            batched += 1
+    if batched:
+        print(f"✅ Batched metrics of {batched} VM(s) in {region}")
+    await _collect_per_vm(session, fallback, throttle, stats, window, interval, subscription_id, sink,
+                          available_metrics)
+
+async def _collect_per_vm(session, vms, throttle, stats, window, interval, subscription_id, sink,
+                          available_metrics=None):
+    results = await asyncio.gather(*(
+        collect_vm_metrics(session, vm, throttle, stats, window, interval, subscription_id, sink, available_metrics)
+        for vm in vms
+    ), return_exceptions=True)
+    for vm, result in zip(vms, results):
+        # ✅ ADDED: Robust handling of account-level failures
+        if isinstance(result, Exception):
+            print(f"❌ UNEXPECTED ERROR during processing of VM '{vm['name']}'. Skipping. Error: {result}")
+
+async def collect_all_vm_metrics(vms, headers, window, interval, subscription_id, sink, definitions,
+                                 batch_headers=None):
+    """
+    Collect the metrics of every VM over one shared session into `sink`.
+
+    VMs are grouped by region and fetched with metrics:getBatch when `batch_headers` holds a
+    metrics data-plane token; the rest go through the per-resource ARM endpoint. Requests
+    run concurrently, bounded by adaptive throttles (one for ARM, one for the data plane)
+    that back off on the rate-limit headers and 429s instead of sleeping between calls.
+
+    Returns:
+        bool: False when a region failed unexpectedly.
+    """
+    throttle = AdaptiveThrottle()
+    batch_throttle = AdaptiveThrottle()
+    stats = RequestStats()
+    by_region = {}
+    for vm in vms:
+        by_region.setdefault(vm.get("location", "").lower(), []).append(vm)
 
-            data = response.json()
-            namespace = data.get("namespace", "")
-            resourceregion = data.get("resourceregion", "")
-
-            for metric in data.get("value", []):
-                full_id = metric.get("id", "")
-                resource_id = full_id.split("/providers/Microsoft.Insights/metrics")[0] if "/providers/Microsoft.Insights/metrics" in full_id else full_id
-                metric_unit = metric.get("unit", "")
-                metric_name_actual = metric["name"]["value"]
-                display_desc = metric.get("displayDescription", "")
-
-                for series in metric.get("timeseries", []):
-                    for point in series.get("data", []):
-                        
-                        # ✅ FIXED: Extract value based on the correct aggregation type
-                        if aggregation == "Total":
-                            raw_value = point.get("total", 0.0)
-                        else:
-                            # Default to Average
-                            raw_value = point.get("average", 0.0)
-                            
-                        # Normalize only if the metric is 'Percentage CPU'
-                        if metric_name_actual.lower() in ["percentage cpu", "cpu percentage"]:
-                            # Convert to 0-100% scale (same as Azure UI)
-                            value = min(raw_value, 100)  # Cap at 100%
-                        else:
-                            value = raw_value
-
-                        row = {
-                            "vm_name": vm_name,
-                            "resource_group": resource_group,
-                            "subscription_id": subscription_id,
-                            "timestamp": point.get("timeStamp"),
-                            "value": value,
-                            "metric_name": metric_name_actual,
-                            "unit": metric_unit,
-                            "displaydescription": display_desc,
-                            "namespace": namespace,
-                            "resourceregion": resourceregion,
-                            "resource_id": resource_id,
-                            "instance_type": instance_type,
-                            "cost": "",  # To be filled from separate billing export later
-                        }
-                        rows.append(row)
-    return pd.DataFrame(rows)
+    async with aiohttp.ClientSession(headers=headers, timeout=ARM_REQUEST_TIMEOUT) as session:
+        results = await asyncio.gather(*(
+            collect_region_vm_metrics(session, region, region_vms, throttle, batch_throttle, stats, window,
+                                      interval, subscription_id, batch_headers, sink, definitions)
+            for region, region_vms in by_region.items()
+        ), return_exceptions=True)
+    complete = True
+    for region, result in zip(by_region, results):
+        if isinstance(result, Exception):
+            print(f"❌ UNEXPECTED ERROR during processing of VMs in '{region}'. Skipping. Error: {result}")
+            complete = False
+    stats.report(f"VM metrics for subscription {subscription_id}")
+    return complete
 
 def metrics_dump(tenant_id, client_id, client_secret,subscription_id,schema_name,table_name):
-    access_token = get_access_token(tenant_id, client_id, client_secret)
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    client = ArmClient(tenant_id, client_id, client_secret)
+    batch_token = get_metrics_batch_token(tenant_id, client_id, client_secret)
+    batch_headers = {"Authorization": f"Bearer {batch_token}"} if batch_token else None
 
     try:
-        vms = list_vms(subscription_id, headers)
+        headers = client.headers()
+        vms = list_vms(client, subscription_id)
     except Exception as e:
         print(f"❌ Failed to list VMs. Halting ingestion. Error: {e}")
         return
     
     print(f"📦 Found {len(vms)} VM(s)\n")
 
-    end_time = datetime.utcnow()
-    start_time = end_time - timedelta(days=days_back)
-    timespan = f"{start_time.isoformat()}Z/{end_time.isoformat()}Z"
-
-    all_metrics_df = pd.DataFrame()
-
-    for vm in vms:
-        vm_name = vm["name"]
-        # ✅ ADDED: Robust try/except block for account-level failures 
-        try:
-            vm_id = vm["id"]
-            available_metrics = get_available_metrics(vm_id, headers)
-            
-            if not available_metrics:
-                print(f"⚠️ No metrics available for VM: {vm['name']}")
-                continue
-
-            print(f"Processing VM: {vm_name}")
-            vm_metrics_df = collect_all_vm_metrics(
-                vms=[vm],  # Send one VM at a time
-                headers=headers,
-                timespan=timespan,
-                interval=interval,
-                metric_names=available_metrics,
-                subscription_id=subscription_id
-            )
-            
-            all_metrics_df = pd.concat([all_metrics_df, vm_metrics_df], ignore_index=True)
-            print(f"✅ Successfully processed metrics for VM: {vm_name}")
-
-        except requests.exceptions.RequestException as e:
-            # Catch network errors (ConnectionError, Timeout, etc.)
-            print(f"❌ FATAL REQUEST ERROR for VM '{vm_name}'. Skipping to next VM. Error: {e}")
-            continue 
-        
-        except Exception as e:
-            # Catch any other unexpected error 
-            print(f"❌ UNEXPECTED ERROR during processing of VM '{vm_name}'. Skipping. Error: {e}")
-            continue
+    # Each series is requested from its watermark; new ones are backfilled over days_back
+    run_started = utc_now()
+    lookback = timedelta(days=days_back)
+    watermarks = fetch_metric_watermarks(schema_name, VM_COLLECTOR, table_name, SERIES_COLUMNS) or {}
+    gaps = detect_metric_gaps(schema_name, VM_COLLECTOR, table_name, SERIES_COLUMNS, interval_step,
+                              run_started - lookback) or {}
+    window = CollectionWindow(run_started, lookback, watermarks, gaps)
+    window.summary(f"VM metrics for subscription {subscription_id}")
 
-    print(f"\n📊 Total records collected: {len(all_metrics_df)}")
-    print(f"\n📊 Total records collected: {len(all_metrics_df)}")
-    if not all_metrics_df.empty:
-        # ✅ FIX: Define the stable, unique set of columns for hashing
-        # These columns define a unique metric reading at a specific time for a resource.
-        key_columns = ["resource_id", "timestamp", "metric_name", "subscription_id"]
+    # Rows are written in batches as they are collected. A datapoint is identified by its
+    # series, timestamp and aggregation, so datapoints collected again update their rows,
+    # and each batch advances the watermarks of its series in the same transaction.
+    sink = MetricsSink(
+        f"VM metrics for subscription {subscription_id}",
+        write=lambda frame: upsert_metrics(frame, schema_name, table_name, VM_COLLECTOR, SERIES_COLUMNS),
+        prepare=lambda frame: add_metric_keys(frame, *SERIES_COLUMNS, "aggregation"),
+    )
+    # Metric definitions are shared per region through the schema's definitions cache
+    definitions = MetricDefinitionCache(fetch_metric_definitions(schema_name))
+    collected = asyncio.run(collect_all_vm_metrics(
+        vms=vms,
+        headers=headers,
+        window=window,
+        interval=interval,
+        subscription_id=subscription_id,
+        sink=sink,
+        definitions=definitions,
+        batch_headers=batch_headers
+    ))
+    if definitions.discovered:
+        store_metric_definitions(schema_name, definitions.discovered)
+    definitions.summary(f"VM metrics for subscription {subscription_id}")
 
-        # ✅ FIX: Call the function with the required 'columns' argument
-        all_metrics_df = create_hash_key(all_metrics_df, key_columns) 
+    if sink.close() and collected:
+        # Gaps are only marked checked once every series was requested and written
+        advance_metric_watermarks(schema_name, VM_COLLECTOR, pd.DataFrame(), SERIES_COLUMNS, run_started)
+    if not sink.rows_written:
+        print("⚠️ No data collected to dump.")
+    ENDPOINT_LATENCY.report(f"VM metrics for subscription {subscription_id}")
 
-        dump_to_postgresql(all_metrics_df, schema_name, table_name)
-    else:
-        print("⚠️ No data collected to dump.")
\ No newline at end of file
+def compact_vm_metrics(schema_name, table_name):
+    """Drop duplicate VM datapoints still stored under the old per-process keys."""
+    return compact_metrics(schema_name, table_name, SERIES_COLUMNS, AGGREGATION_METHODS, "Average",
+                           dependent_tables=[("silver_azure_vm_metrics", "hash_key")])
@@ -5,6 +5,13 @@ import pandas as pd
 from sqlalchemy import create_engine
 from dotenv import load_dotenv
 import hashlib
+from app.ingestion.partitions import ensure_partitioned_table, fetch_period_fingerprints
+from app.ingestion.partitions import create_staging_partition, append_to_staging_partition
+from app.ingestion.partitions import seal_staging_partition, drop_staging_partition, swap_in_partition
+from app.ingestion.partitions import split_by_period, period_fingerprint
+from app.ingestion.watermarks import seed_watermarks, fetch_watermarks, detect_gaps, advance_watermarks
+from app.ingestion.metric_keys import upsert_metric_rows, compact_metrics_table
+from app.ingestion.azure.metric_definitions import fetch_definitions, store_definitions
 load_dotenv()
 
 DB_HOST_NAME = os.getenv("DB_HOST_NAME")
@@ -85,6 +92,7 @@ def dump_to_postgresql(connection, new_data, schema_name, table_name):
         execute_values(cursor, insert_query, records)
         connection.commit()  # Commit transaction
         print(f"Data dumped into {schema_name}.{table_name} table successfully.")
+        return True
 
     except Exception as e:
         print(f"Error dumping data into {schema_name}.{table_name} table: {e}")
@@ -138,12 +146,14 @@ def fetch_data_from_pg(connection, schema_name, table_or_view_name):
 
 
 @connection
-def run_sql_file(connection, sql_file_path, schema_name, budget):
+def run_sql_file(connection, sql_file_path, schema_name, budget, batch_id=None):
     try:
         # Read the SQL file
         with open(sql_file_path, 'r') as file:
             sql_script = file.read()
         sql_script = sql_script.replace('__schema__', schema_name).replace('__budget__', str(budget)).replace('__databasename__', DB_NAME).replace('__password__', DB_PASSWORD)
+        if batch_id is not None:
+            sql_script = sql_script.replace('__batch_id__', batch_id)
 
         # Create a cursor object
         cursor = connection.cursor()
@@ -163,6 +173,140 @@ def run_sql_file(connection, sql_file_path, schema_name, budget):
     except Exception as error:
         print(f"Error executing {sql_file_path}: {error}")
 
+@connection
+def create_partitioned_bronze_table(connection, provider, schema_name, table_name, partition_column):
+    """Create the bronze table, range-partitioned by billing month, if it does not exist."""
+    cursor = connection.cursor()
+    ensure_partitioned_table(cursor, provider, schema_name, table_name, partition_column)
+    connection.commit()
+    cursor.close()
+    print(f"Partitioned table {schema_name}.{table_name} is ready.")
+
+@connection
+def fetch_loaded_periods(connection, schema_name, table_name):
+    """Return {month start: fingerprint} for the billing months loaded in a bronze table."""
+    cursor = connection.cursor()
+    fingerprints = fetch_period_fingerprints(cursor, schema_name, table_name)
+    cursor.close()
+    print(f"Fetched fingerprints of {len(fingerprints)} loaded billing periods.")
+    return fingerprints
+
+@connection
+def fetch_blob_ledger(connection, schema_name, container_name):
+    """Return {period_key: {blob_name: etag}} for the export blobs already loaded into bronze."""
+    cursor = connection.cursor()
+    cursor.execute("SELECT to_regclass(%s)", (f'{schema_name}.azure_blob_ledger',))
+    if cursor.fetchone()[0] is None:
+        # The blob_ledger migration has not been applied; every export run is loaded
+        cursor.close()
+        print(f"No blob ledger in {schema_name}; loading every export run.")
+        return {}
+    cursor.execute(
+        sql.SQL("SELECT period_key, blob_name, etag FROM {}.azure_blob_ledger WHERE container_name = %s").format(
+            sql.Identifier(schema_name)),
+        (container_name,)
+    )
+    ledger = {}
+    for period_key, blob_name, etag in cursor.fetchall():
+        ledger.setdefault(period_key, {})[blob_name] = etag
+    cursor.close()
+    print(f"Fetched ledger entries for {len(ledger)} export periods.")
+    return ledger
+
+@connection
+def record_loaded_blobs(connection, schema_name, container_name, runs):
+    """Replace the ledger entries of each loaded run's period with the blobs of that run."""
+    from psycopg2.extras import execute_values
+    try:
+        cursor = connection.cursor()
+        for run in runs:
+            cursor.execute(
+                sql.SQL("DELETE FROM {}.azure_blob_ledger WHERE container_name = %s AND period_key = %s").format(
+                    sql.Identifier(schema_name)),
+                (container_name, run.period_key)
+            )
+            records = [
+                (container_name, blob.name, run.period_key, run.run_id, blob.etag, blob.size,
+                 blob.last_modified, run.rows_loaded.get(blob.name, 0))
+                for blob in run.blobs
+            ]
+            execute_values(cursor, sql.SQL(
+                "INSERT INTO {}.azure_blob_ledger (container_name, blob_name, period_key, run_id, etag, "
+                "size_bytes, last_modified, rows_loaded) VALUES %s "
+                "ON CONFLICT (container_name, blob_name) DO UPDATE SET period_key = EXCLUDED.period_key, "
+                "run_id = EXCLUDED.run_id, etag = EXCLUDED.etag, size_bytes = EXCLUDED.size_bytes, "
+                "last_modified = EXCLUDED.last_modified, rows_loaded = EXCLUDED.rows_loaded, loaded_at = now()"
+            ).format(sql.Identifier(schema_name)).as_string(cursor), records)
+        connection.commit()
+        cursor.close()
+        print(f"Recorded {sum(len(run.blobs) for run in runs)} loaded blobs in the ledger.")
+
+    except Exception as ex:
+        connection.rollback()
+        print(f"Error recording loaded blobs: {ex}")
+
+@connection
+def replace_billing_periods(connection, batches, schema_name, table_name, partition_column, loaded_periods,
+                            load_batch_id):
+    """
+    Stream batches into per-month staging tables, then replace each changed month of a
+    partitioned bronze table.
+
+    Each batch is split by month and appended to that month's staging table, so only one
+    batch is held at a time. Rows repeated across batches are skipped by hash key. Once
+    every batch is staged, a month whose fingerprint matches `loaded_periods` is
+    discarded; the others are swapped in, each in its own short transaction.
+
+    Args:
+        batches (Iterable[pd.DataFrame]): Hashed and coerced rows with load_batch_id set.
+        loaded_periods (dict): {month start: fingerprint} of the months already loaded.
+
+    Returns:
+        bool: True when every month was replaced or found unchanged.
+    """
+    stages, keys = {}, {}
+    try:
+        cursor = connection.cursor()
+        for batch in batches:
+            for period_start, period_data in split_by_period(batch, partition_column).items():
+                seen = keys.setdefault(period_start, set())
+                period_data = period_data.drop_duplicates(subset=['hash_key'])
+                period_data = period_data[~period_data['hash_key'].isin(seen)]
+                if period_data.empty:
+                    continue
+                seen.update(period_data['hash_key'])
+                if period_start not in stages:
+                    stages[period_start] = create_staging_partition(cursor, schema_name, table_name, period_start)
+                append_to_staging_partition(cursor, period_data, schema_name, stages[period_start])
+            connection.commit()
+
+        for period_start, stage in sorted(stages.items()):
+            # Fingerprints are taken over the hex keys, as they were before keys became binary
+            fingerprint = period_fingerprint(key.hex() for key in keys[period_start])
+            if loaded_periods.get(period_start) == fingerprint:
+                drop_staging_partition(cursor, schema_name, stage)
+                connection.commit()
+                print(f"Billing period {period_start:%Y-%m} unchanged, skipping")
+                continue
+            seal_staging_partition(cursor, schema_name, stage, partition_column, period_start)
+            connection.commit()
+            swap_in_partition(cursor, schema_name, table_name, stage, period_start, fingerprint, load_batch_id)
+            connection.commit()
+            print(f"Replaced billing period {period_start:%Y-%m} of {schema_name}.{table_name} "
+                  f"with {len(keys[period_start])} rows.")
+        cursor.close()
+        return True
+
+    except Exception as ex:
+        connection.rollback()
+        print(f"Error replacing billing periods of {schema_name}.{table_name}: {ex}")
+        # Stages already swapped in were renamed, so only the unfinished ones are dropped
+        cursor = connection.cursor()
+        for stage in stages.values():
+            drop_staging_partition(cursor, schema_name, stage)
+        connection.commit()
+        return False
+
 @connection
 def fetch_existing_hash_keys(connection, schema_name, table_name):
     try:
@@ -178,8 +322,114 @@ def fetch_existing_hash_keys(connection, schema_name, table_name):
         print(f"Error fetching hash keys: {ex}")
         return set()
 
+@connection
+def upsert_metrics(connection, frame, schema_name, table_name, collector=None, series_columns=None):
+    """
+    Write metrics rows keyed by `add_metric_keys`, updating datapoints already stored.
+
+    With a `collector`, its watermarks are advanced past the rows in the same transaction.
+    """
+    try:
+        cursor = connection.cursor()
+        written = upsert_metric_rows(cursor, frame, schema_name, table_name)
+        if collector:
+            advance_watermarks(cursor, schema_name, collector, frame, *series_columns)
+        connection.commit()
+        cursor.close()
+        print(f"Upserted {written} rows into {schema_name}.{table_name}.")
+        return True
+
+    except Exception as ex:
+        connection.rollback()
+        print(f"Error upserting into {schema_name}.{table_name}: {ex}")
+        return False
+
+@connection
+def compact_metrics(connection, schema_name, table_name, series_columns, aggregations, default_aggregation,
+                    dimension_column=None, order_column=None, dependent_tables=()):
+    """Drop duplicate datapoints of a metrics table still holding un-keyed rows and move it to stable keys."""
+    cursor = connection.cursor()
+    deleted, rekeyed = compact_metrics_table(
+        cursor, schema_name, table_name, series_columns, 'aggregation', aggregations, default_aggregation,
+        dimension_column=dimension_column, order_column=order_column, dependent_tables=dependent_tables)
+    connection.commit()
+    cursor.close()
+    if deleted or rekeyed:
+        print(f"Compacted {schema_name}.{table_name}: {deleted} duplicate rows deleted, {rekeyed} rows rekeyed.")
+    return deleted, rekeyed
+
+@connection
+def fetch_metric_watermarks(connection, schema_name, collector, table_name, series_columns):
+    """
+    Return {(resource_id, metric_name): last stored timestamp} of a metrics collector,
+    seeding the watermarks from its bronze table on the first incremental run.
+
+    Args:
+        series_columns (tuple): Resource, metric and timestamp columns of `table_name`.
+    """
+    cursor = connection.cursor()
+    seed_watermarks(cursor, schema_name, collector, table_name, *series_columns)
+    connection.commit()
+    watermarks = fetch_watermarks(cursor, schema_name, collector)
+    cursor.close()
+    print(f"Fetched {len(watermarks)} {collector} watermarks.")
+    return watermarks
+
+@connection
+def detect_metric_gaps(connection, schema_name, collector, table_name, series_columns, max_step, since):
+    """Return {(resource_id, metric_name): gap start} of the unchecked holes in a metrics table."""
+    cursor = connection.cursor()
+    gaps = detect_gaps(cursor, schema_name, collector, table_name, *series_columns, max_step, since)
+    cursor.close()
+    if gaps:
+        print(f"Found gaps in {len(gaps)} {collector} series, requesting them again.")
+    return gaps
+
+@connection
+def advance_metric_watermarks(connection, schema_name, collector, frame, series_columns, checked_at):
+    """Advance a collector's watermarks past the rows of a frame that was stored in bronze."""
+    cursor = connection.cursor()
+    advance_watermarks(cursor, schema_name, collector, frame, *series_columns, checked_at)
+    connection.commit()
+    cursor.close()
+    print(f"Advanced {collector} watermarks.")
+
+@connection
+def fetch_metric_definitions(connection, schema_name):
+    """Return the stored metric definitions that have not expired."""
+    cursor = connection.cursor()
+    definitions = fetch_definitions(cursor, schema_name)
+    connection.commit()
+    cursor.close()
+    print(f"Fetched {len(definitions)} cached metric definition set(s).")
+    return definitions
+
+@connection
+def store_metric_definitions(connection, schema_name, definitions):
+    """Persist metric definitions discovered during a run."""
+    try:
+        cursor = connection.cursor()
+        store_definitions(cursor, schema_name, definitions)
+        connection.commit()
+        cursor.close()
+        print(f"Stored {len(definitions)} metric definition set(s).")
+        return True
+
+    except Exception as ex:
+        connection.rollback()
+        print(f"Error storing metric definitions: {ex}")
+        return False
+
 def create_hash_key(df):
-    """Generate an MD5 hash key using all available columns in the dataframe."""
-    # Concatenate all columns to form a single string per row
-    df['hash_key'] = df.apply(lambda row: hashlib.md5(''.join(map(str, row)).encode('utf-8')).hexdigest(), axis=1)
+    """
+    Set `hash_key` to the binary MD5 of every row of a coerced frame.
+
+    Values are joined with a separator, so adjacent columns cannot run into each other,
+    and missing values key as empty strings.
+    """
+    columns = [column for column in df.columns if column not in ('hash_key', 'load_batch_id')]
+    df['hash_key'] = [
+        hashlib.md5('|'.join('' if value is None else str(value) for value in row).encode('utf-8')).digest()
+        for row in df[columns].itertuples(index=False, name=None)
+    ]
     return df
\ No newline at end of file
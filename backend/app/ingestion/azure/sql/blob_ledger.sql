@@ -0,0 +1,16 @@
+-- One row per cost export blob whose rows are in bronze. A period (export folder and
+-- date range) is only downloaded again when its latest run has different blobs or ETags.
+CREATE TABLE IF NOT EXISTS __schema__.azure_blob_ledger (
+    container_name text NOT NULL,
+    blob_name text NOT NULL,
+    period_key text NOT NULL,
+    run_id text,
+    etag text NOT NULL,
+    size_bytes bigint,
+    last_modified timestamp with time zone,
+    rows_loaded bigint NOT NULL DEFAULT 0,
+    loaded_at timestamp NOT NULL DEFAULT now(),
+    PRIMARY KEY (container_name, blob_name)
+);
+
+CREATE INDEX IF NOT EXISTS azure_blob_ledger_period_idx ON __schema__.azure_blob_ledger (container_name, period_key);
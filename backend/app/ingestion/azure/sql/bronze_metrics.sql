@@ -15,4 +15,9 @@ CREATE TABLE if not exists __schema__.bronze_azure_vm_metrics (
     instance_type TEXT,                  -- VM SKU like Standard_D4s_v3
     cost FLOAT,                         -- Cost placeholder (nullable)
     hash_key TEXT UNIQUE
-);
\ No newline at end of file
+);
+
+-- Aggregation the value was read with; part of hash_key
+ALTER TABLE __schema__.bronze_azure_vm_metrics ADD COLUMN IF NOT EXISTS aggregation TEXT;
+-- Rows written before it was keyed; empty once the table is compacted
+CREATE INDEX IF NOT EXISTS ix_bronze_vm_unkeyed ON __schema__.bronze_azure_vm_metrics (hash_key) WHERE aggregation IS NULL;
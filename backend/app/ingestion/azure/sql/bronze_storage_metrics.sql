@@ -21,7 +21,7 @@ CREATE TABLE IF NOT EXISTS __schema__.bronze_azure_storage_account_metrics (
     kind                     TEXT,
     storage_account_status   TEXT,
     cost                     DOUBLE PRECISION,
-    -- deterministic hash key for dedupe (MD5 hex)
+    -- deterministic hash key for dedupe (sha256 hex)
     hash_key                 VARCHAR(64) NOT NULL,
     ingested_at              TIMESTAMP DEFAULT now()
 );
@@ -29,6 +29,11 @@ CREATE TABLE IF NOT EXISTS __schema__.bronze_azure_storage_account_metrics (
 -- Unique index on hash_key prevents duplicates at DB level
 CREATE UNIQUE INDEX IF NOT EXISTS ux_bronze_storage_hash ON __schema__.bronze_azure_storage_account_metrics (hash_key);
 
+-- Aggregation the value was read with; part of hash_key
+ALTER TABLE __schema__.bronze_azure_storage_account_metrics ADD COLUMN IF NOT EXISTS aggregation TEXT;
+-- Rows written before it was keyed; empty once the table is compacted
+CREATE INDEX IF NOT EXISTS ix_bronze_storage_unkeyed ON __schema__.bronze_azure_storage_account_metrics (hash_key) WHERE aggregation IS NULL;
+
 -- Helpful view: recent ingestions
 CREATE OR REPLACE VIEW __schema__.v_bronze_storage_recent AS
 SELECT * FROM __schema__.bronze_azure_storage_account_metrics
@@ -1,103 +1,144 @@
 
---resource dim
-CREATE OR REPLACE VIEW __schema__.gold_azure_resource_dim AS
-SELECT DISTINCT 
-    "ResourceId" AS resource_id, 
-    "ResourceName" AS resource_name,  
-    "RegionId" AS region_id, 
-    "RegionName" AS region_name, 
-    "ServiceCategory" AS service_category, 
-    "ServiceName" AS service_name
-FROM __schema__.silver_azure_focus;
+-- Gold is materialized in tables maintained from the current load batch (__batch_id__),
+-- as gold_aws_fact_focus_mat is: only the billing months silver merged for the batch (its
+-- silver_refresh_log entry) are deleted from gold_azure_fact_cost_mat and re-inserted
+-- from silver, and the resource dim
+-- only gains the resources of the batch. Both are rebuilt in full when they are new or
+-- silver was backfilled. Dashboards read indexed tables and are not blocked while
+-- ingestion writes them. The public views keep their names and columns and only project
+-- these tables.
+DO $$
+DECLARE
+    v_full_backfill boolean;
+    v_months date[];
+    v_deleted bigint := 0;
+    v_inserted bigint := 0;
+    v_resources bigint := 0;
+BEGIN
+    SELECT coalesce(bool_or(full_backfill), false), coalesce(array_agg(DISTINCT m.month_start), '{}')
+    INTO v_full_backfill, v_months
+    FROM __schema__.silver_refresh_log
+    LEFT JOIN LATERAL unnest(billing_months) AS m(month_start) ON true
+    WHERE table_name = 'silver_azure_focus' AND load_batch_id = '__batch_id__';
+    v_full_backfill := v_full_backfill OR NOT EXISTS (
+        SELECT 1 FROM information_schema.tables
+        WHERE table_schema = '__schema__' AND table_name = 'gold_azure_fact_cost_mat');
+
+    CREATE TABLE IF NOT EXISTS __schema__.gold_azure_resource_dim_mat (
+        resource_id text,
+        resource_name text,
+        region_id text,
+        region_name text,
+        service_category text,
+        service_name text
+    );
+    CREATE INDEX IF NOT EXISTS gold_azure_resource_dim_mat_resource_idx ON __schema__.gold_azure_resource_dim_mat (resource_id);
+    CREATE INDEX IF NOT EXISTS gold_azure_resource_dim_mat_service_idx ON __schema__.gold_azure_resource_dim_mat (service_name);
 
+    CREATE TABLE IF NOT EXISTS __schema__.gold_azure_fact_cost_mat (
+        tags_key text,
+        sub_account_id text,
+        resource_id text,
+        sku_id text,
+        resource_group_name text,
+        charge_period_start date,
+        pricing_category text,
+        pricing_unit text,
+        list_unit_price double precision,
+        contracted_unit_price double precision,
+        pricing_quantity double precision,
+        billed_cost double precision,
+        consumed_quantity double precision,
+        consumed_unit text,
+        effective_cost double precision,
+        contracted_cost double precision,
+        list_cost double precision,
+        effective_unit_price double precision,
+        billed_cost_in_usd double precision,
+        effective_cost_in_usd double precision,
+        list_cost_in_usd double precision,
+        sku_price_id text,
+        sku_meter_name text,
+        sku_meter_subcategory text,
+        sku_service_family text,
+        hash_key text PRIMARY KEY,
+        billing_period_start date
+    );
+    CREATE INDEX IF NOT EXISTS gold_azure_fact_cost_mat_charge_period_idx ON __schema__.gold_azure_fact_cost_mat (charge_period_start);
+    CREATE INDEX IF NOT EXISTS gold_azure_fact_cost_mat_resource_idx ON __schema__.gold_azure_fact_cost_mat (resource_id, charge_period_start);
+    CREATE INDEX IF NOT EXISTS gold_azure_fact_cost_mat_service_idx ON __schema__.gold_azure_fact_cost_mat (sku_service_family, charge_period_start);
+    CREATE INDEX IF NOT EXISTS gold_azure_fact_cost_mat_tags_idx ON __schema__.gold_azure_fact_cost_mat (tags_key);
+    CREATE INDEX IF NOT EXISTS gold_azure_fact_cost_mat_billing_period_idx ON __schema__.gold_azure_fact_cost_mat (billing_period_start);
 
---charge_summary_dim
-CREATE OR REPLACE VIEW __schema__.gold_azure_charge_summary_dim AS
-SELECT DISTINCT 
-    "SkuId" AS sku_id,
-    "ChargeCategory" AS charge_category,
-    "ChargeClass" AS charge_class,
-    "ChargeDescription" AS charge_description,
-    "ChargeFrequency" AS charge_frequency,
-    "x_SkuDescription" AS x_sku_description
-FROM __schema__.silver_azure_focus;
+    IF v_full_backfill THEN
+        TRUNCATE __schema__.gold_azure_fact_cost_mat, __schema__.gold_azure_resource_dim_mat;
+    ELSE
+        DELETE FROM __schema__.gold_azure_fact_cost_mat
+        WHERE date_trunc('month', billing_period_start)::date = ANY (v_months);
+        GET DIAGNOSTICS v_deleted = ROW_COUNT;
+    END IF;
 
---azure_account_dim
-CREATE OR REPLACE VIEW __schema__.gold_azure_account_dim AS
-SELECT DISTINCT 
-    "SubAccountId" AS sub_account_id,
-    "SubAccountName" AS sub_account_name,
-    "SubAccountType" AS sub_account_type,
-    "x_AccountId" AS x_account_id,
-    "x_AccountName" AS x_account_name,
-    "x_AccountOwnerId" AS x_account_owner_id,
-    "x_BillingProfileId" AS x_billing_profile_id,
-    "x_BillingProfileName" AS x_billing_profile_name,
-    "BillingAccountId" AS billing_account_id,
-    "BillingAccountName" AS billing_account_name,
-    "BillingAccountType" AS billing_account_type
-FROM __schema__.silver_azure_focus;
+    INSERT INTO __schema__.gold_azure_fact_cost_mat
+    SELECT
+        md5(cast("Tags" AS text)),
+        "SubAccountId",
+        "ResourceId",
+        "SkuId",
+        "x_ResourceGroupName",
+        "ChargePeriodStart",
+        "PricingCategory",
+        "PricingUnit",
+        "ListUnitPrice",
+        "ContractedUnitPrice",
+        "PricingQuantity",
+        "BilledCost",
+        "ConsumedQuantity",
+        "ConsumedUnit",
+        "EffectiveCost",
+        "ContractedCost",
+        "ListCost",
+        "x_EffectiveUnitPrice",
+        "x_BilledCostInUsd",
+        "x_EffectiveCostInUsd",
+        "x_ListCostInUsd",
+        "SkuPriceId",
+        "x_SkuMeterName",
+        "x_SkuMeterSubcategory",
+        "x_SkuServiceFamily",
+        "hash_key",
+        "BillingPeriodStart"
+    FROM __schema__.silver_azure_focus
+    WHERE v_full_backfill OR date_trunc('month', "BillingPeriodStart")::date = ANY (v_months)
+    ON CONFLICT (hash_key) DO NOTHING;
+    GET DIAGNOSTICS v_inserted = ROW_COUNT;
 
+    -- Resources are only added; one that stops appearing stays until the next full backfill
+    INSERT INTO __schema__.gold_azure_resource_dim_mat
+    SELECT DISTINCT
+        "ResourceId",
+        "ResourceName",
+        "RegionId",
+        "RegionName",
+        "ServiceCategory",
+        "ServiceName"
+    FROM __schema__.silver_azure_focus s
+    WHERE (v_full_backfill OR s.load_batch_id = '__batch_id__')
+      AND NOT EXISTS (
+          SELECT 1 FROM __schema__.gold_azure_resource_dim_mat d
+          WHERE d.resource_id IS NOT DISTINCT FROM s."ResourceId"
+            AND d.resource_name IS NOT DISTINCT FROM s."ResourceName"
+            AND d.region_id IS NOT DISTINCT FROM s."RegionId"
+            AND d.region_name IS NOT DISTINCT FROM s."RegionName"
+            AND d.service_category IS NOT DISTINCT FROM s."ServiceCategory"
+            AND d.service_name IS NOT DISTINCT FROM s."ServiceName");
+    GET DIAGNOSTICS v_resources = ROW_COUNT;
 
--- METRICS DIM TABLE (NEW)
-CREATE OR REPLACE VIEW __schema__.gold_azure_metric_dim AS
-SELECT DISTINCT
-    metric_name,
-    unit,
-    displaydescription,
-    namespace
-FROM __schema__.silver_azure_vm_metrics
-WHERE metric_name IS NOT NULL;
+    RAISE NOTICE 'gold_azure_fact_cost_mat batch % (months %): % rows removed, % added, % new resources (full backfill: %)',
+        '__batch_id__', v_months, v_deleted, v_inserted, v_resources, v_full_backfill;
+END $$;
 
--- METRICS FACT TABLE (NEW)
-CREATE OR REPLACE VIEW __schema__.gold_azure_fact_vm_metrics AS
-SELECT
-    resource_id,
-    resource_group,
-    subscription_id,
-    timestamp,
-    metric_name,
-    value,
-    unit,
-    vm_name,
-    instance_type,
-    namespace,
-    resourceregion
-FROM __schema__.silver_azure_vm_metrics
-WHERE resource_id IS NOT NULL;
--- fact
-CREATE OR REPLACE VIEW __schema__.gold_azure_fact_cost AS
-SELECT 
-    md5(cast("Tags" AS text)) AS tags_key,
-    "SubAccountId" AS sub_account_id,
-    "ResourceId" AS resource_id,
-    "SkuId" AS sku_id,
-    "x_ResourceGroupName" AS resource_group_name,
-    "ChargePeriodStart" AS charge_period_start,
-    "PricingCategory" AS pricing_category,
-    "PricingUnit" AS pricing_unit,
-    "ListUnitPrice" AS list_unit_price,
-    "ContractedUnitPrice" AS contracted_unit_price,
-    "PricingQuantity" AS pricing_quantity,
-    "BilledCost" AS billed_cost,
-    "ConsumedQuantity" AS consumed_quantity,
-    "ConsumedUnit" AS consumed_unit,
-    "EffectiveCost" AS effective_cost,
-    "ContractedCost" AS contracted_cost,
-    "ListCost" AS list_cost,
-    "x_EffectiveUnitPrice" AS effective_unit_price,
-    "x_BilledCostInUsd" AS billed_cost_in_usd,
-    "x_EffectiveCostInUsd" AS effective_cost_in_usd,
-    "x_ListCostInUsd" AS list_cost_in_usd,
-    "SkuPriceId" AS sku_price_id,
-    "x_SkuMeterName" AS sku_meter_name,
-    "x_SkuMeterSubcategory" AS sku_meter_subcategory,
-    "x_SkuServiceFamily" AS sku_service_family,
-    __budget__::integer as monthly_budget,
-    "hash_key" as hash_key
-FROM __schema__.silver_azure_focus;  
 
-CREATE OR REPLACE FUNCTION azure_tags_view_generation()
+CREATE OR REPLACE FUNCTION __schema__.azure_tags_view_generation()
 RETURNS text AS $$
 DECLARE
     record_tagkey record;
@@ -0,0 +1,92 @@
+-- Gold views. This file runs as a schema migration:
+-- it is applied only when its content (including the embedded budget) changes, so
+-- daily loads no longer take view locks that queue behind dashboard queries.
+
+CREATE OR REPLACE VIEW __schema__.gold_azure_resource_dim AS
+SELECT resource_id, resource_name, region_id, region_name, service_category, service_name
+FROM __schema__.gold_azure_resource_dim_mat;
+
+--charge_summary_dim
+CREATE OR REPLACE VIEW __schema__.gold_azure_charge_summary_dim AS
+SELECT DISTINCT 
+    "SkuId" AS sku_id,
+    "ChargeCategory" AS charge_category,
+    "ChargeClass" AS charge_class,
+    "ChargeDescription" AS charge_description,
+    "ChargeFrequency" AS charge_frequency,
+    "x_SkuDescription" AS x_sku_description
+FROM __schema__.silver_azure_focus;
+
+--azure_account_dim
+CREATE OR REPLACE VIEW __schema__.gold_azure_account_dim AS
+SELECT DISTINCT 
+    "SubAccountId" AS sub_account_id,
+    "SubAccountName" AS sub_account_name,
+    "SubAccountType" AS sub_account_type,
+    "x_AccountId" AS x_account_id,
+    "x_AccountName" AS x_account_name,
+    "x_AccountOwnerId" AS x_account_owner_id,
+    "x_BillingProfileId" AS x_billing_profile_id,
+    "x_BillingProfileName" AS x_billing_profile_name,
+    "BillingAccountId" AS billing_account_id,
+    "BillingAccountName" AS billing_account_name,
+    "BillingAccountType" AS billing_account_type
+FROM __schema__.silver_azure_focus;
+
+-- METRICS DIM TABLE (NEW)
+CREATE OR REPLACE VIEW __schema__.gold_azure_metric_dim AS
+SELECT DISTINCT
+    metric_name,
+    unit,
+    displaydescription,
+    namespace
+FROM __schema__.silver_azure_vm_metrics
+WHERE metric_name IS NOT NULL;
+
+-- METRICS FACT TABLE (NEW)
+CREATE OR REPLACE VIEW __schema__.gold_azure_fact_vm_metrics AS
+SELECT
+    resource_id,
+    resource_group,
+    subscription_id,
+    timestamp,
+    metric_name,
+    value,
+    unit,
+    vm_name,
+    instance_type,
+    namespace,
+    resourceregion
+FROM __schema__.silver_azure_vm_metrics
+WHERE resource_id IS NOT NULL;
+
+CREATE OR REPLACE VIEW __schema__.gold_azure_fact_cost AS
+SELECT
+    tags_key,
+    sub_account_id,
+    resource_id,
+    sku_id,
+    resource_group_name,
+    charge_period_start,
+    pricing_category,
+    pricing_unit,
+    list_unit_price,
+    contracted_unit_price,
+    pricing_quantity,
+    billed_cost,
+    consumed_quantity,
+    consumed_unit,
+    effective_cost,
+    contracted_cost,
+    list_cost,
+    effective_unit_price,
+    billed_cost_in_usd,
+    effective_cost_in_usd,
+    list_cost_in_usd,
+    sku_price_id,
+    sku_meter_name,
+    sku_meter_subcategory,
+    sku_service_family,
+    __budget__::integer as monthly_budget,
+    hash_key
+FROM __schema__.gold_azure_fact_cost_mat;
@@ -90,8 +90,36 @@
 
 
 
+-- Silver is merged from the bronze rows of the current load batch (__batch_id__) on
+-- hash_key. Rows of the restated months that bronze no longer holds are deleted, and all
+-- other months are left alone. The whole merge is one transaction and never truncates,
+-- so readers see either the previous or the new silver and are not blocked.
+-- Exports carry no stable line id, so a restated row with different values counts as one
+-- delete and one insert. A table from before billing-period tracking is backfilled once.
 DO $$
+DECLARE
+    v_full_rebuild boolean := false;
+    v_deleted bigint := 0;
+    v_inserted bigint := 0;
+    v_updated bigint := 0;
+    v_orphaned bigint := 0;
+    v_started_at timestamp := clock_timestamp();
+    v_months date[];
 BEGIN
+    CREATE TABLE IF NOT EXISTS __schema__.silver_refresh_log (
+        id bigserial PRIMARY KEY,
+        table_name text NOT NULL,
+        load_batch_id text,
+        full_backfill boolean NOT NULL DEFAULT false,
+        rows_inserted bigint NOT NULL DEFAULT 0,
+        rows_updated bigint NOT NULL DEFAULT 0,
+        started_at timestamp NOT NULL,
+        finished_at timestamp NOT NULL DEFAULT clock_timestamp()
+    );
+    ALTER TABLE __schema__.silver_refresh_log ADD COLUMN IF NOT EXISTS rows_deleted bigint NOT NULL DEFAULT 0;
+    -- Billing months the batch merged, which gold refreshes
+    ALTER TABLE __schema__.silver_refresh_log ADD COLUMN IF NOT EXISTS billing_months date[];
+
     -- Check if the silver table exists
     IF NOT EXISTS (
         SELECT FROM information_schema.tables 
@@ -145,14 +173,26 @@ BEGIN
             "x_SkuMeterName" TEXT,
             "x_SkuMeterSubcategory" TEXT,
             "x_SkuServiceFamily" TEXT,
-            "hash_key" TEXT PRIMARY KEY 
+            "hash_key" TEXT PRIMARY KEY,
+            "BillingPeriodStart" DATE,
+            load_batch_id TEXT
         );
-    ELSE
-        -- Truncate the silver table if it already exists
-        TRUNCATE TABLE __schema__.silver_azure_focus;
+        v_full_rebuild := true;
+    ELSIF NOT EXISTS (
+        SELECT FROM information_schema.columns
+        WHERE table_schema = '__schema__'
+        AND table_name = 'silver_azure_focus'
+        AND column_name = 'BillingPeriodStart'
+    ) THEN
+        ALTER TABLE __schema__.silver_azure_focus ADD COLUMN "BillingPeriodStart" DATE;
+        v_full_rebuild := true;
     END IF;
+    ALTER TABLE __schema__.silver_azure_focus ADD COLUMN IF NOT EXISTS load_batch_id TEXT;
+    CREATE INDEX IF NOT EXISTS silver_azure_focus_billing_period_idx ON __schema__.silver_azure_focus ("BillingPeriodStart");
+    CREATE INDEX IF NOT EXISTS silver_azure_focus_load_batch_idx ON __schema__.silver_azure_focus (load_batch_id);
 
     -- Insert data with robust JSON sanitization and validation
+    WITH upserted AS (
     INSERT INTO __schema__.silver_azure_focus (
         "BilledCost", "BillingAccountId", "BillingAccountName", "BillingAccountType", 
         "ChargePeriodStart", "ChargeCategory", "ChargeClass", "ChargeDescription", 
@@ -165,11 +205,11 @@ BEGIN
         "x_BilledCostInUsd", "x_BillingProfileId", "x_BillingProfileName", 
         "x_EffectiveCostInUsd", "x_EffectiveUnitPrice", "x_ListCostInUsd", 
         "x_ResourceGroupName", "x_SkuDescription", "x_SkuMeterName", 
-        "x_SkuMeterSubcategory", "x_SkuServiceFamily", "hash_key"
+        "x_SkuMeterSubcategory", "x_SkuServiceFamily", "hash_key", "BillingPeriodStart", load_batch_id
     )
     SELECT 
         "BilledCost", "BillingAccountId", "BillingAccountName", "BillingAccountType",
-        SUBSTRING("ChargePeriodStart", 1, 10)::DATE AS ChargePeriodStart,
+        SUBSTRING("ChargePeriodStart"::text, 1, 10)::DATE AS ChargePeriodStart,
         "ChargeCategory", "ChargeClass", "ChargeDescription", "ChargeFrequency", 
         "ConsumedQuantity", "ConsumedUnit", "ContractedCost", "ContractedUnitPrice", 
         "EffectiveCost", "ListCost", "ListUnitPrice", "PricingCategory", 
@@ -185,7 +225,51 @@ BEGIN
         "x_BillingProfileId", "x_BillingProfileName", "x_EffectiveCostInUsd", 
         "x_EffectiveUnitPrice", "x_ListCostInUsd", "x_ResourceGroupName", 
         "x_SkuDescription", "x_SkuMeterName", "x_SkuMeterSubcategory", 
-        "x_SkuServiceFamily", "hash_key"
-    FROM __schema__.bronze_azure_focus;
+        "x_SkuServiceFamily",
+        encode("hash_key", 'hex'),  -- bronze keys are binary digests; silver keeps the hex form
+        "BillingPeriodStart"::DATE,
+        load_batch_id
+    FROM __schema__.bronze_azure_focus
+    WHERE load_batch_id = '__batch_id__' OR v_full_rebuild
+    -- The key covers every column, so an existing row only moves to the new batch
+    ON CONFLICT (hash_key) DO UPDATE
+        SET load_batch_id = EXCLUDED.load_batch_id,
+            "BillingPeriodStart" = EXCLUDED."BillingPeriodStart"
+    RETURNING (xmax = 0) AS inserted
+    )
+    SELECT
+        count(*) FILTER (WHERE inserted),
+        count(*) FILTER (WHERE NOT inserted)
+    INTO v_inserted, v_updated
+    FROM upserted;
+
+    SELECT coalesce(array_agg(DISTINCT date_trunc('month', "BillingPeriodStart")::date), '{}')
+    INTO v_months
+    FROM __schema__.bronze_azure_focus
+    WHERE load_batch_id = '__batch_id__' OR v_full_rebuild;
+
+    -- Rows dropped from a restated month; bronze lookups hit one partition each
+    DELETE FROM __schema__.silver_azure_focus s
+    USING unnest(v_months) AS restated(month_start)
+    WHERE s."BillingPeriodStart" >= restated.month_start
+      AND s."BillingPeriodStart" < restated.month_start + interval '1 month'
+      AND NOT EXISTS (
+          SELECT 1 FROM __schema__.bronze_azure_focus b
+          WHERE b.hash_key = decode(s.hash_key, 'hex')
+            AND b."BillingPeriodStart" >= restated.month_start
+            AND b."BillingPeriodStart" < restated.month_start + interval '1 month');
+    GET DIAGNOSTICS v_deleted = ROW_COUNT;
+
+    IF v_full_rebuild THEN
+        -- Rows of a backfilled table that bronze no longer holds have no billing period
+        DELETE FROM __schema__.silver_azure_focus WHERE "BillingPeriodStart" IS NULL;
+        GET DIAGNOSTICS v_orphaned = ROW_COUNT;
+        v_deleted := v_deleted + v_orphaned;
+    END IF;
+
+    INSERT INTO __schema__.silver_refresh_log (table_name, load_batch_id, full_backfill, rows_inserted, rows_updated, rows_deleted, billing_months, started_at)
+    VALUES ('silver_azure_focus', '__batch_id__', v_full_rebuild, v_inserted, v_updated, v_deleted, v_months, v_started_at);
 
+    RAISE NOTICE 'silver_azure_focus batch %: % inserted, % updated, % deleted (full rebuild: %)',
+        '__batch_id__', v_inserted, v_updated, v_deleted, v_full_rebuild;
 END $$;
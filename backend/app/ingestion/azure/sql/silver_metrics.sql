@@ -61,8 +61,11 @@ BEGIN
             instance_type,
             hash_key
         FROM __schema__.bronze_azure_vm_metrics
-        -- 💡 INCREMENTAL LOGIC: If a record with this hash_key exists in Silver, skip insertion.
-        ON CONFLICT (hash_key) DO NOTHING
+        -- 💡 INCREMENTAL LOGIC: hash_key identifies a datapoint, so a datapoint collected
+        -- again only updates its value.
+        ON CONFLICT (hash_key) DO UPDATE
+        SET value = EXCLUDED.value
+        WHERE __schema__.silver_azure_vm_metrics.value IS DISTINCT FROM EXCLUDED.value
     ';
 
     -- STEP 4: Clean up Bronze
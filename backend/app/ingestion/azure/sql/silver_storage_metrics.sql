@@ -107,5 +107,8 @@ WHERE
     -- OPTIONAL: Add filtering here if you only want to process new records
     -- e.g., WHERE t1.ingested_at > (SELECT MAX(processed_at) FROM __schema__.silver_azure_storage_metrics_clean)
 
--- Handling duplicates: Ensures the insert is idempotent based on the primary key
-ON CONFLICT (metric_observation_id) DO NOTHING;
\ No newline at end of file
+-- Handling duplicates: hash_key identifies a datapoint, so a datapoint collected again
+-- only updates its value
+ON CONFLICT (metric_observation_id) DO UPDATE
+SET value = EXCLUDED.value, processed_at = now()
+WHERE __schema__.silver_azure_storage_metrics_clean.value IS DISTINCT FROM EXCLUDED.value;
\ No newline at end of file
@@ -0,0 +1,100 @@
+"""
+COPY-based loading of typed frames into bronze tables.
+
+Frames coerced with `coerce_dataframe` are encoded column by column from the registered
+Postgres type (bytea keys as hex, booleans as t/f, timestamps in ISO format, jsonb as
+JSON text) and streamed with one COPY into a temporary stage shaped like the target
+table. Arrow tables coerced with `coerce_arrow` are written as CSV by Arrow itself, with
+only their keys rendered in Python. The stage is merged with INSERT ... SELECT ... ON
+CONFLICT DO NOTHING, so rows whose key is already stored are skipped by the database
+instead of by comparing keys in Python. Empty strings are loaded as NULL, as the
+execute_values loaders did.
+
+The helpers take a cursor and leave commits to the caller. Provider postgres modules
+wrap them with their own `@connection` decorator.
+"""
+import csv
+import io
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from psycopg2 import sql
+from app.ingestion.focus_schema import get_schema, KEY_COLUMN, BYTEA, BOOLEAN, TIMESTAMP, TIMESTAMPTZ
+
+
+def _encode(value, pg_type):
+    """Render one value as a COPY CSV field; None (and "") become NULL."""
+    if value is None:
+        return None
+    if pg_type == BYTEA:
+        return "\\x" + bytes(value).hex()
+    if pg_type == BOOLEAN:
+        return "t" if value else "f"
+    if pg_type in (TIMESTAMP, TIMESTAMPTZ):
+        return value.isoformat()
+    if isinstance(value, float):
+        return repr(float(value))
+    return str(value) if value != "" else None
+
+
+def _copy_buffer(frame, types):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    encoders = [types.get(column) for column in frame.columns]
+    for row in frame.itertuples(index=False, name=None):
+        writer.writerow([_encode(value, pg_type) for value, pg_type in zip(row, encoders)])
+    buffer.seek(0)
+    return buffer
+
+
+def _arrow_copy_buffer(table, key_column):
+    keys = [None if key is None else "\\x" + key.hex() for key in table.column(key_column).to_pylist()]
+    table = table.set_column(table.column_names.index(key_column), key_column, pa.array(keys, pa.string()))
+    buffer = io.BytesIO()
+    pa_csv.write_csv(table, buffer, pa_csv.WriteOptions(include_header=False))
+    buffer.seek(0)
+    return buffer
+
+
+def copy_new_rows(cursor, frame, provider, schema_name, table_name, key_column=KEY_COLUMN, seen_keys=None):
+    """
+    Load a coerced frame, skipping rows whose key is already in the table.
+
+    Args:
+        frame (pd.DataFrame | pa.Table): Output of `coerce_dataframe`, or of `coerce_arrow`
+            with binary keys, for `provider`.
+        provider (str): Registry key used to encode the columns, e.g. 'gcp_focus'.
+        seen_keys (str): Temporary table with a `key_column` column that collects the key
+            of every row in the frame, inserted or not. Not collected when None.
+
+    Returns:
+        int: Number of rows inserted.
+    """
+    if isinstance(frame, pa.Table):
+        if frame.num_rows == 0:
+            return 0
+        # Keys repeated within the table are skipped by the insert's conflict clause
+        column_names = frame.column_names
+        buffer = _arrow_copy_buffer(frame, key_column)
+    else:
+        if frame.empty:
+            return 0
+        frame = frame.drop_duplicates(subset=[key_column])
+        column_names = list(frame.columns)
+        buffer = _copy_buffer(frame, dict(get_schema(provider), **{key_column: BYTEA}))
+    columns = sql.SQL(", ").join(sql.Identifier(c) for c in column_names)
+    stage = sql.Identifier(f"{table_name}_stage")
+
+    cursor.execute(sql.SQL("CREATE TEMP TABLE IF NOT EXISTS {} (LIKE {}.{} INCLUDING DEFAULTS) ON COMMIT DROP").format(
+        stage, sql.Identifier(schema_name), sql.Identifier(table_name)))
+    cursor.copy_expert(sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+        stage, columns).as_string(cursor), buffer)
+    cursor.execute(sql.SQL(
+        "INSERT INTO {}.{} ({columns}) SELECT {columns} FROM {} ON CONFLICT ({}) DO NOTHING"
+    ).format(sql.Identifier(schema_name), sql.Identifier(table_name), stage, sql.Identifier(key_column),
+             columns=columns))
+    inserted = cursor.rowcount
+    if seen_keys:
+        cursor.execute(sql.SQL("INSERT INTO {} ({key}) SELECT {key} FROM {} ON CONFLICT DO NOTHING").format(
+            sql.Identifier(seen_keys), stage, key=sql.Identifier(key_column)))
+    cursor.execute(sql.SQL("TRUNCATE {}").format(stage))
+    return inserted
@@ -1,4 +1,5 @@
 from app.ingestion.dashboard.postgres_operations import run_sql_file
+from app.ingestion.sql_runner import SqlPipeline
 import json
 from fastapi import HTTPException
 from tortoise.exceptions import DoesNotExist
@@ -72,8 +73,10 @@ async def create_dashboard_view(project_ids, project_names, cloud_platforms, das
         run_sql_file(f'{base_path}/sql/consolidated_data.sql', schemas_and_tables_json, dashboard_name)
         print(f"Schema {schema_name} created successfully.")
 
-        # Execute SQL file using the consolidated JSON
-        run_sql_file(f'{base_path}/sql/consolidated_views.sql', schemas_and_tables_json, dashboard_name)
+        # The views are versioned in the dashboard schema and only replaced when they change
+        views_pipeline = SqlPipeline('dashboard', dashboard_name, {'dashboardname': dashboard_name, 'budget': 0})
+        views_pipeline.add_migration('consolidated_views', f'{base_path}/sql/consolidated_views.sql')
+        views_pipeline.run()
         print(f"views created successfully.")
 
         return True
@@ -7,13 +7,12 @@ DECLARE
 
     insert_query TEXT;
     schema_rec RECORD;
+    key_expr TEXT;
 
 BEGIN
     -- Create the target schema if it doesn't exist
     EXECUTE 'CREATE SCHEMA IF NOT EXISTS ' || quote_ident(target_schema);
 
-    -- Drop and recreate the consolidated table
-    EXECUTE 'DROP TABLE IF EXISTS ' || quote_ident(target_schema) || '.' || quote_ident(target_table) || ' CASCADE';
     -- Create the consolidated table if it doesn't exist
     EXECUTE '
     CREATE TABLE IF NOT EXISTS ' || quote_ident(target_schema) || '.' || quote_ident(target_table) || ' (
@@ -56,6 +55,9 @@ BEGIN
         SubAccountId TEXT,
         Tags TEXT
     )';
+    -- Empty it instead of dropping it, so the views built on it (consolidated_views.sql)
+    -- survive and only need recreating when their definition changes
+    EXECUTE 'TRUNCATE TABLE ' || quote_ident(target_schema) || '.' || quote_ident(target_table);
 
     -- Loop through each schema and table
     FOR schema_rec IN 
@@ -64,6 +66,14 @@ BEGIN
             (json_array_elements(schemas_and_tables)->>'table') AS source_table,
             (json_array_elements(schemas_and_tables)->>'cloud') AS cloud_source
     LOOP
+        -- Bronze keys are binary digests; a source not yet converted still holds hex text
+        SELECT CASE WHEN data_type = 'bytea' THEN 'encode(hash_key, ''hex'')' ELSE 'hash_key' END
+        INTO key_expr
+        FROM information_schema.columns
+        WHERE table_schema = schema_rec.source_schema
+          AND table_name = schema_rec.source_table
+          AND column_name = 'hash_key';
+
         -- Dynamically build the INSERT query
         insert_query := '
             INSERT INTO ' || quote_ident(target_schema) || '.' || quote_ident(target_table) || ' (
@@ -108,7 +118,7 @@ BEGIN
             )
             SELECT 
                 ''' || schema_rec.cloud_source || ''' AS cloud_source,
-                hash_key,
+                ' || coalesce(key_expr, 'hash_key') || ' AS hash_key,
                 CAST("BilledCost" AS NUMERIC),
                 "BillingAccountId",
                 "BillingCurrency",
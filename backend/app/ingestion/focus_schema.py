@@ -0,0 +1,756 @@
+"""
+Declarative column schemas for the billing exports loaded into bronze.
+
+Each provider maps its source columns to the Postgres type the bronze table stores
+them as. The registry drives type coercion before loading, bronze table DDL and
+schema-drift reporting, so silver and gold no longer have to recast text into
+numbers, timestamps and JSON on every query.
+"""
+import ast
+import json
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from psycopg2 import sql
+
+TEXT = "text"
+DOUBLE = "double precision"
+BIGINT = "bigint"
+BOOLEAN = "boolean"
+TIMESTAMP = "timestamp without time zone"
+TIMESTAMPTZ = "timestamp with time zone"
+JSONB = "jsonb"
+BYTEA = "bytea"
+
+# Bronze dedup keys are the raw 16-byte md5 digest rather than its 32-character hex text
+KEY_TYPE = BYTEA
+KEY_LENGTH = 16
+
+# AWS Data Exports, FOCUS 1.0 with AWS columns
+AWS_FOCUS = {
+    "AvailabilityZone": TEXT,
+    "BilledCost": DOUBLE,
+    "BillingAccountId": TEXT,
+    "BillingAccountName": TEXT,
+    "BillingCurrency": TEXT,
+    "BillingPeriodEnd": TIMESTAMP,
+    "BillingPeriodStart": TIMESTAMP,
+    "ChargeCategory": TEXT,
+    "ChargeClass": TEXT,
+    "ChargeDescription": TEXT,
+    "ChargeFrequency": TEXT,
+    "ChargePeriodEnd": TIMESTAMP,
+    "ChargePeriodStart": TIMESTAMP,
+    "CommitmentDiscountCategory": TEXT,
+    "CommitmentDiscountId": TEXT,
+    "CommitmentDiscountName": TEXT,
+    "CommitmentDiscountStatus": TEXT,
+    "CommitmentDiscountType": TEXT,
+    "ConsumedQuantity": DOUBLE,
+    "ConsumedUnit": TEXT,
+    "ContractedCost": DOUBLE,
+    "ContractedUnitPrice": DOUBLE,
+    "EffectiveCost": DOUBLE,
+    "InvoiceIssuerName": TEXT,
+    "ListCost": DOUBLE,
+    "ListUnitPrice": DOUBLE,
+    "PricingCategory": TEXT,
+    "PricingQuantity": DOUBLE,
+    "PricingUnit": TEXT,
+    "ProviderName": TEXT,
+    "PublisherName": TEXT,
+    "RegionId": TEXT,
+    "RegionName": TEXT,
+    "ResourceId": TEXT,
+    "ResourceName": TEXT,
+    "ResourceType": TEXT,
+    "ServiceCategory": TEXT,
+    "ServiceName": TEXT,
+    "SkuId": TEXT,
+    "SkuPriceId": TEXT,
+    "SubAccountId": TEXT,
+    "SubAccountName": TEXT,
+    "Tags": JSONB,
+    "x_CostCategories": JSONB,
+    "x_Discounts": JSONB,
+    "x_Operation": TEXT,
+    "x_ServiceCode": TEXT,
+    "x_UsageType": TEXT,
+}
+
+# AWS Data Exports, CUR 2.0 standard table
+AWS_CUR2 = {
+    "bill_bill_type": TEXT,
+    "bill_billing_entity": TEXT,
+    "bill_billing_period_end_date": TIMESTAMP,
+    "bill_billing_period_start_date": TIMESTAMP,
+    "bill_invoice_id": TEXT,
+    "bill_invoicing_entity": TEXT,
+    "bill_payer_account_id": TEXT,
+    "bill_payer_account_name": TEXT,
+    "cost_category": JSONB,
+    "discount": JSONB,
+    "discount_bundled_discount": DOUBLE,
+    "discount_total_discount": DOUBLE,
+    "identity_line_item_id": TEXT,
+    "identity_time_interval": TEXT,
+    "line_item_availability_zone": TEXT,
+    "line_item_blended_cost": DOUBLE,
+    "line_item_blended_rate": TEXT,
+    "line_item_currency_code": TEXT,
+    "line_item_legal_entity": TEXT,
+    "line_item_line_item_description": TEXT,
+    "line_item_line_item_type": TEXT,
+    "line_item_net_unblended_cost": DOUBLE,
+    "line_item_net_unblended_rate": TEXT,
+    "line_item_normalization_factor": DOUBLE,
+    "line_item_normalized_usage_amount": DOUBLE,
+    "line_item_operation": TEXT,
+    "line_item_product_code": TEXT,
+    "line_item_resource_id": TEXT,
+    "line_item_tax_type": TEXT,
+    "line_item_unblended_cost": DOUBLE,
+    "line_item_unblended_rate": TEXT,
+    "line_item_usage_account_id": TEXT,
+    "line_item_usage_account_name": TEXT,
+    "line_item_usage_amount": DOUBLE,
+    "line_item_usage_end_date": TIMESTAMP,
+    "line_item_usage_start_date": TIMESTAMP,
+    "line_item_usage_type": TEXT,
+    "pricing_currency": TEXT,
+    "pricing_lease_contract_length": TEXT,
+    "pricing_offering_class": TEXT,
+    "pricing_public_on_demand_cost": DOUBLE,
+    "pricing_public_on_demand_rate": TEXT,
+    "pricing_purchase_option": TEXT,
+    "pricing_rate_code": TEXT,
+    "pricing_rate_id": TEXT,
+    "pricing_term": TEXT,
+    "pricing_unit": TEXT,
+    "product": JSONB,
+    "product_comment": TEXT,
+    "product_fee_code": TEXT,
+    "product_fee_description": TEXT,
+    "product_from_location": TEXT,
+    "product_from_location_type": TEXT,
+    "product_from_region_code": TEXT,
+    "product_instance_family": TEXT,
+    "product_instance_type": TEXT,
+    "product_instancesku": TEXT,
+    "product_location": TEXT,
+    "product_location_type": TEXT,
+    "product_operation": TEXT,
+    "product_pricing_unit": TEXT,
+    "product_product_family": TEXT,
+    "product_region_code": TEXT,
+    "product_servicecode": TEXT,
+    "product_sku": TEXT,
+    "product_to_location": TEXT,
+    "product_to_location_type": TEXT,
+    "product_to_region_code": TEXT,
+    "product_usagetype": TEXT,
+    "reservation_amortized_upfront_cost_for_usage": DOUBLE,
+    "reservation_amortized_upfront_fee_for_billing_period": DOUBLE,
+    "reservation_availability_zone": TEXT,
+    "reservation_effective_cost": DOUBLE,
+    "reservation_end_time": TEXT,
+    "reservation_modification_status": TEXT,
+    "reservation_net_effective_cost": DOUBLE,
+    "reservation_normalized_units_per_reservation": TEXT,
+    "reservation_number_of_reservations": TEXT,
+    "reservation_recurring_fee_for_usage": DOUBLE,
+    "reservation_reservation_a_r_n": TEXT,
+    "reservation_start_time": TEXT,
+    "reservation_subscription_id": TEXT,
+    "reservation_total_reserved_normalized_units": TEXT,
+    "reservation_total_reserved_units": TEXT,
+    "reservation_units_per_reservation": TEXT,
+    "reservation_unused_amortized_upfront_fee_for_billing_period": DOUBLE,
+    "reservation_unused_normalized_unit_quantity": DOUBLE,
+    "reservation_unused_quantity": DOUBLE,
+    "reservation_unused_recurring_fee": DOUBLE,
+    "reservation_upfront_value": DOUBLE,
+    "resource_tags": JSONB,
+    "savings_plan_amortized_upfront_commitment_for_billing_period": DOUBLE,
+    "savings_plan_net_savings_plan_effective_cost": DOUBLE,
+    "savings_plan_recurring_commitment_for_billing_period": DOUBLE,
+    "savings_plan_savings_plan_a_r_n": TEXT,
+    "savings_plan_savings_plan_effective_cost": DOUBLE,
+    "savings_plan_savings_plan_rate": DOUBLE,
+    "savings_plan_total_commitment_to_date": DOUBLE,
+    "savings_plan_used_commitment": DOUBLE,
+}
+
+# Azure Cost Management FOCUS export
+AZURE_FOCUS = {
+    "BilledCost": DOUBLE,
+    "BillingAccountId": TEXT,
+    "BillingAccountName": TEXT,
+    "BillingAccountType": TEXT,
+    "BillingCurrency": TEXT,
+    "BillingPeriodEnd": TIMESTAMP,
+    "BillingPeriodStart": TIMESTAMP,
+    "ChargeCategory": TEXT,
+    "ChargeClass": TEXT,
+    "ChargeDescription": TEXT,
+    "ChargeFrequency": TEXT,
+    "ChargePeriodEnd": TIMESTAMP,
+    "ChargePeriodStart": TIMESTAMP,
+    "CommitmentDiscountCategory": TEXT,
+    "CommitmentDiscountId": TEXT,
+    "CommitmentDiscountName": TEXT,
+    "CommitmentDiscountStatus": TEXT,
+    "CommitmentDiscountType": TEXT,
+    "ConsumedQuantity": DOUBLE,
+    "ConsumedUnit": TEXT,
+    "ContractedCost": DOUBLE,
+    "ContractedUnitPrice": DOUBLE,
+    "EffectiveCost": DOUBLE,
+    "InvoiceIssuerName": TEXT,
+    "ListCost": DOUBLE,
+    "ListUnitPrice": DOUBLE,
+    "PricingCategory": TEXT,
+    "PricingQuantity": DOUBLE,
+    "PricingUnit": TEXT,
+    "ProviderName": TEXT,
+    "PublisherName": TEXT,
+    "RegionId": TEXT,
+    "RegionName": TEXT,
+    "ResourceId": TEXT,
+    "ResourceName": TEXT,
+    "ResourceType": TEXT,
+    "ServiceCategory": TEXT,
+    "ServiceName": TEXT,
+    "SkuId": TEXT,
+    "SkuPriceId": TEXT,
+    "SubAccountId": TEXT,
+    "SubAccountName": TEXT,
+    "SubAccountType": TEXT,
+    "Tags": JSONB,
+    "x_AccountId": TEXT,
+    "x_AccountName": TEXT,
+    "x_AccountOwnerId": TEXT,
+    "x_BilledCostInUsd": DOUBLE,
+    "x_BilledUnitPrice": DOUBLE,
+    "x_BillingAccountId": TEXT,
+    "x_BillingAccountName": TEXT,
+    "x_BillingExchangeRate": DOUBLE,
+    "x_BillingExchangeRateDate": TIMESTAMP,
+    "x_BillingProfileId": TEXT,
+    "x_BillingProfileName": TEXT,
+    "x_ContractedCostInUsd": DOUBLE,
+    "x_CostAllocationRuleName": TEXT,
+    "x_CostCenter": TEXT,
+    "x_CustomerId": TEXT,
+    "x_CustomerName": TEXT,
+    "x_EffectiveCostInUsd": DOUBLE,
+    "x_EffectiveUnitPrice": DOUBLE,
+    "x_InvoiceId": TEXT,
+    "x_InvoiceIssuerId": TEXT,
+    "x_InvoiceSectionId": TEXT,
+    "x_InvoiceSectionName": TEXT,
+    "x_ListCostInUsd": DOUBLE,
+    "x_PartnerCreditApplied": TEXT,
+    "x_PartnerCreditRate": DOUBLE,
+    "x_PricingBlockSize": DOUBLE,
+    "x_PricingCurrency": TEXT,
+    "x_PricingSubcategory": TEXT,
+    "x_PricingUnitDescription": TEXT,
+    "x_PublisherCategory": TEXT,
+    "x_PublisherId": TEXT,
+    "x_ResellerId": TEXT,
+    "x_ResellerName": TEXT,
+    "x_ResourceGroupName": TEXT,
+    "x_ResourceType": TEXT,
+    "x_ServicePeriodEnd": TIMESTAMP,
+    "x_ServicePeriodStart": TIMESTAMP,
+    "x_SkuDescription": TEXT,
+    "x_SkuDetails": JSONB,
+    "x_SkuIsCreditEligible": BOOLEAN,
+    "x_SkuMeterCategory": TEXT,
+    "x_SkuMeterId": TEXT,
+    "x_SkuMeterName": TEXT,
+    "x_SkuMeterSubcategory": TEXT,
+    "x_SkuOfferId": TEXT,
+    "x_SkuOrderId": TEXT,
+    "x_SkuOrderName": TEXT,
+    "x_SkuPartNumber": TEXT,
+    "x_SkuRegion": TEXT,
+    "x_SkuServiceFamily": TEXT,
+    "x_SkuTerm": TEXT,
+    "x_SkuTier": TEXT,
+}
+
+# BigQuery billing export rendered through the focus_format_temp view
+GCP_FOCUS = {
+    "AvailabilityZone": TEXT,
+    "BilledCost": DOUBLE,
+    "BillingAccountId": TEXT,
+    "BillingCurrency": TEXT,
+    "BillingPeriodStart": TIMESTAMPTZ,
+    "BillingPeriodEnd": TIMESTAMPTZ,
+    "ChargeCategory": TEXT,
+    "ChargeClass": TEXT,
+    "ChargeDescription": TEXT,
+    "ChargePeriodStart": TIMESTAMPTZ,
+    "ChargePeriodEnd": TIMESTAMPTZ,
+    "CommitmentDiscountCategory": TEXT,
+    "CommitmentDiscountId": TEXT,
+    "CommitmentDiscountName": TEXT,
+    "ConsumedQuantity": DOUBLE,
+    "ConsumedUnit": TEXT,
+    "ContractedCost": DOUBLE,
+    "ContractedUnitPrice": DOUBLE,
+    "EffectiveCost": DOUBLE,
+    "ListCost": DOUBLE,
+    "ListUnitPrice": DOUBLE,
+    "PricingCategory": TEXT,
+    "PricingQuantity": DOUBLE,
+    "PricingUnit": TEXT,
+    "ProviderName": TEXT,
+    "PublisherName": TEXT,
+    "RegionId": TEXT,
+    "RegionName": TEXT,
+    "ResourceId": TEXT,
+    "ResourceName": TEXT,
+    "ResourceType": TEXT,
+    "ServiceCategory": TEXT,
+    "ServiceName": TEXT,
+    "SkuId": TEXT,
+    "SkuPriceId": TEXT,
+    "SubAccountId": TEXT,
+    "Tags": JSONB,
+    "x_Credits": JSONB,
+    "x_CostType": TEXT,
+    "x_CurrencyConversionRate": DOUBLE,
+    "x_ExportTime": TIMESTAMPTZ,
+    "x_Location": TEXT,
+    "x_ProjectId": TEXT,
+    "x_ProjectNumber": TEXT,
+    "x_ProjectName": TEXT,
+    "x_ProjectAncestryNumbers": TEXT,
+    "x_ProjectAncestors": JSONB,
+    "x_Project": JSONB,
+    "x_ServiceId": TEXT,
+}
+
+SCHEMAS = {
+    "aws_focus": AWS_FOCUS,
+    "aws_cur2": AWS_CUR2,
+    "azure_focus": AZURE_FOCUS,
+    "gcp_focus": GCP_FOCUS,
+}
+
+# Columns added by the pipeline rather than the source export
+PIPELINE_COLUMNS = ("hash_key",)
+KEY_COLUMN = "hash_key"
+
+
+def get_schema(provider):
+    """Return the column -> Postgres type mapping registered for a provider."""
+    try:
+        return SCHEMAS[provider]
+    except KeyError:
+        raise ValueError(f"No column schema registered for provider '{provider}'")
+
+
+def report_schema_drift(columns, provider, extra_columns=PIPELINE_COLUMNS):
+    """
+    Compare incoming columns to the registry and print anything unexpected.
+
+    Args:
+        columns (Iterable[str]): Columns present in the incoming frame.
+        provider (str): Registry key, e.g. 'aws_focus'.
+        extra_columns (Iterable[str]): Pipeline-generated columns that are always allowed.
+
+    Returns:
+        dict: {'unexpected': [...], 'missing': [...]}
+    """
+    schema = get_schema(provider)
+    columns = list(columns)
+    unexpected = [c for c in columns if c not in schema and c not in extra_columns]
+    missing = [c for c in schema if c not in columns]
+    if unexpected:
+        print(f"Schema drift for {provider}: unexpected columns {unexpected} will not be loaded.")
+    if missing:
+        print(f"Schema drift for {provider}: {len(missing)} registered columns missing from source: {missing}")
+    return {"unexpected": unexpected, "missing": missing}
+
+
+def _is_missing(value):
+    return not isinstance(value, (str, list, tuple, dict, np.ndarray)) and pd.isna(value)
+
+
+def _to_json_value(value):
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    elif _is_missing(value):
+        return None
+    if isinstance(value, str):
+        if value in ("", "nan", "None"):
+            return None
+        try:
+            value = json.loads(value)
+        except ValueError:
+            # Frames that went through CSV carry the Python repr of maps and structs
+            try:
+                value = ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                return None
+    if isinstance(value, (list, tuple)):
+        items = [v.tolist() if isinstance(v, np.ndarray) else v for v in value]
+        # Arrow map columns arrive as a list of (key, value) pairs
+        if items and all(isinstance(v, (list, tuple)) and len(v) == 2 for v in items):
+            value = {str(k): v for k, v in items}
+        else:
+            value = items
+    return json.dumps(value, default=str)
+
+
+def _to_boolean(value):
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in ("true", "1", "yes"):
+            return True
+        if lowered in ("false", "0", "no"):
+            return False
+        return None
+    if _is_missing(value):
+        return None
+    return bool(value)
+
+
+def key_digest(hash_key):
+    """Return the binary form of a hex md5 row key, as stored in bronze."""
+    if hash_key is None or isinstance(hash_key, bytes):
+        return hash_key
+    return bytes.fromhex(hash_key)
+
+
+def _to_text(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, np.ndarray):
+        return str(value.tolist())
+    if _is_missing(value):
+        return None
+    return str(value)
+
+
+def coerce_dataframe(df, provider, extra_columns=PIPELINE_COLUMNS):
+    """
+    Cast a frame to the registered Postgres types, ready for loading.
+
+    A loader keys rows either from the values as read, hashing before this call, or from
+    the cast values, hashing after it; switching between the two changes every key. A
+    hex key already in `hash_key` is converted to its binary digest. Unexpected columns are
+    reported and dropped so new export columns cannot break the insert. Missing values
+    become None for every type.
+
+    Args:
+        df (pd.DataFrame): Frame as read from the export.
+        provider (str): Registry key, e.g. 'azure_focus'.
+        extra_columns (Iterable[str]): Pipeline-generated columns to keep unchanged.
+
+    Returns:
+        pd.DataFrame: A new frame holding only registered and pipeline columns.
+    """
+    schema = get_schema(provider)
+    drift = report_schema_drift(df.columns, provider, extra_columns)
+    df = df.drop(columns=drift["unexpected"])
+
+    for column in df.columns:
+        if column == KEY_COLUMN:
+            df[column] = df[column].map(key_digest)
+            continue
+        pg_type = schema.get(column)
+        if pg_type is None:
+            continue
+        if pg_type in (DOUBLE, BIGINT):
+            df[column] = pd.to_numeric(df[column], errors="coerce")
+            if pg_type == BIGINT:
+                df[column] = df[column].round().astype("Int64")
+        elif pg_type in (TIMESTAMP, TIMESTAMPTZ):
+            parsed = pd.to_datetime(df[column], errors="coerce", utc=True)
+            df[column] = parsed.dt.tz_localize(None) if pg_type == TIMESTAMP else parsed
+        elif pg_type == BOOLEAN:
+            df[column] = df[column].map(_to_boolean)
+        elif pg_type == JSONB:
+            df[column] = df[column].map(_to_json_value)
+        else:
+            df[column] = df[column].map(_to_text)
+
+    df = df.astype(object)
+    return df.where(pd.notna(df), None)
+
+
+_ARROW_TYPES = {
+    DOUBLE: pa.float64(),
+    BIGINT: pa.int64(),
+    BOOLEAN: pa.bool_(),
+    TIMESTAMP: pa.timestamp("us"),
+    TIMESTAMPTZ: pa.timestamp("us", tz="UTC"),
+}
+
+
+def _python_values(column, convert):
+    return pa.chunked_array([pa.array([convert(value) for value in column.to_pylist()], pa.string())])
+
+
+def _arrow_text(column):
+    """Text column with empty strings as null; nested values keep their Python text."""
+    if pa.types.is_nested(column.type):
+        column = _python_values(column, _to_text)
+    elif not pa.types.is_string(column.type):
+        column = pc.cast(column, pa.string())
+    return pc.if_else(pc.equal(column, ""), pa.scalar(None, pa.string()), column)
+
+
+def coerce_arrow(table, provider, extra_columns=PIPELINE_COLUMNS):
+    """
+    Cast an Arrow table to the registered Postgres types, like `coerce_dataframe` does
+    for frames, without converting it to pandas.
+
+    Numbers, booleans and timestamps are cast by Arrow; naive timestamps are taken as
+    UTC. jsonb columns become JSON text and structured values in text columns their
+    Python text, as `coerce_dataframe` renders them. Empty strings become null.
+
+    Args:
+        table (pa.Table): Rows as read from the export.
+        provider (str): Registry key, e.g. 'gcp_focus'.
+        extra_columns (Iterable[str]): Pipeline-generated columns to keep unchanged.
+
+    Returns:
+        pa.Table: Only the registered and pipeline columns.
+    """
+    schema = get_schema(provider)
+    drift = report_schema_drift(table.column_names, provider, extra_columns)
+    table = table.drop_columns(drift["unexpected"])
+
+    for index, name in enumerate(table.column_names):
+        pg_type = schema.get(name)
+        if pg_type is None:
+            continue
+        column = table.column(index)
+        if pg_type in _ARROW_TYPES:
+            column = pc.cast(column, _ARROW_TYPES[pg_type], safe=False)
+        elif pg_type == JSONB:
+            column = _python_values(column, _to_json_value)
+        else:
+            column = _arrow_text(column)
+        table = table.set_column(index, name, column)
+    return table
+
+
+def csv_dtypes(provider):
+    """
+    Return `read_csv` dtypes for a provider's exports: numeric columns as float64 and
+    everything else, unregistered columns included, as text for `coerce_dataframe`.
+    """
+    numeric = {column: "float64" for column, pg_type in get_schema(provider).items()
+               if pg_type in (DOUBLE, BIGINT)}
+    return defaultdict(lambda: str, numeric)
+
+
+def _key_length_check(table_name, key_column):
+    return sql.SQL("CONSTRAINT {} CHECK (octet_length({}) = {})").format(
+        sql.Identifier(f"{table_name[:40]}_{key_column}_length_check"),
+        sql.Identifier(key_column), sql.Literal(KEY_LENGTH))
+
+
+def bronze_table_ddl(provider, schema_name, table_name, key_column=KEY_COLUMN):
+    """
+    Build the CREATE TABLE IF NOT EXISTS statement for a provider's bronze table.
+
+    Returns:
+        psycopg2.sql.Composed: Statement with safely quoted identifiers.
+    """
+    columns = [sql.SQL("{} {} PRIMARY KEY").format(sql.Identifier(key_column), sql.SQL(KEY_TYPE))]
+    for column, pg_type in get_schema(provider).items():
+        columns.append(sql.SQL("{} {}").format(sql.Identifier(column), sql.SQL(pg_type)))
+    columns.append(_key_length_check(table_name, key_column))
+    return sql.SQL("CREATE TABLE IF NOT EXISTS {}.{} (\n    {}\n)").format(
+        sql.Identifier(schema_name),
+        sql.Identifier(table_name),
+        sql.SQL(",\n    ").join(columns),
+    )
+
+
+def partitioned_table_ddl(provider, schema_name, table_name, partition_column,
+                          key_column=KEY_COLUMN, extra_columns=("load_batch_id",)):
+    """
+    Build the CREATE TABLE IF NOT EXISTS statement for a bronze table range-partitioned
+    on `partition_column`.
+
+    Postgres requires the partition key in every unique constraint, so the primary key
+    is (key_column, partition_column). Rows without a partition value cannot be stored.
+
+    Returns:
+        psycopg2.sql.Composed: Statement with safely quoted identifiers.
+    """
+    schema = get_schema(provider)
+    if partition_column not in schema:
+        raise ValueError(f"Partition column '{partition_column}' is not registered for provider '{provider}'")
+    columns = [sql.SQL("{} {} NOT NULL").format(sql.Identifier(key_column), sql.SQL(KEY_TYPE))]
+    for column, pg_type in schema.items():
+        not_null = sql.SQL(" NOT NULL") if column == partition_column else sql.SQL("")
+        columns.append(sql.SQL("{} {}{}").format(sql.Identifier(column), sql.SQL(pg_type), not_null))
+    for column in extra_columns:
+        columns.append(sql.SQL("{} text").format(sql.Identifier(column)))
+    columns.append(_key_length_check(table_name, key_column))
+    columns.append(sql.SQL("PRIMARY KEY ({}, {})").format(
+        sql.Identifier(key_column), sql.Identifier(partition_column)))
+    return sql.SQL("CREATE TABLE IF NOT EXISTS {}.{} (\n    {}\n) PARTITION BY RANGE ({})").format(
+        sql.Identifier(schema_name),
+        sql.Identifier(table_name),
+        sql.SQL(",\n    ").join(columns),
+        sql.Identifier(partition_column),
+    )
+
+
+def _drop_dependent_views(cursor, schema_name, table_name):
+    """Drop the views reading a table directly; they block changing its column types."""
+    cursor.execute(
+        "SELECT DISTINCT v.oid::regclass::text, v.relkind FROM pg_depend d "
+        "JOIN pg_rewrite r ON r.oid = d.objid "
+        "JOIN pg_class v ON v.oid = r.ev_class "
+        "WHERE d.classid = 'pg_rewrite'::regclass AND d.refclassid = 'pg_class'::regclass "
+        "AND d.refobjid = %s::regclass AND v.oid <> d.refobjid",
+        (f'"{schema_name}"."{table_name}"',),
+    )
+    for view_name, relkind in cursor.fetchall():
+        kind = "MATERIALIZED VIEW" if relkind == "m" else "VIEW"
+        cursor.execute(sql.SQL("DROP {} IF EXISTS {} CASCADE").format(sql.SQL(kind), sql.SQL(view_name)))
+        print(f"Dropped {view_name}, which reads {schema_name}.{table_name}; it is recreated by its gold script.")
+
+
+def ensure_binary_key(cursor, schema_name, table_name, key_column=KEY_COLUMN):
+    """
+    Convert a bronze table still keyed on hex text to the binary key in place.
+
+    The column is rewritten with decode(..., 'hex'), which also rebuilds its indexes, and
+    gets the fixed-length check. On a partitioned table both apply to every partition.
+    Views reading the table directly block the type change, so they are dropped and left
+    for the gold scripts to recreate on their next run. Tables already keyed on bytea
+    are left alone. The caller commits.
+
+    Returns:
+        bool: True if the table was converted.
+    """
+    cursor.execute(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_schema = %s AND table_name = %s AND column_name = %s",
+        (schema_name, table_name, key_column),
+    )
+    row = cursor.fetchone()
+    if row is None or row[0] == KEY_TYPE:
+        return False
+    table_id, key_id = sql.Identifier(schema_name, table_name), sql.Identifier(key_column)
+    _drop_dependent_views(cursor, schema_name, table_name)
+    cursor.execute(sql.SQL("ALTER TABLE {} ALTER COLUMN {} TYPE {} USING decode({}, 'hex')").format(
+        table_id, key_id, sql.SQL(KEY_TYPE), key_id))
+    cursor.execute(sql.SQL("ALTER TABLE {} ADD {}").format(table_id, _key_length_check(table_name, key_column)))
+    print(f"Converted {schema_name}.{table_name}.{key_column} from hex text to {KEY_TYPE}.")
+    return True
+
+
+# Text the text-only loaders wrote for a missing value
+_MISSING_TEXT = "('', 'None', 'nan', 'NaN', 'NaT')"
+
+# Lenient text -> registered type casts, for columns stored as text before the registry
+# typed them. A value that does not parse becomes NULL, as in `coerce_dataframe`. jsonb
+# falls back to reading the Python repr a CSV round trip left behind, then to keeping the
+# raw text as a JSON string.
+_SAFE_CASTS = {
+    DOUBLE: "RETURN CASE WHEN value IN {missing} THEN NULL ELSE value::double precision END;",
+    BIGINT: "RETURN CASE WHEN value IN {missing} THEN NULL ELSE round(value::numeric)::bigint END;",
+    BOOLEAN: "RETURN CASE WHEN value IN {missing} THEN NULL ELSE value::boolean END;",
+    TIMESTAMP: "RETURN CASE WHEN value IN {missing} THEN NULL ELSE value::timestamptz AT TIME ZONE 'UTC' END;",
+    TIMESTAMPTZ: "RETURN CASE WHEN value IN {missing} THEN NULL ELSE value::timestamptz END;",
+    JSONB: """IF value IN {missing} THEN
+        RETURN NULL;
+    END IF;
+    BEGIN
+        RETURN value::jsonb;
+    EXCEPTION WHEN others THEN
+        RETURN replace(replace(replace(replace(value, '''', '"'),
+            'None', 'null'), 'True', 'true'), 'False', 'false')::jsonb;
+    END;""",
+}
+_SAFE_CAST_FALLBACK = {JSONB: "to_jsonb(value)"}
+
+
+def safe_cast_function(cursor, pg_type):
+    """
+    Create the session-local function casting text to `pg_type` leniently and return its
+    qualified name, e.g. 'pg_temp.focus_to_jsonb'.
+    """
+    name = "focus_to_" + pg_type.replace(" ", "_")
+    cursor.execute(
+        f"CREATE OR REPLACE FUNCTION pg_temp.{name}(value text) RETURNS {pg_type} AS $$\n"
+        f"BEGIN\n"
+        f"    {_SAFE_CASTS[pg_type].format(missing=_MISSING_TEXT)}\n"
+        f"EXCEPTION WHEN others THEN\n"
+        f"    RETURN {_SAFE_CAST_FALLBACK.get(pg_type, 'NULL')};\n"
+        f"END\n"
+        f"$$ LANGUAGE plpgsql IMMUTABLE"
+    )
+    return f"pg_temp.{name}"
+
+
+def column_types(cursor, schema_name, table_name):
+    """Return {column: data_type} of a table, as information_schema reports them."""
+    cursor.execute(
+        "SELECT column_name, data_type FROM information_schema.columns "
+        "WHERE table_schema = %s AND table_name = %s",
+        (schema_name, table_name),
+    )
+    return dict(cursor.fetchall())
+
+
+def column_cast(cursor, column, pg_type, current_type):
+    """
+    Return SQL reading `column`, stored as `current_type`, as `pg_type`: the column itself
+    when the types match, otherwise a lenient cast of its text.
+    """
+    column_id = sql.Identifier(column)
+    if current_type == pg_type:
+        return column_id
+    if pg_type not in _SAFE_CASTS:
+        return sql.SQL("{}::{}").format(column_id, sql.SQL(pg_type))
+    return sql.SQL("{}({}::text)").format(sql.SQL(safe_cast_function(cursor, pg_type)), column_id)
+
+
+def ensure_column_types(cursor, provider, schema_name, table_name):
+    """
+    Convert the registered columns of an existing bronze table to their registered types.
+
+    Tables created by the text-only loaders keep text columns until this runs once; after
+    that it finds nothing to convert. All mismatched columns are rewritten in one ALTER
+    TABLE with lenient casts, so a stray value becomes NULL instead of failing the
+    migration. On a partitioned table the change applies to every partition. Views reading
+    the table block the change, so they are dropped, as in `ensure_binary_key`. The caller
+    commits.
+
+    Returns:
+        list: Columns that were converted.
+    """
+    current = column_types(cursor, schema_name, table_name)
+    mismatched = [column for column, pg_type in get_schema(provider).items()
+                  if column in current and current[column] != pg_type]
+    if not mismatched:
+        return []
+    schema = get_schema(provider)
+    _drop_dependent_views(cursor, schema_name, table_name)
+    alterations = [
+        sql.SQL("ALTER COLUMN {} TYPE {} USING {}").format(
+            sql.Identifier(column), sql.SQL(schema[column]),
+            column_cast(cursor, column, schema[column], current[column]))
+        for column in mismatched
+    ]
+    cursor.execute(sql.SQL("ALTER TABLE {}.{} {}").format(
+        sql.Identifier(schema_name), sql.Identifier(table_name), sql.SQL(", ").join(alterations)))
+    print(f"Converted {len(mismatched)} columns of {schema_name}.{table_name} to their registered types: {mismatched}")
+    return mismatched
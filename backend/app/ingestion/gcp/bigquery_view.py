@@ -1,6 +1,8 @@
+import hashlib
 from google.oauth2 import service_account
 from google.cloud import bigquery
 from google.cloud.exceptions import NotFound
+from app.ingestion.gcp.postgres_operations import fetch_view_fingerprint, record_view_fingerprint
 
 view_query = """
 WITH
@@ -52,6 +54,8 @@ region_names AS (
 usage_cost_data AS (
   SELECT
     *,
+    -- Exposed so incremental extraction can prune the export's daily partitions
+    _PARTITIONTIME AS partition_time,
     (
       SELECT AS STRUCT type, id, full_name
       FROM UNNEST(credits)
@@ -194,6 +198,7 @@ SELECT
   usage_cost_data.cost_type AS x_CostType,
   CAST(usage_cost_data.currency_conversion_rate AS NUMERIC) AS x_CurrencyConversionRate,
   usage_cost_data.export_time AS x_ExportTime,
+  usage_cost_data.partition_time AS x_PartitionTime,
   usage_cost_data.location.location AS x_Location,
   usage_cost_data.project.id AS x_ProjectId,
   usage_cost_data.project.number AS x_ProjectNumber,
@@ -221,32 +226,67 @@ def view_exists(client, dataset_id, view_id):
         return False
 
 
-def create_view(credentials, project_id, dataset_id, billing_account_id, view_id, date):
+def render_view_query(project_id, dataset_id, billing_account_id, date):
+    # sample billing table name gcp_billing_export_resource_v1_000000_111111_222222
+    # replace - to _ in billing_account_id
+    billing_account_id = f"gcp_billing_export_resource_v1_{billing_account_id.replace('-', '_')}"
+    return view_query.replace('__project_id__', project_id).replace('__dataset_id__', dataset_id).replace('__billing_account_id__', billing_account_id).replace('__date__', date)
+
+
+def view_fingerprint(query):
+    """sha256 of a rendered view query, ignoring leading and trailing whitespace."""
+    return hashlib.sha256(query.strip().encode('utf-8')).hexdigest()
+
+
+def create_view(credentials, project_id, dataset_id, billing_account_id, view_id, date, schema=None, force=False):
+    """
+    Create the FOCUS view, or update it when its rendered definition changed.
+
+    With `schema`, the fingerprint of the definition last applied is kept in that project
+    schema, and a run whose definition matches it returns without calling BigQuery. Every
+    create or update is recorded in the schema's bigquery_view_changes table. `force`
+    re-issues the DDL whatever the stored fingerprint, e.g. after the view was edited or
+    dropped in BigQuery.
+    """
+    query = render_view_query(project_id, dataset_id, billing_account_id, date)
+    fingerprint = view_fingerprint(query)
+
+    stored = None
+    if schema:
+        stored = fetch_view_fingerprint(schema, project_id, dataset_id, view_id)
+        if stored == fingerprint and not force:
+            print(f'View {view_id} in dataset {dataset_id} is up to date. Skipping creation.')
+            return True
+
     credentials_obj = service_account.Credentials.from_service_account_info(credentials)
 
     # Initialize the BigQuery client
     client = bigquery.Client(credentials=credentials_obj, project=project_id)
 
-    # Check if the view already exists
-    if view_exists(client=client,
-                   dataset_id=dataset_id,
-                   view_id=view_id):
-        print(f'View {view_id} already exists in dataset {dataset_id}. Skipping creation.')
-        return True
-
     # Set the view reference
     view_ref = client.dataset(dataset_id).table(view_id)
 
-    # sample billing table name gcp_billing_export_resource_v1_000000_111111_222222
-    # replace - to _ in billing_account_id
-    billing_account_id = f"gcp_billing_export_resource_v1_{billing_account_id.replace('-', '_')}"
-
-    # Define the view
-    view = bigquery.Table(view_ref)
-    view.view_query = view_query.replace('__project_id__', project_id).replace('__dataset_id__', dataset_id).replace('__billing_account_id__', billing_account_id).replace('__date__', date)
+    try:
+        view = client.get_table(view_ref)
+    except NotFound:
+        view = None
 
-    # Create the view
-    view = client.create_table(view)
+    if view is None:
+        view = bigquery.Table(view_ref)
+        view.view_query = query
+        client.create_table(view)
+        action = 'created'
+        print(f'View {view_id} created successfully in dataset {dataset_id}.')
+    elif view_fingerprint(view.view_query or '') != fingerprint or force:
+        view.view_query = query
+        client.update_table(view, ['view_query'])
+        action = 'forced' if force else 'updated'
+        print(f'View {view_id} updated in dataset {dataset_id}.')
+    else:
+        # Views created before fingerprints were kept already hold the current definition
+        action = 'adopted'
+        print(f'View {view_id} already exists in dataset {dataset_id}. Skipping creation.')
 
-    print(f'View {view_id} created successfully in dataset {dataset_id}.')
+    if schema:
+        record_view_fingerprint(schema, project_id, dataset_id, view_id, fingerprint, action, stored)
     return True
@@ -57,13 +57,37 @@
 
 import hashlib
 import os
-import tempfile
+import uuid
+from datetime import datetime, timedelta, timezone
 from google.oauth2 import service_account
 from google.cloud import bigquery
+from google.cloud import bigquery_storage
 import pandas as pd
-from sqlalchemy import create_engine, inspect
-from .postgres_operations import run_sql_file, dump_to_postgresql, connection
-from sqlalchemy.exc import SQLAlchemyError
+import pyarrow as pa
+import pyarrow.compute as pc
+from dotenv import load_dotenv
+from .postgres_operations import run_sql_file, create_bronze_table
+from .postgres_operations import fetch_export_state, load_export_increment, replace_invoice_month
+from app.ingestion.focus_schema import coerce_arrow
+from app.ingestion.sql_runner import SqlPipeline
+from app.ingestion import run_ledger
+
+load_dotenv()
+
+# Hours of exports before the watermark read again, for rows BigQuery exported late
+GCP_EXPORT_OVERLAP_HOURS = int(os.getenv("GCP_EXPORT_OVERLAP_HOURS", "6"))
+# Invoice months (current one included) checked for restatement after every load
+GCP_RESTATEMENT_MONTHS = int(os.getenv("GCP_RESTATEMENT_MONTHS", "2"))
+# Rows fetched per BigQuery result page when results are read over the REST API
+GCP_QUERY_PAGE_SIZE = int(os.getenv("GCP_QUERY_PAGE_SIZE", "50000"))
+# Read query results as Arrow streams over the BigQuery Storage Read API
+GCP_BQ_STORAGE_API = os.getenv("GCP_BQ_STORAGE_API", "true").lower() == "true"
+
+KEY_SEPARATOR = "|"
+# Billed cost difference below which a month is considered unchanged
+COST_TOLERANCE = 0.01
+# Days before an invoice month whose usage can still be billed in it
+PARTITION_LOOKBACK_DAYS = 7
 
 # project_id = "cloud-meter-dev"
 # dataset_id = "cloud_dataset"
@@ -72,66 +96,163 @@ from sqlalchemy.exc import SQLAlchemyError
 # schema = "test"
 # table_name = "gcp_temp"
 
-def generate_hash_key(row):
+
+def add_row_keys(table):
     """
-    Generate an MD5 hash key for a given row by concatenating all column values.
+    Append `hash_key`, the binary md5 of every row of a coerced Arrow table.
+
+    Values are rendered as text and joined with a separator by Arrow, so adjacent columns
+    cannot run into each other, and missing values key as empty strings.
     """
-    # print("This is rowww-------",row)
-    concatenated_values = ''.join(str(value) for value in row)
-    return hashlib.md5(concatenated_values.encode('utf-8')).hexdigest()
-
-@connection
-def fetch_existing_hash_keys(connection, schema, table_name):
-    try:
-        cursor = connection.cursor()
-        query = f"SELECT hash_key FROM {schema}.{table_name};"
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        existing_keys = set(row[0] for row in rows)
-        print(f"Fetched {len(existing_keys)} existing hash keys.")
-        return existing_keys
-
-    except Exception as ex:
-        print(f"Error fetching hash keys: {ex}")
-        return set()
-
-
-def fetch_data_from_bigquery_to_postgres(project_id, dataset_id, view_id, credentials, schema, table_name, monthly_budget):
-    # Hardcoded path to the SQL script
-    # sql_script_path = "/Users/adityakumarbharatdeshmukh/Desktop/project/bigquery_to_postgress/sql/create_table.sql"
-    print("-------", credentials)
-    print("Data type of credentials:", type(credentials))
+    columns = [pc.cast(table[name], pa.string()) for name in table.column_names if name != 'hash_key']
+    rows = pc.binary_join_element_wise(*columns, KEY_SEPARATOR, null_handling='replace', null_replacement='')
+    keys = [hashlib.md5(row.encode('utf-8')).digest() for row in rows.to_pylist()]
+    return table.append_column('hash_key', pa.array(keys, pa.binary(16)))
 
-    base_path = "app/ingestion/gcp"
-    table_name = 'bronze_focus_gcp_data'
-        # parent_folder = f'{s3_prefix}/{export_name}/data/'
 
-    # Use from_service_account_info if credentials is a dict
-    if isinstance(credentials, dict):
-        credentials_obj = service_account.Credentials.from_service_account_info(credentials)
-    else:
-        # Fallback for file-based credentials
-        credentials_obj = service_account.Credentials.from_service_account_file(credentials)
+def open_invoice_month(now=None):
+    """First day of the oldest invoice month that can still be restated."""
+    now = now or datetime.now(timezone.utc)
+    month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    for _ in range(GCP_RESTATEMENT_MONTHS - 1):
+        month = (month - timedelta(days=1)).replace(day=1)
+    return month
 
-    # Initialize the BigQuery client
-    client = bigquery.Client(credentials=credentials_obj, project=project_id)
 
-    print("BigQuery client initialized successfully.")
+def _as_utc(value):
+    value = pd.Timestamp(value)
+    return value.tz_localize('UTC') if value.tzinfo is None else value.tz_convert('UTC')
 
-    # Construct the query
-    query = f"""
-    SELECT *
-    FROM `{project_id}.{dataset_id}.{view_id}`
+
+class BillingExport:
     """
+    Reads the FOCUS view of one billing export as Arrow record batches.
+
+    Batches come from the Storage Read API when a read client is given, otherwise from
+    REST result pages; either way only one batch is held at a time. Views created with x_PartitionTime (the `_PARTITIONTIME` of the export table) are
+    filtered on it too, so BigQuery only scans the partitions the query can match.
 
-    # Execute the query and convert the results to a pandas DataFrame
-    dataframe = client.query(query).to_dataframe()
+    Args:
+        client (bigquery.Client): Client of the export's project; a stub in tests.
+        view (str): Fully qualified view, e.g. `project.dataset.view`.
+        read_client (bigquery_storage.BigQueryReadClient): Storage Read API client, or None.
+    """
+
+    def __init__(self, client, view, read_client=None):
+        self.client = client
+        self.view = view
+        self.read_client = read_client
+        self.partitioned = 'x_PartitionTime' in {field.name for field in client.get_table(view).schema}
+        if not self.partitioned:
+            print(f"View {view} has no x_PartitionTime; queries scan every partition until it is recreated.")
+
+    def _columns(self):
+        return "* EXCEPT (x_PartitionTime)" if self.partitioned else "*"
+
+    def _query(self, query, parameters):
+        job_config = bigquery.QueryJobConfig(query_parameters=parameters)
+        return self.client.query(query, job_config=job_config).result(page_size=GCP_QUERY_PAGE_SIZE)
+
+    def _pages(self, query, parameters):
+        with run_ledger.stage("download"):
+            rows = self._query(query, parameters)
+        batches = rows.to_arrow_iterable(bqstorage_client=self.read_client)
+        for batch in run_ledger.timed_iter(batches, "download"):
+            if batch.num_rows == 0:
+                continue
+            run_ledger.add("rows_read", batch.num_rows)
+            run_ledger.add("bytes_read", batch.nbytes)
+            # Pages stay in Arrow from the read to the COPY buffer; only structured
+            # values and the row digests go through Python
+            with run_ledger.stage("parse"):
+                page = coerce_arrow(pa.Table.from_batches([batch]), 'gcp_focus')
+            with run_ledger.stage("hash"):
+                page = add_row_keys(page)
+            yield page
+
+    def exported_since(self, since):
+        """Yield Arrow tables of the keyed and coerced rows exported after `since` (every row when None)."""
+        conditions, parameters = [], []
+        if since is not None:
+            conditions.append("x_ExportTime > @since")
+            parameters.append(bigquery.ScalarQueryParameter("since", "TIMESTAMP", since.to_pydatetime()))
+            if self.partitioned:
+                conditions.append("x_PartitionTime >= TIMESTAMP_TRUNC(@since, DAY)")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._pages(f"SELECT {self._columns()} FROM `{self.view}` {where}", parameters)
+
+    def invoice_month(self, period_start):
+        """Yield Arrow tables of the keyed and coerced rows of one invoice month."""
+        parameters = [bigquery.ScalarQueryParameter("period_start", "TIMESTAMP", period_start.to_pydatetime())]
+        conditions = ["BillingPeriodStart = @period_start"]
+        if self.partitioned:
+            conditions.append(f"x_PartitionTime >= TIMESTAMP_SUB(@period_start, INTERVAL {PARTITION_LOOKBACK_DAYS} DAY)")
+        return self._pages(f"SELECT {self._columns()} FROM `{self.view}` WHERE {' AND '.join(conditions)}",
+                           parameters)
+
+    def month_totals(self, open_from):
+        """
+        Return {BillingPeriodStart: (rows, billed cost)} of the months from `open_from`.
+
+        Bronze keeps one copy of identical rows (they share a key), and the FOCUS view can
+        map distinct export rows to identical ones, so identical rows are counted once here.
+        """
+        parameters = [bigquery.ScalarQueryParameter("open_from", "TIMESTAMP", open_from)]
+        conditions = ["BillingPeriodStart >= @open_from"]
+        if self.partitioned:
+            conditions.append(f"x_PartitionTime >= TIMESTAMP_SUB(@open_from, INTERVAL {PARTITION_LOOKBACK_DAYS} DAY)")
+        query = (f"SELECT BillingPeriodStart, COUNT(*) AS row_count, IFNULL(SUM(BilledCost), 0) AS billed_cost "
+                 f"FROM (SELECT ANY_VALUE(r.BillingPeriodStart) AS BillingPeriodStart, "
+                 f"ANY_VALUE(r.BilledCost) AS BilledCost "
+                 f"FROM (SELECT {self._columns()} FROM `{self.view}` WHERE {' AND '.join(conditions)}) AS r "
+                 f"GROUP BY TO_JSON_STRING(r)) GROUP BY BillingPeriodStart")
+        return {_as_utc(row.BillingPeriodStart): (row.row_count, float(row.billed_cost))
+                for row in self._query(query, parameters)}
+
+
+def restated_months(exported, loaded):
+    """Invoice months whose rows or billed cost in bronze differ from the export."""
+    loaded = {_as_utc(period_start): totals for period_start, totals in loaded.items()}
+    months = []
+    for period_start, (rows, cost) in sorted(exported.items()):
+        loaded_rows, loaded_cost = loaded.get(period_start, (0, 0.0))
+        if rows != loaded_rows or abs(cost - loaded_cost) > COST_TOLERANCE:
+            print(f"Invoice month {period_start:%Y-%m} differs from the export: {loaded_rows} rows / "
+                  f"{loaded_cost:.2f} loaded, {rows} rows / {cost:.2f} exported.")
+            months.append(period_start)
+    return months
+
+
+def fetch_data_from_bigquery_to_postgres(project_id, dataset_id, view_id, credentials, schema, table_name,
+                                         monthly_budget, client=None):
+    """
+    Load the rows exported since the last run into bronze, then refresh silver and gold.
+
+    The watermark is the latest x_ExportTime in bronze, so it commits with the rows it
+    covers. Exports since the watermark minus GCP_EXPORT_OVERLAP_HOURS are read again and
+    replace what bronze holds for that window: rows already loaded are skipped, and rows
+    not read again are deleted. Invoice months still open to restatement are then
+    compared with the export by row count and billed cost; a month that differs is
+    re-extracted and replaced as a whole.
+    """
+    base_path = "app/ingestion/gcp"
+    table_name = 'bronze_focus_gcp_data'
 
-    # Replace problematic None/NaN values
-    dataframe = dataframe.fillna(value="")
+    read_client = None
+    if client is None:
+        # Use from_service_account_info if credentials is a dict
+        if isinstance(credentials, dict):
+            credentials_obj = service_account.Credentials.from_service_account_info(credentials)
+        else:
+            # Fallback for file-based credentials
+            credentials_obj = service_account.Credentials.from_service_account_file(credentials)
+        client = bigquery.Client(credentials=credentials_obj, project=project_id)
+        if GCP_BQ_STORAGE_API:
+            read_client = bigquery_storage.BigQueryReadClient(credentials=credentials_obj)
+        print("BigQuery client initialized successfully.")
+
+    export = BillingExport(client, f"{project_id}.{dataset_id}.{view_id}", read_client)
 
-    # Log the data fetched from BigQuery
-    print(f"Fetched {len(dataframe)} rows from BigQuery.")
     # Create new schema
     run_sql_file(sql_file_path=f'{base_path}/sql/new_schema.sql',
                  schema_name=schema,
@@ -139,61 +260,43 @@ def fetch_data_from_bigquery_to_postgres(project_id, dataset_id, view_id, creden
                  )
     print(f"Schema {schema} created...")
 
-    # Execute the SQL script to ensure the table exists in PostgreSQL
-    run_sql_file(sql_file_path=f'{base_path}/sql/create_table.sql',
-                 schema_name=schema,
-                 budget=monthly_budget
-                 )
-    print(f"Table {table_name} created...")
-
-    print(f"Table {schema}.{table_name} ensured to exist.")
-
-    # Create a temporary CSV file
-    with tempfile.NamedTemporaryFile(delete=False, mode='w', newline='', suffix='.csv') as temp_csv_file:
-        temp_csv_path = temp_csv_file.name
-        # Save the DataFrame to the CSV file
-        dataframe.to_csv(temp_csv_file, index=False)
-        print(f"DataFrame saved to temporary CSV file: {temp_csv_path}")
-
-    # Read the CSV file back into a DataFrame
-    temp_dataframe = pd.read_csv(temp_csv_path)
-    print(f"CSV file loaded into DataFrame with {len(temp_dataframe)} rows.")
-
-    # Create hash keys for each row after re-loading the data from CSV
-    temp_dataframe['hash_key'] = temp_dataframe.apply(generate_hash_key, axis=1)
-
-    # Use the function
-    existing_keys = fetch_existing_hash_keys(schema, table_name)
-    print(f"Existing keys: {len(existing_keys)}")
-
-
-    # # Filter out rows that already exist in the PostgreSQL table
-    new_data = temp_dataframe[~temp_dataframe['hash_key'].isin(existing_keys)]
-    
-    # Log the number of new rows before appending
-    print(f"New rows to append: {len(new_data)}")
-
-    # Only dump new data into PostgreSQL
-    if not new_data.empty:
-        dump_to_postgresql(new_data, schema, table_name)
-        print(f"Appended {len(new_data)} new rows to {schema}.{table_name}.")
-    # Run the bronze-to-silver SQL script
-        run_sql_file(sql_file_path=f'{base_path}/sql/silver.sql',
-                    schema_name=schema,
-                    budget=monthly_budget
-                    )
-        # Run the silver-to-gold SQL script
-        run_sql_file(sql_file_path=f'{base_path}/sql/gold.sql',
-                    schema_name=schema,
-                    budget=monthly_budget
-                    )
-    else:
-        print("No new rows to append. All data already exists in the PostgreSQL table.")
+    # Ensure the typed bronze table exists in PostgreSQL
+    create_bronze_table('gcp_focus', schema, table_name)
 
-    # Remove the temporary CSV file after the operation
-    os.remove(temp_csv_path)
-    print(f"Temporary CSV file removed: {temp_csv_path}")
+    open_from = open_invoice_month()
+    # Totals are read before the increment, so months exported meanwhile are compared next run
+    exported_totals = export.month_totals(open_from)
+
+    last_export_time, _ = fetch_export_state(schema, table_name, open_from)
+    since = None
+    if last_export_time is not None:
+        since = _as_utc(last_export_time) - timedelta(hours=GCP_EXPORT_OVERLAP_HOURS)
+        print(f"Extracting rows exported after {since:%Y-%m-%d %H:%M:%S} UTC.")
+    else:
+        print("No rows loaded yet; extracting the whole export.")
+
+    # Tags the billing periods this run writes, which gold refreshes
+    load_batch_id = uuid.uuid4().hex
+    with run_ledger.stage("load"):
+        loaded, removed = load_export_increment(export.exported_since(since), schema, table_name, since=since,
+                                                load_batch_id=load_batch_id)
+    run_ledger.add("rows_loaded", loaded)
+    print(f"Appended {loaded} new rows to {schema}.{table_name}.")
+
+    _, loaded_totals = fetch_export_state(schema, table_name, open_from)
+    restated = restated_months(exported_totals, loaded_totals)
+    for period_start in restated:
+        with run_ledger.stage("load"):
+            run_ledger.add("rows_loaded", replace_invoice_month(export.invoice_month(period_start), schema,
+                                                                table_name, period_start, load_batch_id))
+
+    # Bronze-to-silver and silver-to-gold run as pipeline stages. Without changes only
+    # an earlier run that failed part way is finished.
+    focus_pipeline = SqlPipeline('gcp_focus', schema, {'budget': monthly_budget, 'batch_id': load_batch_id})
+    focus_pipeline.add_stage('silver', f'{base_path}/sql/silver.sql')
+    focus_pipeline.add_stage('gold', f'{base_path}/sql/gold.sql', depends_on=['silver'])
+    focus_pipeline.add_migration('gold_views', f'{base_path}/sql/gold_views.sql', depends_on=['gold'])
+    focus_pipeline.run_or_raise(resume=True, new_run=bool(loaded or removed or restated))
 
 # Call the function
 # fetch_data_from_bigquery_to_postgres(project_id, dataset_id, view_id, credentials_path, schema, table_name)
-
@@ -4,6 +4,8 @@ import os
 import pandas as pd
 from sqlalchemy import create_engine
 from dotenv import load_dotenv
+from app.ingestion.focus_schema import bronze_table_ddl, ensure_binary_key, ensure_column_types
+from app.ingestion.copy_loader import copy_new_rows
 
 # Load environment variables from .env file
 load_dotenv()
@@ -108,6 +110,219 @@ def dump_to_postgresql(connection, new_data, schema, table_name):
         raise
 
 
+# Billing periods written to bronze by each load batch, which gold refreshes
+LOAD_PERIODS_TABLE = "bronze_load_periods"
+# Days load periods are kept; a failed pipeline run is resumed well within them
+LOAD_PERIODS_RETENTION_DAYS = 30
+
+
+@connection
+def create_bronze_table(connection, provider, schema, table_name):
+    """
+    Create the bronze table from the typed column registry if it does not exist, and
+    convert a table created by the text-only loader to binary keys and typed columns.
+    Also creates the load periods table and prunes its old batches.
+    """
+    cursor = connection.cursor()
+    cursor.execute(bronze_table_ddl(provider, schema, table_name))
+    ensure_binary_key(cursor, schema, table_name)
+    ensure_column_types(cursor, provider, schema, table_name)
+    periods_id = sql.Identifier(schema, LOAD_PERIODS_TABLE)
+    cursor.execute(sql.SQL(
+        "CREATE TABLE IF NOT EXISTS {} ("
+        "load_batch_id text NOT NULL, "
+        "table_name text NOT NULL, "
+        "period_start timestamptz NOT NULL, "
+        "recorded_at timestamp NOT NULL DEFAULT now(), "
+        "PRIMARY KEY (load_batch_id, table_name, period_start))"
+    ).format(periods_id))
+    cursor.execute(sql.SQL("DELETE FROM {} WHERE recorded_at < now() - %s * interval '1 day'").format(periods_id),
+                   (LOAD_PERIODS_RETENTION_DAYS,))
+    connection.commit()
+    cursor.close()
+    print(f"Table {schema}.{table_name} is ready.")
+
+
+@connection
+def fetch_export_state(connection, schema, table_name, open_from):
+    """
+    Return the latest export time loaded into bronze, and the row count and billed cost of
+    every invoice month starting at or after `open_from`.
+
+    Columns are cast as silver reads them, so a table still holding the text columns of
+    the old loader is read correctly too.
+
+    Returns:
+        tuple: (datetime | None, {BillingPeriodStart: (rows, billed cost)})
+    """
+    cursor = connection.cursor()
+    schema_id, table_id = sql.Identifier(schema), sql.Identifier(table_name)
+    cursor.execute(sql.SQL(
+        'SELECT max(NULLIF("x_ExportTime"::text, \'None\')::timestamptz) FROM {}.{}'
+    ).format(schema_id, table_id))
+    last_export_time = cursor.fetchone()[0]
+    cursor.execute(sql.SQL(
+        'SELECT period_start, count(*), coalesce(sum(NULLIF("BilledCost"::text, \'None\')::double precision), 0) '
+        'FROM (SELECT *, NULLIF("BillingPeriodStart"::text, \'None\')::timestamptz AS period_start FROM {}.{}) t '
+        'WHERE period_start >= %s GROUP BY period_start'
+    ).format(schema_id, table_id), (open_from,))
+    months = {period_start: (rows, float(cost)) for period_start, rows, cost in cursor.fetchall()}
+    cursor.close()
+    return last_export_time, months
+
+
+def _record_load_periods(cursor, schema, table_name, load_batch_id, condition, parameters=()):
+    """Record the billing periods of the bronze rows matching `condition` under the batch."""
+    if load_batch_id is None:
+        return
+    cursor.execute(sql.SQL(
+        'INSERT INTO {} (load_batch_id, table_name, period_start) '
+        'SELECT DISTINCT %s, %s, "BillingPeriodStart" FROM {} WHERE {} AND "BillingPeriodStart" IS NOT NULL '
+        'ON CONFLICT DO NOTHING'
+    ).format(sql.Identifier(schema, LOAD_PERIODS_TABLE), sql.Identifier(schema, table_name), condition),
+        (load_batch_id, table_name) + tuple(parameters))
+
+
+@connection
+def load_export_increment(connection, frames, schema, table_name, since=None, load_batch_id=None):
+    """
+    Load the rows exported after `since` (the watermark minus the overlap), one frame at
+    a time, in one transaction.
+
+    Frames are COPYed through a stage and rows whose key is already stored are skipped by
+    the insert. The export after `since` is read in full, so bronze rows exported after
+    it whose key was not read again are stale copies (keyed by an earlier loader, or
+    removed from the export) and are deleted: the overlap is replaced, not appended to.
+    Nothing is kept if the stream fails part way, so the watermark (the latest export time
+    in bronze) only moves once every row before it was written.
+
+    The billing periods of the window, before the stale rows go, are recorded under
+    `load_batch_id` for gold to refresh.
+
+    Args:
+        frames (Iterable[pa.Table]): Keyed and coerced rows.
+        since (datetime): Lower bound of the export read, or None when it was read whole.
+        load_batch_id (str): Batch the periods are recorded under; not recorded when None.
+
+    Returns:
+        tuple: (rows inserted, stale rows deleted)
+    """
+    cursor = connection.cursor()
+    seen_keys = f"{table_name}_seen_keys"
+    cursor.execute(sql.SQL("CREATE TEMP TABLE IF NOT EXISTS {} (hash_key bytea PRIMARY KEY) ON COMMIT DROP").format(
+        sql.Identifier(seen_keys)))
+    inserted = 0
+    for frame in frames:
+        inserted += copy_new_rows(cursor, frame, 'gcp_focus', schema, table_name, seen_keys=seen_keys)
+        print(f"Appended {inserted} rows to {schema}.{table_name} so far.")
+
+    stale_filter = sql.SQL('"x_ExportTime" > %s') if since is not None else sql.SQL("true")
+    window = (since,) if since is not None else ()
+    _record_load_periods(cursor, schema, table_name, load_batch_id, stale_filter, window)
+    cursor.execute(sql.SQL(
+        "DELETE FROM {}.{} b WHERE {} AND NOT EXISTS (SELECT 1 FROM {} s WHERE s.hash_key = b.hash_key)"
+    ).format(sql.Identifier(schema), sql.Identifier(table_name), stale_filter, sql.Identifier(seen_keys)),
+        window or None)
+    deleted = cursor.rowcount
+    if deleted:
+        print(f"Deleted {deleted} stale rows exported after {since} from {schema}.{table_name}.")
+    cursor.close()
+    return inserted, deleted
+
+
+@connection
+def replace_invoice_month(connection, frames, schema, table_name, period_start, load_batch_id=None):
+    """
+    Replace every bronze row of one invoice month with the rows streamed from the export.
+
+    The delete and the inserts commit together, so readers see either the old month or
+    the restated one. The month is recorded under `load_batch_id` for gold to refresh.
+
+    Returns:
+        int: Number of rows the month now holds.
+    """
+    cursor = connection.cursor()
+    cursor.execute(sql.SQL('DELETE FROM {}.{} WHERE "BillingPeriodStart" = %s').format(
+        sql.Identifier(schema), sql.Identifier(table_name)), (period_start,))
+    deleted = cursor.rowcount
+
+    inserted = 0
+    for frame in frames:
+        inserted += copy_new_rows(cursor, frame, 'gcp_focus', schema, table_name)
+    if load_batch_id is not None:
+        cursor.execute(sql.SQL(
+            "INSERT INTO {} (load_batch_id, table_name, period_start) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING"
+        ).format(sql.Identifier(schema, LOAD_PERIODS_TABLE)), (load_batch_id, table_name, period_start))
+    cursor.close()
+    print(f"Replaced invoice month {period_start:%Y-%m} of {schema}.{table_name}: "
+          f"{deleted} rows deleted, {inserted} rows inserted.")
+    return inserted
+
+
+VIEW_FINGERPRINTS_TABLE = "bigquery_view_fingerprints"
+VIEW_CHANGES_TABLE = "bigquery_view_changes"
+
+
+def _ensure_view_tables(cursor, schema):
+    cursor.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(sql.Identifier(schema)))
+    cursor.execute(sql.SQL(
+        "CREATE TABLE IF NOT EXISTS {}.{} ("
+        "gcp_project_id text NOT NULL, "
+        "dataset_id text NOT NULL, "
+        "view_id text NOT NULL, "
+        "fingerprint text NOT NULL, "
+        "updated_at timestamp NOT NULL DEFAULT now(), "
+        "PRIMARY KEY (gcp_project_id, dataset_id, view_id))"
+    ).format(sql.Identifier(schema), sql.Identifier(VIEW_FINGERPRINTS_TABLE)))
+    cursor.execute(sql.SQL(
+        "CREATE TABLE IF NOT EXISTS {}.{} ("
+        "id bigserial PRIMARY KEY, "
+        "gcp_project_id text NOT NULL, "
+        "dataset_id text NOT NULL, "
+        "view_id text NOT NULL, "
+        "action text NOT NULL, "
+        "previous_fingerprint text, "
+        "fingerprint text NOT NULL, "
+        "changed_at timestamp NOT NULL DEFAULT now())"
+    ).format(sql.Identifier(schema), sql.Identifier(VIEW_CHANGES_TABLE)))
+
+
+@connection
+def fetch_view_fingerprint(connection, schema, gcp_project_id, dataset_id, view_id):
+    """Return the fingerprint of the view definition last applied, or None."""
+    cursor = connection.cursor()
+    _ensure_view_tables(cursor, schema)
+    cursor.execute(sql.SQL(
+        "SELECT fingerprint FROM {}.{} WHERE gcp_project_id = %s AND dataset_id = %s AND view_id = %s"
+    ).format(sql.Identifier(schema), sql.Identifier(VIEW_FINGERPRINTS_TABLE)), (gcp_project_id, dataset_id, view_id))
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0] if row else None
+
+
+@connection
+def record_view_fingerprint(connection, schema, gcp_project_id, dataset_id, view_id, fingerprint, action,
+                            previous_fingerprint=None):
+    """
+    Store the fingerprint of the view definition now in BigQuery, with an audit row
+    saying what was done ('created', 'updated', 'forced' or 'adopted').
+    """
+    cursor = connection.cursor()
+    _ensure_view_tables(cursor, schema)
+    key = (gcp_project_id, dataset_id, view_id)
+    cursor.execute(sql.SQL(
+        "INSERT INTO {}.{} (gcp_project_id, dataset_id, view_id, fingerprint) VALUES (%s, %s, %s, %s) "
+        "ON CONFLICT (gcp_project_id, dataset_id, view_id) DO UPDATE "
+        "SET fingerprint = EXCLUDED.fingerprint, updated_at = now()"
+    ).format(sql.Identifier(schema), sql.Identifier(VIEW_FINGERPRINTS_TABLE)), key + (fingerprint,))
+    cursor.execute(sql.SQL(
+        "INSERT INTO {}.{} (gcp_project_id, dataset_id, view_id, action, previous_fingerprint, fingerprint) "
+        "VALUES (%s, %s, %s, %s, %s, %s)"
+    ).format(sql.Identifier(schema), sql.Identifier(VIEW_CHANGES_TABLE)),
+        key + (action, previous_fingerprint, fingerprint))
+    cursor.close()
+
+
 @connection
 def get_tables_in_schema(connection, schema):
     try:
@@ -84,15 +84,6 @@
 -- $$ LANGUAGE plpgsql;
 
 
-CREATE OR REPLACE VIEW __schema__.gold_gcp_billing_dim AS
-SELECT
-   DISTINCT billing_account_id,
-   sub_account_id
-FROM
-   __schema__.silver_focus_gcp_data;
-
-
-
 --CREATE OR REPLACE VIEW __schema__.gold_gcp_cost_dim AS
 --SELECT
 --    DISTINCT contracted_cost,
@@ -102,41 +93,130 @@ FROM
 --    __schema__.silver_focus_gcp_data;
 
 
-
-CREATE OR REPLACE VIEW __schema__.gold_gcp_fact_dim AS
-SELECT
-    billed_cost,
-	billing_account_id,
-    resource_name,
-    resource_type,
-    billing_period_start,
-	billing_period_end,
-    x_project_id,
-    region_id,
-    x_service_id,
-    charge_period_start,
-	charge_period_end,
-    contracted_cost,
-    charge_description,
-    charge_category,
-    substr(cast(digest(tags::text, 'sha256') as text), 3, 64) as tags_key,
-    __budget__::integer AS monthly_budget,
-    consumed_quantity,
-    pricing_quantity,
-    provider_name,
-    list_cost,
-	effective_cost,
-	region_name,
-    x_location,
-	sku_id,
-	service_name,
-	service_category,
-    hash_key,
-    resource_id
-FROM
-   __schema__.silver_focus_gcp_data;
-
-CREATE OR REPLACE FUNCTION gcp_tags_view_generation()
+-- Gold is materialized in tables maintained per billing period, as gold_aws_fact_focus_mat
+-- is. The bronze load records the billing periods each load batch (__batch_id__) wrote in
+-- bronze_load_periods; only those periods are deleted from gold_gcp_fact_dim_mat and
+-- re-inserted from silver, and the billing dim only gains their accounts. Both are built
+-- in full when they are new. Dashboards read indexed tables and are not blocked while
+-- ingestion writes them. gold_gcp_fact_dim and gold_gcp_billing_dim keep their names and
+-- columns and only project these tables.
+DO $$
+DECLARE
+    v_full_backfill boolean;
+    v_periods timestamp[];
+    v_deleted bigint := 0;
+    v_inserted bigint := 0;
+    v_accounts bigint := 0;
+BEGIN
+    v_full_backfill := NOT EXISTS (
+        SELECT 1 FROM information_schema.tables
+        WHERE table_schema = '__schema__' AND table_name = 'gold_gcp_fact_dim_mat');
+
+    -- Column types follow silver_focus_gcp_data, which the public views project
+    CREATE TABLE IF NOT EXISTS __schema__.gold_gcp_billing_dim_mat (
+        billing_account_id VARCHAR(255),
+        sub_account_id VARCHAR(255)
+    );
+    CREATE INDEX IF NOT EXISTS gold_gcp_billing_dim_mat_account_idx ON __schema__.gold_gcp_billing_dim_mat (billing_account_id, sub_account_id);
+
+    CREATE TABLE IF NOT EXISTS __schema__.gold_gcp_fact_dim_mat (
+        billed_cost FLOAT,
+        billing_account_id VARCHAR(255),
+        resource_name VARCHAR(255),
+        resource_type VARCHAR(255),
+        billing_period_start TIMESTAMP,
+        billing_period_end TIMESTAMP,
+        x_project_id VARCHAR(255),
+        region_id VARCHAR(255),
+        x_service_id VARCHAR(255),
+        charge_period_start TIMESTAMP,
+        charge_period_end TIMESTAMP,
+        contracted_cost FLOAT,
+        charge_description TEXT,
+        charge_category VARCHAR(255),
+        tags_key TEXT,
+        consumed_quantity FLOAT,
+        pricing_quantity FLOAT,
+        provider_name VARCHAR(255),
+        list_cost FLOAT,
+        effective_cost FLOAT,
+        region_name VARCHAR(255),
+        x_location VARCHAR(255),
+        sku_id VARCHAR(255),
+        service_name VARCHAR(255),
+        service_category VARCHAR(255),
+        hash_key TEXT PRIMARY KEY,
+        resource_id VARCHAR(255)
+    );
+    CREATE INDEX IF NOT EXISTS gold_gcp_fact_dim_mat_charge_period_idx ON __schema__.gold_gcp_fact_dim_mat (charge_period_start);
+    CREATE INDEX IF NOT EXISTS gold_gcp_fact_dim_mat_resource_idx ON __schema__.gold_gcp_fact_dim_mat (resource_id, charge_period_start);
+    CREATE INDEX IF NOT EXISTS gold_gcp_fact_dim_mat_service_idx ON __schema__.gold_gcp_fact_dim_mat (service_name, charge_period_start);
+    CREATE INDEX IF NOT EXISTS gold_gcp_fact_dim_mat_tags_idx ON __schema__.gold_gcp_fact_dim_mat (tags_key);
+    CREATE INDEX IF NOT EXISTS gold_gcp_fact_dim_mat_billing_period_idx ON __schema__.gold_gcp_fact_dim_mat (billing_period_start);
+
+    IF v_full_backfill THEN
+        TRUNCATE __schema__.gold_gcp_fact_dim_mat, __schema__.gold_gcp_billing_dim_mat;
+    ELSE
+        SELECT coalesce(array_agg(DISTINCT period_start::timestamp), '{}')
+        INTO v_periods
+        FROM __schema__.bronze_load_periods
+        WHERE load_batch_id = '__batch_id__' AND table_name = 'bronze_focus_gcp_data';
+
+        DELETE FROM __schema__.gold_gcp_fact_dim_mat WHERE billing_period_start = ANY (v_periods);
+        GET DIAGNOSTICS v_deleted = ROW_COUNT;
+    END IF;
+
+    INSERT INTO __schema__.gold_gcp_fact_dim_mat
+    SELECT
+        billed_cost,
+        billing_account_id,
+        resource_name,
+        resource_type,
+        billing_period_start,
+        billing_period_end,
+        x_project_id,
+        region_id,
+        x_service_id,
+        charge_period_start,
+        charge_period_end,
+        contracted_cost,
+        charge_description,
+        charge_category,
+        substr(cast(digest(tags::text, 'sha256') as text), 3, 64),
+        consumed_quantity,
+        pricing_quantity,
+        provider_name,
+        list_cost,
+        effective_cost,
+        region_name,
+        x_location,
+        sku_id,
+        service_name,
+        service_category,
+        hash_key,
+        resource_id
+    FROM __schema__.silver_focus_gcp_data
+    WHERE v_full_backfill OR billing_period_start = ANY (v_periods)
+    ON CONFLICT (hash_key) DO NOTHING;
+    GET DIAGNOSTICS v_inserted = ROW_COUNT;
+
+    -- Accounts are only added; one that stops appearing stays until the next full backfill
+    INSERT INTO __schema__.gold_gcp_billing_dim_mat
+    SELECT DISTINCT billing_account_id, sub_account_id
+    FROM __schema__.silver_focus_gcp_data s
+    WHERE (v_full_backfill OR s.billing_period_start = ANY (v_periods))
+      AND NOT EXISTS (
+          SELECT 1 FROM __schema__.gold_gcp_billing_dim_mat d
+          WHERE d.billing_account_id IS NOT DISTINCT FROM s.billing_account_id
+            AND d.sub_account_id IS NOT DISTINCT FROM s.sub_account_id);
+    GET DIAGNOSTICS v_accounts = ROW_COUNT;
+
+    RAISE NOTICE 'gold_gcp_fact_dim_mat batch % (periods %): % rows removed, % added, % new accounts (full backfill: %)',
+        '__batch_id__', v_periods, v_deleted, v_inserted, v_accounts, v_full_backfill;
+END $$;
+
+
+CREATE OR REPLACE FUNCTION __schema__.gcp_tags_view_generation()
 RETURNS text AS $$
 DECLARE
     record_tagkey record;
@@ -157,20 +237,19 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+-- Recreate the tags view only when its generated definition changed (a new tag key).
+-- The definition's md5 is kept as the view comment, so unchanged runs take no view lock.
 DO $$
 DECLARE
-    del_statement text := 'DROP VIEW IF EXISTS __schema__.gold_gcp_tags_dim CASCADE';
     q_statement text;
 BEGIN
     -- Generate the view creation query
-    q_statement := gcp_tags_view_generation();
-
-    -- Drop the existing view if it exists
-    EXECUTE del_statement;
+    q_statement := __schema__.gcp_tags_view_generation();
 
-    -- Execute the dynamically generated query
-    EXECUTE q_statement;
+    IF obj_description(to_regclass('__schema__.gold_gcp_tags_dim'), 'pg_class') IS DISTINCT FROM md5(q_statement) THEN
+        EXECUTE 'DROP VIEW IF EXISTS __schema__.gold_gcp_tags_dim CASCADE';
+        EXECUTE q_statement;
+        EXECUTE format('COMMENT ON VIEW __schema__.gold_gcp_tags_dim IS %L', md5(q_statement));
+    END IF;
 END;
 $$ LANGUAGE plpgsql;
-
-
@@ -0,0 +1,39 @@
+-- Gold views. This file runs as a schema migration:
+-- it is applied only when its content (including the embedded budget) changes, so
+-- daily loads no longer take view locks that queue behind dashboard queries.
+
+CREATE OR REPLACE VIEW __schema__.gold_gcp_billing_dim AS
+SELECT billing_account_id, sub_account_id
+FROM __schema__.gold_gcp_billing_dim_mat;
+
+CREATE OR REPLACE VIEW __schema__.gold_gcp_fact_dim AS
+SELECT
+    billed_cost,
+    billing_account_id,
+    resource_name,
+    resource_type,
+    billing_period_start,
+    billing_period_end,
+    x_project_id,
+    region_id,
+    x_service_id,
+    charge_period_start,
+    charge_period_end,
+    contracted_cost,
+    charge_description,
+    charge_category,
+    tags_key,
+    __budget__::integer AS monthly_budget,
+    consumed_quantity,
+    pricing_quantity,
+    provider_name,
+    list_cost,
+    effective_cost,
+    region_name,
+    x_location,
+    sku_id,
+    service_name,
+    service_category,
+    hash_key,
+    resource_id
+FROM __schema__.gold_gcp_fact_dim_mat;
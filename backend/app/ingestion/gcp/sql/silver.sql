@@ -58,7 +58,7 @@ BEGIN
         INSERT INTO __schema__.silver_focus_gcp_data
         SELECT
             "AvailabilityZone"::VARCHAR(255) AS availability_zone,
-            NULLIF("BilledCost", 'None')::FLOAT AS billed_cost,
+            NULLIF("BilledCost"::text, 'None')::FLOAT AS billed_cost,
             "BillingAccountId"::VARCHAR(255) AS billing_account_id,
             "BillingCurrency"::VARCHAR(10) AS billing_currency,
             "BillingPeriodStart"::TIMESTAMP AS billing_period_start,
@@ -71,15 +71,15 @@ BEGIN
             "CommitmentDiscountCategory"::VARCHAR(255) AS commitment_discount_category,
             "CommitmentDiscountId"::VARCHAR(255) AS commitment_discount_id,
             "CommitmentDiscountName"::VARCHAR(255) AS commitment_discount_name,
-            NULLIF("ConsumedQuantity", 'None')::FLOAT AS consumed_quantity,
+            NULLIF("ConsumedQuantity"::text, 'None')::FLOAT AS consumed_quantity,
             "ConsumedUnit"::VARCHAR(50) AS consumed_unit,
-            NULLIF("ContractedCost", 'None')::FLOAT AS contracted_cost,
-            NULLIF("ContractedUnitPrice", 'None')::FLOAT AS contracted_unit_price,
-            NULLIF("EffectiveCost", 'None')::FLOAT AS effective_cost,
-            NULLIF("ListCost", 'None')::FLOAT AS list_cost,
-            NULLIF("ListUnitPrice", 'None')::FLOAT AS list_unit_price,
+            NULLIF("ContractedCost"::text, 'None')::FLOAT AS contracted_cost,
+            NULLIF("ContractedUnitPrice"::text, 'None')::FLOAT AS contracted_unit_price,
+            NULLIF("EffectiveCost"::text, 'None')::FLOAT AS effective_cost,
+            NULLIF("ListCost"::text, 'None')::FLOAT AS list_cost,
+            NULLIF("ListUnitPrice"::text, 'None')::FLOAT AS list_unit_price,
             "PricingCategory"::VARCHAR(255) AS pricing_category,
-            NULLIF("PricingQuantity", 'None')::FLOAT AS pricing_quantity,
+            NULLIF("PricingQuantity"::text, 'None')::FLOAT AS pricing_quantity,
             "PricingUnit"::VARCHAR(50) AS pricing_unit,
             "ProviderName"::VARCHAR(255) AS provider_name,
             "PublisherName"::VARCHAR(255) AS publisher_name,
@@ -94,7 +94,18 @@ BEGIN
             "SkuPriceId"::VARCHAR(255) AS sku_price_id,
             "SubAccountId"::VARCHAR(255) AS sub_account_id,
             CASE
-                WHEN "Tags" IS NULL OR "Tags" = 'None' THEN NULL::jsonb
+                WHEN "Tags" IS NULL OR "Tags"::text = 'None' THEN NULL::jsonb
+                -- Typed loads store the BigQuery label array as JSON
+                WHEN "Tags"::text LIKE '[{"%' THEN (
+                    SELECT jsonb_object_agg(
+                        t->>'key',
+                        CASE
+                            WHEN t->>'value' ~ '^[-]?[0-9]+([.][0-9]+)?$' THEN (t->>'value')::jsonb
+                            ELSE to_jsonb(t->>'value')
+                        END
+                    )
+                    FROM jsonb_array_elements("Tags"::text::jsonb) AS t
+                )
                 ELSE (
                     SELECT jsonb_object_agg(
                         trim(both '"' from key),
@@ -109,14 +120,14 @@ BEGIN
                             trim(both '{' from trim(both '}' from trim(split_part(kv, ':', 1)))) AS key,
                             trim(both '{' from trim(both '}' from trim(split_part(kv, ':', 2)))) AS value
                         FROM regexp_split_to_table(
-                            regexp_replace("Tags", '^\[{|}\]$', '', 'g'),
+                            regexp_replace("Tags"::text, '^\[{|}\]$', '', 'g'),
                             ',(?=(?:[^'']*''[^'']*'')*[^'']*$)'
                         ) AS kv
                     ) AS kvs
                 )
             END AS tags,
             "x_CostType"::VARCHAR(50) AS x_cost_type,
-            NULLIF("x_CurrencyConversionRate", 'None')::FLOAT AS x_currency_conversion_rate,
+            NULLIF("x_CurrencyConversionRate"::text, 'None')::FLOAT AS x_currency_conversion_rate,
             "x_ExportTime"::TIMESTAMP AS x_export_time,
             "x_Location"::VARCHAR(255) AS x_location,
             "x_ProjectId"::VARCHAR(255) AS x_project_id,
@@ -126,7 +137,7 @@ BEGIN
             "x_ProjectAncestors"::TEXT AS x_project_ancestors,
             "x_Project"::VARCHAR(255) AS x_project,
             "x_ServiceId"::VARCHAR(255) AS x_service_id,
-            "hash_key" as hash_key
+            encode("hash_key", 'hex') as hash_key  -- bronze keys are binary digests
         FROM __schema__.bronze_focus_gcp_data;
     ELSE
         -- Truncate the table if it already exists
@@ -136,7 +147,7 @@ BEGIN
         INSERT INTO __schema__.silver_focus_gcp_data
         SELECT
             "AvailabilityZone"::VARCHAR(255) AS availability_zone,
-            NULLIF("BilledCost", 'None')::FLOAT AS billed_cost,
+            NULLIF("BilledCost"::text, 'None')::FLOAT AS billed_cost,
             "BillingAccountId"::VARCHAR(255) AS billing_account_id,
             "BillingCurrency"::VARCHAR(10) AS billing_currency,
             "BillingPeriodStart"::TIMESTAMP AS billing_period_start,
@@ -149,15 +160,15 @@ BEGIN
             "CommitmentDiscountCategory"::VARCHAR(255) AS commitment_discount_category,
             "CommitmentDiscountId"::VARCHAR(255) AS commitment_discount_id,
             "CommitmentDiscountName"::VARCHAR(255) AS commitment_discount_name,
-            NULLIF("ConsumedQuantity", 'None')::FLOAT AS consumed_quantity,
+            NULLIF("ConsumedQuantity"::text, 'None')::FLOAT AS consumed_quantity,
             "ConsumedUnit"::VARCHAR(50) AS consumed_unit,
-            NULLIF("ContractedCost", 'None')::FLOAT AS contracted_cost,
-            NULLIF("ContractedUnitPrice", 'None')::FLOAT AS contracted_unit_price,
-            NULLIF("EffectiveCost", 'None')::FLOAT AS effective_cost,
-            NULLIF("ListCost", 'None')::FLOAT AS list_cost,
-            NULLIF("ListUnitPrice", 'None')::FLOAT AS list_unit_price,
+            NULLIF("ContractedCost"::text, 'None')::FLOAT AS contracted_cost,
+            NULLIF("ContractedUnitPrice"::text, 'None')::FLOAT AS contracted_unit_price,
+            NULLIF("EffectiveCost"::text, 'None')::FLOAT AS effective_cost,
+            NULLIF("ListCost"::text, 'None')::FLOAT AS list_cost,
+            NULLIF("ListUnitPrice"::text, 'None')::FLOAT AS list_unit_price,
             "PricingCategory"::VARCHAR(255) AS pricing_category,
-            NULLIF("PricingQuantity", 'None')::FLOAT AS pricing_quantity,
+            NULLIF("PricingQuantity"::text, 'None')::FLOAT AS pricing_quantity,
             "PricingUnit"::VARCHAR(50) AS pricing_unit,
             "ProviderName"::VARCHAR(255) AS provider_name,
             "PublisherName"::VARCHAR(255) AS publisher_name,
@@ -172,7 +183,18 @@ BEGIN
             "SkuPriceId"::VARCHAR(255) AS sku_price_id,
             "SubAccountId"::VARCHAR(255) AS sub_account_id,
             CASE
-                WHEN "Tags" IS NULL OR "Tags" = 'None' THEN NULL::jsonb
+                WHEN "Tags" IS NULL OR "Tags"::text = 'None' THEN NULL::jsonb
+                -- Typed loads store the BigQuery label array as JSON
+                WHEN "Tags"::text LIKE '[{"%' THEN (
+                    SELECT jsonb_object_agg(
+                        t->>'key',
+                        CASE
+                            WHEN t->>'value' ~ '^[-]?[0-9]+([.][0-9]+)?$' THEN (t->>'value')::jsonb
+                            ELSE to_jsonb(t->>'value')
+                        END
+                    )
+                    FROM jsonb_array_elements("Tags"::text::jsonb) AS t
+                )
                 ELSE (
                     SELECT jsonb_object_agg(
                         trim(both '"' from key),
@@ -187,14 +209,14 @@ BEGIN
                             trim(both '{' from trim(both '}' from trim(split_part(kv, ':', 1)))) AS key,
                             trim(both '{' from trim(both '}' from trim(split_part(kv, ':', 2)))) AS value
                         FROM regexp_split_to_table(
-                            regexp_replace("Tags", '^\[{|}\]$', '', 'g'),
+                            regexp_replace("Tags"::text, '^\[{|}\]$', '', 'g'),
                             ',(?=(?:[^'']*''[^'']*'')*[^'']*$)'
                         ) AS kv
                     ) AS kvs
                 )
             END AS tags,
             "x_CostType"::VARCHAR(50) AS x_cost_type,
-            NULLIF("x_CurrencyConversionRate", 'None')::FLOAT AS x_currency_conversion_rate,
+            NULLIF("x_CurrencyConversionRate"::text, 'None')::FLOAT AS x_currency_conversion_rate,
             "x_ExportTime"::TIMESTAMP AS x_export_time,
             "x_Location"::VARCHAR(255) AS x_location,
             "x_ProjectId"::VARCHAR(255) AS x_project_id,
@@ -204,7 +226,7 @@ BEGIN
             "x_ProjectAncestors"::TEXT AS x_project_ancestors,
             "x_Project"::VARCHAR(255) AS x_project,
             "x_ServiceId"::VARCHAR(255) AS x_service_id,
-            "hash_key" as hash_key
+            encode("hash_key", 'hex') as hash_key  -- bronze keys are binary digests
         FROM __schema__.bronze_focus_gcp_data;
     END IF;
 END $$;
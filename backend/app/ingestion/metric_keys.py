@@ -0,0 +1,167 @@
+"""
+Row identity of the bronze metrics tables.
+
+A metrics row is one datapoint of one series: a resource, a metric, a timestamp and the
+aggregation it was read with, plus a dimension value for metrics split by one (an S3
+storage type). Its hash_key is the sha256 of those parts in a canonical form, so every
+worker process and every run derives the same key for the same datapoint, unlike the
+built-in hash(), which is salted per interpreter. Bronze tables enforce the key with a
+unique constraint and rows are upserted on it, so a datapoint collected again (window
+overlap, gap refill) updates its row instead of adding one.
+
+Rows written before the aggregation was part of the key have no aggregation. Provider
+ingestion runs `compact_metrics_table` on every bronze metrics table before collecting
+into it: while such rows exist it drops duplicate datapoints, keeping the latest row of
+each, and rewrites the remaining keys; afterwards it finds none and returns at once.
+`metric_key_sql` computes the key in SQL exactly as `add_metric_keys` does in Python.
+
+The helpers take a cursor and leave commits to the caller. Provider postgres modules
+wrap them with their own `@connection` decorator.
+"""
+import hashlib
+import io
+import pandas as pd
+from psycopg2 import sql
+
+KEY_SEPARATOR = "|"
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+SQL_TIMESTAMP_FORMAT = 'YYYY-MM-DD"T"HH24:MI:SS"Z"'
+
+
+def add_metric_keys(df, resource_column, metric_column, timestamp_column, aggregation_column,
+                    dimension_column=None, key_column="hash_key"):
+    """
+    Set `key_column` to the stable key of every row.
+
+    Timestamps are read as UTC and keyed to the second; resource IDs and aggregations are
+    compared case-insensitively.
+    """
+    parts = [
+        df[resource_column].fillna("").astype(str).str.lower(),
+        df[metric_column].fillna("").astype(str),
+        pd.to_datetime(df[timestamp_column], utc=True, errors="coerce").dt.strftime(TIMESTAMP_FORMAT).fillna(""),
+        df[aggregation_column].fillna("").astype(str).str.lower(),
+    ]
+    if dimension_column:
+        parts.append(df[dimension_column].fillna("").astype(str))
+    canonical = parts[0].str.cat(parts[1:], sep=KEY_SEPARATOR)
+    df[key_column] = [hashlib.sha256(value.encode("utf-8")).hexdigest() for value in canonical]
+    return df
+
+
+def metric_key_sql(resource_column, metric_column, timestamp_column, aggregation_column, dimension_column=None):
+    """SQL expression computing `add_metric_keys`' key from the columns of a row."""
+    parts = [
+        sql.SQL("lower(coalesce({}::text, ''))").format(sql.Identifier(resource_column)),
+        sql.SQL("coalesce({}::text, '')").format(sql.Identifier(metric_column)),
+        sql.SQL("coalesce(to_char({}, {}), '')").format(
+            sql.Identifier(timestamp_column), sql.Literal(SQL_TIMESTAMP_FORMAT)),
+        sql.SQL("lower(coalesce({}::text, ''))").format(sql.Identifier(aggregation_column)),
+    ]
+    if dimension_column:
+        parts.append(sql.SQL("coalesce({}::text, '')").format(sql.Identifier(dimension_column)))
+    return sql.SQL("encode(sha256(convert_to(concat_ws({}, {}), 'UTF8')), 'hex')").format(
+        sql.Literal(KEY_SEPARATOR), sql.SQL(", ").join(parts))
+
+
+def upsert_metric_rows(cursor, frame, schema_name, table_name, key_column="hash_key"):
+    """
+    Insert rows, updating the row of every key that is already stored.
+
+    Rows are COPYed into a temporary stage shaped like the table and merged from there, so
+    a batch costs one round trip for the data and one statement for the upsert.
+
+    Returns:
+        int: Number of rows written.
+    """
+    frame = frame.drop_duplicates(subset=[key_column], keep="last").replace("", None)
+    columns = list(frame.columns)
+    updates = [column for column in columns if column != key_column]
+    column_list = sql.SQL(", ").join(sql.Identifier(c) for c in columns)
+    stage = sql.Identifier(f"{table_name}_stage")
+
+    cursor.execute(sql.SQL("CREATE TEMP TABLE IF NOT EXISTS {} (LIKE {}.{} INCLUDING DEFAULTS) ON COMMIT DROP").format(
+        stage, sql.Identifier(schema_name), sql.Identifier(table_name)))
+    buffer = io.StringIO()
+    # Unquoted empty fields are NULL in COPY's CSV format; empty strings were replaced above
+    frame.to_csv(buffer, index=False, header=False, date_format="%Y-%m-%d %H:%M:%S")
+    buffer.seek(0)
+    cursor.copy_expert(sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+        stage, column_list).as_string(cursor), buffer)
+    cursor.execute(sql.SQL(
+        "INSERT INTO {}.{} ({columns}) SELECT {columns} FROM {} ON CONFLICT ({}) DO UPDATE SET {}"
+    ).format(
+        sql.Identifier(schema_name), sql.Identifier(table_name), stage,
+        sql.Identifier(key_column),
+        sql.SQL(", ").join(sql.SQL("{} = EXCLUDED.{}").format(sql.Identifier(c), sql.Identifier(c)) for c in updates),
+        columns=column_list,
+    ))
+    cursor.execute(sql.SQL("TRUNCATE {}").format(stage))
+    return len(frame)
+
+
+def compact_metrics_table(cursor, schema_name, table_name, series_columns, aggregation_column, aggregations,
+                          default_aggregation, dimension_column=None, order_column=None, key_column="hash_key",
+                          dependent_tables=()):
+    """
+    Move a metrics table to stable keys and drop its duplicate datapoints.
+
+    Nothing is done when every row has its aggregation, i.e. the table is keyed. Rows stored before the aggregation was recorded get it from `aggregations` (metric
+    name -> aggregation) or `default_aggregation`. Of each set of duplicates the row with
+    the latest `order_column` (physical position without one) is kept. Rows of
+    `dependent_tables` ((table, key column) pairs, e.g. silver tables keyed by the bronze
+    hash_key) whose key no longer exists are removed, so their next load re-inserts them
+    under the new key.
+
+    Args:
+        series_columns (tuple): Resource, metric and timestamp columns.
+
+    Returns:
+        tuple: (rows deleted, rows rekeyed)
+    """
+    resource_column, metric_column, timestamp_column = series_columns
+    table_id = sql.SQL("{}.{}").format(sql.Identifier(schema_name), sql.Identifier(table_name))
+    key_expr = metric_key_sql(resource_column, metric_column, timestamp_column, aggregation_column, dimension_column)
+
+    cursor.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} text").format(
+        table_id, sql.Identifier(aggregation_column)))
+    cursor.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {} WHERE {} IS NULL)").format(
+        table_id, sql.Identifier(aggregation_column)))
+    if not cursor.fetchone()[0]:
+        return 0, 0
+    aggregation_expr = sql.Literal(default_aggregation)
+    if aggregations:
+        aggregation_expr = sql.SQL("CASE {} {} ELSE {} END").format(
+            sql.Identifier(metric_column),
+            sql.SQL(" ").join(
+                sql.SQL("WHEN {} THEN {}").format(sql.Literal(metric), sql.Literal(aggregation))
+                for metric, aggregation in aggregations.items()
+            ),
+            aggregation_expr,
+        )
+    cursor.execute(sql.SQL("UPDATE {} SET {} = {} WHERE {} IS NULL").format(
+        table_id, sql.Identifier(aggregation_column), aggregation_expr, sql.Identifier(aggregation_column)))
+
+    order = sql.SQL("ctid DESC") if order_column is None else sql.SQL("{} DESC NULLS LAST, ctid DESC").format(
+        sql.Identifier(order_column))
+    cursor.execute(sql.SQL(
+        "DELETE FROM {table} WHERE ctid IN ("
+        "  SELECT ctid FROM ("
+        "    SELECT ctid, row_number() OVER (PARTITION BY {key} ORDER BY {order}) AS rn FROM {table}"
+        "  ) ranked WHERE rn > 1)"
+    ).format(table=table_id, key=key_expr, order=order))
+    deleted = cursor.rowcount
+
+    cursor.execute(sql.SQL("UPDATE {} SET {} = {} WHERE {} IS DISTINCT FROM {}").format(
+        table_id, sql.Identifier(key_column), key_expr, sql.Identifier(key_column), key_expr))
+    rekeyed = cursor.rowcount
+
+    for dependent_table, dependent_key in dependent_tables:
+        cursor.execute("SELECT to_regclass(%s)", (f"{schema_name}.{dependent_table}",))
+        if cursor.fetchone()[0] is None:
+            continue
+        cursor.execute(sql.SQL(
+            "DELETE FROM {}.{} d WHERE NOT EXISTS (SELECT 1 FROM {} b WHERE b.{} = d.{})"
+        ).format(sql.Identifier(schema_name), sql.Identifier(dependent_table), table_id,
+                 sql.Identifier(key_column), sql.Identifier(dependent_key)))
+    return deleted, rekeyed
@@ -0,0 +1,76 @@
+"""
+Batched writes of collected metrics rows.
+
+Collectors hand the rows of every response to a `MetricsSink` as they arrive instead of
+keeping them until the end of the run. The sink buffers up to METRICS_SINK_BATCH_SIZE
+rows and then writes them as one batch, so memory stays bounded by one batch whatever
+the size of the subscription, and every batch written before a crash stays written.
+Responses are never split across batches, so all datapoints of a series fetched by one
+request are committed together with its watermark.
+
+Usage:
+    sink = MetricsSink("VM metrics", write=lambda frame: upsert_metrics(frame, ...),
+                       prepare=lambda frame: add_metric_keys(frame, ...))
+    sink.add(rows)
+    complete = sink.close()
+"""
+import os
+import time
+import pandas as pd
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Rows buffered before a batch is written
+METRICS_SINK_BATCH_SIZE = int(os.getenv("METRICS_SINK_BATCH_SIZE", "5000"))
+
+
+class MetricsSink:
+    """
+    Buffer of metrics rows written in batches.
+
+    Args:
+        label (str): Name used in the log lines.
+        write (callable): Writes one prepared frame; returns True once it is committed.
+        prepare (callable): Turns the frame of one batch into the rows to write, e.g. adds keys.
+        batch_size (int): Rows buffered before a batch is written.
+    """
+
+    def __init__(self, label, write, prepare=None, batch_size=METRICS_SINK_BATCH_SIZE):
+        self.label = label
+        self.write = write
+        self.prepare = prepare
+        self.batch_size = batch_size
+        self.buffer = []
+        self.started_at = time.monotonic()
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.batches = 0
+
+    def add(self, rows):
+        """Buffer the rows of one response, writing a batch once the buffer is full."""
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        rows, self.buffer = self.buffer, []
+        frame = pd.DataFrame(rows)
+        if self.prepare:
+            frame = self.prepare(frame)
+        if self.write(frame):
+            self.rows_written += len(frame)
+            self.batches += 1
+        else:
+            self.rows_failed += len(frame)
+            print(f"❌ {self.label}: batch of {len(frame)} rows was not written")
+
+    def close(self):
+        """Write what is left; returns True when every batch was written."""
+        self.flush()
+        elapsed = max(time.monotonic() - self.started_at, 1e-6)
+        print(f"💾 {self.label}: {self.rows_written} rows written in {self.batches} batch(es) "
+              f"({self.rows_written / elapsed:.0f} rows/s), {self.rows_failed} rows failed")
+        return self.rows_failed == 0
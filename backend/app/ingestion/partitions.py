@@ -0,0 +1,314 @@
+"""
+Billing-period partitioning for the bronze fact tables.
+
+Bronze tables are range-partitioned by month on their billing period column. A restated
+month is written to a standalone staging table first, then swapped in for the existing
+partition in one short transaction, so readers see either the old month or the new one
+and every other month is left untouched.
+
+Each replaced month is fingerprinted (row count and an md5 over its sorted hash keys) in
+`bronze_period_fingerprints`, which lets a run skip months whose export did not change
+without reading the partition itself.
+
+The helpers take a cursor and leave commits to the caller. Provider postgres modules
+wrap them with their own `@connection` decorator.
+"""
+import hashlib
+from datetime import datetime
+import pandas as pd
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from app.ingestion.focus_schema import (
+    KEY_COLUMN, KEY_LENGTH, KEY_TYPE, column_cast, column_types, ensure_binary_key, ensure_column_types,
+    get_schema, partitioned_table_ddl,
+)
+
+FINGERPRINT_TABLE = "bronze_period_fingerprints"
+LEGACY_SUFFIX = "_pre_partitioning"
+# Comment set on a pre-partitioning table once its rows were copied into the parent
+LEGACY_COPIED = "Rows copied into the partitioned bronze table"
+
+
+def month_start(value):
+    """Return the first instant of the month containing `value`."""
+    value = pd.Timestamp(value)
+    return datetime(value.year, value.month, 1)
+
+
+def month_bounds(period_start):
+    """Return the [start, end) bounds of the monthly partition holding `period_start`."""
+    start = month_start(period_start)
+    end = datetime(start.year + 1, 1, 1) if start.month == 12 else datetime(start.year, start.month + 1, 1)
+    return start, end
+
+
+def partition_name(table_name, period_start):
+    return f"{table_name}_p{month_start(period_start):%Y%m}"
+
+
+def period_fingerprint(hash_keys):
+    """Fingerprint a month by its row count and an md5 over its sorted hash keys."""
+    hash_keys = sorted(hash_keys)
+    digest = hashlib.md5("".join(hash_keys).encode("utf-8")).hexdigest()
+    return f"{len(hash_keys)}:{digest}"
+
+
+def split_by_period(df, partition_column):
+    """
+    Split a frame into one frame per billing month.
+
+    Rows without a billing period cannot be placed in a partition and are dropped.
+
+    Returns:
+        dict: {month start (datetime): pd.DataFrame}
+    """
+    periods = pd.to_datetime(df[partition_column], errors="coerce", utc=True).dt.tz_localize(None)
+    missing = periods.isna()
+    if missing.any():
+        print(f"Dropping {int(missing.sum())} rows without {partition_column}; they cannot be partitioned.")
+    df = df[~missing]
+    periods = periods[~missing].dt.to_period("M")
+    return {
+        period.to_timestamp().to_pydatetime(): frame
+        for period, frame in df.groupby(periods.values, sort=True)
+    }
+
+
+def _relation_kind(cursor, schema_name, table_name):
+    cursor.execute(
+        "SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE n.nspname = %s AND c.relname = %s",
+        (schema_name, table_name),
+    )
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def ensure_partitioned_table(cursor, provider, schema_name, table_name, partition_column):
+    """
+    Create the partitioned bronze parent, its load batch index and the fingerprint table
+    if they do not exist, and convert a parent still keyed on hex text to binary keys.
+
+    A plain (pre-partitioning) table of the same name is renamed to
+    `<table>_pre_partitioning`, together with its indexes, and its rows are copied into
+    the new parent (see `copy_legacy_rows`). The renamed table is kept as a backup.
+
+    Returns:
+        str | None: Name the old table was moved to, if one was migrated.
+    """
+    moved_to = None
+    if _relation_kind(cursor, schema_name, table_name) == "r":
+        moved_to = f"{table_name}{LEGACY_SUFFIX}"
+        if _relation_kind(cursor, schema_name, moved_to) is not None:
+            moved_to = f"{moved_to}_{datetime.utcnow():%Y%m%d%H%M%S}"
+        cursor.execute(
+            "SELECT indexname FROM pg_indexes WHERE schemaname = %s AND tablename = %s",
+            (schema_name, table_name),
+        )
+        for (index_name,) in cursor.fetchall():
+            cursor.execute(sql.SQL("ALTER INDEX {}.{} RENAME TO {}").format(
+                sql.Identifier(schema_name), sql.Identifier(index_name),
+                sql.Identifier(f"{index_name[:40]}{LEGACY_SUFFIX}")))
+        cursor.execute(sql.SQL("ALTER TABLE {}.{} RENAME TO {}").format(
+            sql.Identifier(schema_name), sql.Identifier(table_name), sql.Identifier(moved_to)))
+        print(f"Moved unpartitioned {schema_name}.{table_name} to {schema_name}.{moved_to}.")
+
+    cursor.execute(partitioned_table_ddl(provider, schema_name, table_name, partition_column))
+    # Parents created before keys were stored as binary digests or columns were typed
+    ensure_binary_key(cursor, schema_name, table_name)
+    ensure_column_types(cursor, provider, schema_name, table_name)
+    # Lets silver pick up the rows of the current load batch
+    cursor.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {}.{} (load_batch_id)").format(
+        sql.Identifier(f"{table_name}_load_batch_idx"), sql.Identifier(schema_name), sql.Identifier(table_name)))
+    cursor.execute(sql.SQL(
+        "CREATE TABLE IF NOT EXISTS {}.{} ("
+        "table_name text NOT NULL, "
+        "period_start timestamp NOT NULL, "
+        "fingerprint text NOT NULL, "
+        "load_batch_id text, "
+        "loaded_at timestamp NOT NULL DEFAULT now(), "
+        "PRIMARY KEY (table_name, period_start))"
+    ).format(sql.Identifier(schema_name), sql.Identifier(FINGERPRINT_TABLE)))
+    # Includes tables moved by earlier runs, which renamed them without copying
+    for legacy_table in _uncopied_legacy_tables(cursor, schema_name, table_name):
+        copy_legacy_rows(cursor, provider, schema_name, table_name, legacy_table, partition_column)
+    return moved_to
+
+
+def _uncopied_legacy_tables(cursor, schema_name, table_name):
+    cursor.execute(
+        "SELECT c.relname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE n.nspname = %s AND c.relkind = 'r' AND starts_with(c.relname, %s) "
+        "AND obj_description(c.oid, 'pg_class') IS DISTINCT FROM %s ORDER BY c.relname",
+        (schema_name, f"{table_name}{LEGACY_SUFFIX}", LEGACY_COPIED),
+    )
+    return [relname for (relname,) in cursor.fetchall()]
+
+
+def copy_legacy_rows(cursor, provider, schema_name, table_name, legacy_table, partition_column):
+    """
+    Copy the rows of a pre-partitioning bronze table into the partitioned parent.
+
+    Columns are cast to their registered types and hex keys decoded to binary. Rows
+    without a billing period take the month of their charge period; rows with neither,
+    or with a malformed key, cannot be stored and are left behind. Only months
+    without a partition are copied: a month already in the parent was loaded from the
+    export since, and is newer than the copy. The legacy table is then marked as copied
+    and kept as a backup.
+
+    Returns:
+        int: Number of rows copied.
+    """
+    schema = get_schema(provider)
+    legacy_types = column_types(cursor, schema_name, legacy_table)
+    schema_id, legacy_id = sql.Identifier(schema_name), sql.Identifier(legacy_table)
+
+    key = sql.Identifier(KEY_COLUMN)
+    if legacy_types.get(KEY_COLUMN) != KEY_TYPE:
+        key = sql.SQL("decode(CASE WHEN {key} ~ %s THEN {key} END, 'hex')").format(key=key)
+    partition_type = sql.SQL(schema[partition_column])
+    period = sql.SQL("NULL::{}").format(partition_type)
+    if partition_column in legacy_types:
+        period = column_cast(cursor, partition_column, schema[partition_column], legacy_types[partition_column])
+    if "ChargePeriodStart" in legacy_types and "ChargePeriodStart" in schema:
+        charge_start = column_cast(cursor, "ChargePeriodStart", schema["ChargePeriodStart"],
+                                   legacy_types["ChargePeriodStart"])
+        period = sql.SQL("coalesce({}, date_trunc('month', {})::{})").format(period, charge_start, partition_type)
+
+    columns = [column for column in schema if column in legacy_types and column != partition_column]
+    selected = [sql.SQL("{} AS {}").format(key, sql.Identifier(KEY_COLUMN)),
+                sql.SQL("{} AS {}").format(period, sql.Identifier(partition_column))]
+    selected += [sql.SQL("{} AS {}").format(
+        column_cast(cursor, column, schema[column], legacy_types[column]), sql.Identifier(column))
+        for column in columns]
+    rows = sql.SQL("(SELECT {} FROM {}.{}) legacy").format(sql.SQL(", ").join(selected), schema_id, legacy_id)
+    month = sql.SQL("date_trunc('month', {})").format(sql.Identifier(partition_column))
+
+    key_pattern = f"^[0-9a-fA-F]{{{KEY_LENGTH * 2}}}$"
+    key_parameters = (key_pattern,) if legacy_types.get(KEY_COLUMN) != KEY_TYPE else ()
+    cursor.execute(sql.SQL("SELECT DISTINCT {} FROM {} WHERE {} IS NOT NULL").format(
+        month, rows, sql.Identifier(partition_column)), key_parameters)
+    months = []
+    for (period_start,) in cursor.fetchall():
+        partition = partition_name(table_name, period_start)
+        if _relation_kind(cursor, schema_name, partition) is not None:
+            continue
+        start, end = month_bounds(period_start)
+        cursor.execute(sql.SQL("CREATE TABLE {}.{} PARTITION OF {}.{} FOR VALUES FROM (%s) TO (%s)").format(
+            schema_id, sql.Identifier(partition), schema_id, sql.Identifier(table_name)), (start, end))
+        months.append(start)
+
+    copied = 0
+    if months:
+        names = sql.SQL(", ").join(sql.Identifier(c) for c in [KEY_COLUMN, partition_column] + columns)
+        cursor.execute(sql.SQL(
+            "INSERT INTO {}.{} ({names}) SELECT {names} FROM {} "
+            "WHERE {} = ANY(%s) AND octet_length({}) = {} ON CONFLICT DO NOTHING"
+        ).format(schema_id, sql.Identifier(table_name), rows, month, sql.Identifier(KEY_COLUMN),
+                 sql.Literal(KEY_LENGTH), names=names), key_parameters + (months,))
+        copied = cursor.rowcount
+    cursor.execute(sql.SQL("SELECT count(*) FROM {}.{}").format(schema_id, legacy_id))
+    total = cursor.fetchone()[0]
+    cursor.execute(sql.SQL("COMMENT ON TABLE {}.{} IS {}").format(schema_id, legacy_id, sql.Literal(LEGACY_COPIED)))
+    print(f"Copied {copied} of {total} rows from {schema_name}.{legacy_table} into {len(months)} new monthly "
+          f"partitions of {schema_name}.{table_name}; the rest were malformed, duplicated or of months "
+          f"loaded since. {legacy_table} is kept as a backup.")
+    return copied
+
+
+def fetch_period_fingerprints(cursor, schema_name, table_name):
+    """Return {month start: fingerprint} for the months currently loaded in a table."""
+    cursor.execute(
+        sql.SQL("SELECT period_start, fingerprint FROM {}.{} WHERE table_name = %s").format(
+            sql.Identifier(schema_name), sql.Identifier(FINGERPRINT_TABLE)),
+        (table_name,),
+    )
+    return {period_start: fingerprint for period_start, fingerprint in cursor.fetchall()}
+
+
+def create_staging_partition(cursor, schema_name, table_name, period_start):
+    """
+    Create an empty standalone staging table for one month, shaped like the parent.
+
+    The table copies the parent's constraints and indexes, so attaching it later needs
+    no index build. A stage left over from a failed run is replaced.
+
+    Returns:
+        str: Name of the staging table.
+    """
+    stage = f"{partition_name(table_name, period_start)}_stage"
+    schema_id, stage_id = sql.Identifier(schema_name), sql.Identifier(stage)
+    cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}.{}").format(schema_id, stage_id))
+    cursor.execute(sql.SQL(
+        "CREATE TABLE {}.{} (LIKE {}.{} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING INDEXES)"
+    ).format(schema_id, stage_id, schema_id, sql.Identifier(table_name)))
+    return stage
+
+
+def append_to_staging_partition(cursor, frame, schema_name, stage, page_size=10000):
+    """Insert a frame into a staging table. Months can be staged a batch at a time."""
+    columns = sql.SQL(", ").join(sql.Identifier(c) for c in frame.columns)
+    insert_query = sql.SQL("INSERT INTO {}.{} ({}) VALUES %s").format(
+        sql.Identifier(schema_name), sql.Identifier(stage), columns)
+    records = [tuple(row) for row in frame.to_numpy()]
+    execute_values(cursor, insert_query.as_string(cursor), records, page_size=page_size)
+
+
+def seal_staging_partition(cursor, schema_name, stage, partition_column, period_start):
+    """
+    Add the CHECK constraint matching the month's partition bounds, so attaching the
+    staging table needs no validation scan. Commit before calling `swap_in_partition`:
+    the swap must not run in a transaction that already holds a lock on the parent.
+    """
+    start, end = month_bounds(period_start)
+    column_id = sql.Identifier(partition_column)
+    cursor.execute(sql.SQL("ALTER TABLE {}.{} ADD CHECK ({} >= %s AND {} < %s)").format(
+        sql.Identifier(schema_name), sql.Identifier(stage), column_id, column_id), (start, end))
+
+
+def drop_staging_partition(cursor, schema_name, stage):
+    cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}.{}").format(sql.Identifier(schema_name), sql.Identifier(stage)))
+
+
+def build_staging_partition(cursor, frame, schema_name, table_name, partition_column, period_start,
+                            page_size=10000):
+    """
+    Load one month into a sealed staging table in one go.
+
+    Commit before calling `swap_in_partition`.
+
+    Returns:
+        str: Name of the staging table.
+    """
+    stage = create_staging_partition(cursor, schema_name, table_name, period_start)
+    append_to_staging_partition(cursor, frame, schema_name, stage, page_size=page_size)
+    seal_staging_partition(cursor, schema_name, stage, partition_column, period_start)
+    return stage
+
+
+def swap_in_partition(cursor, schema_name, table_name, stage, period_start, fingerprint, load_batch_id=None):
+    """
+    Replace the month's partition with the staging table.
+
+    Detach, drop, rename and attach run in the caller's transaction, so the month is
+    replaced atomically when it commits.
+    """
+    start, end = month_bounds(period_start)
+    partition = partition_name(table_name, start)
+    schema_id, parent_id = sql.Identifier(schema_name), sql.Identifier(table_name)
+    partition_id = sql.Identifier(partition)
+
+    if _relation_kind(cursor, schema_name, partition) is not None:
+        cursor.execute(sql.SQL("ALTER TABLE {}.{} DETACH PARTITION {}.{}").format(
+            schema_id, parent_id, schema_id, partition_id))
+        cursor.execute(sql.SQL("DROP TABLE {}.{}").format(schema_id, partition_id))
+    cursor.execute(sql.SQL("ALTER TABLE {}.{} RENAME TO {}").format(
+        schema_id, sql.Identifier(stage), partition_id))
+    cursor.execute(sql.SQL("ALTER TABLE {}.{} ATTACH PARTITION {}.{} FOR VALUES FROM (%s) TO (%s)").format(
+        schema_id, parent_id, schema_id, partition_id), (start, end))
+
+    cursor.execute(sql.SQL(
+        "INSERT INTO {}.{} (table_name, period_start, fingerprint, load_batch_id) VALUES (%s, %s, %s, %s) "
+        "ON CONFLICT (table_name, period_start) DO UPDATE "
+        "SET fingerprint = EXCLUDED.fingerprint, load_batch_id = EXCLUDED.load_batch_id, loaded_at = now()"
+    ).format(schema_id, sql.Identifier(FINGERPRINT_TABLE)), (table_name, start, fingerprint, load_batch_id))
@@ -0,0 +1,255 @@
+"""
+Ledger of ingestion runs: one row per run in the `ingestionrun` table (app.models.ingestion_run).
+
+A Celery task opens an `IngestionRunLedger` around one project's ingestion. While it is
+open, the ingestion modules report into it through the module functions, without the run
+being passed down:
+
+    with run_ledger.stage("download"):
+        df = download_and_read_parquet(...)
+    run_ledger.add("rows_loaded", len(df))
+
+Stage time is exclusive: a stage entered inside another one (a download pulled by a
+generator the loader consumes) is deducted from the outer stage, so the stages of a run
+add up to at most its wall time. Stages run by parallel threads are summed. Peak memory
+is the highest resident set size sampled while the run is open. Nothing is recorded when
+no run is open, and a ledger write that fails never fails the ingestion.
+
+The dashboard refresh runs after the projects it covers were ingested, so its time is
+booked by `book_dashboard` onto the latest successful run of each of those projects, as
+their `dashboard` stage; it is not part of their wall time.
+
+Celery's prefork workers run one task per process, so one run is open per process.
+"""
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DB_HOST_NAME = os.getenv("DB_HOST_NAME")
+DB_NAME = os.getenv("DB_NAME")
+DB_USER_NAME = os.getenv("DB_USER_NAME")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+DB_PORT = os.getenv("DB_PORT")
+
+# Seconds between resident memory samples
+RUN_LEDGER_MEMORY_SAMPLE_INTERVAL = float(os.getenv("RUN_LEDGER_MEMORY_SAMPLE_INTERVAL", "1"))
+
+STAGES = ("download", "parse", "hash", "load", "silver", "gold", "dashboard")
+COUNTERS = ("rows_read", "rows_loaded", "bytes_read")
+
+_current = None
+_stack = threading.local()
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        # Lifetime peak of the process; kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _execute(query, params):
+    connection = None
+    try:
+        connection = psycopg2.connect(host=DB_HOST_NAME, database=DB_NAME, user=DB_USER_NAME,
+                                      password=DB_PASSWORD, port=DB_PORT, sslmode='require')
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+        connection.commit()
+    except Exception as ex:
+        print(f"Could not write the ingestion run ledger: {ex}")
+    finally:
+        if connection:
+            connection.close()
+
+
+class IngestionRunLedger:
+    """
+    One ingestion run of a project, recorded when it starts and when it ends.
+
+    Args:
+        project_id (int): Project the run ingests.
+        provider (str): 'aws', 'azure' or 'gcp'.
+        trigger (str): What started the run, e.g. 'schedule', 'rerun' or 'create'.
+        run_id (str): Celery task id, or a new id.
+    """
+
+    def __init__(self, project_id, provider, trigger, run_id=None):
+        self.project_id = project_id
+        self.provider = provider
+        self.trigger = trigger
+        self.run_id = run_id or uuid.uuid4().hex
+        self.status = "running"
+        self.error = None
+        self.stage_durations = {}
+        self.counters = {}
+        self.peak_memory_bytes = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._started = None
+
+    def _sample_memory(self):
+        while True:
+            self.peak_memory_bytes = max(self.peak_memory_bytes, _rss_bytes())
+            if self._stop.wait(RUN_LEDGER_MEMORY_SAMPLE_INTERVAL):
+                return
+
+    def start(self):
+        global _current
+        self._started = time.monotonic()
+        _current = self
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample_memory, daemon=True)
+        self._sampler.start()
+        _execute(
+            'INSERT INTO "ingestionrun" (run_id, project_id, provider, trigger, status, started_at, stage_durations) '
+            'VALUES (%s, %s, %s, %s, %s, now(), %s) ON CONFLICT (run_id) DO UPDATE SET status = EXCLUDED.status',
+            (self.run_id, self.project_id, self.provider, self.trigger, self.status, json.dumps({})))
+        return self
+
+    def record_stage(self, name, seconds):
+        with self._lock:
+            self.stage_durations[name] = self.stage_durations.get(name, 0.0) + seconds
+
+    def add(self, counter, value):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + int(value)
+
+    def finish(self, status, error=None):
+        global _current
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join()
+        if _current is self:
+            _current = None
+        self.status = status
+        self.error = error
+        duration = time.monotonic() - self._started
+        stages = {name: round(seconds, 3) for name, seconds in self.stage_durations.items()}
+        _execute(
+            'UPDATE "ingestionrun" SET status = %s, finished_at = now(), duration_s = %s, stage_durations = %s, '
+            'rows_read = %s, rows_loaded = %s, bytes_read = %s, peak_memory_bytes = %s, error = %s '
+            'WHERE run_id = %s',
+            (status, round(duration, 3), json.dumps(stages), self.counters.get("rows_read"),
+             self.counters.get("rows_loaded"), self.counters.get("bytes_read"), self.peak_memory_bytes or None,
+             error, self.run_id))
+        print(f"Ingestion run {self.run_id} of project {self.project_id} {status} in {duration:.1f}s: "
+              + ", ".join(f"{name} {seconds:.1f}s" for name, seconds in stages.items()))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.status == "running":
+            self.finish("failed" if exc else "succeeded", str(exc) if exc else None)
+        return False
+
+
+def recorded(provider, trigger):
+    """Record every call of a task taking a payload with `project_id` as one run."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(payload, *args, **kwargs):
+            with IngestionRunLedger(payload["project_id"], provider, payload.get("trigger", trigger)):
+                return func(payload, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current():
+    """The run open in this process, or None."""
+    return _current
+
+
+def skip_current(reason):
+    """Close the run open in this process as skipped, e.g. when its project lock is held."""
+    run = _current
+    if run is not None:
+        run.finish("skipped", str(reason))
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as stage `name` of the open run, excluding nested stages."""
+    run = _current
+    if run is None:
+        yield
+        return
+    frames = getattr(_stack, "frames", None)
+    if frames is None:
+        frames = _stack.frames = []
+    frame = {"nested": 0.0}
+    frames.append(frame)
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - started
+        frames.pop()
+        if frames:
+            frames[-1]["nested"] += elapsed
+        run.record_stage(name, elapsed - frame["nested"])
+
+
+def timed_iter(iterable, name):
+    """Yield from `iterable`, timing every item it produces as stage `name`."""
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def add(counter, value):
+    """Add to a counter of the open run: rows_read, rows_loaded or bytes_read."""
+    run = _current
+    if run is not None:
+        run.add(counter, value)
+
+
+def book_dashboard(project_ids, seconds):
+    """Add a dashboard refresh's time to the latest successful run of each covered project."""
+    if not project_ids:
+        return
+    _execute(
+        """
+        UPDATE "ingestionrun"
+        SET stage_durations = stage_durations || jsonb_build_object(
+            'dashboard', round(COALESCE((stage_durations->>'dashboard')::numeric, 0) + %s::numeric, 3))
+        WHERE run_id IN (
+            SELECT DISTINCT ON (project_id) run_id FROM "ingestionrun"
+            WHERE project_id = ANY(%s) AND status = 'succeeded'
+            ORDER BY project_id, started_at DESC)
+        """,
+        (round(seconds, 3), [int(project_id) for project_id in project_ids]))
+
+
+def record_pipeline_stage(pipeline_name, stage_name, seconds):
+    """Book a SqlPipeline stage as silver, gold or (bronze DDL) load time."""
+    if stage_name.startswith("silver"):
+        name = "silver"
+    elif stage_name.startswith("gold"):
+        name = "gold"
+    else:
+        name = "load"
+    frames = getattr(_stack, "frames", None)
+    if frames:
+        frames[-1]["nested"] += seconds
+    run = _current
+    if run is not None:
+        run.record_stage(name, seconds)
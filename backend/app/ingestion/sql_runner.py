@@ -0,0 +1,479 @@
+"""
+Staged runner for the ingestion SQL files.
+
+A pipeline declares its SQL files as named stages with dependencies. A run executes
+them in dependency order on one pooled session. Each stage is its own explicit
+transaction and is split into single statements, so every statement's duration and
+rowcount can be recorded in `<schema>.sql_stage_runs` and
+`<schema>.sql_statement_timings`. A run that fails stops at the failing stage. The next
+run with resume=True first finishes that run, with its own parameters, from the failed
+stage on, up to SQL_PIPELINE_MAX_RESUMES times; a run that still fails is then
+abandoned and the next run starts afresh.
+
+Stages added with `add_migration` hold DDL. Their rendered SQL is checksummed and
+recorded per schema in `<schema>.schema_migrations`, and they are only executed when
+the checksum changed or an object they create has gone missing. They run with a short
+lock_timeout, so a view replacement that would queue behind a long dashboard query
+fails fast and is retried by the next run instead of blocking every reader.
+
+Placeholders (`__schema__`, `__budget__`, `__batch_id__`, ...) are still substituted
+textually, because the SQL files also use them inside string literals. Every value is
+validated first: identifiers must be plain Postgres names and the budget must be
+numeric, so nothing a caller passes can change the statements themselves. Identifiers
+are folded to lower case, as Postgres folds them where the files use them unquoted.
+
+Usage:
+    pipeline = SqlPipeline('aws_cost', schema_name, {'budget': monthly_budget, 'batch_id': load_batch_id})
+    pipeline.add_stage('silver', f'{base_path}/sql/parquet_silver.sql')
+    pipeline.add_stage('gold', f'{base_path}/sql/parquet_gold_views.sql', depends_on=['silver'])
+    pipeline.run(resume=True)
+
+Ingestion entry points call `run_or_raise` instead, so a failed stage fails the task and
+the project is retried.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+import psycopg2
+from psycopg2 import pool, sql
+from dotenv import load_dotenv
+from app.core.locks import check_held
+from app.ingestion import run_ledger
+
+load_dotenv()
+
+DB_HOST_NAME = os.getenv("DB_HOST_NAME")
+DB_NAME = os.getenv("DB_NAME")
+DB_USER_NAME = os.getenv("DB_USER_NAME")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+DB_PORT = os.getenv("DB_PORT")
+# Upper bound on pooled sessions shared by all pipelines of a worker process
+SQL_RUNNER_POOL_SIZE = int(os.getenv("SQL_RUNNER_POOL_SIZE", "4"))
+# How long a migration waits for a lock before giving up until the next run
+SQL_MIGRATION_LOCK_TIMEOUT = os.getenv("SQL_MIGRATION_LOCK_TIMEOUT", "5s")
+# Times an unfinished run is resumed before it is abandoned
+SQL_PIPELINE_MAX_RESUMES = int(os.getenv("SQL_PIPELINE_MAX_RESUMES", "3"))
+
+IDENTIFIER_PATTERN = re.compile(r"^[a-z_][a-z0-9_]{0,62}$", re.IGNORECASE)
+TOKEN_PATTERN = re.compile(r"^[A-Za-z0-9_\-]{1,64}$")
+CREATED_RELATION_PATTERN = re.compile(
+    r"^\s*CREATE\s+(?:OR\s+REPLACE\s+)?(?:MATERIALIZED\s+)?(?:VIEW|TABLE)\s+(?:IF\s+NOT\s+EXISTS\s+)?([\w.]+)",
+    re.IGNORECASE)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = pool.ThreadedConnectionPool(
+                1,
+                SQL_RUNNER_POOL_SIZE,
+                host=DB_HOST_NAME,
+                database=DB_NAME,
+                user=DB_USER_NAME,
+                password=DB_PASSWORD,
+                port=DB_PORT,
+                sslmode='require'
+            )
+        return _pool
+
+
+def validate_identifier(value, what="identifier"):
+    """Return `value` folded to lower case, or raise ValueError unless it is a plain Postgres name."""
+    if not isinstance(value, str) or not IDENTIFIER_PATTERN.match(value):
+        raise ValueError(f"Unsafe {what} {value!r}: expected letters, digits and underscores")
+    return value.lower()
+
+
+def render_placeholders(script, schema_name, params):
+    """
+    Substitute `__schema__` and `__<name>__` placeholders after validating every value.
+
+    'budget' must be numeric, 'batch_id' a short token and anything else a plain
+    identifier.
+    """
+    script = script.replace("__schema__", validate_identifier(schema_name, "schema name"))
+    for name, value in params.items():
+        if name == "budget":
+            value = str(float(value)).rstrip("0").rstrip(".") if value is not None else "0"
+        elif name == "batch_id":
+            if not TOKEN_PATTERN.match(str(value)):
+                raise ValueError(f"Unsafe batch id {value!r}")
+            value = str(value)
+        else:
+            value = validate_identifier(value, name)
+        script = script.replace(f"__{name}__", value)
+    return script
+
+
+def split_statements(script):
+    """
+    Split a SQL script into statements on top-level semicolons.
+
+    Semicolons inside quoted strings, quoted identifiers, dollar-quoted bodies
+    (DO blocks and functions) and comments are ignored. Statements consisting only
+    of comments are dropped.
+    """
+    statements = []
+    start = 0
+    i = 0
+    length = len(script)
+    has_code = False
+    while i < length:
+        char = script[i]
+        if script.startswith("--", i):
+            end = script.find("\n", i)
+            i = length if end == -1 else end + 1
+            continue
+        if script.startswith("/*", i):
+            end = script.find("*/", i + 2)
+            i = length if end == -1 else end + 2
+            continue
+        if char in ("'", '"'):
+            # E'...' strings also escape quotes with a backslash
+            escape_string = char == "'" and i > 0 and script[i - 1] in "Ee" and (
+                i == 1 or not (script[i - 2].isalnum() or script[i - 2] == "_"))
+            end = i + 1
+            while end < length:
+                if escape_string and script[end] == "\\":
+                    end += 2
+                    continue
+                if script[end] == char:
+                    # A doubled quote is an escaped quote
+                    if end + 1 < length and script[end + 1] == char:
+                        end += 2
+                        continue
+                    break
+                end += 1
+            i = end + 1
+            has_code = True
+            continue
+        if char == "$":
+            match = re.match(r"\$[A-Za-z_]*\$", script[i:])
+            if match:
+                tag = match.group(0)
+                end = script.find(tag, i + len(tag))
+                i = length if end == -1 else end + len(tag)
+                has_code = True
+                continue
+        if char == ";":
+            if has_code:
+                statements.append(script[start:i].strip())
+            start = i + 1
+            has_code = False
+        elif not char.isspace():
+            has_code = True
+        i += 1
+    if has_code and script[start:].strip():
+        statements.append(script[start:].strip())
+    return statements
+
+
+def created_relations(statements):
+    """Return the schema-qualified tables and views the statements create."""
+    relations = []
+    for statement in statements:
+        # Leading comments are kept on statements by split_statements
+        body = re.sub(r"^(\s*--[^\n]*\n)+", "", statement)
+        match = CREATED_RELATION_PATTERN.match(body)
+        if match and "." in match.group(1):
+            relations.append(match.group(1))
+    return relations
+
+
+class SqlPipelineFailed(Exception):
+    """Raised by `SqlPipeline.run_or_raise` when a run did not complete."""
+
+
+class SqlStage:
+    """One SQL file of a pipeline and the stages it depends on."""
+
+    def __init__(self, name, sql_file_path, depends_on=(), migration=False):
+        self.name = name
+        self.sql_file_path = sql_file_path
+        self.depends_on = list(depends_on)
+        self.migration = migration
+
+
+class SqlPipeline:
+    """
+    An ordered set of SQL stages run against one tenant schema.
+
+    The schema name is validated when the pipeline runs, so a name that cannot be used
+    fails the run instead of raising where the pipeline is declared.
+    """
+
+    def __init__(self, name, schema_name, params=None):
+        self.name = name
+        self.schema_name = schema_name
+        self.params = dict(params or {})
+        self.stages = {}
+
+    def add_stage(self, name, sql_file_path, depends_on=(), migration=False):
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dependency}'")
+        self.stages[name] = SqlStage(name, sql_file_path, depends_on, migration)
+        return self
+
+    def add_migration(self, name, sql_file_path, depends_on=()):
+        """Add a DDL stage that is only applied when its rendered SQL changed."""
+        return self.add_stage(name, sql_file_path, depends_on, migration=True)
+
+    def ordered_stages(self):
+        """Return the stages in dependency order (declaration order breaks ties)."""
+        ordered, done = [], set()
+        pending = list(self.stages.values())
+        while pending:
+            ready = [stage for stage in pending if all(d in done for d in stage.depends_on)]
+            if not ready:
+                raise ValueError(f"Pipeline '{self.name}' has a dependency cycle")
+            stage = ready[0]
+            ordered.append(stage)
+            done.add(stage.name)
+            pending.remove(stage)
+        return ordered
+
+    def _ensure_run_tables(self, cursor):
+        schema = sql.Identifier(self.schema_name)
+        cursor.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {}.sql_stage_runs (
+                run_id text NOT NULL,
+                pipeline text NOT NULL,
+                stage text NOT NULL,
+                params text NOT NULL DEFAULT '{{}}',
+                status text NOT NULL,
+                error text,
+                duration_ms double precision,
+                started_at timestamp NOT NULL DEFAULT now(),
+                finished_at timestamp,
+                PRIMARY KEY (run_id, stage)
+            )""").format(schema))
+        cursor.execute(sql.SQL(
+            "ALTER TABLE {}.sql_stage_runs ADD COLUMN IF NOT EXISTS attempts integer NOT NULL DEFAULT 1"
+        ).format(schema))
+        cursor.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {}.sql_statement_timings (
+                run_id text NOT NULL,
+                stage text NOT NULL,
+                statement_no integer NOT NULL,
+                statement text NOT NULL,
+                duration_ms double precision NOT NULL,
+                row_count bigint,
+                error text,
+                recorded_at timestamp NOT NULL DEFAULT now(),
+                PRIMARY KEY (run_id, stage, statement_no)
+            )""").format(schema))
+        cursor.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {}.schema_migrations (
+                migration text PRIMARY KEY,
+                checksum text NOT NULL,
+                run_id text,
+                applied_at timestamp NOT NULL DEFAULT now(),
+                times_applied integer NOT NULL DEFAULT 1
+            )""").format(schema))
+
+    def _resumable_run(self, cursor):
+        """
+        Return (run_id, params, committed stages) of this pipeline's last run if it did
+        not finish, else None. A run already resumed SQL_PIPELINE_MAX_RESUMES times is
+        marked abandoned instead.
+        """
+        schema = sql.Identifier(self.schema_name)
+        cursor.execute(sql.SQL("""
+            SELECT run_id, min(params), bool_or(status NOT IN ('succeeded', 'skipped', 'abandoned')), max(attempts)
+            FROM {}.sql_stage_runs
+            WHERE pipeline = %s
+            GROUP BY run_id
+            ORDER BY max(started_at) DESC
+            LIMIT 1""").format(schema), (self.name,))
+        row = cursor.fetchone()
+        if not row or not row[2]:
+            return None
+        if row[3] > SQL_PIPELINE_MAX_RESUMES:
+            cursor.execute(sql.SQL(
+                "UPDATE {}.sql_stage_runs SET status = 'abandoned' WHERE run_id = %s "
+                "AND status NOT IN ('succeeded', 'skipped')"
+            ).format(schema), (row[0],))
+            print(f"Abandoning {self.name} run {row[0]} after {row[3] - 1} failed resumes")
+            return None
+        cursor.execute(sql.SQL(
+            "SELECT stage FROM {}.sql_stage_runs WHERE run_id = %s AND status IN ('succeeded', 'skipped')"
+        ).format(schema), (row[0],))
+        return row[0], row[1], {stage for (stage,) in cursor.fetchall()}
+
+    def _record_stage(self, cursor, run_id, params, stage, status, duration_ms=None, error=None):
+        cursor.execute(sql.SQL("""
+            INSERT INTO {}.sql_stage_runs (run_id, pipeline, stage, params, status, error, duration_ms, finished_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, CASE WHEN %s = 'running' THEN NULL ELSE now() END)
+            ON CONFLICT (run_id, stage) DO UPDATE
+                SET status = EXCLUDED.status, error = EXCLUDED.error,
+                    duration_ms = EXCLUDED.duration_ms, finished_at = EXCLUDED.finished_at,
+                    attempts = sql_stage_runs.attempts + (EXCLUDED.status = 'running')::int
+        """).format(sql.Identifier(self.schema_name)),
+            (run_id, self.name, stage.name, params, status, error, duration_ms, status))
+
+    def _record_timings(self, cursor, run_id, stage, timings):
+        cursor.execute(sql.SQL("DELETE FROM {}.sql_statement_timings WHERE run_id = %s AND stage = %s").format(
+            sql.Identifier(self.schema_name)), (run_id, stage.name))
+        for statement_no, (statement, duration_ms, row_count, error) in enumerate(timings, start=1):
+            cursor.execute(sql.SQL("""
+                INSERT INTO {}.sql_statement_timings (run_id, stage, statement_no, statement, duration_ms, row_count, error)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """).format(sql.Identifier(self.schema_name)),
+                (run_id, stage.name, statement_no, statement[:500], duration_ms, row_count, error))
+
+    def _migration_is_current(self, cursor, stage, checksum, statements):
+        """True when the ledger holds this checksum and every object it creates exists."""
+        cursor.execute(sql.SQL("SELECT checksum FROM {}.schema_migrations WHERE migration = %s").format(
+            sql.Identifier(self.schema_name)), (f"{self.name}.{stage.name}",))
+        row = cursor.fetchone()
+        if not row or row[0] != checksum:
+            return False
+        for relation in created_relations(statements):
+            cursor.execute("SELECT to_regclass(%s)", (relation,))
+            if cursor.fetchone()[0] is None:
+                print(f"{relation} is missing, re-applying migration {stage.name}")
+                return False
+        return True
+
+    def _record_migration(self, cursor, run_id, stage, checksum):
+        cursor.execute(sql.SQL("""
+            INSERT INTO {}.schema_migrations (migration, checksum, run_id)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (migration) DO UPDATE
+                SET checksum = EXCLUDED.checksum, run_id = EXCLUDED.run_id,
+                    applied_at = now(), times_applied = schema_migrations.times_applied + 1
+        """).format(sql.Identifier(self.schema_name)), (f"{self.name}.{stage.name}", checksum, run_id))
+
+    def _run_stage(self, connection, cursor, run_id, stage, params):
+        """Run one stage in its own transaction. Returns (status, timings, error)."""
+        with open(stage.sql_file_path, 'r') as file:
+            script = render_placeholders(file.read(), self.schema_name, params)
+        statements = split_statements(script)
+
+        if stage.migration:
+            checksum = hashlib.sha256(script.encode("utf-8")).hexdigest()
+            current = self._migration_is_current(cursor, stage, checksum, statements)
+            connection.commit()
+            if current:
+                return 'skipped', [], None
+            cursor.execute("SET LOCAL lock_timeout = %s", (SQL_MIGRATION_LOCK_TIMEOUT,))
+
+        timings = []
+        for statement in statements:
+            started = time.perf_counter()
+            try:
+                cursor.execute(statement)
+            except Exception as error:
+                timings.append((statement, (time.perf_counter() - started) * 1000, None, str(error)))
+                connection.rollback()
+                return 'failed', timings, error
+            timings.append((statement, (time.perf_counter() - started) * 1000, cursor.rowcount, None))
+            for notice in connection.notices:
+                print(notice.strip())
+            del connection.notices[:]
+        if stage.migration:
+            self._record_migration(cursor, run_id, stage, checksum)
+        connection.commit()
+        return 'succeeded', timings, None
+
+    def _run_stages(self, connection, cursor, run_id, params_json, completed):
+        """Run every stage not in `completed` under `run_id`. Returns True on success."""
+        params = json.loads(params_json)
+        for stage in self.ordered_stages():
+            if stage.name in completed:
+                continue
+            # A run whose project lease was lost stops before another run's stages overlap it
+            check_held()
+            self._record_stage(cursor, run_id, params_json, stage, 'running')
+            connection.commit()
+
+            started = time.perf_counter()
+            status, timings, error = self._run_stage(connection, cursor, run_id, stage, params)
+            duration_ms = (time.perf_counter() - started) * 1000
+            run_ledger.record_pipeline_stage(self.name, stage.name, duration_ms / 1000)
+
+            if status == 'skipped':
+                self._record_stage(cursor, run_id, params_json, stage, status, duration_ms)
+                connection.commit()
+                print(f"{self.name} migration '{stage.name}' is up to date, skipped")
+                continue
+            self._record_stage(cursor, run_id, params_json, stage, status, duration_ms,
+                               str(error) if error else None)
+            self._record_timings(cursor, run_id, stage, timings)
+            connection.commit()
+
+            if error:
+                print(f"{self.name} stage '{stage.name}' failed after {duration_ms:.0f} ms: {error}")
+                return False
+            slowest = max(timings, key=lambda t: t[1]) if timings else None
+            print(f"{self.name} stage '{stage.name}' finished in {duration_ms:.0f} ms"
+                  + (f", slowest statement {slowest[1]:.0f} ms" if slowest else ""))
+        return True
+
+    def run(self, resume=False, new_run=True):
+        """
+        Run every stage in dependency order.
+
+        Args:
+            resume (bool): If the last run of this pipeline did not finish, complete its
+                remaining stages first, with the parameters it was started with. When
+                those match the current parameters nothing else is run.
+            new_run (bool): Start a run with the current parameters. Pass False to only
+                finish an unfinished run.
+
+        Returns:
+            bool: True when all stages succeeded.
+        """
+        try:
+            self.schema_name = validate_identifier(self.schema_name, "schema name")
+        except ValueError as error:
+            print(f"{self.name} pipeline not run: {error}")
+            return False
+        params_json = json.dumps(self.params, sort_keys=True, default=str)
+        connection_pool = get_pool()
+        connection = connection_pool.getconn()
+        if connection.closed:
+            connection_pool.putconn(connection, close=True)
+            connection = connection_pool.getconn()
+        try:
+            connection.autocommit = False
+            cursor = connection.cursor()
+            self._ensure_run_tables(cursor)
+            unfinished = self._resumable_run(cursor) if resume else None
+            connection.commit()
+
+            if unfinished:
+                run_id, run_params, completed = unfinished
+                print(f"Resuming {self.name} run {run_id}, skipping {sorted(completed)}")
+                if not self._run_stages(connection, cursor, run_id, run_params, completed):
+                    return False
+                if run_params == params_json:
+                    return True
+
+            if not new_run:
+                return True
+            return self._run_stages(connection, cursor, uuid.uuid4().hex, params_json, set())
+
+        except (psycopg2.Error, ValueError, OSError) as error:
+            connection.rollback()
+            print(f"{self.name} pipeline aborted: {error}")
+            return False
+
+        finally:
+            connection_pool.putconn(connection)
+
+    def run_or_raise(self, resume=False, new_run=True):
+        """Run like `run`, raising SqlPipelineFailed instead of returning False."""
+        if not self.run(resume=resume, new_run=new_run):
+            raise SqlPipelineFailed(f"{self.name} pipeline of {self.schema_name} failed")
+        return True
@@ -0,0 +1,209 @@
+"""
+High-water marks for incremental metrics collection.
+
+`metric_watermarks` holds, per collector, resource and metric, the latest datapoint
+timestamp stored in bronze. A collector requests each series only from its watermark
+minus METRICS_WATERMARK_OVERLAP_HOURS (late or revised datapoints), instead of its full
+look-back. Series without a watermark (new resources or metrics) are backfilled over the
+look-back, as is every series when the collector runs in backfill mode.
+
+Gap detection looks for holes longer than the collector's expected step in the series
+stored since the previous successful run and requests them again once: the next run
+starts that series at the start of its gap. A hole that is still empty afterwards (a
+stopped VM, a deleted bucket) is not requested again.
+
+The helpers take a cursor and leave commits to the caller. Provider postgres modules
+wrap them with their own `@connection` decorator.
+"""
+import os
+from datetime import datetime, timedelta
+import pandas as pd
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+
+load_dotenv()
+
+WATERMARK_TABLE = "metric_watermarks"
+# Re-requested window before each watermark, for datapoints published late
+METRICS_WATERMARK_OVERLAP_HOURS = int(os.getenv("METRICS_WATERMARK_OVERLAP_HOURS", "6"))
+# Set to true to ignore the watermarks and collect every series over its full look-back
+METRICS_BACKFILL = os.getenv("METRICS_BACKFILL", "false").lower() == "true"
+
+
+def ensure_watermark_table(cursor, schema_name):
+    cursor.execute(sql.SQL(
+        "CREATE TABLE IF NOT EXISTS {}.{} ("
+        "collector text NOT NULL, "
+        "resource_id text NOT NULL, "
+        "metric_name text NOT NULL, "
+        "last_timestamp timestamp NOT NULL, "
+        "gaps_checked_at timestamp, "
+        "updated_at timestamp NOT NULL DEFAULT now(), "
+        "PRIMARY KEY (collector, resource_id, metric_name))"
+    ).format(sql.Identifier(schema_name), sql.Identifier(WATERMARK_TABLE)))
+
+
+def _naive_utc(value):
+    value = pd.Timestamp(value)
+    return (value.tz_convert(None) if value.tzinfo else value).to_pydatetime()
+
+
+def seed_watermarks(cursor, schema_name, collector, table_name, resource_column, metric_column, timestamp_column):
+    """
+    Start a collector without watermarks from the latest timestamps already in its bronze
+    table, so switching to incremental collection does not backfill stored series again.
+    """
+    ensure_watermark_table(cursor, schema_name)
+    cursor.execute(sql.SQL("SELECT 1 FROM {}.{} WHERE collector = %s LIMIT 1").format(
+        sql.Identifier(schema_name), sql.Identifier(WATERMARK_TABLE)), (collector,))
+    if cursor.fetchone() is not None:
+        return
+    cursor.execute("SELECT to_regclass(%s)", (f"{schema_name}.{table_name}",))
+    if cursor.fetchone()[0] is None:
+        return
+    resource = sql.SQL("lower({})").format(sql.Identifier(resource_column))
+    metric, ts = sql.Identifier(metric_column), sql.Identifier(timestamp_column)
+    cursor.execute(sql.SQL(
+        "INSERT INTO {schema}.{watermarks} (collector, resource_id, metric_name, last_timestamp, gaps_checked_at) "
+        "SELECT %s, {resource}, {metric}, max({ts})::timestamp, max({ts})::timestamp FROM {schema}.{table} "
+        "WHERE {resource} IS NOT NULL AND {metric} IS NOT NULL AND {ts} IS NOT NULL "
+        "GROUP BY {resource}, {metric} ON CONFLICT DO NOTHING"
+    ).format(
+        resource=resource, metric=metric, ts=ts,
+        schema=sql.Identifier(schema_name), table=sql.Identifier(table_name),
+        watermarks=sql.Identifier(WATERMARK_TABLE),
+    ), (collector,))
+    print(f"Seeded {cursor.rowcount} {collector} watermarks from {schema_name}.{table_name}")
+
+
+def fetch_watermarks(cursor, schema_name, collector):
+    """Return {(resource_id, metric_name): last timestamp} of one collector."""
+    ensure_watermark_table(cursor, schema_name)
+    cursor.execute(
+        sql.SQL("SELECT resource_id, metric_name, last_timestamp FROM {}.{} WHERE collector = %s").format(
+            sql.Identifier(schema_name), sql.Identifier(WATERMARK_TABLE)),
+        (collector,),
+    )
+    return {(resource_id, metric_name): _naive_utc(last) for resource_id, metric_name, last in cursor.fetchall()}
+
+
+def detect_gaps(cursor, schema_name, collector, table_name, resource_column, metric_column, timestamp_column,
+                max_step, since):
+    """
+    Find holes longer than `max_step` in the series stored since `since`.
+
+    Only holes that end after the series' last gap check are returned, so each hole is
+    requested again at most once.
+
+    Returns:
+        dict: {(resource_id, metric_name): start of the earliest unchecked gap}
+    """
+    ensure_watermark_table(cursor, schema_name)
+    resource = sql.SQL("lower({})").format(sql.Identifier(resource_column))
+    metric, ts = sql.Identifier(metric_column), sql.Identifier(timestamp_column)
+    cursor.execute(sql.SQL(
+        "SELECT s.resource_id, s.metric_name, min(s.previous) FROM ("
+        "  SELECT {resource} AS resource_id, {metric} AS metric_name, {ts} AS ts, "
+        "         lag({ts}) OVER (PARTITION BY {resource}, {metric} ORDER BY {ts}) AS previous "
+        "  FROM {schema}.{table} WHERE {ts} >= %s"
+        ") s "
+        "LEFT JOIN {schema}.{watermarks} w "
+        "  ON w.collector = %s AND w.resource_id = s.resource_id AND w.metric_name = s.metric_name "
+        "WHERE s.ts - s.previous > %s AND s.ts > coalesce(w.gaps_checked_at, %s) "
+        "GROUP BY s.resource_id, s.metric_name"
+    ).format(
+        resource=resource, metric=metric, ts=ts,
+        schema=sql.Identifier(schema_name), table=sql.Identifier(table_name),
+        watermarks=sql.Identifier(WATERMARK_TABLE),
+    ), (since, collector, max_step, since))
+    return {(resource_id, metric_name): _naive_utc(gap_start) for resource_id, metric_name, gap_start in cursor.fetchall()}
+
+
+def advance_watermarks(cursor, schema_name, collector, frame, resource_column, metric_column, timestamp_column,
+                       checked_at=None):
+    """
+    Move the watermarks forward to the latest timestamps of a stored frame, and mark every
+    series of the collector as gap-checked up to `checked_at` (the start of the run).
+
+    Call only after the frame was written to bronze, or in the transaction writing it.
+    Runs writing in batches pass no `checked_at` per batch and mark the gaps checked once
+    every batch was written.
+    """
+    ensure_watermark_table(cursor, schema_name)
+    table_id = sql.SQL("{}.{}").format(sql.Identifier(schema_name), sql.Identifier(WATERMARK_TABLE))
+    if not frame.empty:
+        timestamps = pd.to_datetime(frame[timestamp_column], utc=True, errors="coerce").dt.tz_localize(None)
+        latest = (
+            pd.DataFrame({
+                "resource_id": frame[resource_column].astype(str).str.lower(),
+                "metric_name": frame[metric_column].astype(str),
+                "last_timestamp": timestamps,
+            })
+            .dropna(subset=["last_timestamp"])
+            .groupby(["resource_id", "metric_name"], as_index=False)["last_timestamp"].max()
+        )
+        records = [
+            (collector, row.resource_id, row.metric_name, row.last_timestamp.to_pydatetime())
+            for row in latest.itertuples(index=False)
+        ]
+        execute_values(cursor, sql.SQL(
+            "INSERT INTO {} (collector, resource_id, metric_name, last_timestamp) VALUES %s "
+            "ON CONFLICT (collector, resource_id, metric_name) DO UPDATE "
+            "SET last_timestamp = greatest({}.last_timestamp, EXCLUDED.last_timestamp), updated_at = now()"
+        ).format(table_id, sql.Identifier(WATERMARK_TABLE)).as_string(cursor), records)
+    if checked_at is None:
+        return
+    cursor.execute(
+        sql.SQL("UPDATE {} SET gaps_checked_at = %s WHERE collector = %s").format(table_id),
+        (checked_at, collector),
+    )
+
+
+class CollectionWindow:
+    """
+    Start of the request window of each series of one collector run.
+
+    Args:
+        now (datetime): End of every window (naive UTC).
+        lookback (timedelta): Window of a series without watermark, and in backfill mode.
+        watermarks (dict): {(resource_id, metric_name): last stored timestamp}.
+        gaps (dict): {(resource_id, metric_name): start of a gap to request again}.
+    """
+
+    def __init__(self, now, lookback, watermarks=None, gaps=None, backfill=METRICS_BACKFILL,
+                 overlap=timedelta(hours=METRICS_WATERMARK_OVERLAP_HOURS)):
+        self.now = now
+        self.earliest = now - lookback
+        self.watermarks = watermarks or {}
+        self.gaps = gaps or {}
+        self.backfill = backfill
+        self.overlap = overlap
+
+    def start(self, resource_id, metric_name):
+        key = (resource_id.lower(), metric_name)
+        last = self.watermarks.get(key)
+        if self.backfill or last is None:
+            return self.earliest
+        start = last - self.overlap
+        if key in self.gaps:
+            start = min(start, self.gaps[key])
+        return max(self.earliest, start)
+
+    def start_for(self, resource_id, metric_names):
+        """Earliest start over several metrics fetched in one request."""
+        return min((self.start(resource_id, metric_name) for metric_name in metric_names), default=self.earliest)
+
+    def timespan(self, start):
+        """ISO 8601 'start/end' timespan, as taken by Azure Monitor."""
+        return f"{start.isoformat()}Z/{self.now.isoformat()}Z"
+
+    def summary(self, label):
+        mode = "backfill" if self.backfill else "incremental"
+        print(f"🕒 {label}: {mode} run, {len(self.watermarks)} watermarked series, "
+              f"{len(self.gaps)} gap(s) to request again, look-back from {self.earliest:%Y-%m-%d %H:%M}")
+
+
+def utc_now():
+    """Naive UTC now, truncated to the minute so every window of a run shares its end."""
+    return datetime.utcnow().replace(second=0, microsecond=0)
@@ -79,6 +79,7 @@ register_tortoise(
         "app.models.resources",
         "app.models.resources_tags",
         "app.models.llm_cache",
+        "app.models.ingestion_run",
 
     ]},
     generate_schemas=False,
@@ -0,0 +1,32 @@
+from tortoise import fields, models
+from tortoise.contrib.pydantic import pydantic_model_creator
+
+
+class IngestionRun(models.Model):
+    id = fields.IntField(pk=True)
+    run_id = fields.CharField(max_length=64, unique=True)
+    provider = fields.CharField(max_length=20, null=False)
+    trigger = fields.CharField(max_length=20, null=False)
+    status = fields.CharField(max_length=20, null=False)
+    started_at = fields.DatetimeField(null=False, auto_now_add=True)
+    finished_at = fields.DatetimeField(null=True)
+    duration_s = fields.FloatField(null=True)
+    # Seconds per stage: download, parse, hash, load, silver, gold, dashboard
+    stage_durations = fields.JSONField(default=dict)
+    rows_read = fields.BigIntField(null=True)
+    rows_loaded = fields.BigIntField(null=True)
+    bytes_read = fields.BigIntField(null=True)
+    peak_memory_bytes = fields.BigIntField(null=True)
+    error = fields.TextField(null=True)
+
+    project = fields.ForeignKeyField('models.Project', related_name='ingestion_runs')
+
+    class Meta:
+        indexes = (("project_id", "started_at"),)
+
+    class PydanticMeta:
+        model_config = {'extra': 'allow'}
+
+
+# Create Pydantic models from Tortoise ORM models
+IngestionRun_Pydantic = pydantic_model_creator(IngestionRun, name="IngestionRun")
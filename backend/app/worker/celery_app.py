@@ -21,21 +21,7 @@ celery_app.conf.update(
             'task': 'task_run_daily_ingestion',
             'schedule': crontab(hour=7, minute=00),  # Run every day at 07:00 UTC
         },
-        'run-dashboard-ingestion-every-day': {
-            'task': 'task_run_daily_dashboard_ingestion',
-            'schedule': crontab(hour=7, minute=30),  # Run every day at 07:30 UTC
-        },
-        'run-daily-alerts': {
-            'task': 'run_daily_alerts', 
-            'schedule': crontab(minute=0, hour=8),  # Run every day at 08:00 UTC
-        },
-        'run-weekly-alerts': {
-            'task': 'run_weekly_alerts',  
-            'schedule': crontab(minute=0, hour=8, day_of_week=0),  # Run every Monday at 08:00 UTC
-        },
-        'run-monthly-alerts': {
-            'task': 'run_monthly_alerts', 
-            'schedule': crontab(minute=0, hour=8, day_of_month=1),  # Run on the 1st of each month at 08:00 UTC
-        },
+        # The dashboard refresh and the daily, weekly and monthly alerts are started by
+        # task_finish_daily_ingestion once every project of the daily run is ingested
     }
 )
@@ -3,6 +3,8 @@ import json
 import datetime
 import asyncpg
 import asyncio
+import time
+from celery import chain, chord, group
 from .celery_app import celery_app
 from app.ingestion.aws.main import aws_create_focus_export, aws_run_ingestion
 from app.ingestion.aws.aws_ce.main import aws_ce_main
@@ -17,6 +19,8 @@ from app.ingestion.azure.azure_ops import AzFunctions
 from app.ingestion.dashboard.main import create_dashboard_view
 from app.core.misc import execute_query
 from app.core.encryption import decrypt_data
+from app.core.locks import LeaseLock, LockBusy, exclusive, queue_deadline_passed, LOCK_REQUEUE_DELAY, QUEUE, SKIP
+from app.ingestion.run_ledger import IngestionRunLedger, book_dashboard, recorded, skip_current
 from app.models.project import Project
 from app.models.alert_integration import Integration
 from app.models.alert import Alert
@@ -28,6 +32,12 @@ DB_USER_NAME = os.getenv("DB_USER_NAME")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_PORT = os.getenv("DB_PORT")
 
+# Projects ingested at the same time by the daily fan-out
+INGESTION_FANOUT_CONCURRENCY = int(os.getenv("INGESTION_FANOUT_CONCURRENCY", "4"))
+# Retries of a project whose ingestion failed, and the seconds before each
+INGESTION_TASK_MAX_RETRIES = int(os.getenv("INGESTION_TASK_MAX_RETRIES", "2"))
+INGESTION_RETRY_DELAY = int(os.getenv("INGESTION_RETRY_DELAY", "300"))
+
 
 @celery_app.task(name="run_daily_alerts")
 def run_daily_alerts_sync():
@@ -246,6 +256,8 @@ def task_create_aws_export(payload):
 
 
 @celery_app.task(name="task_run_ingestion_aws")
+@recorded("aws", trigger="create")
+@exclusive("ingestion", on_busy=skip_current)
 def task_run_ingestion_aws(payload):
     print("task_run_ingestion_aws start...")
     aws_run_ingestion(
@@ -337,6 +349,8 @@ def task_drop_schema(schema_name):
 
 
 @celery_app.task(name="task_run_ingestion_gcp")
+@recorded("gcp", trigger="create")
+@exclusive("ingestion", on_busy=skip_current)
 def task_run_ingestion_gcp(payload):
     print("task_run_ingestion_gcp start...")
 
@@ -345,7 +359,9 @@ def task_run_ingestion_gcp(payload):
                 dataset_id=payload["dataset_id"],
                 billing_account_id=payload["billing_account_id"],
                 date=payload["date"],
-                view_id="focus_format_temp")
+                view_id="focus_format_temp",
+                schema=payload["project_name"],
+                force=payload.get("force_view_refresh", False))
 
     fetch_data_from_bigquery_to_postgres(project_id=payload["gcp_project_id"],
                                          dataset_id=payload["dataset_id"],
@@ -416,6 +432,8 @@ def task_create_azure_export(payload):
 
 
 @celery_app.task(name="task_run_ingestion_azure")
+@recorded("azure", trigger="create")
+@exclusive("ingestion", on_busy=skip_current)
 def task_run_ingestion_azure(payload):
     print("task_run_ingestion_azure start...")
 
@@ -462,172 +480,288 @@ def task_delete_azure_project(payload):
     return True
 
 
+def ingest_project(p, encryption_key):
+    """
+    Run the ingestion of every connection of one project row (`select * from project`).
+
+    Errors are raised to the caller, so the fan-out task can retry the project.
+    """
+    if p[4] == "aws":
+        query = f"""select id, aws_access_key, aws_secret_key, monthly_budget, date, export_location
+        from awsconnection 
+        where project_id = {p[0]};"""
+        connection = execute_query(query=query)
+        for c in connection:
+            print("aws conn: ", c)
+
+            s3_bucket_split = c[5].split("/")
+            print(c[4], type(c[4]))
+            billing_period = datetime.datetime.utcnow().strftime("%Y-%m")
+            payload = {
+                "project_id": p[0],
+                "project_name": p[1],
+                "aws_connection_id": c[0],
+                "aws_access_key": decrypt_data(encrypted_data=c[1], key=encryption_key),
+                "aws_secret_key": decrypt_data(encrypted_data=c[2], key=encryption_key),
+                "aws_region": 'us-east-1',
+                "monthly_budget": c[3],
+                "s3_bucket": s3_bucket_split[2],
+                "s3_prefix": s3_bucket_split[3],
+                "export_name": s3_bucket_split[4],
+                "billing_period": billing_period
+            }
+            # task_run_ingestion_aws(payload)
+            aws_run_ingestion(
+                project_name=payload["project_name"],
+                monthly_budget=str(payload["monthly_budget"]),
+                aws_access_key=payload["aws_access_key"],
+                aws_secret_key=payload["aws_secret_key"],
+                aws_region=payload["aws_region"],
+                s3_bucket=payload["s3_bucket"],
+                s3_prefix=payload["s3_prefix"],
+                export_name=payload["export_name"],
+                billing_period=payload["billing_period"]
+            )
+            query = f"""
+            update project set status = true where id = {payload["project_id"]};
+            """
+            execute_query(query=query, fetch=False)
+
+            query = f"""
+            update awsconnection set status = true where id = {payload["aws_connection_id"]};
+            """
+            execute_query(query=query, fetch=False)
+
+    elif p[4] == "azure":
+        query = f"""select id, azure_tenant_id, azure_client_id, azure_client_secret, monthly_budget, storage_account_name, container_name,subscription_info
+         from azureconnection 
+         where project_id = {p[0]};"""
+        connection = execute_query(query=query)
+        for c in connection:
+            print("azure conn: ", c)
+            subscription_info = c[7]
+            if isinstance(subscription_info, str):
+                subscription_info = json.loads(subscription_info)
+                print("Parsed subscription_info: ", subscription_info)
+
+            payload = {
+                "project_id": p[0],
+                "project_name": p[1],
+                "azure_connection_id": c[0],
+                "azure_tenant_id": decrypt_data(encrypted_data=c[1], key=encryption_key),
+                "azure_client_id": decrypt_data(encrypted_data=c[2], key=encryption_key),
+                "azure_client_secret": decrypt_data(encrypted_data=c[3], key=encryption_key),
+                "monthly_budget": c[4],
+                "storage_account_name": c[5],
+                "container_name": c[6],
+                "subscription_info": subscription_info
+            }
+            # task_run_ingestion_azure(payload)
+            azure_main(project_name=payload["project_name"],
+                       budget=str(payload["monthly_budget"]),
+                       tenant_id=payload["azure_tenant_id"],
+                       client_id=payload["azure_client_id"],
+                       client_secret=payload["azure_client_secret"],
+                       storage_account_name=payload["storage_account_name"],
+                       container_name=payload["container_name"],
+                       subscription_id = payload["subscription_info"]["subscription_id"]
+                       )
+
+            query = f"""
+            update project set status = true where id = {payload["project_id"]};
+            """
+            execute_query(query=query, fetch=False)
+
+            query = f"""
+            update azureconnection set status = true where id = {payload["azure_connection_id"]};
+            """
+            execute_query(query=query, fetch=False)
+
+    elif p[4] == "gcp":
+        query = f"""select id, credentials, project_info, date, monthly_budget, dataset_id, billing_account_id
+        from gcpconnection 
+        where project_id = {p[0]};"""
+        connection = execute_query(query=query)
+        for c in connection:
+            print("gcp conn: ", c)
+
+            credentials = json.loads(
+                decrypt_data(encrypted_data=c[1]["encrypted_credentials"], key=encryption_key))
+
+            payload = {
+                "project_id": p[0],
+                "project_name": p[1],
+                "gcp_connection_id": c[0],
+                "credentials": credentials,
+                "gcp_project_id": c[2]["project_id"],
+                "date": c[3],
+                "monthly_budget": c[4],
+                "dataset_id": c[5],
+                "billing_account_id": c[6],
+            }
+            # task_run_ingestion_gcp(payload)
+            create_view(credentials=payload["credentials"],
+                        project_id=payload["gcp_project_id"],
+                        dataset_id=payload["dataset_id"],
+                        billing_account_id=payload["billing_account_id"],
+                        date=payload["date"],
+                        view_id="focus_format_temp",
+                        schema=payload["project_name"])
+            fetch_data_from_bigquery_to_postgres(project_id=payload["gcp_project_id"],
+                                                 dataset_id=payload["dataset_id"],
+                                                 view_id="focus_format_temp",
+                                                 credentials=payload["credentials"],
+                                                 schema=payload["project_name"],
+                                                 table_name="bronze_focus_gcp_data",
+                                                 monthly_budget=str(payload["monthly_budget"]))
+
+            query = f"""
+            update project set status = true where id = {payload["project_id"]};
+            """
+            execute_query(query=query, fetch=False)
+
+            query = f"""
+            update gcpconnection set status = true where id = {payload["gcp_connection_id"]};
+            """
+            execute_query(query=query, fetch=False)
+
+
+def fanout_buckets(project_ids, concurrency):
+    """Split projects into at most `concurrency` lists, dealt round-robin; at least one list."""
+    concurrency = max(1, concurrency)
+    buckets = [project_ids[i::concurrency] for i in range(concurrency)]
+    return [bucket for bucket in buckets if bucket]
+
+
+def due_alert_tasks(today):
+    """Alert tasks due on `today`, matching their former beat schedules."""
+    tasks = [run_daily_alerts_sync]
+    # crontab numbering: day_of_week=0 is Sunday
+    if today.isoweekday() % 7 == 0:
+        tasks.append(run_weekly_alerts_sync)
+    if today.day == 1:
+        tasks.append(run_monthly_alerts_sync)
+    return tasks
+
+
+@celery_app.task(bind=True, name="task_ingest_project", max_retries=INGESTION_TASK_MAX_RETRIES)
+def task_ingest_project(self, results, project_id, lock_policy=SKIP, trigger="schedule", queued_at=None):
+    """
+    Ingest one project as part of the daily fan-out.
+
+    Runs in a chain with the other projects of its bucket: `results` holds the outcomes
+    of the projects before it, and the outcome of this one is appended. Failures are
+    retried after INGESTION_RETRY_DELAY seconds; once retries are exhausted the failure is
+    recorded and returned rather than raised, so the rest of the chain and the chord
+    callback still run.
+
+    The project's ingestion lock is held for the run. When another run holds it,
+    `lock_policy` decides: SKIP records the project as skipped, QUEUE replaces this task
+    with the same one LOCK_REQUEUE_DELAY seconds later, keeping its place in the chain,
+    until LOCK_QUEUE_TIMEOUT has passed since `queued_at`. Every attempt is recorded in
+    the ingestion run ledger.
+    """
+    started = time.monotonic()
+    attempt = self.request.retries + 1
+    try:
+        encryption_key = os.getenv("ENCRYPTION_KEY")
+        if not encryption_key:
+            raise ValueError("Encryption key not found in environment variables")
+        projects = execute_query(query=f"""select * from project where id = {int(project_id)};""")
+        if not projects:
+            raise ValueError(f"Project {project_id} not found")
+        print("project: ", projects[0])
+        run = IngestionRunLedger(project_id, projects[0][4], trigger, run_id=f"{self.request.id}:{attempt}")
+        with run:
+            try:
+                with LeaseLock(projects[0][1], "ingestion", owner=f"task_ingest_project:{self.request.id}") as lock:
+                    ingest_project(projects[0], bytes.fromhex(encryption_key))
+                    lock.check()
+            except LockBusy as ex:
+                run.finish("skipped", str(ex))
+                raise
+    except LockBusy as ex:
+        if lock_policy == QUEUE and not queue_deadline_passed(queued_at):
+            print(f"Ingestion of project {project_id} queued again in {LOCK_REQUEUE_DELAY}s: {ex}")
+            raise self.replace(task_ingest_project.si(
+                results, project_id, lock_policy=lock_policy, trigger=trigger,
+                queued_at=queued_at or time.time()).set(countdown=LOCK_REQUEUE_DELAY))
+        print(f"Skipping ingestion of project {project_id}: {ex}")
+        return results + [{"project_id": project_id, "status": "skipped", "attempts": attempt,
+                           "error": str(ex), "duration_s": round(time.monotonic() - started, 1)}]
+    except Exception as ex:
+        if self.request.retries < self.max_retries:
+            print(f"Ingestion of project {project_id} failed on attempt {attempt}, retrying: {ex}")
+            raise self.retry(exc=ex, countdown=INGESTION_RETRY_DELAY)
+        print(f"Ingestion of project {project_id} failed after {attempt} attempt(s): {ex}")
+        return results + [{"project_id": project_id, "status": "failed", "attempts": attempt,
+                           "error": str(ex), "duration_s": round(time.monotonic() - started, 1)}]
+    return results + [{"project_id": project_id, "status": "succeeded", "attempts": attempt,
+                       "duration_s": round(time.monotonic() - started, 1)}]
+
+
+@celery_app.task(name="task_finish_daily_ingestion")
+def task_finish_daily_ingestion(bucket_results, run_downstream=True):
+    """
+    Chord callback of the daily fan-out: report the outcome of every project, then start
+    the dashboard refresh followed by the alerts due today.
+    """
+    results = [result for bucket in bucket_results for result in (bucket or [])]
+    failed = [result for result in results if result["status"] == "failed"]
+    skipped = [result for result in results if result["status"] == "skipped"]
+    succeeded = len(results) - len(failed) - len(skipped)
+    print(f"Daily ingestion finished: {succeeded} project(s) succeeded, {len(failed)} failed, "
+          f"{len(skipped)} skipped as already running")
+    for result in failed + skipped:
+        print(f"  project {result['project_id']}: {result.get('error')}")
+
+    if run_downstream:
+        stages = [task_run_daily_dashboard_ingestion.si()]
+        stages += [task.si() for task in due_alert_tasks(datetime.datetime.utcnow().date())]
+        chain(*stages).apply_async()
+    return {"succeeded": succeeded, "failed": len(failed), "skipped": len(skipped)}
+
+
 @celery_app.task(name='task_run_daily_ingestion')
 def task_run_daily_ingestion(input={}):
+    """
+    Fan out the ingestion of every project (or of `input["project_id"]` only).
+
+    Projects are dealt into INGESTION_FANOUT_CONCURRENCY chains run as one group, so at
+    most that many projects ingest at once and a slow project only delays its own chain.
+    A chord callback runs once every chain is done; for the scheduled daily run it starts
+    the dashboard and alert stages. `input["lock_policy"]` (default SKIP) is what a
+    project does when it is already being ingested.
+    """
     print('task_run_daily_ingestion')
 
     # Ensure encryption key is fetched correctly
-    encryption_key = os.getenv("ENCRYPTION_KEY")
-    if not encryption_key:
+    if not os.getenv("ENCRYPTION_KEY"):
         raise ValueError("Encryption key not found in environment variables")
 
-    # Convert encryption key from string to bytes
-    encryption_key = bytes.fromhex(encryption_key)
-
-    query = f"""select * from project order by id desc;"""
-    projects = execute_query(query=query)
-    for p in projects:
-        print("project: ", p)
-
-        # check if project_id is provided in input.
-        # If yes, run ingestion only for that project, else run for all
-        print("input", input)
-        if input:
-            if int(input["project_id"]) != int(p[0]):
-                continue
-
-        try:
-            if p[4] == "aws":
-                query = f"""select id, aws_access_key, aws_secret_key, monthly_budget, date, export_location
-                from awsconnection 
-                where project_id = {p[0]};"""
-                connection = execute_query(query=query)
-                for c in connection:
-                    print("aws conn: ", c)
-
-                    s3_bucket_split = c[5].split("/")
-                    print(c[4], type(c[4]))
-                    billing_period = datetime.datetime.utcnow().strftime("%Y-%m")
-                    payload = {
-                        "project_id": p[0],
-                        "project_name": p[1],
-                        "aws_connection_id": c[0],
-                        "aws_access_key": decrypt_data(encrypted_data=c[1], key=encryption_key),
-                        "aws_secret_key": decrypt_data(encrypted_data=c[2], key=encryption_key),
-                        "aws_region": 'us-east-1',
-                        "monthly_budget": c[3],
-                        "s3_bucket": s3_bucket_split[2],
-                        "s3_prefix": s3_bucket_split[3],
-                        "export_name": s3_bucket_split[4],
-                        "billing_period": billing_period
-                    }
-                    # task_run_ingestion_aws(payload)
-                    aws_run_ingestion(
-                        project_name=payload["project_name"],
-                        monthly_budget=str(payload["monthly_budget"]),
-                        aws_access_key=payload["aws_access_key"],
-                        aws_secret_key=payload["aws_secret_key"],
-                        aws_region=payload["aws_region"],
-                        s3_bucket=payload["s3_bucket"],
-                        s3_prefix=payload["s3_prefix"],
-                        export_name=payload["export_name"],
-                        billing_period=payload["billing_period"]
-                    )
-                    query = f"""
-                    update project set status = true where id = {payload["project_id"]};
-                    """
-                    execute_query(query=query, fetch=False)
-
-                    query = f"""
-                    update awsconnection set status = true where id = {payload["aws_connection_id"]};
-                    """
-                    execute_query(query=query, fetch=False)
-
-            elif p[4] == "azure":
-                query = f"""select id, azure_tenant_id, azure_client_id, azure_client_secret, monthly_budget, storage_account_name, container_name,subscription_info
-                 from azureconnection 
-                 where project_id = {p[0]};"""
-                connection = execute_query(query=query)
-                for c in connection:
-                    print("azure conn: ", c)
-                    subscription_info = c[7]
-                    if isinstance(subscription_info, str):
-                        subscription_info = json.loads(subscription_info)
-                        print("Parsed subscription_info: ", subscription_info)
-
-                    payload = {
-                        "project_id": p[0],
-                        "project_name": p[1],
-                        "azure_connection_id": c[0],
-                        "azure_tenant_id": decrypt_data(encrypted_data=c[1], key=encryption_key),
-                        "azure_client_id": decrypt_data(encrypted_data=c[2], key=encryption_key),
-                        "azure_client_secret": decrypt_data(encrypted_data=c[3], key=encryption_key),
-                        "monthly_budget": c[4],
-                        "storage_account_name": c[5],
-                        "container_name": c[6],
-                        "subscription_info": subscription_info
-                    }
-                    # task_run_ingestion_azure(payload)
-                    azure_main(project_name=payload["project_name"],
-                               budget=str(payload["monthly_budget"]),
-                               tenant_id=payload["azure_tenant_id"],
-                               client_id=payload["azure_client_id"],
-                               client_secret=payload["azure_client_secret"],
-                               storage_account_name=payload["storage_account_name"],
-                               container_name=payload["container_name"],
-                               subscription_id = payload["subscription_info"]["subscription_id"]
-                               )
-
-                    query = f"""
-                    update project set status = true where id = {payload["project_id"]};
-                    """
-                    execute_query(query=query, fetch=False)
-
-                    query = f"""
-                    update azureconnection set status = true where id = {payload["azure_connection_id"]};
-                    """
-                    execute_query(query=query, fetch=False)
-
-            elif p[4] == "gcp":
-                query = f"""select id, credentials, project_info, date, monthly_budget, dataset_id, billing_account_id
-                from gcpconnection 
-                where project_id = {p[0]};"""
-                connection = execute_query(query=query)
-                for c in connection:
-                    print("gcp conn: ", c)
-
-                    credentials = json.loads(
-                        decrypt_data(encrypted_data=c[1]["encrypted_credentials"], key=encryption_key))
-
-                    payload = {
-                        "project_id": p[0],
-                        "project_name": p[1],
-                        "gcp_connection_id": c[0],
-                        "credentials": credentials,
-                        "gcp_project_id": c[2]["project_id"],
-                        "date": c[3],
-                        "monthly_budget": c[4],
-                        "dataset_id": c[5],
-                        "billing_account_id": c[6],
-                    }
-                    # task_run_ingestion_gcp(payload)
-                    create_view(credentials=payload["credentials"],
-                                project_id=payload["gcp_project_id"],
-                                dataset_id=payload["dataset_id"],
-                                billing_account_id=payload["billing_account_id"],
-                                date=payload["date"],
-                                view_id="focus_format_temp")
-                    fetch_data_from_bigquery_to_postgres(project_id=payload["gcp_project_id"],
-                                                         dataset_id=payload["dataset_id"],
-                                                         view_id="focus_format_temp",
-                                                         credentials=payload["credentials"],
-                                                         schema=payload["project_name"],
-                                                         table_name="bronze_focus_gcp_data",
-                                                         monthly_budget=str(payload["monthly_budget"]))
-
-                    query = f"""
-                    update project set status = true where id = {payload["project_id"]};
-                    """
-                    execute_query(query=query, fetch=False)
-
-                    query = f"""
-                    update gcpconnection set status = true where id = {payload["gcp_connection_id"]};
-                    """
-                    execute_query(query=query, fetch=False)
-
-        except Exception as ex:
-            print(ex)
+    query = f"""select id from project order by id desc;"""
+    project_ids = [row[0] for row in execute_query(query=query)]
 
+    # check if project_id is provided in input.
+    # If yes, run ingestion only for that project, else run for all
+    print("input", input)
+    if input:
+        project_ids = [project_id for project_id in project_ids if int(project_id) == int(input["project_id"])]
+    if not project_ids:
+        print("No projects to ingest")
+        return True
+
+    lock_policy = input.get("lock_policy", SKIP) if input else SKIP
+    trigger = input.get("trigger", "rerun") if input else "schedule"
+
+    chains = [
+        chain(task_ingest_project.si([], bucket[0], lock_policy=lock_policy, trigger=trigger),
+              *[task_ingest_project.s(project_id, lock_policy=lock_policy, trigger=trigger)
+                for project_id in bucket[1:]])
+        for bucket in fanout_buckets(project_ids, INGESTION_FANOUT_CONCURRENCY)
+    ]
+    chord(group(chains))(task_finish_daily_ingestion.s(run_downstream=not input))
+    print(f"Scheduled ingestion of {len(project_ids)} project(s) in {len(chains)} chain(s)")
     return True
 
 
@@ -667,8 +801,10 @@ def task_run_daily_dashboard_ingestion(payload={}):
 
 
 @celery_app.task(name="task_create_dashboard_view")
+@exclusive("dashboard", project_of=lambda payload: payload["dashboard_name"])
 def task_create_dashboard_view(payload):
     try:
+        started = time.monotonic()
         # Run the async dashboard creation logic
         result = asyncio.run(create_dashboard_view(
             project_ids=payload["project_ids"],
@@ -686,6 +822,8 @@ def task_create_dashboard_view(payload):
             """
             execute_query(query=update_query, fetch=False)
             print(f"Updated status for all dashboards with name: {payload['dashboard_name']}")
+            # Recorded as the dashboard stage of the covered projects' latest runs
+            book_dashboard(payload["project_ids"], time.monotonic() - started)
 
         return result
 
@@ -0,0 +1,28 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS "ingestionrun" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "run_id" VARCHAR(64) NOT NULL UNIQUE,
+    "provider" VARCHAR(20) NOT NULL,
+    "trigger" VARCHAR(20) NOT NULL,
+    "status" VARCHAR(20) NOT NULL,
+    "started_at" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP,
+    "finished_at" TIMESTAMPTZ,
+    "duration_s" DOUBLE PRECISION,
+    "stage_durations" JSONB NOT NULL,
+    "rows_read" BIGINT,
+    "rows_loaded" BIGINT,
+    "bytes_read" BIGINT,
+    "peak_memory_bytes" BIGINT,
+    "error" TEXT,
+    "project_id" INT NOT NULL REFERENCES "project" ("id") ON DELETE CASCADE
+);
+        CREATE INDEX IF NOT EXISTS "idx_ingestionru_project_2b1f0c" ON "ingestionrun" ("project_id", "started_at");"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS "ingestionrun";"""
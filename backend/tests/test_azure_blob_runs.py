@@ -0,0 +1,125 @@
+"""
+Offline tests of how Azure export blobs are grouped into runs and which runs a load
+downloads, given the blob ledger of what bronze already holds.
+
+The container is a stub listing blobs and serving manifests, so no storage account is
+needed.
+"""
+import json
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("pandas")
+pytest.importorskip("azure.identity")
+pytest.importorskip("azure.storage.blob")
+
+from app.ingestion.azure.blob import list_export_runs, select_runs_to_load  # noqa: E402
+
+UTC = timezone.utc
+SEPTEMBER = "focus/daily/20260901-20260930"
+OCTOBER = "focus/daily/20261001-20261031"
+MONTHLY_OCTOBER = "focus/monthly/20261001-20261031"
+
+
+def blob(name, etag, day=1):
+    return SimpleNamespace(name=name, etag=etag, last_modified=datetime(2026, 10, day, tzinfo=UTC))
+
+
+def manifest(run_id, submitted, blob_names, start, end):
+    return {
+        "runInfo": {"runId": run_id, "submittedTime": submitted, "startDate": start, "endDate": end},
+        # Manifests carry the container name as the first path segment
+        "blobs": [{"blobName": f"exports/{name}"} for name in blob_names],
+    }
+
+
+class FakeContainer:
+    """Lists the given blobs and serves the manifests stored under their names."""
+
+    def __init__(self, blobs, manifests):
+        self.blobs = blobs
+        self.manifests = manifests
+
+    def list_blobs(self):
+        return iter(self.blobs)
+
+    def get_blob_client(self, name):
+        content = json.dumps(self.manifests[name]).encode()
+        return SimpleNamespace(download_blob=lambda: SimpleNamespace(readall=lambda: content))
+
+
+def export_container(october_etag="oct-1", october_parts=("part_0.csv",)):
+    """A September run and an October run, each described by its manifest."""
+    blobs = [
+        blob(f"{SEPTEMBER}/run-sep/part_0.csv", "sep-1"),
+        blob(f"{SEPTEMBER}/run-sep/manifest.json", "sep-m"),
+        blob(f"{OCTOBER}/run-oct/manifest.json", "oct-m", day=17),
+    ]
+    blobs += [blob(f"{OCTOBER}/run-oct/{part}", october_etag, day=17) for part in october_parts]
+    manifests = {
+        f"{SEPTEMBER}/run-sep/manifest.json": manifest(
+            "run-sep", "2026-10-01T03:00:00Z", [f"{SEPTEMBER}/run-sep/part_0.csv"],
+            "2026-09-01", "2026-09-30"),
+        f"{OCTOBER}/run-oct/manifest.json": manifest(
+            "run-oct", "2026-10-17T03:00:00Z", [f"{OCTOBER}/run-oct/{part}" for part in october_parts],
+            "2026-10-01", "2026-10-31"),
+    }
+    return FakeContainer(blobs, manifests)
+
+
+def ledger_of(runs):
+    return {run.period_key: run.etags() for run in runs}
+
+
+def test_manifest_runs_are_grouped_by_date_range_folder():
+    runs = {run.period_key: run for run in list_export_runs(export_container(october_parts=("a.csv", "b.csv")))}
+
+    assert set(runs) == {SEPTEMBER, OCTOBER}
+    assert runs[OCTOBER].run_id == "run-oct"
+    assert runs[OCTOBER].etags() == {f"{OCTOBER}/run-oct/a.csv": "oct-1", f"{OCTOBER}/run-oct/b.csv": "oct-1"}
+    assert runs[OCTOBER].months == {datetime(2026, 10, 1)}
+
+
+def test_new_run_is_loaded():
+    runs = list_export_runs(export_container())
+    september = [run for run in runs if run.period_key == SEPTEMBER]
+
+    selected = select_runs_to_load(runs, ledger_of(september))
+    assert [run.period_key for run in selected] == [OCTOBER]
+
+
+def test_unchanged_runs_are_not_loaded():
+    runs = list_export_runs(export_container())
+    assert select_runs_to_load(runs, ledger_of(runs)) == []
+
+
+def test_overwritten_run_is_loaded_again():
+    loaded = ledger_of(list_export_runs(export_container(october_etag="oct-1")))
+    runs = list_export_runs(export_container(october_etag="oct-2"))
+
+    assert [run.period_key for run in select_runs_to_load(runs, loaded)] == [OCTOBER]
+
+
+def test_failed_or_partial_run_is_retried():
+    runs = list_export_runs(export_container(october_parts=("a.csv", "b.csv")))
+    # A month that failed to load keeps its blobs out of the ledger
+    failed = {SEPTEMBER: ledger_of(runs)[SEPTEMBER]}
+    assert [run.period_key for run in select_runs_to_load(runs, failed)] == [OCTOBER]
+
+    # A run loaded while only its first part had been written
+    partial = dict(ledger_of(runs), **{OCTOBER: {f"{OCTOBER}/run-oct/a.csv": "oct-1"}})
+    assert [run.period_key for run in select_runs_to_load(runs, partial)] == [OCTOBER]
+
+
+def test_other_runs_of_a_changed_month_are_loaded_with_it():
+    container = export_container()
+    # A second export writing the same month is a separate period
+    container.blobs.append(blob(f"{MONTHLY_OCTOBER}/adjustments.csv", "adj-1"))
+    runs = list_export_runs(container)
+    loaded = ledger_of(runs)
+    loaded[OCTOBER] = {f"{OCTOBER}/run-oct/part_0.csv": "oct-0"}
+
+    selected = select_runs_to_load(runs, loaded)
+    assert sorted(run.period_key for run in selected) == [OCTOBER, MONTHLY_OCTOBER]
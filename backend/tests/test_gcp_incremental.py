@@ -0,0 +1,263 @@
+"""
+Offline tests of the incremental GCP billing load: the export-time watermark, restated
+invoice months and the increment handed to the bronze loader.
+
+BigQuery is replaced by a stub answering the queries of `BillingExport` from an Arrow
+fixture, and the bronze operations by fakes recording what they were given.
+"""
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pa = pytest.importorskip("pyarrow")
+pytest.importorskip("google.cloud.bigquery")
+pytest.importorskip("google.cloud.bigquery_storage")
+pytest.importorskip("psycopg2")
+pytest.importorskip("sqlalchemy")
+
+from app.ingestion import copy_loader  # noqa: E402
+from app.ingestion.gcp import main as gcp_main  # noqa: E402
+
+UTC = timezone.utc
+SEPTEMBER = datetime(2026, 9, 1, tzinfo=UTC)
+OCTOBER = datetime(2026, 10, 1, tzinfo=UTC)
+
+
+def export_table():
+    """Three exported rows: one of September, two of October exported a day apart."""
+    return pa.table({
+        "BillingPeriodStart": pa.array([SEPTEMBER, OCTOBER, OCTOBER], pa.timestamp("us", tz="UTC")),
+        "BilledCost": pa.array([10.0, 2.5, 4.0], pa.float64()),
+        "ServiceName": pa.array(["Compute Engine", "BigQuery", "Cloud Storage"]),
+        "x_ExportTime": pa.array([
+            datetime(2026, 10, 2, 3, tzinfo=UTC),
+            datetime(2026, 10, 16, 3, tzinfo=UTC),
+            datetime(2026, 10, 17, 9, tzinfo=UTC),
+        ], pa.timestamp("us", tz="UTC")),
+    })
+
+
+class FakeResult:
+    def __init__(self, table=None, rows=None):
+        self.table = table
+        self.rows = rows or []
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        return iter(self.table.to_batches(max_chunksize=2))
+
+
+class FakeBigQuery:
+    """Answers the totals, increment and invoice month queries from an Arrow table."""
+
+    def __init__(self, table):
+        self.table = table
+        self.queries = []
+
+    def get_table(self, view):
+        return SimpleNamespace(schema=[SimpleNamespace(name=name)
+                                       for name in self.table.column_names + ["x_PartitionTime"]])
+
+    def query(self, query, job_config=None):
+        parameters = {p.name: p.value for p in job_config.query_parameters}
+        self.queries.append((query, parameters))
+        frame = self.table.to_pandas()
+        if "GROUP BY BillingPeriodStart" in query:
+            frame = frame[frame["BillingPeriodStart"] >= pd.Timestamp(parameters["open_from"])]
+            if "GROUP BY TO_JSON_STRING" in query:
+                frame = frame[~frame.astype(str).duplicated()]
+            rows = [SimpleNamespace(BillingPeriodStart=period_start, row_count=len(group),
+                                    billed_cost=group["BilledCost"].sum())
+                    for period_start, group in frame.groupby("BillingPeriodStart")]
+            result = FakeResult(rows=rows)
+        elif "@since" in query:
+            result = FakeResult(table=self._filter(frame["x_ExportTime"] > pd.Timestamp(parameters["since"])))
+        elif "@period_start" in query:
+            result = FakeResult(table=self._filter(
+                frame["BillingPeriodStart"] == pd.Timestamp(parameters["period_start"])))
+        else:
+            result = FakeResult(table=self.table)
+        return SimpleNamespace(result=lambda page_size=None: result)
+
+    def _filter(self, mask):
+        return self.table.filter(pa.array(mask.to_numpy()))
+
+
+class FakeBronze:
+    """Stands in for the bronze table: returns a fixed state and records the loads."""
+
+    def __init__(self, last_export_time=None, months=None, removed=0):
+        self.last_export_time = last_export_time
+        self.months = months or {}
+        self.removed = removed
+        self.increment = None
+        self.since = "unset"
+        self.replaced = {}
+
+    def fetch_export_state(self, schema, table_name, open_from):
+        return self.last_export_time, self.months
+
+    def load_export_increment(self, frames, schema, table_name, since=None, load_batch_id=None):
+        self.increment = [frame for frame in frames]
+        self.since = since
+        self.load_batch_id = load_batch_id
+        return sum(len(frame) for frame in self.increment), self.removed
+
+    def replace_invoice_month(self, frames, schema, table_name, period_start, load_batch_id=None):
+        self.replaced[period_start] = [frame for frame in frames]
+        return sum(len(frame) for frame in self.replaced[period_start])
+
+
+class FakePipeline:
+    runs = []
+    params = None
+
+    def __init__(self, name, schema, params=None):
+        FakePipeline.params = params
+
+    def add_stage(self, *args, **kwargs):
+        pass
+
+    def add_migration(self, *args, **kwargs):
+        pass
+
+    def run_or_raise(self, resume=False, new_run=True):
+        FakePipeline.runs.append(new_run)
+        return True
+
+
+def run_load(monkeypatch, bronze, table, client=None):
+    client = client or FakeBigQuery(table)
+    FakePipeline.runs = []
+    monkeypatch.setattr(gcp_main, "run_sql_file", lambda **kwargs: None)
+    monkeypatch.setattr(gcp_main, "create_bronze_table", lambda *args: None)
+    monkeypatch.setattr(gcp_main, "fetch_export_state", bronze.fetch_export_state)
+    monkeypatch.setattr(gcp_main, "load_export_increment", bronze.load_export_increment)
+    monkeypatch.setattr(gcp_main, "replace_invoice_month", bronze.replace_invoice_month)
+    monkeypatch.setattr(gcp_main, "SqlPipeline", FakePipeline)
+    monkeypatch.setattr(gcp_main, "open_invoice_month", lambda now=None: SEPTEMBER)
+    gcp_main.fetch_data_from_bigquery_to_postgres("proj", "billing", "focus_view", None, "acme",
+                                                  "bronze_focus_gcp_data", 1000, client=client)
+    return client
+
+
+def loaded_totals(table):
+    frame = table.to_pandas()
+    return {period_start: (len(group), float(group["BilledCost"].sum()))
+            for period_start, group in frame.groupby("BillingPeriodStart")}
+
+
+def test_open_invoice_month_covers_the_restatement_window():
+    now = datetime(2026, 10, 18, 12, tzinfo=UTC)
+    assert gcp_main.open_invoice_month(now) == datetime(2026, 9, 1, tzinfo=UTC)
+
+
+def test_restated_months_compare_rows_and_cost():
+    exported = {SEPTEMBER: (1, 10.0), OCTOBER: (2, 6.5)}
+    assert gcp_main.restated_months(exported, {SEPTEMBER: (1, 10.004), OCTOBER: (2, 6.5)}) == []
+    assert gcp_main.restated_months(exported, {SEPTEMBER: (1, 9.0), OCTOBER: (2, 6.5)}) == [pd.Timestamp(SEPTEMBER)]
+    assert gcp_main.restated_months(exported, {SEPTEMBER: (1, 10.0)}) == [pd.Timestamp(OCTOBER)]
+
+
+def test_first_load_reads_the_whole_export(monkeypatch):
+    table = export_table()
+    bronze = FakeBronze(months=loaded_totals(table))
+    client = run_load(monkeypatch, bronze, table)
+
+    increment_query, parameters = client.queries[1]
+    assert "WHERE" not in increment_query and parameters == {}
+    assert bronze.since is None
+    assert sum(len(frame) for frame in bronze.increment) == 3
+    assert bronze.replaced == {}
+    assert FakePipeline.runs == [True]
+
+
+def test_increment_starts_at_the_watermark_minus_the_overlap(monkeypatch):
+    table = export_table()
+    watermark = datetime(2026, 10, 17, 9, tzinfo=UTC)
+    bronze = FakeBronze(last_export_time=watermark, months=loaded_totals(table))
+    client = run_load(monkeypatch, bronze, table)
+
+    increment_query, parameters = client.queries[1]
+    since = pd.Timestamp(watermark) - pd.Timedelta(hours=gcp_main.GCP_EXPORT_OVERLAP_HOURS)
+    assert pd.Timestamp(parameters["since"]) == since
+    assert bronze.since == since
+    # The export table is partitioned, so the increment only scans partitions from `since`
+    assert "x_PartitionTime >= TIMESTAMP_TRUNC(@since, DAY)" in increment_query
+
+    frames = bronze.increment
+    assert sum(len(frame) for frame in frames) == 1
+    keys = [key for frame in frames for key in frame["hash_key"].to_pylist()]
+    assert all(isinstance(key, bytes) and len(key) == 16 for key in keys)
+
+
+def test_overlap_keys_are_stable_across_runs(monkeypatch):
+    table = export_table()
+    watermark = datetime(2026, 10, 17, 9, tzinfo=UTC)
+    first, second = (FakeBronze(last_export_time=watermark, months=loaded_totals(table)) for _ in range(2))
+    run_load(monkeypatch, first, table)
+    run_load(monkeypatch, second, table)
+    keys = [[key for frame in bronze.increment for key in frame["hash_key"].to_pylist()]
+            for bronze in (first, second)]
+    assert keys[0] == keys[1]
+
+
+def test_restated_month_is_replaced_alone(monkeypatch):
+    table = export_table()
+    months = loaded_totals(table)
+    september = pd.Timestamp(SEPTEMBER)
+    months[september] = (1, 7.0)
+    bronze = FakeBronze(last_export_time=datetime(2026, 10, 17, 9, tzinfo=UTC), months=months)
+    client = run_load(monkeypatch, bronze, table)
+
+    assert list(bronze.replaced) == [september]
+    # Gold refreshes the periods recorded under the batch the pipeline is started with
+    assert bronze.load_batch_id and FakePipeline.params["batch_id"] == bronze.load_batch_id
+    assert sum(len(frame) for frame in bronze.replaced[september]) == 1
+    month_query, parameters = client.queries[-1]
+    assert "BillingPeriodStart = @period_start" in month_query
+    assert pd.Timestamp(parameters["period_start"]) == september
+    assert FakePipeline.runs == [True]
+
+
+def test_unchanged_export_does_not_start_a_pipeline_run(monkeypatch):
+    table = export_table()
+    empty = table.slice(0, 0)
+    bronze = FakeBronze(last_export_time=datetime(2026, 10, 17, 9, tzinfo=UTC), months=loaded_totals(table))
+    client = FakeBigQuery(table)
+    # Nothing was exported after the watermark
+    monkeypatch.setattr(client, "_filter", lambda mask: empty)
+    run_load(monkeypatch, bronze, table, client)
+
+    assert bronze.increment == [] and bronze.replaced == {}
+    assert FakePipeline.runs == [False]
+
+
+def test_pages_are_written_as_copy_csv_from_arrow(monkeypatch):
+    table = export_table().append_column("Tags", pa.array([[{"key": "env", "value": "prod"}], [], None]))
+    table = table.set_column(2, "ServiceName", pa.array(["Compute Engine", "", None]))
+    bronze = FakeBronze()
+    run_load(monkeypatch, bronze, table)
+
+    page = pa.concat_tables(bronze.increment)
+    assert page["ServiceName"].to_pylist() == ["Compute Engine", None, None]
+    assert page["Tags"].to_pylist() == ['[{"key": "env", "value": "prod"}]', "[]", None]
+    lines = copy_loader._arrow_copy_buffer(page.slice(0, 1), "hash_key").read().decode().splitlines()
+    assert lines == ['2026-09-01 00:00:00.000000Z,10,"Compute Engine",2026-10-02 03:00:00.000000Z,'
+                     '"[{""key"": ""env"", ""value"": ""prod""}]","\\x' + page["hash_key"][0].as_py().hex() + '"']
+
+
+def test_duplicated_export_rows_do_not_restate_their_month(monkeypatch):
+    table = export_table()
+    # Two export rows the FOCUS view projects to the same row; bronze keeps one of them
+    duplicated = pa.concat_tables([table, table.slice(1, 1)])
+    bronze = FakeBronze(last_export_time=datetime(2026, 10, 17, 9, tzinfo=UTC), months=loaded_totals(table))
+    client = run_load(monkeypatch, bronze, duplicated)
+
+    totals_query, _ = client.queries[0]
+    assert "GROUP BY TO_JSON_STRING(r)" in totals_query
+    assert bronze.replaced == {}
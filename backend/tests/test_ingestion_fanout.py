@@ -0,0 +1,183 @@
+"""
+Offline tests of the daily ingestion fan-out: how projects are bucketed, which alert
+tasks are due, and how a project's failure, retry and lock outcomes reach the chord
+summary.
+
+Tasks run eagerly. The project tables, the lock and the ledger writes are replaced by
+fakes, so no database, broker or Redis is needed.
+"""
+import datetime
+import os
+import time
+
+import pytest
+
+pytest.importorskip("celery")
+pytest.importorskip("tortoise")
+pytest.importorskip("fastapi_azure_auth")
+
+# Read by app.core.config at import time
+for name in ("DATABASE_URL", "OPENAPI_CLIENT_ID", "APP_CLIENT_ID", "TENANT_ID", "SCOPE_DESCRIPTION"):
+    os.environ.setdefault(name, "test")
+
+from app.core.locks import LOCK_QUEUE_TIMEOUT, LockBusy, QUEUE  # noqa: E402
+from app.ingestion import run_ledger  # noqa: E402
+from app.worker import celery_worker  # noqa: E402
+
+PROJECT = (7, "acme", None, None, "aws")
+AWS_CONNECTION = (3, "key", "secret", 1000, None, "s3://billing-bucket/exports/focus")
+
+
+def fake_execute_query(query, fetch=True):
+    if "from project" in query:
+        return [PROJECT]
+    if "from awsconnection" in query:
+        return [AWS_CONNECTION]
+    return []
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    ledger_writes = []
+    monkeypatch.setenv("ENCRYPTION_KEY", "00")
+    monkeypatch.setattr(celery_worker, "execute_query", fake_execute_query)
+    monkeypatch.setattr(celery_worker, "decrypt_data", lambda encrypted_data, key: encrypted_data)
+    monkeypatch.setattr(run_ledger, "_execute", lambda query, params: ledger_writes.append(params))
+    monkeypatch.setattr(celery_worker, "LeaseLock", FakeLeaseLock)
+    monkeypatch.setitem(celery_worker.celery_app.conf, "task_always_eager", True)
+    return ledger_writes
+
+
+class FakeLeaseLock:
+    """Always acquired; stands in for the Redis lease."""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def acquire(self):
+        return self
+
+    def check(self):
+        pass
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class BusyLeaseLock(FakeLeaseLock):
+    """Held by another run."""
+
+    def acquire(self):
+        raise LockBusy("acme", "ingestion", {"owner": "worker-2"})
+
+    def __enter__(self):
+        return self.acquire()
+
+
+class Requeued(Exception):
+    """Raised in place of Celery's replace, which would run the replacement eagerly at once."""
+
+
+def ingest(project_id=PROJECT[0], **kwargs):
+    return celery_worker.task_ingest_project.apply(args=([], project_id), kwargs=kwargs).get()
+
+
+@pytest.mark.parametrize("project_ids, concurrency, buckets", [
+    ([1, 2, 3, 4, 5, 6, 7], 3, [[1, 4, 7], [2, 5], [3, 6]]),
+    ([1, 2], 4, [[1], [2]]),
+    ([1, 2, 3], 0, [[1, 2, 3]]),
+    ([1, 2, 3], -2, [[1, 2, 3]]),
+    ([], 4, []),
+])
+def test_projects_are_dealt_round_robin_into_buckets(project_ids, concurrency, buckets):
+    assert celery_worker.fanout_buckets(project_ids, concurrency) == buckets
+
+
+@pytest.mark.parametrize("today, due", [
+    (datetime.date(2026, 10, 19), ["run_daily_alerts"]),
+    (datetime.date(2026, 10, 18), ["run_daily_alerts", "run_weekly_alerts"]),
+    (datetime.date(2026, 12, 1), ["run_daily_alerts", "run_monthly_alerts"]),
+    # A first of the month that is a Sunday
+    (datetime.date(2026, 11, 1), ["run_daily_alerts", "run_weekly_alerts", "run_monthly_alerts"]),
+])
+def test_alert_tasks_due(today, due):
+    assert [task.name for task in celery_worker.due_alert_tasks(today)] == due
+
+
+def test_ingested_project_is_reported_succeeded(monkeypatch, worker):
+    monkeypatch.setattr(celery_worker, "aws_run_ingestion", lambda **kwargs: None)
+    [result] = ingest()
+
+    assert result == {"project_id": PROJECT[0], "status": "succeeded", "attempts": 1,
+                      "duration_s": result["duration_s"]}
+    assert [params[0] for params in worker if params[0] in ("succeeded", "failed", "skipped")] == ["succeeded"]
+
+
+def test_locked_project_is_skipped(monkeypatch, worker):
+    monkeypatch.setattr(celery_worker, "LeaseLock", BusyLeaseLock)
+    [result] = ingest()
+
+    assert result["status"] == "skipped" and result["attempts"] == 1
+    assert result["error"] == "ingestion of acme is already running (worker-2)"
+    assert [params[0] for params in worker if params[0] in ("succeeded", "failed", "skipped")] == ["skipped"]
+
+
+def test_locked_project_is_queued_until_the_deadline(monkeypatch, worker):
+    replacements = []
+
+    def replace(sig):
+        replacements.append(sig)
+        return Requeued()
+
+    monkeypatch.setattr(celery_worker, "LeaseLock", BusyLeaseLock)
+    monkeypatch.setattr(celery_worker.task_ingest_project, "replace", replace)
+    with pytest.raises(Requeued):
+        ingest(lock_policy=QUEUE)
+
+    [sig] = replacements
+    assert sig.args == ([], PROJECT[0]) and sig.kwargs["lock_policy"] == QUEUE
+    assert sig.kwargs["queued_at"] is not None and sig.options["countdown"] == celery_worker.LOCK_REQUEUE_DELAY
+
+    # Once the run has waited LOCK_QUEUE_TIMEOUT it is reported skipped instead
+    [result] = ingest(lock_policy=QUEUE, queued_at=time.time() - LOCK_QUEUE_TIMEOUT)
+    assert result["status"] == "skipped" and len(replacements) == 1
+
+
+def test_failing_provider_is_retried_then_reported_failed(monkeypatch, worker):
+    calls = []
+
+    def failing_ingestion(**kwargs):
+        calls.append(kwargs["project_name"])
+        raise RuntimeError("silver stage failed")
+
+    monkeypatch.setattr(celery_worker, "aws_run_ingestion", failing_ingestion)
+    result = celery_worker.task_ingest_project.apply(args=([], PROJECT[0])).get()
+
+    assert len(calls) == celery_worker.INGESTION_TASK_MAX_RETRIES + 1
+    assert result == [{"project_id": PROJECT[0], "status": "failed", "attempts": len(calls),
+                       "error": "silver stage failed", "duration_s": result[0]["duration_s"]}]
+    # Every attempt closes its ledger run as failed
+    finished = [params for params in worker if params[0] == "failed"]
+    assert len(finished) == len(calls) and all(params[-2] == "silver stage failed" for params in finished)
+
+
+def test_dashboard_refresh_is_booked_onto_covered_projects(monkeypatch, worker):
+    from app.core import locks
+    booked = []
+
+    async def create_dashboard_view(**kwargs):
+        return True
+
+    monkeypatch.setattr(locks, "LeaseLock", FakeLeaseLock)
+    monkeypatch.setattr(celery_worker, "create_dashboard_view", create_dashboard_view)
+    monkeypatch.setattr(celery_worker, "book_dashboard", lambda project_ids, seconds: booked.append(project_ids))
+    payload = {"project_ids": [7, 8], "project_names": ["acme", "globex"], "cloud_platforms": ["aws"],
+               "dashboard_name": "finance"}
+    assert celery_worker.task_create_dashboard_view.apply(args=(payload,)).get() is True
+    assert booked == [[7, 8]]
@@ -0,0 +1,177 @@
+"""
+Offline tests of the Redis lease locks: acquiring, renewing and releasing a lease, and
+what `exclusive` does with a task whose project is already locked.
+
+Redis is replaced by a stub keeping keys in a dict, whose scripts behave like the
+token-guarded renew and release scripts of app.core.locks.
+"""
+import time
+
+import pytest
+
+pytest.importorskip("redis")
+pytest.importorskip("celery")
+
+from app.core import locks  # noqa: E402
+from app.core.locks import LeaseLock, LeaseLost, LockBusy, exclusive, queue_deadline_passed  # noqa: E402
+
+
+class StubRedis:
+    """Keys with millisecond expiries, plus the two lock scripts."""
+
+    def __init__(self):
+        self.values = {}
+        self.expiries = {}
+
+    def set(self, key, value, nx=False, px=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        self.expiries[key] = px
+        return True
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def pttl(self, key):
+        return self.expiries[key] if key in self.values else -2
+
+    def register_script(self, script):
+        def run(keys, args):
+            if self.values.get(keys[0]) != args[0]:
+                return 0
+            if script == locks._RENEW:
+                self.set(keys[1], args[2], px=int(args[1]))
+                self.expiries[keys[0]] = int(args[1])
+                return 1
+            for key in keys:
+                self.values.pop(key, None)
+            return len(keys)
+        return run
+
+
+class ScriptedEvent:
+    """Stands in for the renewer's stop event: `wait` times out `timeouts` times, then stops."""
+
+    def __init__(self, timeouts):
+        self.timeouts = timeouts
+
+    def wait(self, timeout):
+        if self.timeouts:
+            self.timeouts -= 1
+            return False
+        return True
+
+
+class FakeTask:
+    def __init__(self):
+        self.enqueued = []
+
+    def apply_async(self, args, kwargs, countdown):
+        self.enqueued.append((args, countdown))
+
+
+@pytest.fixture
+def redis_stub(monkeypatch):
+    stub = StubRedis()
+    monkeypatch.setattr(locks, "get_redis", lambda: stub)
+    return stub
+
+
+def test_acquire_is_exclusive_and_release_frees_the_lease(redis_stub):
+    lock = LeaseLock("acme", "ingestion", ttl=60, owner="worker-1").acquire()
+    assert redis_stub.get("cloudmeter:lock:acme:ingestion") == lock.token
+    assert redis_stub.pttl("cloudmeter:lock:acme:ingestion") == 60000
+
+    with pytest.raises(LockBusy) as busy:
+        LeaseLock("acme", "ingestion", owner="worker-2").acquire()
+    assert busy.value.holder["owner"] == "worker-1"
+    # Other projects and stages are not affected
+    LeaseLock("globex", "ingestion").acquire().release()
+
+    lock.release()
+    assert redis_stub.get("cloudmeter:lock:acme:ingestion") is None
+    assert lock not in locks._held
+
+
+def test_renewal_extends_the_lease_while_it_holds_the_token(redis_stub):
+    lock = LeaseLock("acme", "ingestion", ttl=60)
+    assert lock.try_acquire()
+    redis_stub.expiries[lock.key] = 1000
+
+    lock._stop = ScriptedEvent(timeouts=2)
+    lock._renew_loop()
+
+    assert redis_stub.pttl(lock.key) == 60000 and not lock.lost
+    lock.check()
+
+
+def test_lease_taken_over_is_marked_lost(redis_stub):
+    lock = LeaseLock("acme", "ingestion", ttl=60).acquire()
+    # The lease expired while the worker was stalled, and another run took it
+    redis_stub.values[lock.key] = "other-token"
+
+    lock._stop, running = ScriptedEvent(timeouts=1), lock._stop
+    lock._renew_loop()
+    with pytest.raises(LeaseLost):
+        locks.check_held()
+
+    # Releasing does not delete the other run's lease
+    lock._stop = running
+    lock.release()
+    assert redis_stub.get(lock.key) == "other-token"
+
+
+def test_queue_deadline(monkeypatch):
+    monkeypatch.setattr(locks, "LOCK_QUEUE_TIMEOUT", 600)
+    assert not queue_deadline_passed(None)
+    assert not queue_deadline_passed(time.time() - 599)
+    assert queue_deadline_passed(time.time() - 600)
+
+
+def busy_task(monkeypatch, redis_stub, default_policy):
+    """A task guarded by `exclusive` whose project lock is already held."""
+    LeaseLock("acme", "ingestion", owner="worker-1").try_acquire()
+    task, busy = FakeTask(), []
+    monkeypatch.setattr(locks, "current_task", task)
+
+    @exclusive("ingestion", default_policy=default_policy, on_busy=busy.append)
+    def ingest(payload):
+        raise AssertionError("ran without the lock")
+
+    return ingest, task, busy
+
+
+def test_skip_policy_returns_without_enqueueing(monkeypatch, redis_stub):
+    ingest, task, busy = busy_task(monkeypatch, redis_stub, locks.QUEUE)
+
+    assert ingest({"project_name": "acme", "lock_policy": locks.SKIP}) is False
+    assert task.enqueued == []
+    assert [type(error) for error in busy] == [LockBusy]
+
+
+def test_queue_policy_enqueues_the_task_again_until_the_deadline(monkeypatch, redis_stub):
+    ingest, task, busy = busy_task(monkeypatch, redis_stub, locks.QUEUE)
+
+    assert ingest({"project_name": "acme"}) is False
+    [((payload,), countdown)] = task.enqueued
+    assert countdown == locks.LOCK_REQUEUE_DELAY
+    queued_at = payload["lock_queued_at"]
+
+    # The requeued run keeps its first queue time
+    ingest(payload)
+    assert task.enqueued[1][0][0]["lock_queued_at"] == queued_at
+
+    expired = dict(payload, lock_queued_at=time.time() - locks.LOCK_QUEUE_TIMEOUT)
+    ingest(expired)
+    assert len(task.enqueued) == 2 and len(busy) == 3
+
+
+def test_exclusive_runs_the_task_under_the_lock(redis_stub):
+    @exclusive("ingestion", default_policy=locks.SKIP)
+    def ingest(payload):
+        assert redis_stub.get("cloudmeter:lock:acme:ingestion") is not None
+        return "done"
+
+    assert ingest({"project_name": "acme"}) == "done"
+    assert redis_stub.get("cloudmeter:lock:acme:ingestion") is None
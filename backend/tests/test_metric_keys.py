@@ -0,0 +1,87 @@
+"""
+Offline tests that the metrics row key computed in Python (`add_metric_keys`) and in SQL
+(`metric_key_sql`, used by the compaction) are the same function of a row.
+
+The SQL expression is compared by its text, and its to_char format is evaluated here
+against the strftime format the Python key uses.
+"""
+import hashlib
+import re
+from datetime import datetime
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("psycopg2")
+
+from psycopg2 import sql  # noqa: E402
+
+from app.ingestion.metric_keys import (  # noqa: E402
+    KEY_SEPARATOR, SQL_TIMESTAMP_FORMAT, TIMESTAMP_FORMAT, add_metric_keys, metric_key_sql,
+)
+
+# The to_char fields SQL_TIMESTAMP_FORMAT may use, as strftime directives
+TO_CHAR_FIELDS = {"YYYY": "%Y", "MM": "%m", "DD": "%d", "HH24": "%H", "MI": "%M", "SS": "%S"}
+
+
+def render(query):
+    """Text of a psycopg2 composable, without a connection to quote against."""
+    if isinstance(query, sql.Composed):
+        return "".join(render(part) for part in query.seq)
+    if isinstance(query, sql.Identifier):
+        return ".".join(f'"{name}"' for name in query.strings)
+    if isinstance(query, sql.Literal):
+        return "'" + str(query.wrapped).replace("'", "''") + "'"
+    return query.string
+
+
+def to_char(value, pattern):
+    """Postgres to_char of a timestamp, for the fields in TO_CHAR_FIELDS and quoted text."""
+    tokens = re.findall(r'"[^"]*"|YYYY|HH24|MM|DD|MI|SS|.', pattern)
+    return "".join(token[1:-1] if token.startswith('"') else value.strftime(TO_CHAR_FIELDS.get(token, token))
+                   for token in tokens)
+
+
+def key(*parts):
+    return hashlib.sha256(KEY_SEPARATOR.join(parts).encode("utf-8")).hexdigest()
+
+
+def test_sql_and_python_timestamp_formats_agree():
+    value = datetime(2026, 1, 2, 3, 4, 5)
+    assert to_char(value, SQL_TIMESTAMP_FORMAT) == value.strftime(TIMESTAMP_FORMAT) == "2026-01-02T03:04:05Z"
+
+
+def test_python_key_is_the_sha256_of_the_canonical_row():
+    frame = pd.DataFrame({
+        "resource_id": ["/SUBSCRIPTIONS/S1/VM1", None],
+        "metric_name": ["Percentage CPU", "BucketSizeBytes"],
+        # Keyed in UTC and to the second
+        "timestamp": [pd.Timestamp("2026-10-17 14:30:05.900", tz="Europe/Berlin"), pd.Timestamp("2026-10-17")],
+        "aggregation": ["AVERAGE", None],
+        "storage_type": [None, "StandardStorage"],
+    })
+    keys = add_metric_keys(frame, "resource_id", "metric_name", "timestamp", "aggregation",
+                           dimension_column="storage_type")["hash_key"].tolist()
+
+    assert keys == [
+        key("/subscriptions/s1/vm1", "Percentage CPU", "2026-10-17T12:30:05Z", "average", ""),
+        key("", "BucketSizeBytes", "2026-10-17T00:00:00Z", "", "StandardStorage"),
+    ]
+
+
+def test_sql_key_builds_the_same_canonical_row():
+    expression = render(metric_key_sql("resource_id", "metric_name", "timestamp", "aggregation", "storage_type"))
+
+    assert expression == (
+        "encode(sha256(convert_to(concat_ws('|', "
+        "lower(coalesce(\"resource_id\"::text, '')), "
+        "coalesce(\"metric_name\"::text, ''), "
+        f"coalesce(to_char(\"timestamp\", '{SQL_TIMESTAMP_FORMAT}'), ''), "
+        "lower(coalesce(\"aggregation\"::text, '')), "
+        "coalesce(\"storage_type\"::text, '')), 'UTF8')), 'hex')"
+    )
+    # Without a dimension neither side appends a part
+    assert render(metric_key_sql("resource_id", "metric_name", "timestamp", "aggregation")).count("coalesce(") == 4
+    frame = add_metric_keys(pd.DataFrame({"r": ["vm"], "m": ["cpu"], "t": [datetime(2026, 10, 17)], "a": ["max"]}),
+                            "r", "m", "t", "a")
+    assert frame["hash_key"][0] == key("vm", "cpu", "2026-10-17T00:00:00Z", "max")
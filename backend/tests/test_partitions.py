@@ -0,0 +1,140 @@
+"""
+Offline tests of the billing-period partitioning helpers: month bounds, splitting a frame
+by month, month fingerprints and the copy of a pre-partitioning bronze table.
+
+The copy runs against a stub cursor that answers the catalog queries and records the
+statements, so no database is needed.
+"""
+from datetime import datetime
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("psycopg2")
+
+from psycopg2 import sql  # noqa: E402
+
+from app.ingestion.partitions import (  # noqa: E402
+    copy_legacy_rows, month_bounds, partition_name, period_fingerprint, split_by_period,
+)
+
+LEGACY_TABLE = "bronze_aws_focus_pre_partitioning"
+
+
+def render(query):
+    """Readable text of a psycopg2 composable, without a connection to quote against."""
+    if isinstance(query, sql.Composed):
+        return "".join(render(part) for part in query.seq)
+    if isinstance(query, sql.Identifier):
+        return ".".join(f'"{name}"' for name in query.strings)
+    if isinstance(query, sql.Literal):
+        return repr(query.wrapped)
+    if isinstance(query, sql.SQL):
+        return query.string
+    return query
+
+
+class CatalogCursor:
+    """Answers the catalog and month queries of `copy_legacy_rows`; records everything run."""
+
+    def __init__(self, legacy_types, months, existing_partitions, legacy_rows):
+        self.legacy_types = legacy_types
+        self.months = months
+        self.existing_partitions = existing_partitions
+        self.legacy_rows = legacy_rows
+        self.statements = []
+        self.result = []
+        self.rowcount = 0
+
+    def execute(self, query, params=None):
+        text = render(query)
+        self.statements.append((text, params))
+        if "information_schema.columns" in text:
+            self.result = list(self.legacy_types.items())
+        elif "SELECT DISTINCT" in text:
+            self.result = [(month,) for month in self.months]
+        elif "FROM pg_class" in text:
+            self.result = [("r",)] if params[1] in self.existing_partitions else []
+        elif text.startswith("INSERT INTO"):
+            self.rowcount = 2
+        elif "count(*)" in text:
+            self.result = [(self.legacy_rows,)]
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+    def executed(self, prefix):
+        return [(text, params) for text, params in self.statements if text.startswith(prefix)]
+
+
+def test_december_bounds_roll_over_into_january():
+    assert month_bounds(datetime(2025, 12, 15, 8)) == (datetime(2025, 12, 1), datetime(2026, 1, 1))
+    assert month_bounds(pd.Timestamp("2026-01-31 23:59")) == (datetime(2026, 1, 1), datetime(2026, 2, 1))
+    assert partition_name("bronze_aws_focus", datetime(2025, 12, 31)) == "bronze_aws_focus_p202512"
+
+
+def test_rows_are_split_by_their_utc_billing_month():
+    frame = pd.DataFrame({
+        "BillingPeriodStart": [
+            pd.Timestamp("2026-09-01 00:00", tz="UTC"),
+            # Still September where it was exported, already October in UTC
+            pd.Timestamp("2026-09-30 23:00", tz="America/Sao_Paulo"),
+            pd.Timestamp("2026-10-01 00:00", tz="UTC"),
+            None,
+        ],
+        "BilledCost": [1.0, 2.0, 3.0, 4.0],
+    })
+    months = split_by_period(frame, "BillingPeriodStart")
+
+    assert list(months) == [datetime(2026, 9, 1), datetime(2026, 10, 1)]
+    assert months[datetime(2026, 9, 1)]["BilledCost"].tolist() == [1.0]
+    assert months[datetime(2026, 10, 1)]["BilledCost"].tolist() == [2.0, 3.0]
+
+
+def test_rows_without_a_billing_period_are_dropped():
+    frame = pd.DataFrame({"BillingPeriodStart": [None, "not a date"], "BilledCost": [1.0, 2.0]})
+    assert split_by_period(frame, "BillingPeriodStart") == {}
+
+
+def test_fingerprint_does_not_depend_on_row_order():
+    keys = ["c3", "a1", "b2"]
+    assert period_fingerprint(keys) == period_fingerprint(sorted(keys)) == period_fingerprint(reversed(keys))
+    assert period_fingerprint(keys).startswith("3:")
+    assert period_fingerprint(keys) != period_fingerprint(keys[:2])
+    assert period_fingerprint([]) == "0:d41d8cd98f00b204e9800998ecf8427e"
+
+
+def test_legacy_rows_are_copied_into_missing_months_only():
+    legacy_types = {"hash_key": "text", "BillingPeriodStart": "text", "ChargePeriodStart": "text",
+                    "BilledCost": "text"}
+    cursor = CatalogCursor(legacy_types, months=[datetime(2026, 8, 1), datetime(2026, 9, 1)],
+                           existing_partitions={"bronze_aws_focus_p202609"}, legacy_rows=5)
+
+    copied = copy_legacy_rows(cursor, "aws_focus", "acme", "bronze_aws_focus", LEGACY_TABLE, "BillingPeriodStart")
+
+    assert copied == 2
+    # Only August has no partition yet; September was loaded from the export since
+    [(create, bounds)] = cursor.executed("CREATE TABLE")
+    assert '"bronze_aws_focus_p202608" PARTITION OF "acme"."bronze_aws_focus"' in create
+    assert bounds == (datetime(2026, 8, 1), datetime(2026, 9, 1))
+    [(insert, params)] = cursor.executed("INSERT INTO")
+    assert params[-1] == [datetime(2026, 8, 1)]
+    # Hex keys are decoded, and keys that are not 16 bytes once decoded are left behind
+    assert "decode(CASE WHEN \"hash_key\" ~ %s" in insert and 'octet_length("hash_key") = 16' in insert
+    assert cursor.executed("COMMENT ON TABLE")
+
+
+def test_legacy_rows_without_any_period_are_left_behind():
+    legacy_types = {"hash_key": "bytea", "BillingPeriodStart": "timestamp without time zone",
+                    "ChargePeriodStart": "timestamp without time zone"}
+    cursor = CatalogCursor(legacy_types, months=[], existing_partitions=set(), legacy_rows=3)
+
+    assert copy_legacy_rows(cursor, "aws_focus", "acme", "bronze_aws_focus", LEGACY_TABLE, "BillingPeriodStart") == 0
+    [(months_query, _)] = cursor.executed("SELECT DISTINCT")
+    # A missing billing period falls back to the charge month; rows with neither have no month
+    assert 'coalesce("BillingPeriodStart", date_trunc(\'month\', "ChargePeriodStart")' in months_query
+    assert months_query.endswith('WHERE "BillingPeriodStart" IS NOT NULL')
+    assert not cursor.executed("CREATE TABLE") and not cursor.executed("INSERT INTO")
@@ -0,0 +1,93 @@
+"""
+Offline tests of the SQL pipeline runner: placeholder rendering, statement splitting and
+the migration ledger check.
+
+The ledger is read through a stub cursor, so no database is needed.
+"""
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from app.ingestion.sql_runner import (  # noqa: E402
+    SqlPipeline, SqlStage, render_placeholders, split_statements,
+)
+
+
+class FakeCursor:
+    """Answers fetchone() from a list of rows and records the executed queries."""
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.queries = []
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+
+    def fetchone(self):
+        return self.rows.pop(0)
+
+
+def test_placeholders_are_rendered_from_validated_values():
+    script = "CREATE TABLE __schema__.t_bronze (budget numeric DEFAULT __budget__, batch text DEFAULT '__batch_id__');"
+    rendered = render_placeholders(script, "Acme", {"budget": 1500.50, "batch_id": "a1b2-c3"})
+    assert rendered == "CREATE TABLE acme.t_bronze (budget numeric DEFAULT 1500.5, batch text DEFAULT 'a1b2-c3');"
+    assert render_placeholders("__budget__", "acme", {"budget": None}) == "0"
+
+
+@pytest.mark.parametrize("schema_name, params", [
+    ("acme", {"budget": "1000; DROP SCHEMA acme"}),
+    ("acme", {"budget": "lots"}),
+    ("acme", {"batch_id": "x'; DROP TABLE t; --"}),
+    ("acme", {"batch_id": ""}),
+    ("acme; DROP SCHEMA public", {}),
+    ("acme", {"table": "bronze focus"}),
+])
+def test_unsafe_placeholder_values_are_rejected(schema_name, params):
+    with pytest.raises(ValueError):
+        render_placeholders("SELECT 1 FROM __schema__.t", schema_name, params)
+
+
+def test_dollar_quoted_bodies_are_kept_whole():
+    script = """
+        DO $$ BEGIN PERFORM 1; PERFORM 2; END $$;
+        CREATE FUNCTION f() RETURNS int AS $body$ SELECT 1; $body$ LANGUAGE sql;
+        SELECT 3;
+    """
+    assert split_statements(script) == [
+        "DO $$ BEGIN PERFORM 1; PERFORM 2; END $$",
+        "CREATE FUNCTION f() RETURNS int AS $body$ SELECT 1; $body$ LANGUAGE sql",
+        "SELECT 3",
+    ]
+
+
+def test_semicolons_in_strings_and_identifiers_do_not_split():
+    script = """SELECT 'a;b', 'it''s;' AS "odd;name"; SELECT E'back\\'slash;'; SELECT 2"""
+    assert split_statements(script) == [
+        """SELECT 'a;b', 'it''s;' AS "odd;name\"""",
+        "SELECT E'back\\'slash;'",
+        "SELECT 2",
+    ]
+
+
+def test_semicolons_in_comments_do_not_split_and_comment_only_statements_are_dropped():
+    script = "-- load; then merge\nSELECT 1; /* one; two */ SELECT 2;\n-- done;\n"
+    assert split_statements(script) == ["-- load; then merge\nSELECT 1", "/* one; two */ SELECT 2"]
+
+
+def test_migration_with_unchanged_checksum_is_skipped():
+    pipeline = SqlPipeline("azure_bronze", "acme")
+    stage = SqlStage("bronze_metrics", "bronze_metrics.sql", migration=True)
+    statements = ["CREATE TABLE IF NOT EXISTS acme.bronze_azure_vm_metrics (hash_key text)"]
+
+    cursor = FakeCursor([("abc",), ("acme.bronze_azure_vm_metrics",)])
+    assert pipeline._migration_is_current(cursor, stage, "abc", statements)
+    assert cursor.queries[0][1] == ("azure_bronze.bronze_metrics",)
+
+    # A changed file is applied again, without looking for its objects
+    cursor = FakeCursor([("abc",)])
+    assert not pipeline._migration_is_current(cursor, stage, "def", statements)
+    assert len(cursor.queries) == 1
+
+    # So is an unchanged one whose table was dropped
+    cursor = FakeCursor([("abc",), (None,)])
+    assert not pipeline._migration_is_current(cursor, stage, "abc", statements)
@@ -0,0 +1,62 @@
+"""
+Offline tests of the per-series request windows of an incremental metrics run
+(`CollectionWindow`): the watermark overlap, gap refills, backfill mode and the
+look-back clamp.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("pandas")
+pytest.importorskip("psycopg2")
+
+from app.ingestion.watermarks import CollectionWindow  # noqa: E402
+
+NOW = datetime(2026, 10, 18, 12, 0)
+LOOKBACK = timedelta(days=7)
+OVERLAP = timedelta(hours=6)
+VM = "/subscriptions/s1/vm1"
+
+
+def window(watermarks=None, gaps=None, backfill=False):
+    return CollectionWindow(NOW, LOOKBACK, watermarks=watermarks, gaps=gaps, backfill=backfill, overlap=OVERLAP)
+
+
+def test_series_without_watermark_is_backfilled_over_the_lookback():
+    assert window().start(VM, "Percentage CPU") == NOW - LOOKBACK
+
+
+def test_watermarked_series_starts_one_overlap_before_its_watermark():
+    last = datetime(2026, 10, 18, 9, 0)
+    # Resource IDs are matched case-insensitively; watermarks are stored lower-cased
+    assert window({(VM, "Percentage CPU"): last}).start(VM.upper(), "Percentage CPU") == last - OVERLAP
+
+
+def test_gap_moves_the_start_back_to_the_gap():
+    last, gap = datetime(2026, 10, 18, 9, 0), datetime(2026, 10, 15, 4, 0)
+    series = {(VM, "Percentage CPU"): last}
+    assert window(series, gaps={(VM, "Percentage CPU"): gap}).start(VM, "Percentage CPU") == gap
+    # A gap inside the overlap does not move the start forward
+    assert window(series, gaps={(VM, "Percentage CPU"): last}).start(VM, "Percentage CPU") == last - OVERLAP
+
+
+def test_starts_are_clamped_to_the_lookback():
+    stale = {(VM, "Percentage CPU"): NOW - timedelta(days=30)}
+    old_gap = {(VM, "Percentage CPU"): NOW - timedelta(days=20)}
+    assert window(stale).start(VM, "Percentage CPU") == NOW - LOOKBACK
+    assert window({(VM, "Percentage CPU"): NOW}, gaps=old_gap).start(VM, "Percentage CPU") == NOW - LOOKBACK
+
+
+def test_backfill_mode_ignores_watermarks():
+    assert window({(VM, "Percentage CPU"): NOW}, backfill=True).start(VM, "Percentage CPU") == NOW - LOOKBACK
+
+
+def test_request_of_several_metrics_starts_at_the_earliest_of_them():
+    watermarks = {(VM, "Percentage CPU"): datetime(2026, 10, 18, 9, 0),
+                  (VM, "Available Memory Bytes"): datetime(2026, 10, 17, 9, 0)}
+    runs = window(watermarks)
+
+    assert runs.start_for(VM, ["Percentage CPU", "Available Memory Bytes"]) == datetime(2026, 10, 17, 3, 0)
+    # A metric seen for the first time backfills the whole request
+    assert runs.start_for(VM, ["Percentage CPU", "Disk Read Bytes"]) == NOW - LOOKBACK
+    assert runs.start_for(VM, []) == NOW - LOOKBACK